@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Read-path benchmark of the CEFI cloud data access patterns.
+
+Synthetic CEFI-shaped files (a monthly hindcast variable and a set of
+seasonal reforecast initializations) are served from a local S3 stand-in
+(moto server) with the same key layout as the bucket. Their kerchunk
+references, the combined reforecast `all.json` and the time-series
+optimized Zarr copy are built with the operational code
+(`gen_kerchunk_index`, `build_combined_index`, `rechunk_to_zarr`).
+
+Each query is timed through every access path:
+- netcdf-*      : `xr.open_dataset` on the S3 object (h5netcdf) with the
+                  s3fs 'none', 'readahead' and 'blockcache' file caches
+- kerchunk      : reference filesystem, no local cache
+- kerchunk-cold : reference filesystem with an empty `ChunkCacheStore`
+                  (`cefi_reader.open_cached`)
+- kerchunk-warm : reference filesystem with a populated `ChunkCacheStore`
+- zarr          : time-series optimized Zarr copy (hindcast queries)
+
+The report gives the median latency, the number of S3 requests and the
+bytes transferred (counted by an s3fs subclass at the `_call_s3` level,
+first repetition of each case).
+
+Usage:
+    python benchmark_read.py
+    python benchmark_read.py --nlat 400 --nlon 360 --months 324 --repeat 5 --output bench.json
+"""
+
+import os
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+import statistics
+import threading
+import time
+import numpy as np
+import xarray as xr
+import boto3
+import fsspec
+from boto3.s3.transfer import TransferConfig
+from s3fs import S3FileSystem
+from moto.server import ThreadedMotoServer
+from s3_upload import gen_kerchunk_index
+from kerchunk_combine import build_combined_index, COMBINED_INDEX_NAME
+from zarr_rechunk import rechunk_to_zarr, upload_zarr_store, zarr_object_prefix
+from cefi_reader import open_cached
+
+BUCKET = 'cefi-benchmark'
+RELEASE = 'r20250212'
+HINDCAST_PREFIX = f'northwest_atlantic/full_domain/hindcast/monthly/regrid/{RELEASE}'
+REFORECAST_PREFIX = f'northwest_atlantic/full_domain/seasonal_reforecast/monthly/regrid/{RELEASE}'
+
+# s3fs file caches of the direct netcdf reads (cache_type, block_size)
+NETCDF_CACHES = {
+    'netcdf-none': ('none', None),
+    'netcdf-readahead': ('readahead', 5 * 1024**2),
+    'netcdf-blockcache': ('blockcache', 8 * 1024**2),
+}
+
+
+class CountingS3FileSystem(S3FileSystem):
+    """s3fs filesystem counting the S3 requests and the bytes read by get_object"""
+
+    counts = {'requests': 0, 'bytes': 0}
+    _count_lock = threading.Lock()
+
+    async def _call_s3(self, method, *akwarglist, **kwargs):
+        out = await super()._call_s3(method, *akwarglist, **kwargs)
+        name = method if isinstance(method, str) else getattr(method, '__name__', '')
+        with self._count_lock:
+            self.counts['requests'] += 1
+            if name == 'get_object':
+                self.counts['bytes'] += out.get('ContentLength', 0)
+        return out
+
+    @classmethod
+    def reset_counts(cls):
+        with cls._count_lock:
+            cls.counts = {'requests': 0, 'bytes': 0}
+
+
+def month_axis(start: str, months: int) -> np.ndarray:
+    """Monthly datetime axis starting at start (YYYY-MM)"""
+    return (np.datetime64(start, 'M') + np.arange(months)).astype('datetime64[ns]')
+
+
+def synthetic_field(rng, shape: tuple, months_axis: int) -> np.ndarray:
+    """Seasonal cycle plus noise along the given axis, float32"""
+    months = np.arange(shape[months_axis]) % 12
+    seasonal = 10 * np.sin(2 * np.pi * months / 12)
+    seasonal = seasonal.reshape([-1 if i == months_axis else 1 for i in range(len(shape))])
+    return (15 + seasonal + rng.standard_normal(shape)).astype('float32')
+
+
+def write_hindcast(path: str, nlat: int, nlon: int, months: int):
+    """Monthly hindcast file with one map per chunk (model output layout)"""
+    rng = np.random.default_rng(0)
+    ds = xr.Dataset(
+        {'tos': (('time', 'lat', 'lon'), synthetic_field(rng, (months, nlat, nlon), 0), {'units': 'degC'})},
+        coords={
+            'time': month_axis('1993-01', months),
+            'lat': np.linspace(5, 58, nlat),
+            'lon': np.linspace(261, 322, nlon),
+        },
+        attrs={'cefi_variable': 'tos'}
+    )
+    ds.to_netcdf(
+        path, engine='h5netcdf',
+        encoding={'tos': {'zlib': True, 'complevel': 1, 'chunksizes': (1, nlat, nlon)}}
+    )
+
+
+def write_reforecast(path: str, init: str, nlat: int, nlon: int, members: int, leads: int):
+    """Seasonal reforecast file of one initialization (one map per chunk)"""
+    rng = np.random.default_rng(int(init))
+    shape = (1, members, leads, nlat, nlon)
+    ds = xr.Dataset(
+        {'tos': (('init_time', 'member', 'lead', 'lat', 'lon'), synthetic_field(rng, shape, 2), {'units': 'degC'})},
+        coords={
+            'init_time': month_axis(f'{init[:4]}-{init[4:]}', 1),
+            'member': np.arange(1, members + 1),
+            'lead': np.arange(leads),
+            'lat': np.linspace(5, 58, nlat),
+            'lon': np.linspace(261, 322, nlon),
+        },
+        attrs={'cefi_variable': 'tos'}
+    )
+    ds.to_netcdf(
+        path, engine='h5netcdf',
+        encoding={'tos': {'zlib': True, 'complevel': 1, 'chunksizes': (1, 1, 1, nlat, nlon)}}
+    )
+
+
+def build_dataset(work_dir: str, s3_client, args) -> dict:
+    """Write the synthetic files, upload them and build their references
+
+    Returns
+    -------
+    dict
+        object keys {'hindcast', 'hindcast_json', 'reforecast', 'combined', 'zarr'}
+    """
+    local_dir = os.path.join(work_dir, 'files')
+    json_dir = os.path.join(work_dir, 'json')
+    os.makedirs(local_dir)
+    os.makedirs(json_dir)
+
+    def upload(local_file, obj_name):
+        s3_client.upload_file(local_file, BUCKET, obj_name)
+
+    end_year = 1993 + (args.months - 1) // 12
+    hindcast_name = f'tos.nwa.full.hcast.monthly.regrid.{RELEASE}.199301-{end_year}12.nc'
+    hindcast_key = f'{HINDCAST_PREFIX}/{hindcast_name}'
+    hindcast_file = os.path.join(local_dir, hindcast_name)
+    write_hindcast(hindcast_file, args.nlat, args.nlon, args.months)
+    upload(hindcast_file, hindcast_key)
+
+    reforecast_keys = []
+    for i in range(args.inits):
+        init = f'{1994 + i // 4}{[1, 4, 7, 10][i % 4]:02d}'
+        name = f'tos.nwa.full.ss_refcast.monthly.regrid.{RELEASE}.enss.i{init}.nc'
+        local_file = os.path.join(local_dir, name)
+        write_reforecast(local_file, init, args.nlat, args.nlon, args.members, args.leads)
+        upload(local_file, f'{REFORECAST_PREFIX}/{name}')
+        reforecast_keys.append(f'{REFORECAST_PREFIX}/{name}')
+
+    # per-file kerchunk references and the combined reforecast index
+    for key in [hindcast_key] + reforecast_keys:
+        json_file = gen_kerchunk_index(f's3://{BUCKET}/{key}', json_dir)
+        upload(json_file, key.removesuffix('.nc') + '.json')
+    combined_file = os.path.join(json_dir, COMBINED_INDEX_NAME)
+    build_combined_index(REFORECAST_PREFIX, BUCKET, combined_file)
+    upload(combined_file, f'{REFORECAST_PREFIX}/{COMBINED_INDEX_NAME}')
+
+    # time-series optimized zarr copy of the hindcast
+    zarr_prefix = zarr_object_prefix(hindcast_key)
+    zarr_result = rechunk_to_zarr(
+        hindcast_file, os.path.join(work_dir, 'zarr', zarr_prefix), 'monthly', variable='tos', max_workers=2
+    )
+    upload_zarr_store(zarr_result['store'], zarr_prefix, BUCKET, TransferConfig(), s3_client)
+
+    return {
+        'hindcast': hindcast_key,
+        'hindcast_json': hindcast_key.removesuffix('.nc') + '.json',
+        'reforecast': reforecast_keys,
+        'combined': f'{REFORECAST_PREFIX}/{COMBINED_INDEX_NAME}',
+        'zarr': zarr_prefix,
+    }
+
+
+def open_kerchunk(reference_key: str, cache_dir: str = None):
+    """Open a kerchunk reference (optionally behind a local chunk cache)"""
+    fs = fsspec.filesystem(
+        'reference',
+        fo=f's3://{BUCKET}/{reference_key}',
+        remote_protocol='s3',
+        remote_options={'anon': True},
+        target_options={'anon': True},
+        skip_instance_cache=True
+    )
+    return open_cached(fs.get_mapper(), cache_dir=cache_dir, namespace='benchmark', prefetch=4)
+
+
+def open_netcdf(keys, cache_type: str, block_size: int):
+    """Open netcdf objects directly with h5netcdf over s3fs file objects"""
+    fs = fsspec.filesystem('s3', anon=True)
+    open_kwargs = {'cache_type': cache_type}
+    if block_size:
+        open_kwargs['block_size'] = block_size
+    if isinstance(keys, str):
+        return xr.open_dataset(fs.open(f'{BUCKET}/{keys}', 'rb', **open_kwargs), engine='h5netcdf')
+    return xr.open_mfdataset(
+        [fs.open(f'{BUCKET}/{key}', 'rb', **open_kwargs) for key in keys],
+        engine='h5netcdf', combine='nested', concat_dim='init_time'
+    )
+
+
+def open_zarr(prefix: str):
+    """Open the time-series optimized Zarr copy"""
+    return xr.open_zarr(fsspec.get_mapper(f's3://{BUCKET}/{prefix}', anon=True))
+
+
+def hindcast_queries(nlat: int, nlon: int) -> dict:
+    """Typical queries of the hindcast variable"""
+    region = {'lat': slice(nlat // 4, nlat // 2), 'lon': slice(nlon // 4, nlon // 2)}
+    return {
+        'map_slice': lambda ds: ds['tos'].isel(time=-1),
+        'point_series': lambda ds: ds['tos'].isel(lat=nlat // 2, lon=nlon // 2),
+        'regional_climatology': lambda ds: ds['tos'].isel(region).groupby('time.month').mean('time'),
+    }
+
+
+def time_case(open_fn, query_fn, repeat: int, before_run=None) -> dict:
+    """Time the open and the query of a case
+
+    Returns
+    -------
+    dict
+        {'latency_s': median latency, 'latencies_s', 'requests', 'bytes'}
+        (requests and bytes of the first repetition)
+    """
+    latencies = []
+    counts = None
+    for _ in range(repeat):
+        if before_run is not None:
+            before_run()
+        CountingS3FileSystem.clear_instance_cache()
+        CountingS3FileSystem.reset_counts()
+        start_time = time.perf_counter()
+        ds = open_fn()
+        query_fn(ds).load()
+        ds.close()
+        latencies.append(time.perf_counter() - start_time)
+        if counts is None:
+            counts = dict(CountingS3FileSystem.counts)
+    return {'latency_s': statistics.median(latencies), 'latencies_s': latencies, **counts}
+
+
+def run_benchmark(args) -> list:
+    """Build the synthetic bucket and time every query through every access path"""
+    endpoint = f'http://127.0.0.1:{args.port}'
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=args.port)
+    server.start()
+
+    # every s3 filesystem (including the ones created by the operational code)
+    #  counts its requests and talks to the local stand-in
+    fsspec.register_implementation('s3', CountingS3FileSystem, clobber=True)
+    fsspec.config.conf.setdefault('s3', {})['endpoint_url'] = endpoint
+
+    work_dir = tempfile.mkdtemp(prefix='cefi_benchmark_')
+    results = []
+    try:
+        s3_client = boto3.client(
+            's3', endpoint_url=endpoint, region_name='us-east-1',
+            aws_access_key_id='testing', aws_secret_access_key='testing'
+        )
+        s3_client.create_bucket(Bucket=BUCKET)
+        # public read like the NODD bucket (the read paths are anonymous),
+        #  moto checks anonymous HEAD requests against 's3:HeadObject'
+        s3_client.put_bucket_policy(Bucket=BUCKET, Policy=json.dumps({
+            'Version': '2012-10-17',
+            'Statement': [{
+                'Effect': 'Allow',
+                'Principal': '*',
+                'Action': ['s3:GetObject', 's3:HeadObject', 's3:ListBucket'],
+                'Resource': [f'arn:aws:s3:::{BUCKET}', f'arn:aws:s3:::{BUCKET}/*'],
+            }]
+        }))
+        keys = build_dataset(work_dir, s3_client, args)
+        cache_dir = os.path.join(work_dir, 'chunk_cache')
+
+        def clear_cache():
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+        cases = {
+            **{
+                name: (lambda cache=cache: open_netcdf(keys['hindcast'], *cache), None)
+                for name, cache in NETCDF_CACHES.items()
+            },
+            'kerchunk': (lambda: open_kerchunk(keys['hindcast_json']), None),
+            'kerchunk-cold': (lambda: open_kerchunk(keys['hindcast_json'], cache_dir), clear_cache),
+            'kerchunk-warm': (lambda: open_kerchunk(keys['hindcast_json'], cache_dir), None),
+            'zarr': (lambda: open_zarr(keys['zarr']), None),
+        }
+        for query_name, query_fn in hindcast_queries(args.nlat, args.nlon).items():
+            for access_name, (open_fn, before_run) in cases.items():
+                if access_name == 'kerchunk-warm':
+                    # populate the chunk cache with one untimed run
+                    clear_cache()
+                    with open_fn() as ds:
+                        query_fn(ds).load()
+                result = time_case(open_fn, query_fn, args.repeat, before_run)
+                results.append({'query': query_name, 'access': access_name, **result})
+
+        def member_lead(ds):
+            return ds['tos'].isel(member=0, lead=2)
+
+        reforecast_cases = {
+            'netcdf-readahead': (lambda: open_netcdf(keys['reforecast'], *NETCDF_CACHES['netcdf-readahead']), None),
+            'kerchunk': (lambda: open_kerchunk(keys['combined']), None),
+            'kerchunk-cold': (lambda: open_kerchunk(keys['combined'], cache_dir), clear_cache),
+        }
+        for access_name, (open_fn, before_run) in reforecast_cases.items():
+            result = time_case(open_fn, member_lead, args.repeat, before_run)
+            results.append({'query': 'reforecast_member_lead', 'access': access_name, **result})
+
+        s3_client.close()
+    finally:
+        server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def print_report(results: list):
+    """Print the benchmark table"""
+    print(f"{'query':<24} {'access':<18} {'latency (s)':>12} {'requests':>9} {'MB':>9}")
+    print('=' * 76)
+    for result in results:
+        print(
+            f"{result['query']:<24} {result['access']:<18} {result['latency_s']:>12.3f} "
+            f"{result['requests']:>9} {result['bytes'] / 1024**2:>9.2f}"
+        )
+
+
+def main():
+    """Main function with command line argument parsing"""
+
+    parser = argparse.ArgumentParser(description='Benchmark the CEFI read paths on a local S3 stand-in')
+    parser.add_argument('--nlat', type=int, default=180, help='Number of latitudes (default: 180)')
+    parser.add_argument('--nlon', type=int, default=160, help='Number of longitudes (default: 160)')
+    parser.add_argument('--months', type=int, default=120, help='Hindcast months (default: 120)')
+    parser.add_argument('--inits', type=int, default=8, help='Reforecast initializations (default: 8)')
+    parser.add_argument('--members', type=int, default=10, help='Reforecast members (default: 10)')
+    parser.add_argument('--leads', type=int, default=12, help='Reforecast leads (default: 12)')
+    parser.add_argument('--repeat', type=int, default=3, help='Repetitions of each case (default: 3)')
+    parser.add_argument('--port', type=int, default=5555, help='Local S3 stand-in port (default: 5555)')
+    parser.add_argument('--output', type=str, default=None, help='Optional JSON output of the results')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    results = run_benchmark(args)
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
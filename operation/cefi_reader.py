@@ -0,0 +1,601 @@
+"""
+Reader helper for the CEFI kerchunk datasets published on the cloud buckets.
+
+The helper resolves the kerchunk reference file of a variable from the
+bucket layout (region/subdomain/experiment/frequency/grid_type/release),
+opens it through the fsspec reference filesystem and puts a local chunk
+cache in front of the remote reads.
+
+The chunk cache is a directory of chunk files shared by every session
+on the machine (default `~/.cache/cefi`). When it grows over its size
+limit, the least recently used chunks are removed. Cached chunks are keyed
+by their reference entry (URL, offset, length), so a reference regenerated
+at the same URL does not serve the chunks of the previous one. Each chunk
+read along the time axis schedules the next chunks along that axis in the background,
+so time series reads do not wait on one request per chunk. The cache is a
+zarr (v3 API) store, closing the dataset stops the read-ahead threads.
+
+Example:
+    from cefi_reader import open_cefi
+    ds = open_cefi('northwest_atlantic', 'hindcast', 'monthly', 'tos')
+    ds_all = open_cefi(
+        'northwest_atlantic', 'seasonal_reforecast', 'monthly', 'all',
+        release='r20250212'
+    )
+
+"""
+
+import os
+import re
+import json
+import asyncio
+import hashlib
+import logging
+import weakref
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import fsspec
+import xarray as xr
+from zarr.abc.store import Store, RangeByteRequest, OffsetByteRequest, SuffixByteRequest
+
+# public buckets of the CEFI regional MOM6 data
+CLOUD_BUCKETS = {
+    's3': 'noaa-oar-cefi-regional-mom6-pds',
+    'gcs': 'noaa-oar-cefi-regional-mom6',
+}
+
+# shared local chunk cache
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'cefi')
+DEFAULT_CACHE_MAX_BYTES = 10 * 1024**3
+
+# dimensions used for the read-ahead (first one found in the variable)
+PREFETCH_DIMS = ('time', 'init_time')
+
+RELEASE_FOLDER_PATTERN = re.compile(r'^r\d{8}$')
+
+
+def resolve_reference(
+    region: str,
+    experiment: str,
+    frequency: str,
+    variable: str,
+    release: str = 'latest',
+    grid_type: str = 'regrid',
+    subdomain: str = 'full_domain',
+    cloud: str = 's3',
+) -> str:
+    """Find the kerchunk reference file of a CEFI variable in the bucket
+
+    Parameters
+    ----------
+    region : str
+        region directory (ex: 'northwest_atlantic')
+    experiment : str
+        experiment directory (ex: 'hindcast', 'seasonal_reforecast')
+    frequency : str
+        output frequency directory (ex: 'daily', 'monthly')
+    variable : str
+        variable name (ex: 'tos'), 'all' for the combined index
+    release : str
+        release folder (ex: 'r20250212') or 'latest'
+    grid_type : str
+        'raw' or 'regrid'
+    subdomain : str
+        subdomain directory (default: 'full_domain')
+    cloud : str
+        's3' or 'gcs'
+
+    Returns
+    -------
+    str
+        URL of the kerchunk reference file
+    """
+    fs = fsspec.filesystem(cloud, anon=True)
+    bucket = CLOUD_BUCKETS[cloud]
+    parent_dir = f'{bucket}/{region}/{subdomain}/{experiment}/{frequency}/{grid_type}'
+
+    # the bucket catalog and release manifest avoid listing the bucket
+    if variable != 'all':
+        reference = _resolve_from_catalog(
+            fs, bucket, parent_dir.removeprefix(f'{bucket}/'), variable, release
+        )
+        if reference is not None:
+            return f'{cloud}://{bucket}/{reference}'
+
+    if release == 'latest':
+        releases = [
+            path.rstrip('/').split('/')[-1] for path in fs.ls(parent_dir, detail=False)
+        ]
+        releases = [r for r in releases if RELEASE_FOLDER_PATTERN.match(r)]
+        if not releases:
+            raise FileNotFoundError(f"No release folder found under {cloud}://{parent_dir}")
+        release = max(releases)
+
+    if variable == 'all':
+        json_files = fs.glob(f'{parent_dir}/{release}/all.json')
+    else:
+        json_files = fs.glob(f'{parent_dir}/{release}/{variable}.*.json')
+
+    if not json_files:
+        raise FileNotFoundError(
+            f"No reference file for '{variable}' under {cloud}://{parent_dir}/{release}"
+        )
+    if len(json_files) > 1:
+        raise ValueError(f"More than one reference file found for '{variable}': {json_files}")
+
+    return f'{cloud}://{json_files[0]}'
+
+
+def _resolve_from_catalog(fs, bucket: str, parent_dir: str, variable: str, release: str):
+    """Look up a reference file key in the bucket catalog (None if not found)."""
+    try:
+        catalog = json.loads(fs.cat(f'{bucket}/catalog.json'))
+        parent = catalog['parents'][parent_dir]
+        if release == 'latest':
+            release = parent['latest_release']
+        manifest = json.loads(fs.cat(f"{bucket}/{parent['releases'][release]['manifest']}"))
+    except (FileNotFoundError, KeyError, ValueError):
+        return None
+
+    references = [
+        entry['reference'] for entry in manifest
+        if entry['variable'] == variable and entry['reference']
+    ]
+    if len(references) != 1:
+        return None
+    return references[0]
+
+
+class _CacheIndex:
+    """Size and use order of the chunk files in a cache directory
+
+    The directory is walked once per process, the index is then kept up
+    to date by the stores writing to and evicting from it. Files added by
+    other sessions after the walk are not counted until the next process.
+
+    Parameters
+    ----------
+    cache_dir : str
+        local chunk cache directory
+    """
+
+    def __init__(self, cache_dir: str):
+        self.lock = threading.Lock()
+        # path -> size, least recently used first
+        self.files = OrderedDict()
+        listing = []
+        for dirpath, _, filenames in os.walk(cache_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                listing.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(listing):
+            self.files[path] = size
+        self.total_bytes = sum(self.files.values())
+
+    def touch(self, path: str):
+        """Mark a cached file as recently used."""
+        with self.lock:
+            if path in self.files:
+                self.files.move_to_end(path)
+
+    def add(self, path: str, size: int):
+        """Record a file written to the cache."""
+        with self.lock:
+            self.total_bytes += size - self.files.pop(path, 0)
+            self.files[path] = size
+
+    def evict(self, max_bytes: int):
+        """Remove least recently used files down to 90% of max_bytes."""
+        target_bytes = int(max_bytes * 0.9)
+        removed = []
+        with self.lock:
+            while self.files and self.total_bytes > target_bytes:
+                path, size = self.files.popitem(last=False)
+                self.total_bytes -= size
+                removed.append(path)
+        for path in removed:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+# one index per cache directory, shared by the stores of the process
+_CACHE_INDEXES = {}
+_CACHE_INDEXES_LOCK = threading.Lock()
+
+
+def _cache_index(cache_dir: str) -> _CacheIndex:
+    cache_dir = os.path.realpath(cache_dir)
+    with _CACHE_INDEXES_LOCK:
+        if cache_dir not in _CACHE_INDEXES:
+            _CACHE_INDEXES[cache_dir] = _CacheIndex(cache_dir)
+        return _CACHE_INDEXES[cache_dir]
+
+
+def _byte_range_slice(data: bytes, byte_range) -> bytes:
+    """Apply a zarr byte range request to a whole object."""
+    if byte_range is None:
+        return data
+    if isinstance(byte_range, RangeByteRequest):
+        return data[byte_range.start:byte_range.end]
+    if isinstance(byte_range, OffsetByteRequest):
+        return data[byte_range.offset:]
+    if isinstance(byte_range, SuffixByteRequest):
+        return data[-byte_range.suffix:] if byte_range.suffix else b''
+    raise TypeError(f"Unexpected byte range {byte_range!r}")
+
+
+class MappingStore(Store):
+    """Read-only zarr store over a synchronous mapping
+
+    zarr 3 turns an fsspec mapper into an asynchronous filesystem store,
+    which fails for a reference filesystem on an async target (S3). Here
+    the mapping is read as is, by threads the zarr event loop waits on.
+
+    Parameters
+    ----------
+    store : MutableMapping
+        mapping to read from (ex: reference filesystem mapper)
+    """
+
+    supports_writes = False
+    supports_deletes = False
+    supports_partial_writes = False
+    supports_listing = True
+
+    def __init__(self, store):
+        super().__init__(read_only=True)
+        self.store = store
+
+    def __eq__(self, other) -> bool:
+        return type(other) is type(self) and self.store is other.store
+
+    def __repr__(self) -> str:
+        return f"MappingStore({self.store!r})"
+
+    def _read(self, key: str):
+        """Read an object (None if missing)."""
+        try:
+            return self.store[key]
+        except KeyError:
+            return None
+
+    async def get(self, key, prototype, byte_range=None):
+        data = await asyncio.to_thread(self._read, key)
+        if data is None:
+            return None
+        return prototype.buffer.from_bytes(_byte_range_slice(data, byte_range))
+
+    async def get_partial_values(self, prototype, key_ranges):
+        return await asyncio.gather(*(
+            self.get(key, prototype, byte_range) for key, byte_range in key_ranges
+        ))
+
+    async def exists(self, key) -> bool:
+        return key in self.store
+
+    async def set(self, key, value):
+        raise PermissionError(f"{type(self).__name__} is read-only")
+
+    async def delete(self, key):
+        raise PermissionError(f"{type(self).__name__} is read-only")
+
+    async def list(self):
+        for key in list(self.store):
+            yield key
+
+    async def list_prefix(self, prefix):
+        for key in list(self.store):
+            if key.startswith(prefix):
+                yield key
+
+    async def list_dir(self, prefix):
+        prefix = prefix.rstrip('/')
+        prefix = f'{prefix}/' if prefix else ''
+        children = set()
+        for key in list(self.store):
+            if key.startswith(prefix):
+                children.add(key[len(prefix):].split('/')[0])
+        for child in sorted(children):
+            yield child
+
+
+class ChunkCacheStore(MappingStore):
+    """Read-only zarr store with a shared on-disk LRU chunk cache
+
+    The chunks are read (and read ahead) by threads, the zarr event loop
+    only waits on them so concurrent chunk reads stay concurrent.
+    Call `close` (done by closing the dataset of `open_cefi`) to stop the
+    read-ahead threads.
+
+    Parameters
+    ----------
+    store : MutableMapping
+        mapping to read from (ex: reference filesystem mapper)
+    cache_dir : str
+        local chunk cache directory shared across sessions
+    namespace : str
+        sub-directory of the cache for this store (ex: hash of the reference URL)
+    max_bytes : int
+        size limit of the whole cache directory
+    prefetch : int
+        number of chunks read ahead along the time axis
+    max_workers : int
+        number of background read-ahead threads
+    """
+
+    def __init__(
+        self,
+        store,
+        cache_dir: str,
+        namespace: str,
+        max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+        prefetch: int = 4,
+        max_workers: int = 8,
+    ):
+        super().__init__(store)
+        self.cache_dir = cache_dir
+        self.store_dir = os.path.join(cache_dir, namespace)
+        self.max_bytes = max_bytes
+        self.prefetch = prefetch
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._array_meta = {}
+        self._index = _cache_index(cache_dir)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers) if prefetch > 0 else None
+        if self._executor is not None:
+            # threads stopped even when the store is dropped without close
+            weakref.finalize(self, self._executor.shutdown, wait=False, cancel_futures=True)
+
+    def __eq__(self, other) -> bool:
+        return (
+            isinstance(other, ChunkCacheStore)
+            and self.store is other.store
+            and self.store_dir == other.store_dir
+        )
+
+    def __repr__(self) -> str:
+        return f"ChunkCacheStore({self.store_dir!r})"
+
+    def close(self):
+        """Stop the read-ahead threads (chunks already read stay in the cache)."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        super().close()
+
+    def _chunk_location(self, key: str):
+        """Reference entry ([url, offset, length]) of a chunk, None if the store has no references."""
+        references = getattr(getattr(self.store, 'fs', None), 'references', None)
+        if references is None:
+            return None
+        try:
+            location = references[self.store._key_to_str(key)]
+        except (KeyError, AttributeError):
+            return None
+        # inlined chunks are keyed by their content
+        if isinstance(location, (bytes, str)):
+            location = hashlib.sha1(
+                location.encode() if isinstance(location, str) else location
+            ).hexdigest()
+        return location
+
+    def _cache_path(self, key: str) -> str:
+        # a reference regenerated at the same URL points the key to other bytes
+        cache_key = json.dumps([key, self._chunk_location(key)])
+        return os.path.join(self.store_dir, hashlib.sha1(cache_key.encode()).hexdigest())
+
+    def _fetch(self, key: str) -> bytes:
+        """Read a chunk from the cache or from the store (and cache it)."""
+        path = self._cache_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # mark as recently used (atime is not reliable on noatime mounts)
+            os.utime(path)
+            self._index.touch(path)
+            return data
+        except FileNotFoundError:
+            pass
+
+        data = self.store[key]
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        self._index.add(path, len(data))
+        if self._index.total_bytes > self.max_bytes:
+            self._index.evict(self.max_bytes)
+        return data
+
+    def _fetch_shared(self, key: str) -> bytes:
+        """Fetch a chunk, waiting on the read-ahead if it is already in flight."""
+        with self._lock:
+            future = self._inflight.get(key)
+        if future is not None:
+            return future.result()
+        return self._fetch(key)
+
+    def _prefetch_done(self, key: str, _future):
+        with self._lock:
+            self._inflight.pop(key, None)
+
+    def _meta(self, array_name: str):
+        """Return (time axis, chunk grid shape, separator) of an array, None if no time axis."""
+        if array_name not in self._array_meta:
+            meta = None
+            try:
+                zarray = json.loads(self.store[f'{array_name}/.zarray'])
+                zattrs = json.loads(self.store[f'{array_name}/.zattrs'])
+                dims = zattrs.get('_ARRAY_DIMENSIONS', [])
+                axis = next((dims.index(d) for d in PREFETCH_DIMS if d in dims), None)
+                if axis is not None:
+                    grid = [
+                        -(-size // chunk) for size, chunk in zip(zarray['shape'], zarray['chunks'])
+                    ]
+                    meta = (axis, grid, zarray.get('dimension_separator', '.'))
+            except (KeyError, ValueError):
+                meta = None
+            self._array_meta[array_name] = meta
+        return self._array_meta[array_name]
+
+    def _schedule_prefetch(self, key: str):
+        """Read ahead the next chunks along the time axis of a chunk key."""
+        array_name, _, chunk_id = key.rpartition('/')
+        meta = self._meta(array_name) if array_name else None
+        if meta is None:
+            return
+        axis, grid, separator = meta
+        try:
+            indices = [int(i) for i in chunk_id.split(separator)]
+        except ValueError:
+            return
+        if len(indices) != len(grid):
+            return
+
+        for step in range(1, self.prefetch + 1):
+            next_indices = list(indices)
+            next_indices[axis] += step
+            if next_indices[axis] >= grid[axis]:
+                break
+            next_key = f'{array_name}/{separator.join(str(i) for i in next_indices)}'
+            if os.path.exists(self._cache_path(next_key)):
+                continue
+            with self._lock:
+                if next_key in self._inflight or self._executor is None:
+                    continue
+                future = self._executor.submit(self._fetch, next_key)
+                self._inflight[next_key] = future
+            future.add_done_callback(lambda f, k=next_key: self._prefetch_done(k, f))
+
+    def _read(self, key: str):
+        """Read an object (None if missing), chunks through the cache."""
+        name = key.rpartition('/')[2]
+        try:
+            # metadata keys are small and inlined in the reference file
+            if name.startswith('.') or name == 'zarr.json':
+                return self.store[key]
+            data = self._fetch_shared(key)
+        except KeyError:
+            return None
+        if self._executor is not None:
+            self._schedule_prefetch(key)
+        return data
+
+
+def open_cached(
+    mapper,
+    cache_dir: str,
+    namespace: str,
+    max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+    prefetch: int = 4,
+    **open_kwargs,
+) -> xr.Dataset:
+    """Open a zarr mapping (ex: reference filesystem mapper) behind the chunk cache
+
+    Parameters
+    ----------
+    mapper : MutableMapping
+        mapping to read from
+    cache_dir : str
+        local chunk cache directory shared across sessions,
+        None to read without a local cache
+    namespace : str
+        sub-directory of the cache for this mapping
+    max_bytes : int
+        size limit of the local chunk cache
+    prefetch : int
+        number of chunks read ahead along the time axis (0 to disable)
+    **open_kwargs
+        passed to `xr.open_dataset`
+
+    Returns
+    -------
+    xr.Dataset
+        lazily loaded dataset, closing it stops the read-ahead threads
+    """
+    if cache_dir is None:
+        store = MappingStore(mapper)
+    else:
+        store = ChunkCacheStore(
+            mapper, cache_dir=cache_dir, namespace=namespace, max_bytes=max_bytes, prefetch=prefetch
+        )
+    ds = xr.open_dataset(store, engine='zarr', consolidated=False, **open_kwargs)
+    # xarray does not close a store it did not open, stop the read-ahead with the dataset
+    close_backend = ds._close
+
+    def close():
+        if close_backend is not None:
+            close_backend()
+        store.close()
+
+    ds.set_close(close)
+    return ds
+
+
+def open_cefi(
+    region: str,
+    experiment: str,
+    frequency: str,
+    variable: str,
+    release: str = 'latest',
+    grid_type: str = 'regrid',
+    subdomain: str = 'full_domain',
+    cloud: str = 's3',
+    cache_dir: str = DEFAULT_CACHE_DIR,
+    cache_max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+    prefetch: int = 4,
+    **open_kwargs,
+) -> xr.Dataset:
+    """Open a published CEFI dataset through its kerchunk reference file
+
+    Parameters
+    ----------
+    region, experiment, frequency, variable, release, grid_type, subdomain, cloud
+        see `resolve_reference`
+    cache_dir : str, optional
+        local chunk cache directory shared across sessions,
+        None to read without a local cache
+    cache_max_bytes : int
+        size limit of the local chunk cache
+    prefetch : int
+        number of chunks read ahead along the time axis (0 to disable)
+    **open_kwargs
+        passed to `xr.open_dataset`
+
+    Returns
+    -------
+    xr.Dataset
+        lazily loaded dataset
+    """
+    reference_url = resolve_reference(
+        region, experiment, frequency, variable,
+        release=release, grid_type=grid_type, subdomain=subdomain, cloud=cloud
+    )
+    logging.info("Opening %s", reference_url)
+
+    fs = fsspec.filesystem(
+        "reference",
+        fo=reference_url,
+        remote_protocol=cloud,
+        remote_options={"anon": True},
+        skip_instance_cache=True,
+        target_options={"anon": True}
+    )
+    return open_cached(
+        fs.get_mapper(),
+        cache_dir=cache_dir,
+        namespace=hashlib.sha1(reference_url.encode()).hexdigest(),
+        max_bytes=cache_max_bytes,
+        prefetch=prefetch,
+        **open_kwargs
+    )
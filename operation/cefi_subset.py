@@ -0,0 +1,542 @@
+"""
+Chunk-aware subset extraction of a CEFI variable from its kerchunk reference.
+
+A user who needs one variable over a small box and time window does not
+need the whole netcdf file. The published reference file gives the
+chunk layout of the variable (`.zarray`) and the byte range of every
+chunk, so this helper:
+
+- converts the bbox/time/member/lead selection into index positions on
+  the coordinates of the variable
+- lists the chunks intersecting the selection and fetches only those,
+  many ranged requests at a time through the fsspec reference filesystem
+- decodes the chunks with the codecs of the array and writes the
+  selected values to a small netcdf or Zarr output
+
+The output is written one chunk row (along the first dimension) at a
+time while the next chunks are fetched, so the memory used is bounded by
+one row of the output plus `max_chunks` raw chunks, not by the selection.
+Values are copied as stored (packed values keep their scale_factor,
+add_offset and _FillValue attributes).
+
+Both grids of the portal are handled: regrid files are selected on the
+`lat`/`lon` coordinates, raw files on the nominal `yh`/`xh` (and `yq`/`xq`)
+coordinates of the MOM6 grid.
+
+Example:
+    from cefi_subset import subset_cefi
+    subset_cefi(
+        'northwest_atlantic', 'hindcast', 'monthly', 'tos', 'tos_gulf_of_maine.nc',
+        bbox=(-71.0, 41.0, -65.0, 45.0), time=('2000-01', '2009-12')
+    )
+
+Usage:
+    python cefi_subset.py --region northwest_atlantic --experiment hindcast --frequency monthly \\
+        --variable tos --bbox -71 41 -65 45 --time 2000-01 2009-12 --output tos_gom.nc
+    python cefi_subset.py --region northwest_atlantic --experiment seasonal_reforecast \\
+        --frequency monthly --variable tos --grid-type raw --member 1 2 3 --lead 0 1 2 \\
+        --time 2010-01 2010-12 --output tos_reforecast.zarr
+
+"""
+
+import sys
+import json
+import logging
+import argparse
+import itertools
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import fsspec
+import xarray as xr
+from cefi_reader import resolve_reference, MappingStore
+from kerchunk_audit import decode_chunk
+
+# dimensions of the grids (regrid: lat/lon, raw MOM6 grid: yh/xh tracer and yq/xq corner points)
+LAT_DIMS = ('lat', 'yh', 'yq')
+LON_DIMS = ('lon', 'xh', 'xq')
+RAW_GRID_DIMS = ('yh', 'xh', 'yq', 'xq')
+
+# time dimensions (hindcast: time, reforecast: init_time)
+TIME_DIMS = ('time', 'init_time')
+
+# encoding kept on the output coordinates (time units and calendar)
+CF_ENCODING_KEYS = ('units', 'calendar', 'dtype')
+
+# number of chunk requests sent at once
+DEFAULT_MAX_CHUNKS = 64
+
+
+def grid_type_of(dims) -> str:
+    """Grid type of a variable from its dimensions ('raw', 'regrid' or None)"""
+    if any(dim in RAW_GRID_DIMS for dim in dims):
+        return 'raw'
+    if 'lat' in dims or 'lon' in dims:
+        return 'regrid'
+    return None
+
+
+def coordinate_indices(values: np.ndarray, low: float, high: float, name: str) -> np.ndarray:
+    """Positions of the coordinate values inside [low, high]
+
+    Parameters
+    ----------
+    values : np.ndarray
+        1-D coordinate values (increasing or decreasing)
+    low, high : float
+        bounds of the selection
+    name : str
+        coordinate name (for the error message)
+
+    Returns
+    -------
+    np.ndarray
+        sorted index positions
+    """
+    indices = np.nonzero((values >= low) & (values <= high))[0]
+    if len(indices) == 0:
+        raise ValueError(
+            f"No '{name}' value in [{low}, {high}] (range {values.min()} to {values.max()})"
+        )
+    return indices
+
+
+def wrap_longitude(values: np.ndarray, west: float, east: float) -> tuple:
+    """Bring the bbox longitudes to the convention (0-360 or -180-180) of the coordinate"""
+    if values.max() > 180 and west < 0:
+        return west + 360, east + 360
+    if values.min() < 0 and east > 180:
+        return west - 360, east - 360
+    return west, east
+
+
+def value_indices(values: np.ndarray, selected: list, name: str) -> np.ndarray:
+    """Positions of the selected values (ex: members, leads) in a coordinate"""
+    mask = np.isin(values, selected)
+    missing = set(selected) - set(values[mask].tolist())
+    if missing:
+        raise ValueError(f"'{name}' values not found: {sorted(missing)}")
+    return np.nonzero(mask)[0]
+
+
+def selection_indices(
+    ds: xr.Dataset,
+    variable: str,
+    bbox: tuple = None,
+    time: tuple = None,
+    member: list = None,
+    lead: list = None,
+) -> dict:
+    """Convert a selection into index positions along the dimensions of a variable
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        dataset opened from the reference file (coordinates are read)
+    variable : str
+        variable name
+    bbox : tuple, optional
+        (west, south, east, north) in degrees, on lat/lon for the regrid
+        grid and on the nominal yh/xh (yq/xq) coordinates for the raw grid
+    time : tuple, optional
+        (start, end) dates (ex: '2000-01', '2009-12'), on time or init_time
+    member : list, optional
+        ensemble members to keep
+    lead : list, optional
+        lead values to keep
+
+    Returns
+    -------
+    dict
+        {dim: sorted index positions} for every dimension of the variable
+    """
+    dims = ds[variable].dims
+    indices = {dim: np.arange(ds.sizes[dim]) for dim in dims}
+
+    def coordinate(dim):
+        if dim not in ds.coords:
+            raise ValueError(f"Dimension '{dim}' of '{variable}' has no coordinate to select on")
+        return np.asarray(ds[dim].values)
+
+    if bbox is not None:
+        west, south, east, north = bbox
+        if west > east:
+            raise ValueError("bbox crossing the antimeridian is not supported (west > east)")
+        lat_dims = [dim for dim in dims if dim in LAT_DIMS]
+        lon_dims = [dim for dim in dims if dim in LON_DIMS]
+        if not lat_dims or not lon_dims:
+            raise ValueError(f"'{variable}' has no horizontal dimensions for a bbox ({dims})")
+        for dim in lat_dims:
+            indices[dim] = coordinate_indices(coordinate(dim), south, north, dim)
+        for dim in lon_dims:
+            values = coordinate(dim)
+            indices[dim] = coordinate_indices(values, *wrap_longitude(values, west, east), dim)
+
+    if time is not None:
+        time_dims = [dim for dim in dims if dim in TIME_DIMS]
+        if not time_dims:
+            raise ValueError(f"'{variable}' has no time dimension ({dims})")
+        for dim in time_dims:
+            time_slice = ds.indexes[dim].slice_indexer(time[0], time[1])
+            indices[dim] = np.arange(ds.sizes[dim])[time_slice]
+            if len(indices[dim]) == 0:
+                raise ValueError(f"No '{dim}' value between {time[0]} and {time[1]}")
+
+    for dim, selected in (('member', member), ('lead', lead)):
+        if selected is not None:
+            if dim not in dims:
+                raise ValueError(f"'{variable}' has no '{dim}' dimension ({dims})")
+            indices[dim] = value_indices(coordinate(dim), selected, dim)
+
+    return indices
+
+
+def chunk_selection(positions: np.ndarray, chunk_size: int) -> list:
+    """Split index positions by chunk
+
+    Returns
+    -------
+    list
+        [(chunk index, positions inside the chunk, positions in the output), ...]
+    """
+    chunk_ids = positions // chunk_size
+    selection = []
+    for chunk_id in np.unique(chunk_ids):
+        out = np.nonzero(chunk_ids == chunk_id)[0]
+        selection.append((int(chunk_id), positions[out] - chunk_id * chunk_size, out))
+    return selection
+
+
+def fetch_chunks(fs, keys: list) -> dict:
+    """Fetch chunks with concurrent requests (None for chunks not in the reference)"""
+    data = fs.cat(keys, on_error='return')
+    chunks = {}
+    for key in keys:
+        value = data.get(key)
+        if isinstance(value, (FileNotFoundError, KeyError)) or value is None:
+            # chunks only made of fill values are not referenced
+            chunks[key] = None
+        elif isinstance(value, Exception):
+            raise value
+        else:
+            chunks[key] = value
+    return chunks
+
+
+class NetCDFSubsetWriter:
+    """Streamed netcdf output: coordinates from xarray, variable written by rows"""
+
+    def __init__(self, output, template, variable, zarray, attrs):
+        import netCDF4
+
+        template.drop_vars(variable).to_netcdf(output, mode='w')
+        self.nc = netCDF4.Dataset(output, 'a')
+        dims = template[variable].dims
+        for dim in dims:
+            if dim not in self.nc.dimensions:
+                self.nc.createDimension(dim, template.sizes[dim])
+        self.var = self.nc.createVariable(
+            variable,
+            np.dtype(zarray['dtype']),
+            dims,
+            zlib=bool(zarray.get('compressor')),
+            complevel=4,
+            chunksizes=[min(chunk, template.sizes[dim]) for chunk, dim in zip(zarray['chunks'], dims)],
+            fill_value=zarray.get('fill_value')
+        )
+        # values are written as stored (packed), with the packing attributes
+        self.var.set_auto_maskandscale(False)
+        self.var.setncatts(attrs)
+
+    def write(self, start: int, block: np.ndarray):
+        self.var[start:start + len(block)] = block
+
+    def close(self):
+        self.nc.close()
+
+
+class ZarrSubsetWriter:
+    """Streamed Zarr output: lazy template written first, variable written by regions"""
+
+    def __init__(self, output, template, variable, zarray, attrs):
+        dims = template[variable].dims
+        template = template.copy()
+        template[variable].attrs = dict(attrs)
+        if zarray.get('fill_value') is not None:
+            template[variable].attrs['_FillValue'] = zarray['fill_value']
+        # storage encoding of the source (compressor, chunks) does not apply to the output
+        for name in template.variables:
+            template[name].encoding = {
+                key: value for key, value in template[name].encoding.items() if key in CF_ENCODING_KEYS
+            }
+        template[variable].encoding = {}
+        chunks = tuple(min(chunk, template.sizes[dim]) for chunk, dim in zip(zarray['chunks'], dims))
+        # lazy template: coordinates and metadata are written, data is not computed
+        #  (dask chunks of the selection realigned on the output chunks)
+        template[variable] = template[variable].chunk(dict(zip(dims, chunks)))
+        template.to_zarr(output, mode='w', compute=False, encoding={variable: {'chunks': chunks}})
+        self.output = output
+        self.variable = variable
+        self.dims = dims
+        self.sizes = dict(template.sizes)
+
+    def write(self, start: int, block: np.ndarray):
+        region = {dim: slice(0, self.sizes[dim]) for dim in self.dims}
+        region[self.dims[0]] = slice(start, start + len(block))
+        xr.Dataset({self.variable: (self.dims, block)}).to_zarr(self.output, mode='r+', region=region)
+
+    def close(self):
+        pass
+
+
+def subset_reference(
+    reference_url: str,
+    variable: str,
+    output: str,
+    bbox: tuple = None,
+    time: tuple = None,
+    member: list = None,
+    lead: list = None,
+    cloud: str = 's3',
+    max_chunks: int = DEFAULT_MAX_CHUNKS,
+) -> dict:
+    """Extract a subset of a variable from its kerchunk reference file
+
+    Parameters
+    ----------
+    reference_url : str
+        URL of the kerchunk reference file (per-variable or combined)
+    variable : str
+        variable name
+    output : str
+        output path, a Zarr store if it ends with '.zarr', netcdf otherwise
+    bbox, time, member, lead
+        see `selection_indices`
+    cloud : str
+        protocol of the referenced netcdf objects ('s3' or 'gcs')
+    max_chunks : int
+        number of chunk requests sent at once (bounds the raw chunks in memory)
+
+    Returns
+    -------
+    dict
+        statistics of the extraction (chunks fetched, bytes fetched and written)
+    """
+    start_time = datetime.now()
+    fs = fsspec.filesystem(
+        "reference",
+        fo=reference_url,
+        remote_protocol=cloud,
+        remote_options={"anon": True},
+        skip_instance_cache=True,
+        target_options={"anon": True}
+    )
+    # packed values are kept as stored, the chunks are decoded without the CF decoding
+    ds = xr.open_dataset(
+        MappingStore(fs.get_mapper()), engine='zarr', consolidated=False, chunks={},
+        mask_and_scale=False, decode_timedelta=False
+    )
+    if variable not in ds:
+        raise KeyError(f"Variable '{variable}' not in {reference_url}")
+
+    dims = ds[variable].dims
+    if not dims:
+        raise ValueError(f"'{variable}' is a scalar, nothing to subset")
+    grid_type = grid_type_of(dims)
+    if grid_type == 'raw' and bbox is not None:
+        logging.info("Raw grid: bbox applied to the nominal %s coordinates",
+                     [dim for dim in dims if dim in RAW_GRID_DIMS])
+
+    indices = selection_indices(ds, variable, bbox=bbox, time=time, member=member, lead=lead)
+    zarray = json.loads(fs.cat_file(f'{variable}/.zarray'))
+    attrs = {
+        name: value for name, value in ds[variable].attrs.items()
+        if name not in ('_FillValue', '_ARRAY_DIMENSIONS')
+    }
+    fill_value = zarray.get('fill_value')
+    if isinstance(fill_value, str):
+        fill_value = float(fill_value)
+        zarray['fill_value'] = fill_value
+    chunk_shape = tuple(zarray['chunks'])
+    separator = zarray.get('dimension_separator', '.')
+    dtype = np.dtype(zarray['dtype'])
+
+    template = ds[[variable]].isel({dim: indices[dim] for dim in dims})
+    # coordinates are small once subset, they are written with the output metadata
+    template = template.assign_coords({name: coord.compute() for name, coord in template.coords.items()})
+    out_shape = tuple(len(indices[dim]) for dim in dims)
+    logging.info(
+        "Subset of %s (%s): %s -> %s", variable, grid_type, ds[variable].shape, out_shape
+    )
+
+    # chunks of every dimension intersecting the selection
+    selections = [chunk_selection(indices[dim], size) for dim, size in zip(dims, chunk_shape)]
+    rows = []
+    for row in selections[0]:
+        keys = [
+            (f"{variable}/{separator.join(str(part[0]) for part in (row,) + combo)}", combo)
+            for combo in itertools.product(*selections[1:])
+        ]
+        for i in range(0, len(keys), max_chunks):
+            rows.append((row, keys[i:i + max_chunks]))
+
+    writer_class = ZarrSubsetWriter if output.rstrip('/').endswith('.zarr') else NetCDFSubsetWriter
+    writer = writer_class(output, template, variable, zarray, attrs)
+
+    stats = {
+        'variable': variable,
+        'reference': reference_url,
+        'output': output,
+        'shape': out_shape,
+        'chunks_total': int(np.prod([-(-size // chunk) for size, chunk in zip(ds[variable].shape, chunk_shape)])),
+        'chunks_fetched': 0,
+        'chunks_fill': 0,
+        'bytes_fetched': 0,
+        'bytes_written': 0,
+    }
+
+    block = None
+    block_row = None
+    try:
+        # one batch of chunk requests in flight while the previous batch is decoded
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(fetch_chunks, fs, [key for key, _ in rows[0][1]]) if rows else None
+            for n, (row, keys) in enumerate(rows):
+                chunks = future.result()
+                if n + 1 < len(rows):
+                    future = executor.submit(fetch_chunks, fs, [key for key, _ in rows[n + 1][1]])
+
+                if block_row is None or block_row[0] != row[0]:
+                    if block is not None:
+                        writer.write(int(block_row[2][0]), block)
+                        stats['bytes_written'] += block.nbytes
+                    block_row = row
+                    block = np.empty((len(row[2]),) + out_shape[1:], dtype=dtype)
+
+                for key, combo in keys:
+                    raw = chunks[key]
+                    if raw is None:
+                        stats['chunks_fill'] += 1
+                        chunk = np.full(chunk_shape, 0 if fill_value is None else fill_value, dtype=dtype)
+                    else:
+                        stats['chunks_fetched'] += 1
+                        stats['bytes_fetched'] += len(raw)
+                        chunk = decode_chunk(raw, zarray).reshape(chunk_shape, order=zarray.get('order', 'C'))
+                    parts = (row,) + combo
+                    block[np.ix_(np.arange(len(row[2])), *(part[2] for part in combo))] = (
+                        chunk[np.ix_(*(part[1] for part in parts))]
+                    )
+
+            if block is not None:
+                writer.write(int(block_row[2][0]), block)
+                stats['bytes_written'] += block.nbytes
+    finally:
+        writer.close()
+        ds.close()
+
+    stats['elapsed_s'] = (datetime.now() - start_time).total_seconds()
+    logging.info(
+        "Wrote %s: %s of %s chunks fetched (%s fill), %.2f MB fetched, %.2f MB written in %.1f s",
+        output, stats['chunks_fetched'], stats['chunks_total'], stats['chunks_fill'],
+        stats['bytes_fetched'] / 1024**2, stats['bytes_written'] / 1024**2, stats['elapsed_s']
+    )
+    return stats
+
+
+def subset_cefi(
+    region: str,
+    experiment: str,
+    frequency: str,
+    variable: str,
+    output: str,
+    bbox: tuple = None,
+    time: tuple = None,
+    member: list = None,
+    lead: list = None,
+    release: str = 'latest',
+    grid_type: str = 'regrid',
+    subdomain: str = 'full_domain',
+    cloud: str = 's3',
+    max_chunks: int = DEFAULT_MAX_CHUNKS,
+) -> dict:
+    """Extract a subset of a published CEFI variable
+
+    Parameters
+    ----------
+    region, experiment, frequency, variable, release, grid_type, subdomain, cloud
+        see `cefi_reader.resolve_reference`
+    output, bbox, time, member, lead, max_chunks
+        see `subset_reference`
+
+    Returns
+    -------
+    dict
+        statistics of the extraction
+    """
+    reference_url = resolve_reference(
+        region, experiment, frequency, variable,
+        release=release, grid_type=grid_type, subdomain=subdomain, cloud=cloud
+    )
+    logging.info("Reference file: %s", reference_url)
+    return subset_reference(
+        reference_url, variable, output,
+        bbox=bbox, time=time, member=member, lead=lead, cloud=cloud, max_chunks=max_chunks
+    )
+
+
+def main():
+    """Main function with command line argument parsing"""
+
+    parser = argparse.ArgumentParser(description='Extract a subset of a CEFI variable through its kerchunk reference')
+    parser.add_argument('--variable', type=str, required=True,
+                        help='Variable name (ex: tos)')
+    parser.add_argument('--output', type=str, required=True,
+                        help='Output file, a Zarr store if it ends with .zarr, netcdf otherwise')
+    parser.add_argument('--reference', type=str, default=None,
+                        help='Reference file URL (instead of region/experiment/frequency)')
+    parser.add_argument('--region', type=str, help='Region (ex: northwest_atlantic)')
+    parser.add_argument('--experiment', type=str, help='Experiment (ex: hindcast, seasonal_reforecast)')
+    parser.add_argument('--frequency', type=str, help='Output frequency (ex: monthly, daily)')
+    parser.add_argument('--release', type=str, default='latest',
+                        help='Release folder rYYYYMMDD (default: latest)')
+    parser.add_argument('--grid-type', type=str, default='regrid', choices=('raw', 'regrid'),
+                        help='Grid type (default: regrid)')
+    parser.add_argument('--subdomain', type=str, default='full_domain',
+                        help='Subdomain (default: full_domain)')
+    parser.add_argument('--cloud', type=str, default='s3', choices=('s3', 'gcs'),
+                        help='Cloud bucket to read from (default: s3)')
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'),
+                        help='Bounding box in degrees')
+    parser.add_argument('--time', type=str, nargs=2, metavar=('START', 'END'),
+                        help='Time range (ex: 2000-01 2009-12), on init_time for reforecasts')
+    parser.add_argument('--member', type=int, nargs='+', help='Ensemble members to keep')
+    parser.add_argument('--lead', type=float, nargs='+', help='Lead values to keep')
+    parser.add_argument('--max-chunks', type=int, default=DEFAULT_MAX_CHUNKS,
+                        help=f'Chunk requests sent at once (default: {DEFAULT_MAX_CHUNKS})')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+
+    selection = {
+        'bbox': args.bbox, 'time': args.time, 'member': args.member, 'lead': args.lead,
+        'max_chunks': args.max_chunks
+    }
+    if args.reference:
+        subset_reference(args.reference, args.variable, args.output, cloud=args.cloud, **selection)
+    else:
+        if not (args.region and args.experiment and args.frequency):
+            parser.error('--region, --experiment and --frequency are required without --reference')
+        subset_cefi(
+            args.region, args.experiment, args.frequency, args.variable, args.output,
+            release=args.release, grid_type=args.grid_type, subdomain=args.subdomain,
+            cloud=args.cloud, **selection
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+"""
+Single command line entry point of the CEFI cloud transfer operations.
+
+Subcommands:
+    scan     list the latest local release folders that an upload would process
+    upload   upload the latest releases (with kerchunk indexes, manifests, catalog)
+    index    (re)generate the kerchunk indexes of netcdf objects in the bucket
+    remove   keep the N newest releases per parent directory in the bucket
+    crawl    crawl the THREDDS catalog, optionally diffed against the bucket
+    audit    check the kerchunk references of a prefix against the bucket
+    merge    merge the results of a sharded upload or index run
+    mirror   download the objects of a prefix to a local directory
+
+All the subcommands share one JSON configuration file (see DEFAULT_CONFIG for
+the keys, missing keys take the default) and one S3 client setup. Modules
+are imported by the subcommand that needs them, so xarray, fsspec and
+kerchunk are only loaded by the subcommands reading netcdf files or
+references, and cron-driven runs of the other subcommands start fast.
+
+Usage:
+    python cefi_transfer.py --config cefi_transfer.json scan
+    python cefi_transfer.py --config cefi_transfer.json upload
+    python cefi_transfer.py index --from-audit kerchunk_audit.json
+    python cefi_transfer.py remove --keep 1 --dry-run
+    python cefi_transfer.py remove --keep 1 --delete --yes
+    python cefi_transfer.py crawl --prefix "northeast_pacific/" --diff
+    python cefi_transfer.py audit --prefix "northeast_pacific/full_domain/hindcast/"
+    python cefi_transfer.py mirror --dest /data/cefi_mirror --prefix "northeast_pacific/"
+
+Sharded upload over 4 nodes (same config and file tree on every node):
+    python cefi_transfer.py --config cefi_transfer.json upload --shard 0/4   # node 0
+    ...
+    python cefi_transfer.py --config cefi_transfer.json upload --shard 3/4   # node 3
+    python cefi_transfer.py --config cefi_transfer.json merge --shards 4     # once all are done
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+from kerchunk_cache import DEFAULT_CACHE_MAX_BYTES
+
+# shared configuration (overridden by the --config JSON file)
+DEFAULT_CONFIG = {
+    'bucket': 'noaa-oar-cefi-regional-mom6-pds',
+    'local_root_dirs': '/Projects/CEFI/regional_mom6/cefi_portal/',
+    'log_dir': '.',
+    'kerchunk_save_dir': None,
+    'kerchunk_cache_max_bytes': DEFAULT_CACHE_MAX_BYTES,
+    'zarr_save_dir': None,
+    'repack_dir': None,
+    'repack_chunks': None,
+    'inventory_file': None,
+    'inventory_max_age': 3600,
+    'max_file_workers': 4,
+    'max_pool_connections': 64,
+}
+
+
+# load the configuration JSON file
+def load_config(json_file):
+    """Load the configuration from a JSON file on top of the defaults."""
+    config = dict(DEFAULT_CONFIG)
+    if json_file is not None:
+        with open(json_file, 'r', encoding='utf-8') as jsonfile:
+            config.update(json.load(jsonfile))
+    return config
+
+
+# setup logging
+def setup_logging(log_file):
+    """Set up logging to a log file (replaced at every run) and stdout."""
+    if os.path.exists(log_file):
+        os.remove(log_file)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(log_file),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+
+
+def get_client(config):
+    """Create the S3 client shared by a subcommand."""
+    from s3_small_upload import get_pooled_s3_client
+    return get_pooled_s3_client(max_pool_connections=config['max_pool_connections'])
+
+
+def cmd_scan(args, config):
+    """List the latest release folders under the local root directory."""
+    from s3_upload import iter_latest_releases
+
+    releases = []
+    for parent_dir, release_folder, list_files, dict_previous_releases in iter_latest_releases(
+        config['local_root_dirs']
+    ):
+        size = sum(os.path.getsize(file_info['local']) for file_info in list_files)
+        logging.info(
+            "%s/%s: %s files (%.2f MB), %s older releases",
+            parent_dir, release_folder, len(list_files), size / 1024**2, len(dict_previous_releases)
+        )
+        releases.append({
+            'parent': parent_dir,
+            'release': release_folder,
+            'files': len(list_files),
+            'bytes': size,
+            'previous_releases': sorted(dict_previous_releases),
+        })
+
+    logging.info("%s release folders found", len(releases))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(releases, f, indent=2)
+    return 0
+
+
+def cmd_upload(args, config):
+    """Upload the latest releases to the bucket."""
+    from s3_upload import run_upload
+
+    kerchunk_save_dir = None if args.no_kerchunk else config['kerchunk_save_dir']
+    s3_client = get_client(config)
+    run_report = run_upload(
+        local_root_dirs=args.root or config['local_root_dirs'],
+        s3_bucket_name=config['bucket'],
+        kerchunk_save_dir=kerchunk_save_dir,
+        kerchunk_cache_max_bytes=config['kerchunk_cache_max_bytes'],
+        zarr_save_dir=config['zarr_save_dir'],
+        max_file_workers=config['max_file_workers'],
+        s3_client=s3_client,
+        shard=args.shard,
+        repack_dir=config['repack_dir'],
+        repack_chunks=config['repack_chunks']
+    )
+    s3_client.close()
+    failed = [result for result in run_report['results'] if result['action'] == 'failed']
+    return 1 if failed or run_report['verify_failed'] else 0
+
+
+def cmd_index(args, config):
+    """(Re)generate the kerchunk indexes of netcdf objects in the bucket."""
+    from s3_upload import gen_kerchunk_index, remote_index_is_current
+    from s3_small_upload import put_small_object
+    from kerchunk_cache import KerchunkCache
+    from transfer_shard import ShardAssigner, shard_file
+
+    if config['kerchunk_save_dir'] is None:
+        logging.error("kerchunk_save_dir is not set in the configuration")
+        return 1
+
+    s3_client = get_client(config)
+    bucket = config['bucket']
+
+    if args.from_audit:
+        with open(args.from_audit, 'r', encoding='utf-8') as f:
+            audit = json.load(f)
+        # sizes of the listing used for the audit (balance of the shards)
+        sizes = audit.get('sizes', {})
+        objects = [
+            {'Key': obj_name, 'Size': sizes.get(obj_name, 0)} for obj_name in sorted(
+                {entry['netcdf'] for entry in audit['stale'] if entry['netcdf']}
+                | set(audit['missing_index'])
+            )
+        ]
+    else:
+        from s3_remove_prefix import scan_prefix
+        objects, _, _ = scan_prefix(s3_client, bucket, args.prefix)
+        objects = [obj for obj in objects if obj['Key'].endswith('.nc')]
+
+    kerchunk_cache_dir = config['kerchunk_save_dir']
+    output = args.output
+    if args.shard is not None:
+        objects = ShardAssigner(args.shard[1]).select(
+            objects, args.shard[0], key=lambda obj: obj['Key'], size=lambda obj: obj['Size']
+        )
+        kerchunk_cache_dir = os.path.join(kerchunk_cache_dir, f'shard{args.shard[0]}of{args.shard[1]}')
+        output = shard_file(output, args.shard)
+        logging.info("%s netcdf objects assigned to shard %s/%s", len(objects), *args.shard)
+
+    cache = KerchunkCache(kerchunk_cache_dir, max_bytes=config['kerchunk_cache_max_bytes'])
+    index_report = {'indexed': [], 'current': [], 'failed': []}
+    for obj in objects:
+        obj_name = obj['Key']
+        json_obj_name = obj_name.removesuffix('.nc') + '.json'
+        is_current, source_metadata = remote_index_is_current(obj_name, json_obj_name, bucket, s3_client)
+        if source_metadata is None:
+            index_report['failed'].append(obj_name)
+            continue
+        if is_current and not args.force:
+            logging.info("Kerchunk index %s is current, skip kerchunking.", json_obj_name)
+            index_report['current'].append(obj_name)
+            continue
+        try:
+            json_file = gen_kerchunk_index(
+                s3_path=f's3://{bucket}/{obj_name}',
+                save_dir=cache.cache_dir,
+                cache=cache
+            )
+        except Exception as e:
+            logging.error("Error indexing %s: %s", obj_name, e)
+            index_report['failed'].append(obj_name)
+            continue
+        if put_small_object(json_file, json_obj_name, bucket, s3_client, metadata=source_metadata):
+            index_report['indexed'].append(obj_name)
+        else:
+            index_report['failed'].append(obj_name)
+
+    cache.evict()
+    cache.save()
+    s3_client.close()
+
+    if args.shard is not None:
+        index_report['shard'] = f'{args.shard[0]}/{args.shard[1]}'
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(index_report, f, indent=2)
+    logging.info(
+        "%s netcdf objects indexed, %s current, %s failed (report: %s)",
+        len(index_report['indexed']), len(index_report['current']), len(index_report['failed']), output
+    )
+    return 1 if index_report['failed'] else 0
+
+
+def cmd_merge(args, config):
+    """Merge the per-shard results of a sharded upload or index run."""
+    from transfer_shard import merge_reports, shard_file
+
+    if args.index_report:
+        shards = [(index, args.shards) for index in range(args.shards)]
+        merged = merge_reports([shard_file(args.index_report, shard) for shard in shards])
+        with open(args.index_report, 'w', encoding='utf-8') as f:
+            json.dump(merged, f, indent=2)
+        logging.info("Merged index report written to %s", args.index_report)
+        return 1 if merged.get('failed') else 0
+
+    from s3_upload import merge_shard_runs
+
+    s3_client = get_client(config)
+    run_report = merge_shard_runs(
+        args.shards,
+        s3_bucket_name=config['bucket'],
+        kerchunk_save_dir=config['kerchunk_save_dir'],
+        s3_client=s3_client
+    )
+    s3_client.close()
+    failed = [result for result in run_report['results'] if result['action'] == 'failed']
+    return 1 if failed or run_report['verify_failed'] else 0
+
+
+def cmd_remove(args, config):
+    """Keep the N newest releases per parent directory in the bucket."""
+    from s3_retention import apply_retention
+
+    if args.delete and not args.yes:
+        response = input("Are you sure you want to proceed? Type 'DELETE' to confirm: ")
+        if response != 'DELETE':
+            logging.info("Deletion cancelled by user")
+            return 0
+
+    s3_client = get_client(config)
+    result = apply_retention(
+        config['bucket'],
+        args.prefix,
+        args.keep,
+        args.pin,
+        dry_run=not args.delete,
+        max_workers=args.workers,
+        s3_client=s3_client,
+        inventory_file=config['inventory_file'],
+        inventory_max_age=config['inventory_max_age']
+    )
+    s3_client.close()
+    return 1 if result['failed'] else 0
+
+
+def cmd_crawl(args, config):
+    """Crawl the THREDDS catalog (and diff it against the bucket)."""
+    from thredds_diff import thredds_files, diff_thredds_bucket
+
+    thredds = thredds_files(args.prefix)
+    logging.info("THREDDS crawl complete: %s netcdf files under '%s'", len(thredds), args.prefix)
+
+    output = thredds
+    if args.diff:
+        from s3_remove_prefix import scan_prefix
+        s3_client = get_client(config)
+        bucket_objects, _, _ = scan_prefix(s3_client, config['bucket'], args.prefix)
+        s3_client.close()
+        output = diff_thredds_bucket(thredds, bucket_objects)
+        logging.info(
+            "Diff: %s missing, %s size different, %s stale, %s only in the bucket",
+            len(output['missing']), len(output['size_different']),
+            len(output['stale']), len(output['extra'])
+        )
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(output, f, indent=2)
+    logging.info("Crawl written to %s", args.output)
+    return 0
+
+
+def cmd_audit(args, config):
+    """Audit the kerchunk references of a prefix."""
+    from kerchunk_audit import audit_prefix
+
+    s3_client = get_client(config)
+    result = audit_prefix(
+        config['bucket'],
+        args.prefix,
+        samples=args.samples,
+        max_workers=args.workers,
+        s3_client=s3_client,
+        inventory_file=config['inventory_file'],
+        inventory_max_age=config['inventory_max_age']
+    )
+    s3_client.close()
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=2)
+    logging.info("Audit written to %s", args.output)
+    return 1 if result['stale'] or result['missing_index'] else 0
+
+
+def cmd_mirror(args, config):
+    """Mirror the objects of a prefix into a local directory."""
+    from s3_mirror import mirror_prefix
+
+    s3_client = get_client(config)
+    result = mirror_prefix(
+        config['bucket'],
+        args.prefix,
+        args.dest,
+        netcdf_only=args.netcdf_only,
+        dry_run=args.dry_run,
+        max_workers=args.workers,
+        max_file_workers=args.file_workers,
+        s3_client=s3_client
+    )
+    s3_client.close()
+    return 1 if result['failed'] else 0
+
+
+def shard_arg(value):
+    """argparse type of the --shard option"""
+    from transfer_shard import parse_shard
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from e
+
+
+def build_parser():
+    """Command line parser with one sub-parser per subcommand"""
+
+    parser = argparse.ArgumentParser(description='CEFI cloud transfer operations')
+    parser.add_argument('--config', type=str, default=None,
+                        help='Shared JSON configuration file')
+    parser.add_argument('--bucket', type=str, default=None,
+                        help='S3 bucket name (overrides the configuration)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    scan = subparsers.add_parser('scan', help='List the latest local release folders')
+    scan.add_argument('--output', type=str, default=None,
+                      help='Optional JSON output of the release folders')
+    scan.set_defaults(func=cmd_scan)
+
+    upload = subparsers.add_parser('upload', help='Upload the latest releases')
+    upload.add_argument('--root', type=str, default=None,
+                        help='Local root directory (default: local_root_dirs of the configuration)')
+    upload.add_argument('--no-kerchunk', action='store_true',
+                        help='Skip the kerchunk indexes')
+    upload.add_argument('--shard', type=shard_arg, default=None,
+                        help='Only process shard i of N (i/N, i from 0), publish with the merge subcommand')
+    upload.set_defaults(func=cmd_upload)
+
+    index = subparsers.add_parser('index', help='(Re)generate kerchunk indexes in the bucket')
+    index_source = index.add_mutually_exclusive_group(required=True)
+    index_source.add_argument('--prefix', type=str,
+                              help='Index the netcdf objects under this prefix')
+    index_source.add_argument('--from-audit', type=str,
+                              help='Index the stale and missing references of an audit output')
+    index.add_argument('--force', action='store_true',
+                       help='Regenerate indexes that are current')
+    index.add_argument('--shard', type=shard_arg, default=None,
+                       help='Only process shard i of N (i/N, i from 0)')
+    index.add_argument('--output', type=str, default='cefi_transfer_index.json',
+                       help='Result file of the indexing (default: cefi_transfer_index.json)')
+    index.set_defaults(func=cmd_index)
+
+    remove = subparsers.add_parser('remove', help='Keep the N newest releases per parent directory')
+    remove_action = remove.add_mutually_exclusive_group(required=True)
+    remove_action.add_argument('--dry-run', action='store_true',
+                               help='Report what would be deleted without actually deleting')
+    remove_action.add_argument('--delete', action='store_true',
+                               help='Actually delete the objects')
+    remove.add_argument('--yes', action='store_true',
+                        help='Do not ask for confirmation (cron runs)')
+    remove.add_argument('--keep', type=int, default=1,
+                        help='Number of newest releases kept per parent directory (default: 1)')
+    remove.add_argument('--pin', type=str, action='append', default=[],
+                        help='Release never deleted, rYYYYMMDD or parent_dir/rYYYYMMDD (repeatable)')
+    remove.add_argument('--prefix', type=str, default='',
+                        help='Only apply retention under this prefix (default: whole bucket)')
+    remove.add_argument('--workers', type=int, default=32,
+                        help='Maximum concurrent delete requests, adaptive below it (default: 32)')
+    remove.set_defaults(func=cmd_remove)
+
+    crawl = subparsers.add_parser('crawl', help='Crawl the THREDDS catalog')
+    crawl.add_argument('--prefix', type=str, default='',
+                       help='Bucket prefix of the crawled catalogs (default: whole portal)')
+    crawl.add_argument('--diff', action='store_true',
+                       help='Diff the crawl against the bucket listing')
+    crawl.add_argument('--output', type=str, default='cefi_thredds_catalog.json',
+                       help='Output file (default: cefi_thredds_catalog.json)')
+    crawl.set_defaults(func=cmd_crawl)
+
+    audit = subparsers.add_parser('audit', help='Audit the kerchunk references of a prefix')
+    audit.add_argument('--prefix', type=str, required=True,
+                       help='Prefix to audit (empty string for the whole bucket)')
+    audit.add_argument('--samples', type=int, default=3,
+                       help='Chunks read and decoded per reference file (default: 3)')
+    audit.add_argument('--workers', type=int, default=16,
+                       help='Concurrent reference file reads (default: 16)')
+    audit.add_argument('--output', type=str, default='kerchunk_audit.json',
+                       help='Output file of the audit (default: kerchunk_audit.json)')
+    audit.set_defaults(func=cmd_audit)
+
+    merge = subparsers.add_parser('merge', help='Merge the results of a sharded run')
+    merge.add_argument('--shards', type=int, required=True,
+                       help='Number of shards N of the run')
+    merge.add_argument('--index-report', type=str, default=None,
+                       help='Merge the index result files of this name instead of an upload run')
+    merge.set_defaults(func=cmd_merge)
+
+    mirror = subparsers.add_parser('mirror', help='Download the objects of a prefix to a local directory')
+    mirror.add_argument('--dest', type=str, required=True,
+                        help='Local mirror root (object keys are used as relative paths)')
+    mirror.add_argument('--prefix', type=str, default='',
+                        help='Only mirror this prefix (default: whole bucket)')
+    mirror.add_argument('--netcdf-only', action='store_true',
+                        help='Only mirror the netcdf files (the tree the upload walks)')
+    mirror.add_argument('--dry-run', action='store_true',
+                        help='Report what would be downloaded')
+    mirror.add_argument('--workers', type=int, default=32,
+                        help='Concurrent ranged GET requests (default: 32)')
+    mirror.add_argument('--file-workers', type=int, default=8,
+                        help='Objects downloaded at the same time (default: 8)')
+    mirror.set_defaults(func=cmd_mirror)
+
+    return parser
+
+
+def main(argv: list = None):
+    """Main function with command line argument parsing (argv defaults to sys.argv[1:])"""
+
+    args = build_parser().parse_args(argv)
+
+    config = load_config(args.config)
+    if args.bucket:
+        config['bucket'] = args.bucket
+
+    setup_logging(os.path.join(config['log_dir'], f'cefi_transfer_{args.command}.log'))
+
+    if args.command == 'remove' and args.keep < 1:
+        logging.error("--keep must be at least 1")
+        sys.exit(2)
+
+    sys.exit(args.func(args, config))
+
+if __name__ == '__main__':
+    main()
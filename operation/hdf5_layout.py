@@ -0,0 +1,569 @@
+"""
+Chunk layout advisor (and optional repack) of netcdf4/HDF5 files before upload.
+
+Every stored chunk of a variable is one reference in the kerchunk index of
+the file and one range request for a reader. Two layouts found in the
+CEFI files are expensive in the cloud:
+
+- tiny chunks: millions of references, kerchunk JSON files of hundreds of MB
+  and one request per few KB of data
+- contiguous variables: kerchunk references the whole variable as a single
+  chunk, so reading one time step fetches every time step
+
+`inspect_layout` reads the layout of every variable with h5py (no data is
+read) and reports the estimated number of kerchunk references and the read
+amplification (bytes fetched / bytes used) of two typical queries:
+
+- map: one index of the first (time) dimension, all the other dimensions
+- series: all the first dimension at one index of the other dimensions
+
+`repack_file` rewrites a file with netCDF4 into a configured chunk shape and
+compression (the netcdf dimensions, attributes and raw values are kept).
+`prepare_files` advises several files at once in a process pool and repacks
+the flagged ones, so `s3_upload.run_upload` can upload (and kerchunk) the
+repacked copies instead of the original files.
+
+Usage:
+    python hdf5_layout.py file1.nc file2.nc                  # report only
+    python hdf5_layout.py *.nc --repack-dir ./repacked --chunks time=1 --complevel 4
+
+"""
+
+import os
+import json
+import math
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# target stored size of a chunk when the chunk shape is not configured
+DEFAULT_TARGET_CHUNK_BYTES = 4 * 1024 * 1024
+
+# uncompressed chunk size below which the chunks of a variable larger
+#  than this are considered tiny
+MIN_CHUNK_BYTES = 64 * 1024
+
+# kerchunk references per file above which the file is flagged
+MAX_REFERENCES = 100_000
+
+# contiguous variables larger than this are flagged
+MAX_CONTIGUOUS_BYTES = 64 * 1024 * 1024
+
+# compression of the repacked variables (netCDF4 createVariable keywords)
+DEFAULT_COMPRESSION = {'zlib': True, 'complevel': 4, 'shuffle': True}
+
+# bytes of a variable copied at once by the repack
+COPY_BLOCK_BYTES = 256 * 1024 * 1024
+
+# number of files advised (and repacked) at the same time
+DEFAULT_WORKERS = 4
+
+# start method of the worker processes (the upload threads of the caller
+#  may hold locks that a forked child would inherit locked)
+MP_CONTEXT = 'spawn'
+
+# netcdf dimensions without a coordinate variable are stored as HDF5
+#  datasets whose NAME attribute starts with this text
+NETCDF_DIM_ONLY = b'This is a netCDF dimension but not a netCDF variable'
+
+
+def _dimension_names(dataset) -> list:
+    """netcdf dimension names of an h5py dataset (from the attached dimension scales)."""
+    import h5py
+
+    if dataset.ndim == 1 and h5py.h5ds.is_scale(dataset.id):
+        return [dataset.name.lstrip('/')]
+    names = []
+    for index, dim in enumerate(dataset.dims):
+        names.append(dim[0].name.lstrip('/') if len(dim) else f'phony_dim_{index}')
+    return names
+
+def _amplification(shape: tuple, chunks: tuple, itemsize: int, chunk_bytes: float) -> dict:
+    """Read amplification of the map and series queries for a chunked variable."""
+    if len(shape) < 2 or 0 in shape:
+        return {}
+    grid = [math.ceil(size / chunk) for size, chunk in zip(shape, chunks)]
+    map_bytes = itemsize * math.prod(shape[1:])
+    series_bytes = itemsize * shape[0]
+    return {
+        'map': math.prod(grid[1:]) * chunk_bytes / map_bytes,
+        'series': grid[0] * chunk_bytes / series_bytes,
+    }
+
+def inspect_variable(dataset) -> dict:
+    """Layout of one HDF5 dataset
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+        variable of an open netcdf4/HDF5 file
+
+    Returns
+    -------
+    dict
+        name, dims, shape, dtype, layout ('contiguous', 'chunked' or 'compact'),
+        chunks, compression, stored chunks, stored bytes, estimated
+        kerchunk references and read amplification {'map', 'series'}
+    """
+    import h5py
+
+    shape = tuple(int(size) for size in dataset.shape)
+    itemsize = dataset.dtype.itemsize
+    nbytes = itemsize * math.prod(shape)
+    layout = dataset.id.get_create_plist().get_layout()
+    stored_bytes = dataset.id.get_storage_size()
+
+    info = {
+        'name': dataset.name.lstrip('/'),
+        'dims': _dimension_names(dataset),
+        'shape': list(shape),
+        'dtype': str(dataset.dtype),
+        'chunks': list(dataset.chunks) if dataset.chunks else None,
+        'compression': dataset.compression,
+        'nbytes': nbytes,
+        'stored_bytes': stored_bytes,
+    }
+
+    if layout == h5py.h5d.CHUNKED:
+        n_chunks = dataset.id.get_num_chunks()
+        chunk_bytes = stored_bytes / n_chunks if n_chunks else 0
+        info.update(
+            layout='chunked',
+            stored_chunks=n_chunks,
+            references=n_chunks,
+            chunk_nbytes=itemsize * math.prod(dataset.chunks),
+            amplification=_amplification(shape, dataset.chunks, itemsize, chunk_bytes)
+        )
+    elif layout == h5py.h5d.CONTIGUOUS:
+        # kerchunk references the whole variable as one chunk
+        info.update(
+            layout='contiguous',
+            stored_chunks=1 if stored_bytes else 0,
+            references=1 if stored_bytes else 0,
+            chunk_nbytes=nbytes,
+            amplification=_amplification(shape, shape, itemsize, stored_bytes)
+        )
+    else:
+        # compact data is stored in the object header and inlined by kerchunk
+        info.update(
+            layout='compact',
+            stored_chunks=0,
+            references=0,
+            chunk_nbytes=nbytes,
+            amplification={}
+        )
+    return info
+
+def variable_issues(info: dict) -> list:
+    """Layout problems of a variable reported by `inspect_variable`."""
+    issues = []
+    if info['layout'] == 'contiguous' and info['nbytes'] > MAX_CONTIGUOUS_BYTES:
+        issues.append(f"contiguous {info['nbytes'] / 1024**2:.0f} MB")
+    if (
+        info['layout'] == 'chunked'
+        and info['chunk_nbytes'] < MIN_CHUNK_BYTES < info['nbytes']
+    ):
+        issues.append(f"{info['stored_chunks']} chunks of {info['chunk_nbytes'] / 1024:.0f} KB")
+    return issues
+
+def inspect_layout(local_file: str) -> dict:
+    """Chunk layout report of a netcdf file
+
+    Parameters
+    ----------
+    local_file : str
+        local netcdf file path
+
+    Returns
+    -------
+    dict
+        {'file', 'format', 'variables', 'references', 'amplification',
+        'issues', 'needs_repack'} where references is the estimated number of
+        chunk references of the kerchunk index, amplification the largest
+        read amplification of the variables larger than MIN_CHUNK_BYTES and issues the layout problems found
+        (netcdf3 files have no chunks and are never flagged)
+    """
+    import h5py
+
+    report = {
+        'file': local_file,
+        'format': 'netcdf4',
+        'variables': [],
+        'references': 0,
+        'amplification': {},
+        'issues': [],
+        'needs_repack': False,
+    }
+    if not h5py.is_hdf5(local_file):
+        report['format'] = 'netcdf3'
+        return report
+
+    with h5py.File(local_file, 'r') as h5file:
+        datasets = []
+        h5file.visititems(
+            lambda name, obj: datasets.append(obj) if isinstance(obj, h5py.Dataset) else None
+        )
+        for dataset in datasets:
+            name_attr = dataset.attrs.get('NAME', b'')
+            if isinstance(name_attr, str):
+                name_attr = name_attr.encode()
+            if name_attr.startswith(NETCDF_DIM_ONLY):
+                continue
+            info = inspect_variable(dataset)
+            report['variables'].append(info)
+            report['references'] += info['references']
+            report['issues'].extend(f"{info['name']}: {issue}" for issue in variable_issues(info))
+            if info['nbytes'] <= MIN_CHUNK_BYTES:
+                # small variables are read whole whatever the query
+                continue
+            for query, ratio in info['amplification'].items():
+                report['amplification'][query] = max(report['amplification'].get(query, 0), ratio)
+
+    if report['references'] > MAX_REFERENCES:
+        report['issues'].append(f"{report['references']} kerchunk references")
+    report['needs_repack'] = bool(report['issues'])
+    return report
+
+def repack_chunks(
+    shape: tuple,
+    dims: tuple,
+    itemsize: int,
+    chunks: dict = None,
+    target_bytes: int = DEFAULT_TARGET_CHUNK_BYTES,
+) -> tuple:
+    """Chunk shape of a repacked variable
+
+    A variable smaller than target_bytes is one chunk. Otherwise dimensions
+    listed in chunks take the configured size and the others are filled
+    from the last dimension backward: full length while the chunk stays
+    below target_bytes, then the size that reaches it. With the default
+    (time, ..., y, x) order the chunks are whole maps (or tiles of a map)
+    over as many time steps as the target allows.
+
+    Parameters
+    ----------
+    shape : tuple
+        variable shape
+    dims : tuple
+        variable dimension names
+    itemsize : int
+        bytes per value
+    chunks : dict, optional
+        {dimension name: chunk size} of the configured dimensions
+    target_bytes : int
+        target uncompressed chunk size of the other dimensions
+
+    Returns
+    -------
+    tuple
+        chunk shape (every size at least 1 and at most the dimension length)
+    """
+    if itemsize * math.prod(shape) <= target_bytes:
+        return tuple(max(1, size) for size in shape)
+
+    chunks = chunks or {}
+    result = [None] * len(shape)
+    chunk_bytes = itemsize
+    for index, (dim, size) in enumerate(zip(dims, shape)):
+        if dim in chunks:
+            result[index] = max(1, min(chunks[dim], size))
+            chunk_bytes *= result[index]
+    for index in reversed(range(len(shape))):
+        if result[index] is not None:
+            continue
+        result[index] = max(1, min(shape[index], target_bytes // chunk_bytes))
+        chunk_bytes *= result[index]
+    return tuple(result)
+
+def repack_file(
+    local_file: str,
+    output_file: str,
+    chunks: dict = None,
+    compression: dict = None,
+    target_bytes: int = DEFAULT_TARGET_CHUNK_BYTES,
+) -> dict:
+    """Rewrite a netcdf4 file with a new chunk shape and compression
+
+    Dimensions, global and variable attributes and the raw (packed) values
+    are copied as they are. The data is copied in blocks of whole output
+    chunks along the first dimension, so memory stays around COPY_BLOCK_BYTES.
+    The output is written next to output_file and renamed when complete.
+
+    Parameters
+    ----------
+    local_file : str
+        local netcdf4 file path
+    output_file : str
+        path of the repacked file
+    chunks : dict, optional
+        {dimension name: chunk size}, see `repack_chunks`
+    compression : dict, optional
+        createVariable compression keywords (default DEFAULT_COMPRESSION)
+    target_bytes : int
+        target chunk size of the dimensions missing from chunks
+
+    Returns
+    -------
+    dict
+        layout report of the repacked file (see `inspect_layout`)
+    """
+    import netCDF4
+
+    compression = DEFAULT_COMPRESSION if compression is None else compression
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    tmp_file = output_file + '.tmp'
+
+    with netCDF4.Dataset(local_file, 'r') as src, netCDF4.Dataset(tmp_file, 'w', format='NETCDF4') as dst:
+        src.set_auto_maskandscale(False)
+        dst.set_auto_maskandscale(False)
+        if src.groups:
+            raise ValueError(f"{local_file} has groups, only the root group can be repacked")
+
+        dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+        for name, dim in src.dimensions.items():
+            dst.createDimension(name, None if dim.isunlimited() else len(dim))
+
+        for name, var in src.variables.items():
+            attrs = {key: var.getncattr(key) for key in var.ncattrs()}
+            fill_value = attrs.pop('_FillValue', None)
+            if var.dtype == str or var.ndim == 0:
+                # strings and scalars keep the default storage
+                out = dst.createVariable(name, var.datatype, var.dimensions, fill_value=fill_value)
+            else:
+                out = dst.createVariable(
+                    name,
+                    var.datatype,
+                    var.dimensions,
+                    fill_value=fill_value,
+                    chunksizes=repack_chunks(
+                        var.shape, var.dimensions, var.dtype.itemsize, chunks, target_bytes
+                    ),
+                    **compression
+                )
+            out.setncatts(attrs)
+
+            if var.ndim == 0 or var.shape[0] == 0:
+                if var.ndim == 0:
+                    out[...] = var[...]
+                continue
+            row_bytes = max(1, var.dtype.itemsize * math.prod(var.shape[1:]))
+            step = out.chunking()[0] if isinstance(out.chunking(), list) else 1
+            step = max(step, COPY_BLOCK_BYTES // row_bytes // step * step)
+            for start in range(0, var.shape[0], step):
+                stop = min(start + step, var.shape[0])
+                out[start:stop] = var[start:stop]
+
+    os.replace(tmp_file, output_file)
+    return inspect_layout(output_file)
+
+def advise_file(
+    local_file: str,
+    output_file: str = None,
+    chunks: dict = None,
+    compression: dict = None,
+    target_bytes: int = DEFAULT_TARGET_CHUNK_BYTES,
+) -> dict:
+    """Inspect a file and repack it when its layout is flagged
+
+    Parameters
+    ----------
+    local_file : str
+        local netcdf file path
+    output_file : str, optional
+        path of the repacked file, the file is only inspected when None
+        (a repacked file newer than the source is reused)
+    chunks, compression, target_bytes
+        see `repack_file`
+
+    Returns
+    -------
+    dict
+        layout report of the file (see `inspect_layout`) with 'repacked'
+        set to the layout report of the repacked file (None when not repacked)
+    """
+    report = inspect_layout(local_file)
+    report['repacked'] = None
+    if output_file is None or not report['needs_repack']:
+        return report
+
+    if os.path.exists(output_file) and os.path.getmtime(output_file) >= os.path.getmtime(local_file):
+        report['repacked'] = inspect_layout(output_file)
+    else:
+        report['repacked'] = repack_file(local_file, output_file, chunks, compression, target_bytes)
+    report['repacked'].pop('variables')
+    logging.info(
+        "Repacked %s: %s -> %s references",
+        local_file, report['references'], report['repacked']['references']
+    )
+    return report
+
+def prepare_files(
+    list_file_info: list,
+    repack_dir: str = None,
+    chunks: dict = None,
+    compression: dict = None,
+    target_bytes: int = DEFAULT_TARGET_CHUNK_BYTES,
+    max_workers: int = DEFAULT_WORKERS,
+):
+    """Advise (and repack) the netcdf files of an upload in a process pool
+
+    Parameters
+    ----------
+    list_file_info : list
+        list of {'local': local_file_path, 'cloud': cloud_object_name}
+    repack_dir : str, optional
+        directory of the repacked files (object names used as relative
+        paths), the files are only inspected when None
+    chunks, compression, target_bytes
+        see `repack_file`
+    max_workers : int
+        number of files processed at the same time
+
+    Returns
+    -------
+    tuple
+        (list of file_info, with 'local' pointing to the repacked file and
+        'source' to the original file for the repacked files,
+        list of layout reports without the per-variable details)
+    """
+    reports = {}
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context(MP_CONTEXT)
+    ) as executor:
+        futures = {
+            executor.submit(
+                advise_file,
+                file_info['local'],
+                os.path.join(repack_dir, file_info['cloud']) if repack_dir else None,
+                chunks,
+                compression,
+                target_bytes
+            ): file_info['cloud']
+            for file_info in list_file_info
+        }
+        for future in as_completed(futures):
+            obj_name = futures[future]
+            try:
+                report = future.result()
+            except Exception as e:
+                # the original file is uploaded
+                logging.error("Error checking the layout of %s: %s", obj_name, e)
+                continue
+            report.pop('variables')
+            reports[obj_name] = report
+            for issue in report['issues']:
+                logging.info("%s layout: %s", obj_name, issue)
+
+    list_prepared = []
+    for file_info in list_file_info:
+        report = reports.get(file_info['cloud'])
+        if report is not None and report['repacked'] is not None:
+            file_info = dict(
+                file_info,
+                local=os.path.join(repack_dir, file_info['cloud']),
+                source=file_info['local']
+            )
+        list_prepared.append(file_info)
+    return list_prepared, [dict(reports[obj], cloud=obj) for obj in sorted(reports)]
+
+def repacked_copies(list_file_info: list, repack_dir: str) -> list:
+    """Point the files of a release to their repacked copies, when they exist
+
+    A repacked file is uploaded in place of its original, so a later release
+    must be compared with the repacked copy of the previous one to find
+    the unchanged files (see `s3_upload.find_previous_release_file`).
+
+    Parameters
+    ----------
+    list_file_info : list
+        list of {'local': local_file_path, 'cloud': cloud_object_name}
+    repack_dir : str
+        directory of the repacked files (see `prepare_files`)
+
+    Returns
+    -------
+    list
+        list of file_info, with 'local' pointing to the repacked copy and
+        'source' to the original file for the files repacked since their
+        last change
+    """
+    list_resolved = []
+    for file_info in list_file_info:
+        repacked = os.path.join(repack_dir, file_info['cloud'])
+        try:
+            if os.path.getmtime(repacked) >= os.path.getmtime(file_info['local']):
+                file_info = dict(file_info, local=repacked, source=file_info['local'])
+        except OSError:
+            pass
+        list_resolved.append(file_info)
+    return list_resolved
+
+def chunks_arg(value: str) -> dict:
+    """Parse 'dim=size,dim=size' into {dim: size}."""
+    chunks = {}
+    for item in filter(None, value.split(',')):
+        dim, _, size = item.partition('=')
+        try:
+            chunks[dim.strip()] = int(size)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(f"Invalid chunk size '{item}' (expected dim=size)") from e
+    return chunks
+
+def main():
+    """Main function with command line argument parsing"""
+
+    parser = argparse.ArgumentParser(description='Chunk layout advisor and repack of netcdf files')
+    parser.add_argument('files', nargs='+',
+                        help='netcdf files to inspect')
+    parser.add_argument('--repack-dir', type=str, default=None,
+                        help='repack the flagged files into this directory (default: report only)')
+    parser.add_argument('--chunks', type=chunks_arg, default=None,
+                        help='chunk sizes of the repacked files, ex: time=1,yh=256,xh=256 '
+                             '(other dimensions sized to --target-chunk-mb)')
+    parser.add_argument('--target-chunk-mb', type=float,
+                        default=DEFAULT_TARGET_CHUNK_BYTES / 1024**2,
+                        help=f'target chunk size in MB (default: {DEFAULT_TARGET_CHUNK_BYTES // 1024**2})')
+    parser.add_argument('--complevel', type=int, default=DEFAULT_COMPRESSION['complevel'],
+                        help=f"zlib level of the repacked files, 0 for no compression "
+                             f"(default: {DEFAULT_COMPRESSION['complevel']})")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f'files processed at the same time (default: {DEFAULT_WORKERS})')
+    parser.add_argument('--output', type=str, default=None,
+                        help='optional JSON output of the layout reports')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    compression = dict(DEFAULT_COMPRESSION, complevel=args.complevel)
+    if args.complevel == 0:
+        compression = {}
+    files = [os.path.abspath(local_file) for local_file in args.files]
+    _, reports = prepare_files(
+        [{'local': local_file, 'cloud': os.path.basename(local_file)} for local_file in files],
+        repack_dir=args.repack_dir,
+        chunks=args.chunks,
+        compression=compression,
+        target_bytes=int(args.target_chunk_mb * 1024**2),
+        max_workers=args.workers
+    )
+
+    for report in reports:
+        status = 'ok'
+        if report['needs_repack']:
+            status = 'repacked' if report['repacked'] else 'flagged'
+        amplification = ', '.join(
+            f"{query} x{ratio:.1f}" for query, ratio in report['amplification'].items()
+        )
+        print(f"{report['cloud']}: {report['references']} references, "
+              f"read amplification {amplification or '-'}, {status}")
+        for issue in report['issues']:
+            print(f"    {issue}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, indent=2, default=str)
+
+if __name__ == '__main__':
+    main()
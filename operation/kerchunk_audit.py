@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+Kerchunk reference integrity audit of a bucket prefix.
+
+A kerchunk index stores byte ranges of its netcdf object. When the netcdf
+file is uploaded again (new chunking, new compression, regenerated data)
+the old index still opens but reads the wrong bytes. This script checks
+the indexes of a prefix against one listing of the bucket:
+
+- every netcdf file has its index and every index has its netcdf file
+- the netcdf object is the one the index was built from (size and ETag
+  recorded in the 'source-size'/'source-etag' metadata of the index object)
+- every referenced object exists and every [url, offset, length]
+  reference fits inside the current object size
+- a sample of chunks is read with ranged GETs and decoded with the codecs
+  of the array (`.zarray` compressor and filters)
+
+The result is a JSON list of the stale indexes (with the reasons) to regenerate.
+
+Usage:
+    python kerchunk_audit.py --prefix "northeast_pacific/full_domain/hindcast/"
+    python kerchunk_audit.py --prefix "northeast_pacific/" --samples 0        # no chunk reads
+    python kerchunk_audit.py --prefix "" --output stale_references.json --workers 32
+"""
+
+import sys
+import json
+import random
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Mapping
+import numpy as np
+import numcodecs
+from numcodecs.compat import ensure_bytes
+from botocore.exceptions import ClientError
+from s3_remove_prefix import setup_logging, get_s3_client
+from s3_inventory import DEFAULT_MAX_AGE, ObjectInventory, load_or_scan_inventory
+from kerchunk_combine import is_reference_key
+
+# Configuration
+S3_BUCKET_NAME = 'noaa-oar-cefi-regional-mom6-pds'
+
+# number of concurrent reference file reads
+DEFAULT_WORKERS = 16
+
+# number of chunks read and decoded per reference file
+DEFAULT_SAMPLES = 3
+
+# maximum number of problems kept per reference file
+MAX_REASONS = 20
+
+
+def object_key_of_url(url: str, bucket_name: str):
+    """Object key of a reference URL in the bucket, None for other locations
+
+    HDF5 references store 'bucket/key', netcdf3 references 's3://bucket/key'.
+    """
+    path = url.removeprefix('s3://')
+    if not path.startswith(f'{bucket_name}/'):
+        return None
+    return path[len(bucket_name) + 1:]
+
+
+def pair_objects(listing: Mapping[str, int]) -> Dict[str, List[str]]:
+    """
+    Check that every netcdf object has its index and every index its netcdf object
+
+    Returns:
+        Dictionary {'missing_index': [nc keys], 'orphan_index': [json keys]}
+    """
+    missing_index = []
+    orphan_index = []
+    for key in listing:
+        if key.endswith('.nc'):
+            if f"{key.removesuffix('.nc')}.json" not in listing:
+                missing_index.append(key)
+        elif is_reference_key(key):
+            if f"{key.removesuffix('.json')}.nc" not in listing:
+                orphan_index.append(key)
+    return {'missing_index': sorted(missing_index), 'orphan_index': sorted(orphan_index)}
+
+
+def expand_template(url: str, templates: dict) -> str:
+    """Expand the '{{name}}' templates of a reference URL"""
+    for name, value in templates.items():
+        url = url.replace(f'{{{{{name}}}}}', value)
+    return url
+
+
+def check_ranges(refs: dict, templates: dict, listing: Mapping[str, int], bucket_name: str):
+    """
+    Check every byte range reference against the bucket listing
+
+    Returns:
+        Tuple of (list of problems, list of (chunk_key, object_key, offset, length))
+    """
+    problems = []
+    ranges = []
+    for chunk_key, value in refs.items():
+        if not isinstance(value, list):
+            # inlined data or metadata
+            continue
+        obj_key = object_key_of_url(expand_template(value[0], templates), bucket_name)
+        if obj_key is None:
+            continue
+        if obj_key not in listing:
+            problems.append(f'{chunk_key}: object {obj_key} not found')
+            continue
+        if len(value) == 3:
+            offset, length = value[1], value[2]
+            if offset + length > listing[obj_key]:
+                problems.append(
+                    f'{chunk_key}: range {offset}+{length} beyond size {listing[obj_key]} of {obj_key}'
+                )
+                continue
+            ranges.append((chunk_key, obj_key, offset, length))
+    return problems, ranges
+
+
+def check_source(json_key: str, metadata: Mapping[str, str], listing: ObjectInventory) -> List[str]:
+    """
+    Compare the netcdf object recorded in the index object metadata with the listing
+
+    Indexes uploaded without the 'source-etag'/'source-size' metadata are not checked.
+
+    Returns:
+        List of problems
+    """
+    nc_key = netcdf_key(json_key)
+    index = listing.index_of(nc_key) if nc_key else -1
+    if index < 0:
+        return []
+    problems = []
+    source_etag = metadata.get('source-etag')
+    listed_etag = listing.etag(index)
+    if source_etag and listed_etag and source_etag != listed_etag:
+        problems.append(f'index built from ETag {source_etag}, {nc_key} has ETag {listed_etag}')
+    source_size = metadata.get('source-size')
+    listed_size = int(listing.sizes[index])
+    if source_size and int(source_size) != listed_size:
+        problems.append(f'index built from {source_size} bytes, {nc_key} has {listed_size} bytes')
+    return problems
+
+
+def decode_chunk(raw: bytes, zarray: dict) -> np.ndarray:
+    """Decode a chunk with the compressor and filters of its array"""
+    data = raw
+    if zarray.get('compressor'):
+        data = numcodecs.get_codec(zarray['compressor']).decode(data)
+    for codec_config in reversed(zarray.get('filters') or []):
+        data = numcodecs.get_codec(codec_config).decode(data)
+
+    dtype = np.dtype(zarray['dtype'])
+    expected = int(np.prod(zarray['chunks'])) * dtype.itemsize
+    data = ensure_bytes(data)
+    if len(data) != expected:
+        raise ValueError(f'decoded {len(data)} bytes, expected {expected}')
+    return np.frombuffer(data, dtype=dtype)
+
+
+def sample_chunks(s3_client, bucket_name: str, refs: dict, ranges: list, samples: int, rng) -> List[str]:
+    """
+    Read and decode a random sample of chunks
+
+    Returns:
+        List of problems
+    """
+    problems = []
+    for chunk_key, obj_key, offset, length in rng.sample(ranges, min(samples, len(ranges))):
+        array_name = chunk_key.rpartition('/')[0]
+        try:
+            zarray = json.loads(refs[f'{array_name}/.zarray'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        try:
+            response = s3_client.get_object(
+                Bucket=bucket_name, Key=obj_key, Range=f'bytes={offset}-{offset + length - 1}'
+            )
+            decode_chunk(response['Body'].read(), zarray)
+        except ClientError as e:
+            problems.append(f'{chunk_key}: error reading {obj_key}: {e}')
+        except Exception as e:  # codec errors do not share a base class
+            problems.append(f'{chunk_key}: chunk does not decode: {e}')
+    return problems
+
+
+def audit_reference(
+    s3_client,
+    bucket_name: str,
+    json_key: str,
+    listing: ObjectInventory,
+    samples: int = DEFAULT_SAMPLES,
+    seed: int = 0
+) -> Dict:
+    """
+    Audit a single reference file
+
+    A per-file index is stale when its netcdf object was uploaded again
+    after it was built (source metadata), even if its ranges still decode.
+
+    Returns:
+        Dictionary {'reference', 'checked', 'problems'}
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=json_key)
+        reference = json.loads(response['Body'].read())
+    except (ClientError, ValueError) as e:
+        return {'reference': json_key, 'checked': 0, 'problems': [f'unreadable reference file: {e}']}
+
+    refs = reference.get('refs', reference)
+    templates = reference.get('templates', {})
+
+    problems = check_source(json_key, response.get('Metadata', {}), listing)
+    range_problems, ranges = check_ranges(refs, templates, listing, bucket_name)
+    problems.extend(range_problems)
+    if samples > 0 and not problems:
+        rng = random.Random(f'{seed}:{json_key}')
+        problems.extend(sample_chunks(s3_client, bucket_name, refs, ranges, samples, rng))
+
+    return {'reference': json_key, 'checked': len(ranges), 'problems': problems[:MAX_REASONS]}
+
+
+def netcdf_key(json_key: str):
+    """Netcdf object of a per-file reference (None for the combined index)"""
+    if not is_reference_key(json_key):
+        return None
+    return f"{json_key.removesuffix('.json')}.nc"
+
+
+def audit_prefix(
+    bucket_name: str,
+    prefix: str,
+    samples: int = DEFAULT_SAMPLES,
+    max_workers: int = DEFAULT_WORKERS,
+    s3_client=None,
+    inventory_file: str = None,
+    inventory_max_age: float = DEFAULT_MAX_AGE
+) -> Dict:
+    """
+    Audit all reference files under a prefix
+
+    A client is created (and closed) when s3_client is None. The listing
+    comes from inventory_file when it is younger than inventory_max_age
+    seconds (see s3_inventory).
+
+    Returns:
+        Dictionary with the audit statistics, the stale references and
+        the sizes of the netcdf files to index again
+    """
+    own_client = s3_client is None
+    if own_client:
+        s3_client = get_s3_client()
+
+    # one listing of the prefix, indexes point to objects of their own release folder
+    listing = load_or_scan_inventory(s3_client, bucket_name, prefix, inventory_file, inventory_max_age)
+
+    pairs = pair_objects(listing)
+    json_keys = [key for key in listing if is_reference_key(key, combined=True)]
+    logging.info(
+        f"{len(json_keys)} reference files, {len(pairs['missing_index'])} netcdf files without index, "
+        f"{len(pairs['orphan_index'])} indexes without netcdf file"
+    )
+
+    # an orphan index has no netcdf file to index again
+    stale = [
+        {'reference': key, 'netcdf': None, 'problems': ['netcdf file not found']}
+        for key in pairs['orphan_index']
+    ]
+    checked_ranges = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(audit_reference, s3_client, bucket_name, key, listing, samples)
+            for key in json_keys if key not in pairs['orphan_index']
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            checked_ranges += result['checked']
+            if result['problems']:
+                logging.warning(f"Stale reference {result['reference']}: {result['problems'][0]}")
+                stale.append({
+                    'reference': result['reference'],
+                    'netcdf': netcdf_key(result['reference']),
+                    'problems': result['problems']
+                })
+
+    if own_client:
+        s3_client.close()
+
+    stale.sort(key=lambda entry: entry['reference'])
+    # netcdf files to index again, with their size (to balance sharded reindexing)
+    reindex = {entry['netcdf'] for entry in stale if entry['netcdf']} | set(pairs['missing_index'])
+    logging.info(f"{'='*60}")
+    logging.info(
+        f"TOTALS: {len(json_keys)} reference files, {checked_ranges} byte ranges checked, "
+        f"{len(stale)} stale references, {len(pairs['missing_index'])} missing indexes"
+    )
+    return {
+        'references': len(json_keys),
+        'ranges': checked_ranges,
+        'missing_index': pairs['missing_index'],
+        'stale': stale,
+        'sizes': {
+            key: int(listing.sizes[listing.index_of(key)]) for key in sorted(reindex) if key in listing
+        },
+    }
+
+
+def main():
+    """Main function with command line argument parsing"""
+
+    parser = argparse.ArgumentParser(description='Audit the kerchunk reference files of an S3 prefix')
+    parser.add_argument('--prefix', type=str, required=True,
+                        help='Prefix to audit (empty string for the whole bucket)')
+    parser.add_argument('--bucket', type=str, default=S3_BUCKET_NAME,
+                        help=f'S3 bucket name (default: {S3_BUCKET_NAME})')
+    parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES,
+                        help=f'Chunks read and decoded per reference file (default: {DEFAULT_SAMPLES})')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f'Concurrent reference file reads (default: {DEFAULT_WORKERS})')
+    parser.add_argument('--output', type=str, default='kerchunk_audit.json',
+                        help='Output file of the stale references (default: kerchunk_audit.json)')
+    parser.add_argument('--inventory', type=str, default=None,
+                        help='Inventory file reused between runs (default: list the bucket every run)')
+    parser.add_argument('--inventory-max-age', type=float, default=DEFAULT_MAX_AGE / 60,
+                        help=f'Minutes before the inventory is listed again (default: {DEFAULT_MAX_AGE // 60})')
+    parser.add_argument('--log-file', type=str, default='kerchunk_audit.log',
+                        help='Log file path (default: kerchunk_audit.log)')
+
+    args = parser.parse_args()
+
+    setup_logging(args.log_file)
+
+    result = audit_prefix(
+        args.bucket,
+        args.prefix,
+        samples=args.samples,
+        max_workers=args.workers,
+        inventory_file=args.inventory,
+        inventory_max_age=args.inventory_max_age * 60
+    )
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=2)
+    logging.info(f"Audit written to {args.output}")
+
+    if result['stale'] or result['missing_index']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
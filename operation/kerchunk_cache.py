@@ -0,0 +1,144 @@
+"""
+Persistent cache of kerchunk reference files.
+
+Each cached reference file is keyed by the netcdf object key together
+with the object size and ETag at the time it was indexed, so a reference
+is only rebuilt when the netcdf object really changed. The cached files
+are stored under the cache directory with the same relative path as the
+netcdf object (with a .json suffix) and an `index.json` file keeps
+track of the keys and the last access time of each entry.
+
+When the total size of the cached files goes over the size limit,
+the least recently used entries are removed.
+
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+CACHE_INDEX_FILE = 'index.json'
+
+# default size limit of the cache directory
+DEFAULT_CACHE_MAX_BYTES = 20 * 1024**3
+
+
+class KerchunkCache:
+    """Reference file cache keyed by (object key, size, ETag)
+
+    Parameters
+    ----------
+    cache_dir : str
+        directory holding the cached reference files
+    max_bytes : int, optional
+        total size of cached reference files kept after `evict`
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(cache_dir, CACHE_INDEX_FILE)
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # obj_name -> {'size', 'etag', 'bytes', 'atime'}
+        self.entries = {}
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, 'r', encoding='utf-8') as jsonfile:
+                    self.entries = json.load(jsonfile)
+            except (OSError, ValueError) as e:
+                logging.warning("Kerchunk cache index unreadable, starting fresh: %s", e)
+
+    def path_for(self, obj_name: str) -> str:
+        """Local path of the cached reference file for a netcdf object."""
+        json_name = obj_name.removesuffix('.nc') + '.json'
+        return os.path.join(self.cache_dir, json_name)
+
+    def get(self, obj_name: str, size: int, etag: str):
+        """Look up the cached reference file of a netcdf object
+
+        Parameters
+        ----------
+        obj_name : str
+            object name of the netcdf file
+        size : int
+            current size of the netcdf object
+        etag : str
+            current ETag of the netcdf object
+
+        Returns
+        -------
+        str or None
+            local path of the cached reference file, None if missing or outdated
+        """
+        json_file = self.path_for(obj_name)
+        with self._lock:
+            entry = self.entries.get(obj_name)
+            if entry is None:
+                return None
+            if entry['size'] != size or entry['etag'] != etag or not os.path.exists(json_file):
+                # the netcdf object changed since it was indexed
+                self.entries.pop(obj_name)
+                return None
+            entry['atime'] = time.time()
+        return json_file
+
+    def put(self, obj_name: str, size: int, etag: str, json_file: str) -> str:
+        """Add a reference file to the cache
+
+        Parameters
+        ----------
+        obj_name : str
+            object name of the netcdf file
+        size : int
+            size of the netcdf object that was indexed
+        etag : str
+            ETag of the netcdf object that was indexed
+        json_file : str
+            reference file, moved into the cache if not already there
+
+        Returns
+        -------
+        str
+            local path of the cached reference file
+        """
+        cached_file = self.path_for(obj_name)
+        if os.path.abspath(json_file) != os.path.abspath(cached_file):
+            os.makedirs(os.path.dirname(cached_file), exist_ok=True)
+            os.replace(json_file, cached_file)
+        with self._lock:
+            self.entries[obj_name] = {
+                'size': size,
+                'etag': etag,
+                'bytes': os.path.getsize(cached_file),
+                'atime': time.time()
+            }
+        return cached_file
+
+    def evict(self):
+        """Remove the least recently used entries above the size limit."""
+        with self._lock:
+            total_bytes = sum(entry['bytes'] for entry in self.entries.values())
+            if total_bytes <= self.max_bytes:
+                return
+            for obj_name, entry in sorted(self.entries.items(), key=lambda item: item[1]['atime']):
+                if total_bytes <= self.max_bytes:
+                    break
+                try:
+                    os.remove(self.path_for(obj_name))
+                except FileNotFoundError:
+                    pass
+                total_bytes -= entry['bytes']
+                self.entries.pop(obj_name)
+                logging.info("Evicted kerchunk cache entry: %s", obj_name)
+
+    def save(self):
+        """Write the cache index to the cache directory."""
+        with self._lock:
+            tmp_file = f'{self.index_file}.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as jsonfile:
+                json.dump(self.entries, jsonfile)
+            os.replace(tmp_file, self.index_file)
@@ -0,0 +1,195 @@
+"""
+Combined kerchunk index (all.json) of a release folder.
+
+All the per-file kerchunk indexes of a release folder are combined into a
+single virtual dataset, so one `open_dataset` gives every variable of the
+release. The files are grouped with the CEFI filename parser
+(`s3_catalog.parse_object_key`):
+
+- forecast/reforecast files carry the initialization month
+  (ex: `.i199401.`) and are concatenated along `init_time`
+- hindcast files are concatenated along `time`
+
+Variables are merged across files. The dimensions that are identical in
+every file are inferred from the grid type (`raw` uses the model grid
+xh/yh, `regrid` uses lat/lon) and from the experiment (forecast files
+also share `lead` and `member`). Static grid files are left out because
+they do not share the concatenation dimension.
+
+"""
+
+import json
+import logging
+from datetime import datetime
+from s3_catalog import parse_object_key, RELEASE_PATTERN
+
+COMBINED_INDEX_NAME = 'all.json'
+
+# json files in a release folder that are not per-file kerchunk indexes
+NON_REFERENCE_FILES = (COMBINED_INDEX_NAME, 'manifest.json', 'catalog.json')
+
+# dimensions shared by every file of a grid type
+GRID_IDENTICAL_DIMS = {
+    'raw': ['yh', 'xh', 'yq', 'xq'],
+    'regrid': ['lat', 'lon'],
+}
+
+# dimensions shared by every file of a forecast experiment
+FORECAST_IDENTICAL_DIMS = ['lead', 'member']
+
+
+def is_reference_key(key: str, combined: bool = False) -> bool:
+    """Check that an object key (or path) is a kerchunk index of a release folder
+
+    Only json files directly in an rYYYYMMDD folder are references, so the
+    zarr metadata (`zarr/.../zarr.json`), the catalog and the manifests
+    are never taken for one.
+
+    Parameters
+    ----------
+    key : str
+        object key or local path of a file
+    combined : bool
+        also accept the combined index of the release (all.json)
+
+    Returns
+    -------
+    bool
+        True for a per-file index (or the combined index when combined is True)
+    """
+    parent_dir, _, filename = key.rpartition('/')
+    if not filename.endswith('.json') or not RELEASE_PATTERN.match(parent_dir.rpartition('/')[2]):
+        return False
+    if combined and filename == COMBINED_INDEX_NAME:
+        return True
+    return filename not in NON_REFERENCE_FILES
+
+
+def select_reference_files(json_keys: list) -> list:
+    """Keep the per-file kerchunk indexes that can be combined
+
+    Parameters
+    ----------
+    json_keys : list
+        object names of the json files in a release folder
+
+    Returns
+    -------
+    list
+        parsed fields (see `parse_object_key`) of the selected indexes
+    """
+    selected = []
+    for key in json_keys:
+        if not is_reference_key(key):
+            continue
+        fields = parse_object_key(key)
+        if fields is None:
+            continue
+        if 'static' in fields['filename']:
+            continue
+        selected.append(fields)
+    return sorted(selected, key=lambda fields: fields['key'])
+
+
+def combine_options(list_fields: list) -> dict:
+    """Infer the MultiZarrToZarr options of a release from its parsed file names
+
+    Parameters
+    ----------
+    list_fields : list
+        parsed fields of the per-file indexes (see `select_reference_files`)
+
+    Returns
+    -------
+    dict
+        keyword arguments for MultiZarrToZarr
+        (concat_dims, identical_dims and the init_time mapping for forecasts)
+    """
+    grid_type = list_fields[0]['grid_type']
+    identical_dims = list(GRID_IDENTICAL_DIMS.get(grid_type, []))
+
+    if all(fields['init'] for fields in list_fields):
+        import numpy as np
+
+        # init month from the file name (ex: .i199401.), in the input order
+        init_times = [
+            datetime.strptime(fields['init'] + '01', '%Y%m%d')
+            for fields in list_fields
+        ]
+
+        def fn_to_time(index, fs, var, fn):
+            return init_times[index]
+
+        return {
+            'concat_dims': ['init_time'],
+            'coo_map': {'init_time': fn_to_time},
+            'coo_dtypes': {'init_time': np.dtype('M8[ns]')},
+            'identical_dims': identical_dims + FORECAST_IDENTICAL_DIMS,
+        }
+
+    return {
+        'concat_dims': ['time'],
+        'identical_dims': identical_dims,
+    }
+
+
+def build_combined_index(
+    release_prefix: str,
+    s3_bucket_name: str,
+    json_file: str,
+    server: str = 's3',
+):
+    """Combine the per-file kerchunk indexes of a release folder
+
+    Parameters
+    ----------
+    release_prefix : str
+        release folder object prefix (ex: 'northwest_atlantic/.../regrid/r20250212')
+    s3_bucket_name : str
+        S3 bucket name
+    json_file : str
+        local path of the combined index file
+    server : str
+        The cloud storage server to use (default: 's3')
+
+    Returns
+    -------
+    str or None
+        json_file, None if the release has no index to combine
+    """
+    import fsspec
+    from kerchunk.combine import MultiZarrToZarr
+
+    fs_read = fsspec.filesystem(server, anon=True)
+    release_prefix = release_prefix.rstrip('/')
+    json_paths = fs_read.glob(f'{s3_bucket_name}/{release_prefix}/*.json')
+    list_fields = select_reference_files(
+        [path.removeprefix(f'{s3_bucket_name}/') for path in json_paths]
+    )
+    if not list_fields:
+        logging.info("No kerchunk index to combine in %s", release_prefix)
+        return None
+
+    for fields in list_fields:
+        fields['url'] = f"{server}://{s3_bucket_name}/{fields['key']}"
+
+    options = combine_options(list_fields)
+    logging.info(
+        "Combining %s kerchunk indexes in %s along %s",
+        len(list_fields), release_prefix, options['concat_dims']
+    )
+    # references loaded here: MultiZarrToZarr reads json urls through an
+    #  asynchronous filesystem instance that fails outside an event loop
+    references = fs_read.cat([fields['url'] for fields in list_fields])
+    mzz = MultiZarrToZarr(
+        [json.loads(references[fields['url'].split('://', 1)[1]]) for fields in list_fields],
+        remote_protocol=server,
+        remote_options={'anon': True},
+        target_options={'anon': True},
+        **options
+    )
+
+    with open(json_file, 'wb') as f:
+        f.write(json.dumps(mzz.translate()).encode())
+
+    return json_file
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Rewrite the data URLs of kerchunk references for another mirror of the data.
+
+The AWS bucket, the GCS bucket and the PSL THREDDS file server hold the same
+netcdf bytes under the same relative paths, so a reference generated for one
+of them only needs its URL prefix (and protocol) changed to be used with
+another one. This avoids re-indexing every file for each cloud.
+
+Both reference formats are handled:
+- JSON references (per-file indexes and the combined `all.json`)
+- Parquet references (directory with `.zmetadata` and `refs.*.parq` files)
+
+Reference files are rewritten one at a time by each worker, so the memory
+used is bounded by the number of workers times the size of one reference
+file. The rewritten references are written to a local directory laid out
+like the bucket, ready for `s3_small_upload.py` or the GCS upload.
+
+Usage:
+    python kerchunk_rewrite.py --src s3://noaa-oar-cefi-regional-mom6-pds/northwest_atlantic/full_domain/hindcast/monthly/regrid/r20250212/ \\
+        --dst ./gcs_kerchunk_json --source s3 --target gcs
+    python kerchunk_rewrite.py --src ./s3_kerchunk_json --dst ./thredds_json --source s3 --target thredds
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import fsspec
+from kerchunk_combine import is_reference_key
+
+# URL prefixes of the mirrors (the object keys are the same on every mirror)
+MIRROR_PREFIXES = {
+    's3': 's3://noaa-oar-cefi-regional-mom6-pds/',
+    'gcs': 'gs://noaa-oar-cefi-regional-mom6/',
+    'thredds': 'https://psl.noaa.gov/thredds/fileServer/Projects/CEFI/regional_mom6/cefi_portal/',
+}
+
+# other spellings of the mirror prefixes found in references
+# (HDF5 references store 'bucket/key' without protocol)
+MIRROR_PREFIX_VARIANTS = {
+    's3': ('s3://noaa-oar-cefi-regional-mom6-pds/', 'noaa-oar-cefi-regional-mom6-pds/'),
+    'gcs': (
+        'gs://noaa-oar-cefi-regional-mom6/',
+        'gcs://noaa-oar-cefi-regional-mom6/',
+        'noaa-oar-cefi-regional-mom6/'
+    ),
+    'thredds': (
+        'https://psl.noaa.gov/thredds/fileServer/Projects/CEFI/regional_mom6/cefi_portal/',
+        'http://psl.noaa.gov/thredds/fileServer/Projects/CEFI/regional_mom6/cefi_portal/',
+    ),
+}
+
+DEFAULT_WORKERS = 16
+
+PARQUET_METADATA = '.zmetadata'
+
+
+def rewrite_url(url: str, source: str, target: str):
+    """Change the mirror prefix of a URL
+
+    Parameters
+    ----------
+    url : str
+        data URL of a reference
+    source : str
+        mirror of the URL ('s3', 'gcs' or 'thredds')
+    target : str
+        mirror of the rewritten URL
+
+    Returns
+    -------
+    str or None
+        rewritten URL, None if the URL does not belong to the source mirror
+    """
+    for prefix in MIRROR_PREFIX_VARIANTS[source]:
+        if url.startswith(prefix):
+            return MIRROR_PREFIXES[target] + url[len(prefix):]
+    return None
+
+
+def rewrite_refs(refs: dict, templates: dict, source: str, target: str) -> dict:
+    """Rewrite the URLs of a kerchunk `refs` mapping in place
+
+    Returns
+    -------
+    dict
+        {'rewritten': n, 'skipped': n} counts of the data references
+    """
+    counts = {'rewritten': 0, 'skipped': 0}
+
+    for name, url in templates.items():
+        new_url = rewrite_url(url, source, target)
+        if new_url is not None:
+            templates[name] = new_url
+
+    for key, value in refs.items():
+        if not isinstance(value, list) or not value or '{{' in value[0]:
+            # inlined data, metadata or templated URL (rewritten with the templates)
+            continue
+        new_url = rewrite_url(value[0], source, target)
+        if new_url is None:
+            counts['skipped'] += 1
+            continue
+        refs[key] = [new_url] + value[1:]
+        counts['rewritten'] += 1
+    return counts
+
+
+def rewrite_json_reference(fs, src_path: str, dst_path: str, source: str, target: str) -> dict:
+    """Rewrite a JSON reference file
+
+    Parameters
+    ----------
+    fs : fsspec.AbstractFileSystem
+        filesystem of the source reference
+    src_path : str
+        source reference path on fs
+    dst_path : str
+        local path of the rewritten reference
+    source, target : str
+        mirrors (see `rewrite_url`)
+
+    Returns
+    -------
+    dict
+        counts of rewritten and skipped references
+    """
+    with fs.open(src_path, 'rb') as f:
+        reference = json.load(f)
+
+    if 'refs' in reference:
+        counts = rewrite_refs(reference['refs'], reference.setdefault('templates', {}), source, target)
+    else:
+        # version 0 references are the refs mapping itself
+        counts = rewrite_refs(reference, {}, source, target)
+
+    os.makedirs(os.path.dirname(dst_path) or '.', exist_ok=True)
+    tmp_path = f'{dst_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(reference, f)
+    os.replace(tmp_path, dst_path)
+    return counts
+
+
+def rewrite_parquet_reference(fs, src_dir: str, dst_dir: str, source: str, target: str) -> dict:
+    """Rewrite a Parquet reference directory (one `refs.*.parq` file at a time)
+
+    Parameters
+    ----------
+    fs : fsspec.AbstractFileSystem
+        filesystem of the source reference
+    src_dir : str
+        source reference directory on fs (contains `.zmetadata`)
+    dst_dir : str
+        local directory of the rewritten reference
+    source, target : str
+        mirrors (see `rewrite_url`)
+
+    Returns
+    -------
+    dict
+        counts of rewritten and skipped references
+    """
+    import pandas as pd
+
+    counts = {'rewritten': 0, 'skipped': 0}
+    for src_path in fs.find(src_dir):
+        dst_path = os.path.join(dst_dir, os.path.relpath(src_path, src_dir))
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        if not src_path.endswith('.parq'):
+            fs.get(src_path, dst_path)
+            continue
+
+        with fs.open(src_path, 'rb') as f:
+            table = pd.read_parquet(f)
+        paths = table['path'].astype(object)
+        new_paths = paths.map(
+            lambda url: rewrite_url(url, source, target) if isinstance(url, str) else None
+        )
+        has_url = paths.notna()
+        counts['skipped'] += int((has_url & new_paths.isna()).sum())
+        counts['rewritten'] += int(new_paths.notna().sum())
+        table['path'] = new_paths.where(new_paths.notna(), paths)
+        table.to_parquet(dst_path, index=False)
+    return counts
+
+
+def find_references(fs, root: str) -> list:
+    """List the JSON reference files and Parquet reference directories under root
+
+    Returns
+    -------
+    list
+        (kind, path) tuples, kind is 'json' or 'parquet'
+    """
+    paths = sorted(fs.find(root))
+    parquet_dirs = [
+        path.rsplit('/', 1)[0] for path in paths if path.endswith(f'/{PARQUET_METADATA}')
+    ]
+
+    references = [('parquet', path) for path in parquet_dirs]
+    for path in paths:
+        if not is_reference_key(path, combined=True):
+            continue
+        if any(path.startswith(f'{parquet_dir}/') for parquet_dir in parquet_dirs):
+            continue
+        references.append(('json', path))
+    return references
+
+
+def rewrite_references(src: str, dst: str, source: str, target: str, max_workers: int = DEFAULT_WORKERS) -> dict:
+    """Rewrite every reference under src into dst, in parallel
+
+    Parameters
+    ----------
+    src : str
+        local directory or bucket URL of the references (ex: a release folder)
+    dst : str
+        local output directory (same relative layout as src)
+    source, target : str
+        mirrors (see `rewrite_url`)
+    max_workers : int
+        number of reference files rewritten concurrently
+
+    Returns
+    -------
+    dict
+        totals of the rewrite and the list of failed reference files
+    """
+    storage_options = {'anon': True} if '://' in src else {}
+    fs, root = fsspec.core.url_to_fs(src, **storage_options)
+    root = root.rstrip('/')
+
+    references = find_references(fs, root)
+    logging.info("Rewriting %s references from %s to %s: %s", len(references), source, target, src)
+
+    totals = {'references': 0, 'rewritten': 0, 'skipped': 0, 'failed': []}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for kind, path in references:
+            dst_path = os.path.join(dst, os.path.relpath(path, root))
+            rewrite = rewrite_parquet_reference if kind == 'parquet' else rewrite_json_reference
+            futures[executor.submit(rewrite, fs, path, dst_path, source, target)] = path
+
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                counts = future.result()
+            except Exception as e:
+                logging.error("Error rewriting %s: %s", path, e)
+                totals['failed'].append(path)
+                continue
+            totals['references'] += 1
+            totals['rewritten'] += counts['rewritten']
+            totals['skipped'] += counts['skipped']
+            if counts['skipped']:
+                logging.warning("%s: %s URLs not on the %s mirror left as is", path, counts['skipped'], source)
+
+    logging.info(
+        "Rewrite complete: %s references, %s URLs rewritten, %s skipped, %s failed",
+        totals['references'], totals['rewritten'], totals['skipped'], len(totals['failed'])
+    )
+    return totals
+
+
+def main():
+    """Main function with command line argument parsing"""
+
+    parser = argparse.ArgumentParser(description='Rewrite kerchunk reference URLs for another mirror')
+    parser.add_argument('--src', type=str, required=True,
+                        help='Local directory or bucket URL of the references')
+    parser.add_argument('--dst', type=str, required=True,
+                        help='Local output directory')
+    parser.add_argument('--source', type=str, choices=sorted(MIRROR_PREFIXES), default='s3',
+                        help='Mirror the references point to (default: s3)')
+    parser.add_argument('--target', type=str, choices=sorted(MIRROR_PREFIXES), required=True,
+                        help='Mirror the rewritten references point to')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f'Reference files rewritten concurrently (default: {DEFAULT_WORKERS})')
+    parser.add_argument('--log-file', type=str, default='kerchunk_rewrite.log',
+                        help='Log file path (default: kerchunk_rewrite.log)')
+
+    args = parser.parse_args()
+
+    if args.source == args.target:
+        parser.error("--source and --target must be different mirrors")
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.FileHandler(args.log_file), logging.StreamHandler(sys.stdout)]
+    )
+
+    totals = rewrite_references(args.src, args.dst, args.source, args.target, max_workers=args.workers)
+    if totals['failed']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+Read-ahead remote file for the kerchunk indexing of objects in the bucket.
+
+`SingleHdf5ToZarr` walks the HDF5 metadata (superblock, object headers,
+B-tree nodes) with many reads of a few hundred bytes. Through a plain
+fsspec file each read that misses the file cache is one range GET.
+This file object reads the remote object in aligned blocks instead:
+
+- the head of the file (superblock and most of the metadata written by the
+  netcdf library) is fetched with one request when the file is opened
+- a read that misses the cache fetches the aligned blocks it covers,
+  contiguous missing blocks are fetched with one request, and missing
+  runs separated by a small gap are merged into one request
+
+The number of requests and the bytes fetched are counted in `stats`.
+
+"""
+
+import io
+import logging
+from collections import OrderedDict
+
+# size of the aligned blocks fetched on a cache miss
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+# bytes fetched from the start of the file when it is opened
+DEFAULT_PREFETCH_BYTES = 8 * 1024 * 1024
+
+# missing block runs separated by at most this many cached blocks are merged
+MERGE_GAP_BLOCKS = 2
+
+# size limit of the blocks kept in memory
+DEFAULT_MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+
+class ReadAheadFile(io.RawIOBase):
+    """Read-only block cached file object on an fsspec filesystem
+
+    Parameters
+    ----------
+    fs : fsspec.AbstractFileSystem
+        filesystem of the remote object (s3, gcs, https)
+    path : str
+        path of the object on fs
+    block_size : int
+        size of the aligned blocks fetched on a cache miss
+    prefetch_bytes : int
+        bytes fetched from the start of the file when it is opened
+    max_cache_bytes : int
+        size limit of the blocks kept in memory (least recently used evicted)
+    """
+
+    def __init__(
+        self,
+        fs,
+        path: str,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        prefetch_bytes: int = DEFAULT_PREFETCH_BYTES,
+        max_cache_bytes: int = DEFAULT_MAX_CACHE_BYTES,
+    ):
+        super().__init__()
+        self.fs = fs
+        self.path = path
+        self.size = fs.size(path)
+        self.block_size = block_size
+        self.max_blocks = max(1, max_cache_bytes // block_size)
+        self.blocks = OrderedDict()
+        self.loc = 0
+        self.stats = {'requests': 0, 'bytes_fetched': 0, 'reads': 0, 'bytes_read': 0}
+
+        if prefetch_bytes > 0 and self.size > 0:
+            self._fetch(0, (min(prefetch_bytes, self.size) - 1) // block_size)
+
+    def _fetch(self, first: int, last: int):
+        """Fetch blocks first to last (inclusive) with one range request."""
+        start = first * self.block_size
+        end = min((last + 1) * self.block_size, self.size)
+        data = self.fs.cat_file(self.path, start=start, end=end)
+        self.stats['requests'] += 1
+        self.stats['bytes_fetched'] += len(data)
+
+        for block in range(first, last + 1):
+            offset = (block - first) * self.block_size
+            self.blocks[block] = data[offset:offset + self.block_size]
+            self.blocks.move_to_end(block)
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+
+    def _ensure(self, first: int, last: int):
+        """Make sure blocks first to last are cached, merging nearby missing runs."""
+        runs = []
+        for block in range(first, last + 1):
+            if block in self.blocks:
+                self.blocks.move_to_end(block)
+                continue
+            if runs and block - runs[-1][1] - 1 <= MERGE_GAP_BLOCKS:
+                runs[-1][1] = block
+            else:
+                runs.append([block, block])
+        for run_first, run_last in runs:
+            self._fetch(run_first, run_last)
+
+    def readinto(self, b) -> int:
+        n_bytes = min(len(b), self.size - self.loc)
+        if n_bytes <= 0:
+            return 0
+        first = self.loc // self.block_size
+        last = (self.loc + n_bytes - 1) // self.block_size
+        self._ensure(first, last)
+
+        view = memoryview(b)
+        written = 0
+        while written < n_bytes:
+            block, offset = divmod(self.loc + written, self.block_size)
+            data = self.blocks.get(block)
+            if data is None:
+                # evicted by a read larger than the cache
+                self._fetch(block, block)
+                data = self.blocks[block]
+            chunk = data[offset:offset + n_bytes - written]
+            view[written:written + len(chunk)] = chunk
+            written += len(chunk)
+
+        self.loc += n_bytes
+        self.stats['reads'] += 1
+        self.stats['bytes_read'] += n_bytes
+        return n_bytes
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.loc = offset
+        elif whence == io.SEEK_CUR:
+            self.loc += offset
+        elif whence == io.SEEK_END:
+            self.loc = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        return self.loc
+
+    def tell(self) -> int:
+        return self.loc
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def close(self):
+        if not self.closed:
+            logging.info(
+                "%s: %s reads served with %s requests (%.2f MB fetched)",
+                self.path, self.stats['reads'], self.stats['requests'],
+                self.stats['bytes_fetched'] / 1024**2
+            )
+            self.blocks.clear()
+        super().close()
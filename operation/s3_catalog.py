@@ -0,0 +1,347 @@
+"""
+Bucket catalog and per-release manifests of the CEFI data.
+
+Object keys follow the portal layout
+    region/subdomain/experiment/frequency/grid_type/release/filename
+ex:
+    northeast_pacific/full_domain/hindcast/daily/raw/r20250509/
+        tos.nep.full.hcast.daily.raw.r20250509.199301-201912.nc
+
+For every uploaded release folder a manifest is written next to the files
+(`manifest.json` and, when pandas/pyarrow are available, `manifest.parquet`)
+with one entry per netcdf file. The top-level `catalog.json` lists every
+parent directory with its latest release and the release manifests, and
+`catalog.parquet` holds the manifest entries of all the latest releases.
+Tools can then find files with a single GET instead of listing the bucket.
+
+"""
+
+import re
+import json
+import logging
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+
+MANIFEST_NAME = 'manifest'
+CATALOG_NAME = 'catalog'
+
+# columns of the manifest entries (and of the parquet tables)
+MANIFEST_COLUMNS = [
+    'key', 'size', 'etag', 'sha256', 'reference',
+    'region', 'subdomain', 'experiment', 'frequency', 'grid_type',
+    'release', 'variable', 'init', 'time_range'
+]
+
+RELEASE_PATTERN = re.compile(r'^r\d{8}$')
+INIT_PATTERN = re.compile(r'\.i(\d{6})\.')
+TIME_RANGE_PATTERN = re.compile(r'\.(\d{6,8}-\d{6,8})\.')
+
+
+def parse_object_key(obj_name: str):
+    """Split a CEFI object key into its catalog fields
+
+    Parameters
+    ----------
+    obj_name : str
+        object name (ex: 'northeast_pacific/full_domain/hindcast/daily/raw/r20250509/tos...nc')
+
+    Returns
+    -------
+    dict or None
+        {'key', 'region', 'subdomain', 'experiment', 'frequency', 'grid_type',
+        'release', 'variable', 'init', 'time_range', 'filename'}
+        None if the key does not follow the portal layout
+    """
+    parts = obj_name.split('/')
+    if len(parts) < 7 or not RELEASE_PATTERN.match(parts[-2]):
+        return None
+
+    filename = parts[-1]
+    init = INIT_PATTERN.search(filename)
+    time_range = TIME_RANGE_PATTERN.search(filename)
+    return {
+        'key': obj_name,
+        'region': parts[-7],
+        'subdomain': parts[-6],
+        'experiment': parts[-5],
+        'frequency': parts[-4],
+        'grid_type': parts[-3],
+        'release': parts[-2],
+        'variable': filename.split('.')[0],
+        'init': init.group(1) if init else None,
+        'time_range': time_range.group(1) if time_range else None,
+        'filename': filename,
+    }
+
+
+def list_release_objects(release_prefix: str, s3_bucket_name: str, s3_client) -> list:
+    """List all objects of a release folder
+
+    Parameters
+    ----------
+    release_prefix : str
+        release folder object prefix (ex: 'northeast_pacific/.../raw/r20250509')
+    s3_bucket_name : str
+        S3 bucket name
+    s3_client : _type_
+        boto3 S3 client object
+
+    Returns
+    -------
+    list
+        list of boto3 object dictionaries ('Key', 'Size', 'ETag', ...)
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    objects = []
+    for page in paginator.paginate(Bucket=s3_bucket_name, Prefix=release_prefix.rstrip('/') + '/'):
+        objects.extend(page.get('Contents', []))
+    return objects
+
+
+def build_release_manifest(objects: list, checksums: dict = None) -> list:
+    """Build the manifest entries of a release from its object listing
+
+    Parameters
+    ----------
+    objects : list
+        boto3 object dictionaries of the release folder
+    checksums : dict, optional
+        {object name: sha256} of the files hashed by the uploader
+
+    Returns
+    -------
+    list
+        one manifest entry (dict with MANIFEST_COLUMNS) per netcdf file
+    """
+    checksums = checksums or {}
+    keys = {obj['Key'] for obj in objects}
+    entries = []
+    for obj in objects:
+        if not obj['Key'].endswith('.nc'):
+            continue
+        fields = parse_object_key(obj['Key'])
+        if fields is None:
+            continue
+        json_key = obj['Key'].removesuffix('.nc') + '.json'
+        fields.pop('filename')
+        fields.update(
+            size=obj['Size'],
+            etag=obj['ETag'].strip('"'),
+            sha256=checksums.get(obj['Key']),
+            reference=json_key if json_key in keys else None
+        )
+        entries.append({column: fields[column] for column in MANIFEST_COLUMNS})
+    return sorted(entries, key=lambda entry: entry['key'])
+
+
+def _put_json(obj_name: str, content, s3_bucket_name: str, s3_client):
+    s3_client.put_object(
+        Bucket=s3_bucket_name,
+        Key=obj_name,
+        Body=json.dumps(content, separators=(',', ':')).encode(),
+        ContentType='application/json'
+    )
+
+
+def _put_parquet(obj_name: str, entries: list, s3_bucket_name: str, s3_client) -> bool:
+    """Upload entries as a parquet table, skipped if pandas/pyarrow are missing."""
+    try:
+        import io
+        import pandas as pd
+        buffer = io.BytesIO()
+        pd.DataFrame(entries, columns=MANIFEST_COLUMNS).to_parquet(
+            buffer, index=False, compression='zstd'
+        )
+    except ImportError as e:
+        logging.warning("Parquet output skipped for %s: %s", obj_name, e)
+        return False
+    s3_client.put_object(
+        Bucket=s3_bucket_name,
+        Key=obj_name,
+        Body=buffer.getvalue(),
+        ContentType='application/vnd.apache.parquet'
+    )
+    return True
+
+
+def write_release_manifest(
+    release_prefix: str,
+    s3_bucket_name: str,
+    s3_client,
+    checksums: dict = None,
+) -> dict:
+    """Write the manifest of a release folder to the bucket
+
+    Parameters
+    ----------
+    release_prefix : str
+        release folder object prefix (ex: 'northeast_pacific/.../raw/r20250509')
+    s3_bucket_name : str
+        S3 bucket name
+    s3_client : _type_
+        boto3 S3 client object
+    checksums : dict, optional
+        {object name: sha256} of the files hashed by the uploader
+
+    Returns
+    -------
+    dict
+        release summary used by `update_catalog`
+        {'parent', 'release', 'manifest', 'files', 'bytes', 'entries'}
+    """
+    release_prefix = release_prefix.rstrip('/')
+    objects = list_release_objects(release_prefix, s3_bucket_name, s3_client)
+    entries = build_release_manifest(objects, checksums)
+
+    manifest_key = f'{release_prefix}/{MANIFEST_NAME}.json'
+    _put_json(manifest_key, entries, s3_bucket_name, s3_client)
+    _put_parquet(f'{release_prefix}/{MANIFEST_NAME}.parquet', entries, s3_bucket_name, s3_client)
+    logging.info("Manifest written: %s (%s files)", manifest_key, len(entries))
+
+    parent, _, release = release_prefix.rpartition('/')
+    return {
+        'parent': parent,
+        'release': release,
+        'manifest': manifest_key,
+        'files': len(entries),
+        'bytes': sum(entry['size'] for entry in entries),
+        'entries': entries,
+    }
+
+
+def load_catalog(s3_bucket_name: str, s3_client) -> dict:
+    """Read the top-level catalog from the bucket (empty catalog if missing)."""
+    try:
+        response = s3_client.get_object(Bucket=s3_bucket_name, Key=f'{CATALOG_NAME}.json')
+        return json.loads(response['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            raise
+        return {'parents': {}}
+
+
+def update_catalog(release_summaries: list, s3_bucket_name: str, s3_client) -> dict:
+    """Merge release summaries into the top-level catalog and write it to the bucket
+
+    Parameters
+    ----------
+    release_summaries : list
+        summaries returned by `write_release_manifest`
+    s3_bucket_name : str
+        S3 bucket name
+    s3_client : _type_
+        boto3 S3 client object
+
+    Returns
+    -------
+    dict
+        the updated catalog
+        ex:
+        catalog = {
+            'updated': '2025-05-09T12:00:00+00:00',
+            'parents': {
+                parent_dir: {
+                    'latest_release': 'r20250509',
+                    'latest_prefix': 'parent_dir/r20250509',
+                    'releases': {
+                        'r20250509': {'manifest': key, 'files': 10, 'bytes': 1234},
+                        ...
+                    }
+                },
+                ...
+            }
+        }
+    """
+    catalog = load_catalog(s3_bucket_name, s3_client)
+    parents = catalog.setdefault('parents', {})
+
+    for summary in release_summaries:
+        parent = parents.setdefault(summary['parent'], {'releases': {}})
+        parent['releases'][summary['release']] = {
+            'manifest': summary['manifest'],
+            'files': summary['files'],
+            'bytes': summary['bytes'],
+        }
+        latest_release = max(parent['releases'])
+        parent['latest_release'] = latest_release
+        parent['latest_prefix'] = f"{summary['parent']}/{latest_release}"
+
+    catalog['updated'] = datetime.now(timezone.utc).isoformat()
+    _put_json(f'{CATALOG_NAME}.json', catalog, s3_bucket_name, s3_client)
+
+    # flat table of every file in the latest releases
+    _write_catalog_parquet(parents, release_summaries, s3_bucket_name, s3_client)
+
+    logging.info("Catalog updated: %s parent directories", len(parents))
+    return catalog
+
+
+def _write_catalog_parquet(parents: dict, release_summaries: list, s3_bucket_name: str, s3_client):
+    """Rewrite catalog.parquet from the latest release manifests of the catalog parents
+
+    The entries of the releases in release_summaries are used directly,
+    the other manifests are read from the bucket. Without pandas/pyarrow
+    the parquet copy cannot be rewritten and is deleted instead of being
+    left out of date.
+    """
+    latest_entries = []
+    summaries_by_prefix = {
+        f"{summary['parent']}/{summary['release']}": summary for summary in release_summaries
+    }
+    for parent_dir, parent in sorted(parents.items()):
+        summary = summaries_by_prefix.get(parent['latest_prefix'])
+        if summary is not None:
+            latest_entries.extend(summary['entries'])
+            continue
+        manifest_key = parent['releases'][parent['latest_release']]['manifest']
+        try:
+            response = s3_client.get_object(Bucket=s3_bucket_name, Key=manifest_key)
+            latest_entries.extend(json.loads(response['Body'].read()))
+        except ClientError as e:
+            logging.error("Error reading manifest %s of %s: %s", manifest_key, parent_dir, e)
+    if not _put_parquet(f'{CATALOG_NAME}.parquet', latest_entries, s3_bucket_name, s3_client):
+        s3_client.delete_object(Bucket=s3_bucket_name, Key=f'{CATALOG_NAME}.parquet')
+
+
+def drop_catalog_releases(releases: list, s3_bucket_name: str, s3_client) -> dict:
+    """Remove deleted releases from the top-level catalog
+
+    catalog.json and catalog.parquet are both rewritten when a release
+    was removed (the parquet copy follows the new latest releases).
+
+    Parameters
+    ----------
+    releases : list
+        (parent_dir, release) tuples of the deleted releases
+    s3_bucket_name : str
+        S3 bucket name
+    s3_client : _type_
+        boto3 S3 client object
+
+    Returns
+    -------
+    dict
+        the updated catalog
+    """
+    catalog = load_catalog(s3_bucket_name, s3_client)
+    parents = catalog.setdefault('parents', {})
+
+    dropped = 0
+    for parent_dir, release in releases:
+        parent = parents.get(parent_dir)
+        if parent is None or parent['releases'].pop(release, None) is None:
+            continue
+        dropped += 1
+        if not parent['releases']:
+            del parents[parent_dir]
+            continue
+        latest_release = max(parent['releases'])
+        parent['latest_release'] = latest_release
+        parent['latest_prefix'] = f'{parent_dir}/{latest_release}'
+
+    if dropped:
+        catalog['updated'] = datetime.now(timezone.utc).isoformat()
+        _put_json(f'{CATALOG_NAME}.json', catalog, s3_bucket_name, s3_client)
+        _write_catalog_parquet(parents, [], s3_bucket_name, s3_client)
+    logging.info("Catalog: %s deleted releases removed", dropped)
+    return catalog
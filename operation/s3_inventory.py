@@ -0,0 +1,657 @@
+#!/usr/bin/env python3
+"""
+Compact inventory of the objects of a bucket prefix
+
+`scan_prefix` keeps every listed object as the boto3 dict (key, size,
+datetime, ETag, storage class strings), several hundred bytes per object,
+and the retention and audit loops run over these dicts in Python. The
+inventory keeps only what they need:
+
+- keys in listing (sorted) order, front coded: every FRONT_CODING_BLOCK-th
+  key is stored whole, the others as the length shared with the previous
+  key plus the remaining bytes
+- sizes and modification times in NumPy int64 arrays
+- ETags as 16-byte MD5 digests plus the number of parts of multipart ETags
+- the (parent directory, rYYYYMMDD release) of every key as an index into
+  a table of releases, so grouping and totals per release are NumPy
+  operations (argsort, bincount) instead of dict building
+
+Prefix queries are a binary search over the block head keys. The
+inventory is saved to a local .npz file, so a dry run followed by the
+actual run (or an audit after a retention) does not list the bucket again.
+
+Usage:
+    python s3_inventory.py --prefix "northeast_pacific/" --inventory cefi_inventory.npz
+    python s3_inventory.py --inventory cefi_inventory.npz --max-age 0   # always list again
+"""
+
+import os
+import re
+import json
+import time
+import bisect
+import logging
+import argparse
+import threading
+from array import array
+from collections.abc import Mapping
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Tuple
+import numpy as np
+from s3_remove_prefix import setup_logging, get_s3_client
+from s3_throttle import AdaptiveConcurrency
+
+# Configuration
+S3_BUCKET_NAME = 'noaa-oar-cefi-regional-mom6-pds'
+
+# keys per front coding block (a lookup decodes at most this many keys)
+FRONT_CODING_BLOCK = 16
+
+# age in seconds above which a saved inventory is listed again
+DEFAULT_MAX_AGE = 3600
+
+RELEASE_PATTERN = re.compile(r'^r\d{8}$')
+
+
+def split_release_key(key: str):
+    """Split an object key into (parent directory, release folder)
+
+    The release folder is the last rYYYYMMDD path segment of the key.
+
+    Returns:
+        Tuple of (parent_dir, release) or None if the key has no release folder
+    """
+    segments = key.split('/')[:-1]
+    for i in range(len(segments) - 1, -1, -1):
+        if RELEASE_PATTERN.match(segments[i]):
+            return '/'.join(segments[:i]), segments[i]
+    return None
+
+
+def _encode_etag(etag: str):
+    """
+    Split an ETag into its MD5 digest and number of parts
+
+    Returns:
+        Tuple of (16-byte digest, parts), parts is 0 for a single part ETag
+        and -1 (zero digest) for an ETag that is not MD5 based
+    """
+    digest, _, parts = (etag or '').strip('"').partition('-')
+    try:
+        encoded = bytes.fromhex(digest)
+        parts = int(parts) if parts else 0
+    except ValueError:
+        return bytes(16), -1
+    if len(encoded) != 16:
+        return bytes(16), -1
+    return encoded, parts
+
+
+def _decode_etag(digest: bytes, parts: int):
+    """ETag (without quotes) of an encoded digest, None if it was not recorded"""
+    if parts < 0:
+        return None
+    return digest.hex() + (f'-{parts}' if parts else '')
+
+
+def _shared_length(previous: bytes, key: bytes) -> int:
+    """Length of the common prefix of two byte strings (binary search on slices)"""
+    low, high = 0, min(len(previous), len(key))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if previous[:middle] == key[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+class _BlockHeads:
+    """Sequence of the block head keys (bytes) for bisect"""
+
+    def __init__(self, inventory):
+        self.inventory = inventory
+
+    def __len__(self) -> int:
+        return -(-len(self.inventory) // FRONT_CODING_BLOCK)
+
+    def __getitem__(self, block: int) -> bytes:
+        return self.inventory._suffix(block * FRONT_CODING_BLOCK)
+
+
+class ObjectInventory(Mapping):
+    """
+    Sorted, front coded object keys with NumPy sizes and modification times
+
+    The inventory is a read-only mapping of object key to object size
+    (iteration in key order), so it can replace the {key: size} listings.
+    `sizes`, `mtimes` (epoch seconds), `etags` (MD5 digests, one row of
+    16 bytes per key), `etag_parts` (parts of a multipart ETag, 0 for a
+    single part, -1 when unknown) and `groups` (release index, -1 for keys
+    outside a release folder) are arrays aligned with the key order.
+    """
+
+    def __init__(
+        self,
+        suffixes: bytes,
+        offsets: np.ndarray,
+        shared: np.ndarray,
+        sizes: np.ndarray,
+        mtimes: np.ndarray,
+        etags: np.ndarray,
+        etag_parts: np.ndarray,
+        groups: np.ndarray,
+        releases: List[Tuple[str, str]],
+        bucket: str = '',
+        prefix: str = '',
+        listed_at: float = None
+    ):
+        self._suffixes = suffixes
+        self._offsets = offsets
+        self._shared = shared
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self.etags = etags
+        self.etag_parts = etag_parts
+        self.groups = groups
+        self.releases = [tuple(release) for release in releases]
+        self.bucket = bucket
+        self.prefix = prefix
+        self.listed_at = time.time() if listed_at is None else listed_at
+        self._heads = _BlockHeads(self)
+        # last key looked up by each thread
+        #  (an audit looks up the same netcdf key for every chunk reference)
+        self._last_lookup = threading.local()
+
+    @classmethod
+    def from_objects(cls, objects: Iterable[Dict], bucket: str = '', prefix: str = '', listed_at: float = None):
+        """
+        Build an inventory from list_objects_v2 'Contents' entries
+
+        The entries are consumed one at a time (a generator over the listing
+        pages keeps only one page of dicts in memory). Entries that are not
+        in key order are sorted first.
+
+        Returns:
+            ObjectInventory
+        """
+        suffixes = bytearray()
+        offsets = array('q', [0])
+        shared = array('H')
+        sizes = array('q')
+        mtimes = array('q')
+        etags = bytearray()
+        etag_parts = array('i')
+        groups = array('i')
+        releases = []
+        release_index = {}
+        directory_group = {}
+
+        previous = b''
+        previous_key = None
+        objects = iter(objects)
+        for obj in objects:
+            key = obj['Key']
+            if previous_key is not None and key <= previous_key:
+                # not in key order: sort all the entries (last one of a key kept) and start again
+                entries = list(cls._objects_from_arrays(
+                    suffixes, offsets, shared, sizes, mtimes, etags, etag_parts
+                ))
+                entries.append(obj)
+                entries.extend(objects)
+                entries.sort(key=lambda entry: entry['Key'])
+                unique = {entry['Key']: entry for entry in entries}
+                return cls.from_objects(unique.values(), bucket, prefix, listed_at)
+            previous_key = key
+
+            encoded = key.encode('utf-8')
+            common = 0
+            if len(shared) % FRONT_CODING_BLOCK:
+                common = _shared_length(previous, encoded)
+            suffixes += encoded[common:]
+            offsets.append(len(suffixes))
+            shared.append(common)
+            previous = encoded
+
+            sizes.append(obj['Size'])
+            last_modified = obj.get('LastModified')
+            mtimes.append(int(last_modified.timestamp()) if last_modified is not None else 0)
+            digest, parts = _encode_etag(obj.get('ETag'))
+            etags += digest
+            etag_parts.append(parts)
+
+            # release of the key, resolved once per directory
+            directory = key.rpartition('/')[0]
+            group = directory_group.get(directory)
+            if group is None:
+                split = split_release_key(f'{directory}/')
+                group = -1
+                if split is not None:
+                    group = release_index.setdefault(split, len(releases))
+                    if group == len(releases):
+                        releases.append(split)
+                directory_group[directory] = group
+            groups.append(group)
+
+        return cls(
+            bytes(suffixes),
+            np.frombuffer(offsets, dtype=np.int64).copy(),
+            np.frombuffer(shared, dtype=np.uint16).copy(),
+            np.frombuffer(sizes, dtype=np.int64).copy(),
+            np.frombuffer(mtimes, dtype=np.int64).copy(),
+            np.frombuffer(bytes(etags), dtype=np.uint8).reshape(-1, 16),
+            np.frombuffer(etag_parts, dtype=np.int32).copy(),
+            np.frombuffer(groups, dtype=np.int32).copy(),
+            releases,
+            bucket=bucket,
+            prefix=prefix,
+            listed_at=listed_at
+        )
+
+    @staticmethod
+    def _objects_from_arrays(suffixes, offsets, shared, sizes, mtimes, etags, etag_parts) -> Iterator[Dict]:
+        """Decode the entries of the (not yet finalized) builder arrays"""
+        key = b''
+        for i in range(len(shared)):
+            key = key[:shared[i]] + bytes(suffixes[offsets[i]:offsets[i + 1]])
+            yield {
+                'Key': key.decode('utf-8'),
+                'Size': sizes[i],
+                'LastModified': datetime.fromtimestamp(mtimes[i], timezone.utc),
+                'ETag': _decode_etag(bytes(etags[16 * i:16 * (i + 1)]), etag_parts[i])
+            }
+
+    # ---- keys -------------------------------------------------------------
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def _suffix(self, index: int) -> bytes:
+        return self._suffixes[self._offsets[index]:self._offsets[index + 1]]
+
+    def _decode_range(self, start: int, stop: int) -> Iterator[bytes]:
+        """Keys start to stop (bytes), decoded from the block head of start"""
+        key = b''
+        for i in range(start - start % FRONT_CODING_BLOCK, stop):
+            key = key[:self._shared[i]] + self._suffix(i)
+            if i >= start:
+                yield key
+
+    def key(self, index: int) -> str:
+        """Object key at a position of the inventory"""
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return next(self._decode_range(index, index + 1)).decode('utf-8')
+
+    def iter_keys(self, start: int = 0, stop: int = None) -> Iterator[str]:
+        """Object keys from position start to stop (in key order)"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        for key in self._decode_range(start, stop):
+            yield key.decode('utf-8')
+
+    def keys_at(self, indices: Iterable[int]) -> Iterator[str]:
+        """Object keys at increasing positions (one forward decoding pass per block)"""
+        position, key = -1, b''
+        for index in indices:
+            index = int(index)
+            if index < position or index // FRONT_CODING_BLOCK != position // FRONT_CODING_BLOCK:
+                position, key = index - index % FRONT_CODING_BLOCK - 1, b''
+            while position < index:
+                position += 1
+                key = key[:self._shared[position]] + self._suffix(position)
+            yield key.decode('utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        return self.iter_keys()
+
+    def lower_bound(self, key: str) -> int:
+        """Position of the first key >= key"""
+        encoded = key.encode('utf-8')
+        block = bisect.bisect_right(self._heads, encoded) - 1
+        if block < 0:
+            return 0
+        start = block * FRONT_CODING_BLOCK
+        stop = min(start + FRONT_CODING_BLOCK, len(self))
+        for i, decoded in enumerate(self._decode_range(start, stop), start=start):
+            if decoded >= encoded:
+                return i
+        return stop
+
+    def index_of(self, key: str) -> int:
+        """Position of a key, -1 if the key is not in the inventory"""
+        last_key, last_index = getattr(self._last_lookup, 'entry', (None, -1))
+        if key == last_key:
+            return last_index
+        index = self.lower_bound(key)
+        if index >= len(self) or self.key(index) != key:
+            index = -1
+        self._last_lookup.entry = (key, index)
+        return index
+
+    def __contains__(self, key) -> bool:
+        return isinstance(key, str) and self.index_of(key) >= 0
+
+    def __getitem__(self, key: str) -> int:
+        index = self.index_of(key)
+        if index < 0:
+            raise KeyError(key)
+        return int(self.sizes[index])
+
+    def etag(self, index: int):
+        """ETag (without quotes) of the object at a position, None if not listed with one"""
+        return _decode_etag(self.etags[index].tobytes(), int(self.etag_parts[index]))
+
+    def prefix_range(self, prefix: str) -> Tuple[int, int]:
+        """
+        Positions of the keys starting with prefix
+
+        Returns:
+            Tuple of (start, stop), the keys are iter_keys(start, stop)
+        """
+        if not prefix:
+            return 0, len(self)
+        start = self.lower_bound(prefix)
+        # first key after every key starting with prefix
+        stop = self.lower_bound(prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        return start, stop
+
+    # ---- objects and subsets ---------------------------------------------
+
+    def objects(self, indices: Iterable[int] = None) -> List[Dict]:
+        """
+        list_objects_v2 like entries ({'Key', 'Size', 'LastModified', 'ETag'}) of some positions
+
+        The positions must be increasing (all the objects when None).
+
+        Returns:
+            List of object dictionaries
+        """
+        indices = range(len(self)) if indices is None else indices
+        return [
+            {
+                'Key': key,
+                'Size': int(self.sizes[index]),
+                'LastModified': datetime.fromtimestamp(int(self.mtimes[index]), timezone.utc),
+                'ETag': self.etag(index)
+            }
+            for index, key in zip(indices, self.keys_at(indices))
+        ]
+
+    def subset(self, indices: Iterable[int], prefix: str = None):
+        """
+        Inventory of the objects at increasing positions
+
+        Returns:
+            ObjectInventory
+        """
+        return ObjectInventory.from_objects(
+            self.objects(indices),
+            bucket=self.bucket,
+            prefix=self.prefix if prefix is None else prefix,
+            listed_at=self.listed_at
+        )
+
+    def select(self, prefix: str):
+        """
+        Inventory of the objects under a prefix
+
+        Returns:
+            ObjectInventory (self when prefix selects every key)
+        """
+        start, stop = self.prefix_range(prefix)
+        if start == 0 and stop == len(self):
+            return self
+        return self.subset(range(start, stop), prefix=prefix)
+
+    def total_size(self, start: int = 0, stop: int = None) -> int:
+        """Bytes of the objects from position start to stop"""
+        return int(self.sizes[start:stop].sum())
+
+    # ---- releases ---------------------------------------------------------
+
+    def release_groups(self) -> Dict[str, Dict[str, np.ndarray]]:
+        """
+        Positions of the objects of every release folder
+
+        Returns:
+            Dictionary {parent_dir: {release: increasing positions (np.ndarray)}}
+        """
+        order = np.argsort(self.groups, kind='stable')
+        sorted_groups = self.groups[order]
+        group_ids, starts = np.unique(sorted_groups, return_index=True)
+        stops = np.append(starts[1:], len(order))
+
+        groups = {}
+        for group, start, stop in zip(group_ids, starts, stops):
+            if group < 0:
+                continue
+            parent_dir, release = self.releases[group]
+            groups.setdefault(parent_dir, {})[release] = order[start:stop]
+        return groups
+
+    def release_totals(self) -> Dict[Tuple[str, str], Tuple[int, int]]:
+        """
+        Number of objects and bytes of every release folder
+
+        Returns:
+            Dictionary {(parent_dir, release): (object count, bytes)}
+        """
+        in_release = self.groups >= 0
+        counts = np.bincount(self.groups[in_release], minlength=len(self.releases))
+        sizes = np.bincount(
+            self.groups[in_release], weights=self.sizes[in_release], minlength=len(self.releases)
+        )
+        return {
+            release: (int(count), int(size))
+            for release, count, size in zip(self.releases, counts, sizes)
+            if count
+        }
+
+    # ---- persistence ------------------------------------------------------
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the keys and arrays"""
+        return len(self._suffixes) + sum(
+            array_.nbytes for array_ in (
+                self._offsets, self._shared, self.sizes, self.mtimes,
+                self.etags, self.etag_parts, self.groups
+            )
+        )
+
+    @property
+    def age(self) -> float:
+        """Seconds since the bucket was listed"""
+        return time.time() - self.listed_at
+
+    def save(self, path: str):
+        """Save the inventory to a .npz file (written next to it, then renamed)"""
+        meta = {
+            'bucket': self.bucket,
+            'prefix': self.prefix,
+            'listed_at': self.listed_at,
+            'releases': self.releases,
+            'block': FRONT_CODING_BLOCK,
+        }
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                meta=np.array(json.dumps(meta)),
+                suffixes=np.frombuffer(self._suffixes, dtype=np.uint8),
+                offsets=self._offsets,
+                shared=self._shared,
+                sizes=self.sizes,
+                mtimes=self.mtimes,
+                etags=self.etags,
+                etag_parts=self.etag_parts,
+                groups=self.groups
+            )
+        os.replace(tmp_path, path)
+        logging.info(f"Inventory of {len(self)} objects saved to {path}")
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Load an inventory saved by `save`
+
+        Returns:
+            ObjectInventory
+        """
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            if meta['block'] != FRONT_CODING_BLOCK:
+                raise ValueError(f"{path} was saved with front coding blocks of {meta['block']} keys")
+            return cls(
+                data['suffixes'].tobytes(),
+                data['offsets'],
+                data['shared'],
+                data['sizes'],
+                data['mtimes'],
+                data['etags'],
+                data['etag_parts'],
+                data['groups'],
+                meta['releases'],
+                bucket=meta['bucket'],
+                prefix=meta['prefix'],
+                listed_at=meta['listed_at']
+            )
+
+
+def iter_listing(
+        s3_client,
+        bucket_name: str,
+        prefix: str,
+        controller: AdaptiveConcurrency = None
+    ) -> Iterator[Dict]:
+    """
+    Objects under a prefix, one list_objects_v2 page in memory at a time
+
+    The page requests go through the adaptive concurrency controller
+    (shared backoff when S3 throttles), a private one when None.
+    """
+    controller = controller or AdaptiveConcurrency(initial=1, maximum=1, name='list')
+    page_args = {'Bucket': bucket_name, 'Prefix': prefix}
+    while True:
+        page = controller.call(s3_client.list_objects_v2, **page_args)
+        yield from page.get('Contents', [])
+        if not page.get('IsTruncated'):
+            break
+        page_args['ContinuationToken'] = page['NextContinuationToken']
+
+
+def scan_inventory(
+        s3_client,
+        bucket_name: str,
+        prefix: str,
+        controller: AdaptiveConcurrency = None
+    ) -> ObjectInventory:
+    """
+    List a prefix into an inventory
+
+    Returns:
+        ObjectInventory of the prefix
+    """
+    logging.info(f"Scanning prefix: {prefix}")
+    listed_at = time.time()
+    inventory = ObjectInventory.from_objects(
+        iter_listing(s3_client, bucket_name, prefix, controller),
+        bucket=bucket_name,
+        prefix=prefix,
+        listed_at=listed_at
+    )
+    logging.info(
+        f"Prefix '{prefix}' scan complete: {len(inventory)} objects, "
+        f"{inventory.total_size() / (1024**2):.2f} MB total "
+        f"({inventory.nbytes / (1024**2):.2f} MB inventory)"
+    )
+    return inventory
+
+
+def load_or_scan_inventory(
+        s3_client,
+        bucket_name: str,
+        prefix: str,
+        inventory_file: str = None,
+        max_age: float = DEFAULT_MAX_AGE,
+        controller: AdaptiveConcurrency = None
+    ) -> ObjectInventory:
+    """
+    Inventory of a prefix from the inventory file when it is recent enough
+
+    The saved inventory is used when it is of the same bucket, covers the
+    prefix (saved for the prefix or one of its parents) and is younger than
+    max_age seconds. Otherwise the prefix is listed and, with an
+    inventory_file, the new inventory is saved. A max_age of 0 always
+    lists the prefix.
+
+    Returns:
+        ObjectInventory of the prefix
+    """
+    if inventory_file and os.path.exists(inventory_file):
+        try:
+            inventory = ObjectInventory.load(inventory_file)
+            if (
+                inventory.bucket == bucket_name
+                and prefix.startswith(inventory.prefix)
+                and 0 < max_age
+                and inventory.age <= max_age
+            ):
+                logging.info(
+                    f"Using inventory {inventory_file} of '{inventory.prefix}' "
+                    f"({len(inventory)} objects, listed {inventory.age / 60:.1f} minutes ago)"
+                )
+                return inventory.select(prefix)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring inventory {inventory_file}: {e}")
+
+    inventory = scan_inventory(s3_client, bucket_name, prefix, controller)
+    if inventory_file:
+        inventory.save(inventory_file)
+    return inventory
+
+
+def invalidate_inventory(inventory_file: str = None):
+    """Remove an inventory file after the bucket was changed"""
+    if inventory_file and os.path.exists(inventory_file):
+        os.remove(inventory_file)
+        logging.info(f"Inventory {inventory_file} removed (bucket changed)")
+
+
+def main():
+    """Main function with command line argument parsing"""
+
+    parser = argparse.ArgumentParser(description='Compact inventory of the objects of an S3 prefix')
+    parser.add_argument('--prefix', type=str, default='',
+                        help='Prefix to list (default: whole bucket)')
+    parser.add_argument('--bucket', type=str, default=S3_BUCKET_NAME,
+                        help=f'S3 bucket name (default: {S3_BUCKET_NAME})')
+    parser.add_argument('--inventory', type=str, default='cefi_inventory.npz',
+                        help='Inventory file (default: cefi_inventory.npz)')
+    parser.add_argument('--max-age', type=float, default=DEFAULT_MAX_AGE / 60,
+                        help=f'Minutes before the inventory is listed again (default: {DEFAULT_MAX_AGE // 60})')
+    parser.add_argument('--log-file', type=str, default='s3_inventory.log',
+                        help='Log file path (default: s3_inventory.log)')
+
+    args = parser.parse_args()
+
+    setup_logging(args.log_file)
+
+    s3_client = get_s3_client()
+    inventory = load_or_scan_inventory(
+        s3_client, args.bucket, args.prefix, args.inventory, max_age=args.max_age * 60
+    )
+    s3_client.close()
+
+    totals = inventory.release_totals()
+    logging.info(f"{'='*60}")
+    for (parent_dir, release), (count, size) in sorted(totals.items()):
+        logging.info(f"{parent_dir}/{release:<12} {count:>6} objects ({size / (1024**2):>10.2f} MB)")
+    logging.info(f"{'='*60}")
+    logging.info(
+        f"TOTALS: {len(inventory)} objects, {inventory.total_size() / (1024**2):.2f} MB, "
+        f"{len(totals)} releases"
+    )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,527 @@
+"""
+Parallel mirror of the S3 bucket (or a prefix of it) to a local directory.
+
+The prefix is listed once and every object is compared to the local tree
+by size and ETag. Missing or changed objects are downloaded with parallel
+ranged GET requests written in place into a preallocated `<file>.part`
+file, which is renamed to the final name once complete. The object key
+is used as the relative local path, so mirroring into the portal root
+rebuilds the region/.../rYYYYMMDD/ layout `s3_upload.py` walks.
+
+Features:
+- ETag of the downloaded objects kept in a state file (`.s3_mirror_state.json`)
+  so unchanged files are not read again on the next run
+- Local files without state are checked by computing their S3 ETag
+  (multipart part size taken from the first part of the object)
+- Ranged GETs follow the multipart upload parts, every part is checked
+  against its MD5 and the object ETag is rebuilt after the download
+- Interrupted downloads resume from the parts recorded in `<file>.part.json`
+- GETs are conditional on the listed ETag (object replaced mid-download fails)
+
+Usage:
+    python s3_mirror.py --dest /data/cefi_mirror --dry-run
+    python s3_mirror.py --dest /data/cefi_mirror --prefix "northeast_pacific/"
+    python s3_mirror.py --dest /Projects/CEFI/regional_mom6/cefi_portal/ --netcdf-only
+"""
+
+import os
+import sys
+import json
+import hashlib
+import logging
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Tuple
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError, BotoCoreError
+from s3_remove_prefix import setup_logging, scan_prefix
+from s3_small_upload import get_pooled_s3_client
+from s3_upload import compute_s3_etag
+
+# Configuration
+S3_BUCKET_NAME = 'noaa-oar-cefi-regional-mom6-pds'
+
+# name of the state file written at the root of the mirror
+STATE_FILE_NAME = '.s3_mirror_state.json'
+
+# suffixes of the partial download and its progress record
+PART_SUFFIX = '.part'
+PROGRESS_SUFFIX = '.part.json'
+
+# range size of objects uploaded in one part (multipart objects use their part size)
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+
+# number of concurrent ranged GET requests (and size of the connection pool)
+DEFAULT_WORKERS = 32
+
+# number of objects downloaded at the same time
+DEFAULT_FILE_WORKERS = 8
+
+# size of the reads from the response body
+READ_SIZE = 1024 * 1024
+
+
+def local_path_of_key(dest_root: str, key: str) -> str:
+    """Local path of an object key under the mirror root"""
+    return os.path.join(dest_root, *key.split('/'))
+
+
+def load_mirror_state(dest_root: str) -> Dict:
+    """
+    Load the state of the mirror
+
+    Returns:
+        Dictionary {key: {'size': ..., 'etag': ..., 'mtime': ...}}
+    """
+    state_file = os.path.join(dest_root, STATE_FILE_NAME)
+    if not os.path.exists(state_file):
+        return {}
+    try:
+        with open(state_file, 'r', encoding='utf-8') as jsonfile:
+            return json.load(jsonfile)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Unreadable mirror state {state_file}, starting fresh: {e}")
+        return {}
+
+
+def save_mirror_state(state: Dict, dest_root: str):
+    """Write the state of the mirror (atomic replace)"""
+    state_file = os.path.join(dest_root, STATE_FILE_NAME)
+    tmp_file = f'{state_file}.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as jsonfile:
+        json.dump(state, jsonfile)
+    os.replace(tmp_file, state_file)
+
+
+def etag_part_count(etag: str) -> int:
+    """Number of parts of a multipart ETag (0 for single part objects)"""
+    etag = etag.strip('"')
+    return int(etag.split('-')[1]) if '-' in etag else 0
+
+
+def object_part_size(s3_client, bucket_name: str, obj: Dict) -> int:
+    """
+    Size of the parts a multipart object was uploaded with
+
+    S3 does not keep the part size, the first part is asked for with
+    head_object(PartNumber=1). Uploads with boto3 use equal parts
+    except the last one.
+
+    Returns:
+        Part size in bytes, or None for single part objects
+    """
+    part_count = etag_part_count(obj['ETag'])
+    if part_count < 2:
+        return None
+    head = s3_client.head_object(Bucket=bucket_name, Key=obj['Key'], PartNumber=1)
+    part_size = head['ContentLength']
+    if -(-obj['Size'] // part_size) != part_count:
+        logging.warning(
+            f"{obj['Key']}: {part_count} parts do not match a part size of {part_size} bytes"
+        )
+        return None
+    return part_size
+
+
+def local_etag_matches(local_file: str, obj: Dict, part_size: int) -> bool:
+    """Check a local file against the ETag of the object"""
+    etag = obj['ETag'].strip('"')
+    if etag_part_count(etag) > 1:
+        if part_size is None:
+            return False
+        return compute_s3_etag(local_file, TransferConfig(multipart_chunksize=part_size))['multipart'] == etag
+    # single part ETag is the MD5 of the content
+    return compute_s3_etag(local_file, TransferConfig(multipart_chunksize=obj['Size'] or 1))['md5'] == etag
+
+
+def local_file_current(s3_client, bucket_name: str, obj: Dict, local_file: str) -> bool:
+    """
+    Check the content of a local file (no state) against the object ETag
+
+    Returns:
+        True when the ETag computed from the local file matches
+    """
+    try:
+        part_size = object_part_size(s3_client, bucket_name, obj)
+    except (ClientError, BotoCoreError) as e:
+        logging.warning(f"Cannot get the part size of {obj['Key']}, downloading again: {e}")
+        return False
+    if local_etag_matches(local_file, obj, part_size):
+        return True
+    logging.info(f"ETag changed: {obj['Key']}")
+    return False
+
+
+def plan_mirror(
+    s3_client,
+    bucket_name: str,
+    objects: List[Dict],
+    dest_root: str,
+    state: Dict,
+    max_workers: int = DEFAULT_FILE_WORKERS
+) -> Tuple[List[Dict], int]:
+    """
+    Compare the listed objects with the local tree
+
+    A local file is current when its size matches and either the state
+    records the same ETag for the same local mtime, or the ETag computed
+    from the local file matches (the state is then updated). The ETag
+    checks (one head_object and a full read of the file each) run on
+    max_workers threads.
+
+    Returns:
+        Tuple of (objects_to_download, current_count)
+    """
+    to_download = []
+    to_check = []
+    current = 0
+    for obj in objects:
+        key = obj['Key']
+        local_file = local_path_of_key(dest_root, key)
+        try:
+            stat = os.stat(local_file)
+        except FileNotFoundError:
+            to_download.append(obj)
+            continue
+
+        if stat.st_size != obj['Size']:
+            logging.info(f"Size changed: {key} (local {stat.st_size}, bucket {obj['Size']})")
+            to_download.append(obj)
+            continue
+
+        entry = state.get(key)
+        if entry and entry['etag'] == obj['ETag'] and entry['mtime'] == stat.st_mtime:
+            current += 1
+            continue
+
+        # no (or outdated) state, check the content
+        to_check.append((obj, local_file, stat))
+
+    if to_check:
+        logging.info(f"Checking the content of {len(to_check)} local files without state")
+        with ThreadPoolExecutor(max_workers=max_workers) as check_executor:
+            futures = {
+                check_executor.submit(local_file_current, s3_client, bucket_name, obj, local_file): (obj, stat)
+                for obj, local_file, stat in to_check
+            }
+            for future in as_completed(futures):
+                obj, stat = futures[future]
+                if future.result():
+                    state[obj['Key']] = {'size': stat.st_size, 'etag': obj['ETag'], 'mtime': stat.st_mtime}
+                    current += 1
+                else:
+                    to_download.append(obj)
+
+    return to_download, current
+
+
+def load_progress(local_file: str, obj: Dict, part_size: int) -> Dict:
+    """
+    Load the progress of a partial download
+
+    The progress is dropped (download restarts) when the object or the
+    part size changed since the partial file was written.
+
+    Returns:
+        Dictionary {part_number: part md5 hex} of the completed parts
+    """
+    progress_file = local_file + PROGRESS_SUFFIX
+    if not os.path.exists(progress_file) or not os.path.exists(local_file + PART_SUFFIX):
+        return {}
+    try:
+        with open(progress_file, 'r', encoding='utf-8') as jsonfile:
+            progress = json.load(jsonfile)
+    except (OSError, ValueError):
+        return {}
+    if (
+        progress.get('etag') != obj['ETag']
+        or progress.get('size') != obj['Size']
+        or progress.get('part_size') != part_size
+    ):
+        logging.info(f"Partial download of {obj['Key']} is outdated, restarting")
+        return {}
+    return {int(part): md5 for part, md5 in progress['done'].items()}
+
+
+def save_progress(local_file: str, obj: Dict, part_size: int, done: Dict):
+    """Record the completed parts of a partial download"""
+    progress_file = local_file + PROGRESS_SUFFIX
+    tmp_file = f'{progress_file}.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as jsonfile:
+        json.dump(
+            {'etag': obj['ETag'], 'size': obj['Size'], 'part_size': part_size, 'done': done},
+            jsonfile
+        )
+    os.replace(tmp_file, progress_file)
+
+
+def download_part(
+    s3_client,
+    bucket_name: str,
+    obj: Dict,
+    fd: int,
+    start: int,
+    end: int
+) -> str:
+    """
+    Download bytes start to end (inclusive) of an object into the open file
+
+    Returns:
+        MD5 hex digest of the downloaded range
+    """
+    response = s3_client.get_object(
+        Bucket=bucket_name,
+        Key=obj['Key'],
+        Range=f'bytes={start}-{end}',
+        IfMatch=obj['ETag']
+    )
+    md5 = hashlib.md5()
+    offset = start
+    body = response['Body']
+    for chunk in iter(lambda: body.read(READ_SIZE), b''):
+        os.pwrite(fd, chunk, offset)
+        md5.update(chunk)
+        offset += len(chunk)
+    if offset != end + 1:
+        raise IOError(f"Short read of {obj['Key']} range {start}-{end}: {offset - start} bytes")
+    return md5.hexdigest()
+
+
+def download_object(
+    s3_client,
+    bucket_name: str,
+    obj: Dict,
+    dest_root: str,
+    part_executor: ThreadPoolExecutor,
+    default_part_size: int = DEFAULT_PART_SIZE
+) -> Dict:
+    """
+    Download one object with parallel ranged GETs into a preallocated file
+
+    The ranges follow the multipart upload parts when the object has them
+    (so each part can be checked against the ETag), otherwise ranges of
+    `default_part_size`. Completed parts are recorded so an interrupted
+    download resumes where it stopped.
+
+    Returns:
+        Dictionary {'key': ..., 'status': 'downloaded' | 'failed', 'bytes': ..., 'resumed': ...}
+    """
+    key = obj['Key']
+    size = obj['Size']
+    etag = obj['ETag'].strip('"')
+    local_file = local_path_of_key(dest_root, key)
+    part_file = local_file + PART_SUFFIX
+    result = {'key': key, 'status': 'failed', 'bytes': 0, 'resumed': 0}
+
+    try:
+        os.makedirs(os.path.dirname(local_file), exist_ok=True)
+        multipart_size = object_part_size(s3_client, bucket_name, obj)
+        part_size = multipart_size or max(default_part_size, 1)
+        ranges = [
+            (part, start, min(start + part_size, size) - 1)
+            for part, start in enumerate(range(0, size, part_size), start=1)
+        ]
+
+        done = load_progress(local_file, obj, part_size)
+        result['resumed'] = len(done)
+
+        fd = os.open(part_file, os.O_RDWR | os.O_CREAT)
+        try:
+            if os.fstat(fd).st_size != size:
+                # preallocate the full file, parts are written in place
+                os.ftruncate(fd, size)
+                if size and hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(fd, 0, size)
+
+            futures = {
+                part_executor.submit(download_part, s3_client, bucket_name, obj, fd, start, end): (part, end - start + 1)
+                for part, start, end in ranges if part not in done
+            }
+            errors = []
+            for future in as_completed(futures):
+                part, part_bytes = futures[future]
+                try:
+                    md5 = future.result()
+                except (ClientError, BotoCoreError, OSError) as e:
+                    errors.append(f"part {part}: {e}")
+                    continue
+                done[part] = md5
+                result['bytes'] += part_bytes
+                save_progress(local_file, obj, part_size, done)
+            if errors:
+                raise IOError('; '.join(errors))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        # check the content against the object ETag
+        if multipart_size:
+            part_digests = b''.join(bytes.fromhex(done[part]) for part, _, _ in ranges)
+            local = f"{hashlib.md5(part_digests).hexdigest()}-{len(ranges)}"
+        elif len(ranges) == 1:
+            local = done[1]
+        elif etag_part_count(etag) == 0:
+            local = compute_s3_etag(part_file, TransferConfig(multipart_chunksize=size))['md5']
+        else:
+            # multipart object with unequal parts, only the size can be checked
+            local = etag
+        if size and local != etag:
+            raise IOError(f"ETag mismatch: local {local}, bucket {etag}")
+
+        os.replace(part_file, local_file)
+        if os.path.exists(local_file + PROGRESS_SUFFIX):
+            os.remove(local_file + PROGRESS_SUFFIX)
+        # keep the bucket modification time on the local file
+        modified = obj['LastModified'].timestamp()
+        os.utime(local_file, (modified, modified))
+
+        result['status'] = 'downloaded'
+        logging.info(f"Downloaded: {key} ({size / (1024**2):.2f} MB, {result['resumed']} parts resumed)")
+
+    except (ClientError, BotoCoreError, OSError) as e:
+        logging.error(f"Error downloading {key}: {e}")
+        result['error'] = str(e)
+
+    return result
+
+
+def mirror_prefix(
+    bucket_name: str,
+    prefix: str,
+    dest_root: str,
+    netcdf_only: bool = False,
+    dry_run: bool = False,
+    max_workers: int = DEFAULT_WORKERS,
+    max_file_workers: int = DEFAULT_FILE_WORKERS,
+    part_size: int = DEFAULT_PART_SIZE,
+    s3_client=None
+) -> Dict:
+    """
+    Mirror all objects under a prefix into a local directory
+
+    A client is created (and closed) when s3_client is None.
+
+    Returns:
+        Dictionary with mirror statistics
+    """
+    own_client = s3_client is None
+    if own_client:
+        s3_client = get_pooled_s3_client(max_pool_connections=max_workers)
+
+    logging.info(f"{'[DRY RUN] ' if dry_run else ''}Mirror s3://{bucket_name}/{prefix} to {dest_root}")
+    os.makedirs(dest_root, exist_ok=True)
+    state = load_mirror_state(dest_root)
+
+    objects, _, _ = scan_prefix(s3_client, bucket_name, prefix)
+    objects = [obj for obj in objects if not obj['Key'].endswith('/')]
+    if netcdf_only:
+        objects = [obj for obj in objects if obj['Key'].endswith('.nc')]
+
+    to_download, current = plan_mirror(
+        s3_client, bucket_name, objects, dest_root, state, max_workers=max_file_workers
+    )
+    download_size = sum(obj['Size'] for obj in to_download)
+    logging.info(
+        f"{len(objects)} objects listed, {current} current, "
+        f"{len(to_download)} to download ({download_size / (1024**2):.2f} MB)"
+    )
+
+    result = {
+        'listed': len(objects),
+        'current': current,
+        'to_download': len(to_download),
+        'downloaded': 0,
+        'failed': [],
+        'resumed_parts': 0,
+        'size_mb': download_size / (1024**2),
+        'dry_run': dry_run
+    }
+
+    try:
+        if dry_run:
+            for obj in to_download:
+                logging.info(f"[DRY RUN] Would download: {obj['Key']} ({obj['Size'] / (1024**2):.2f} MB)")
+            return result
+
+        start = datetime.now()
+        with ThreadPoolExecutor(max_workers=max_workers) as part_executor:
+            with ThreadPoolExecutor(max_workers=max_file_workers) as file_executor:
+                # largest first so the long downloads do not end up last
+                futures = {
+                    file_executor.submit(
+                        download_object, s3_client, bucket_name, obj, dest_root, part_executor, part_size
+                    ): obj
+                    for obj in sorted(to_download, key=lambda obj: -obj['Size'])
+                }
+                for future in as_completed(futures):
+                    obj = futures[future]
+                    download = future.result()
+                    result['resumed_parts'] += download['resumed']
+                    if download['status'] == 'downloaded':
+                        result['downloaded'] += 1
+                        stat = os.stat(local_path_of_key(dest_root, obj['Key']))
+                        state[obj['Key']] = {'size': stat.st_size, 'etag': obj['ETag'], 'mtime': stat.st_mtime}
+                    else:
+                        result['failed'].append(obj['Key'])
+
+        elapsed = (datetime.now() - start).total_seconds()
+        logging.info(
+            f"Downloaded {result['downloaded']}/{len(to_download)} objects in {elapsed:.1f} s "
+            f"({download_size / (1024**2) / max(elapsed, 1e-6):.2f} MB/s), {len(result['failed'])} failed"
+        )
+    finally:
+        save_mirror_state(state, dest_root)
+        if own_client:
+            s3_client.close()
+
+    return result
+
+
+def main():
+    """Main function with command line argument parsing"""
+
+    parser = argparse.ArgumentParser(description='Mirror S3 objects to a local directory')
+    parser.add_argument('--dest', type=str, required=True,
+                        help='local mirror root (object keys are used as relative paths)')
+    parser.add_argument('--prefix', type=str, default='',
+                        help='mirror only this prefix (default: whole bucket)')
+    parser.add_argument('--bucket', type=str, default=S3_BUCKET_NAME,
+                        help=f'S3 bucket name (default: {S3_BUCKET_NAME})')
+    parser.add_argument('--netcdf-only', action='store_true',
+                        help='mirror only the netcdf files (the tree s3_upload.py walks)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='list the objects that would be downloaded')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f'concurrent ranged GET requests (default: {DEFAULT_WORKERS})')
+    parser.add_argument('--file-workers', type=int, default=DEFAULT_FILE_WORKERS,
+                        help=f'objects downloaded at the same time (default: {DEFAULT_FILE_WORKERS})')
+    parser.add_argument('--part-size-mb', type=int, default=DEFAULT_PART_SIZE // 1024**2,
+                        help='range size for single part objects in MB '
+                             f'(default: {DEFAULT_PART_SIZE // 1024**2})')
+    parser.add_argument('--log-file', type=str, default='s3_mirror.log',
+                        help='Log file path (default: s3_mirror.log)')
+
+    args = parser.parse_args()
+
+    setup_logging(args.log_file)
+
+    result = mirror_prefix(
+        args.bucket,
+        args.prefix,
+        args.dest,
+        netcdf_only=args.netcdf_only,
+        dry_run=args.dry_run,
+        max_workers=args.workers,
+        max_file_workers=args.file_workers,
+        part_size=args.part_size_mb * 1024**2
+    )
+
+    if result['failed']:
+        logging.warning(f"{len(result['failed'])} downloads failed, run again to resume them")
+        sys.exit(1)
+
+    logging.info("Mirror completed successfully")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+"""
+Single-pass upload of a local netcdf file from one memory mapping.
+
+`upload_file` reads the file on its own, the netcdf validation opens it
+again and the checksums kept in the checksum record (SHA-256 for the
+release-to-release comparison, part MD5s for the S3 ETag) read it a
+third time. On cold GPFS pages every pass is the full file I/O.
+
+Here the file is mapped once and everything works on that mapping:
+
+- the netcdf validation opens the mapped bytes in memory (netCDF4 `memory=`)
+- the whole-file SHA-256 and MD5, the part MD5s and the part checksum sent
+  in the S3 checksum header are computed while walking the parts in order
+- the part bodies are file objects reading straight from the mapping,
+  so the bytes are only copied into the socket buffers
+
+The checksum record entry is filled from the checksums returned by the
+same pass, so the later ETag verification and the next release
+comparison do not read the file.
+
+"""
+
+import io
+import os
+import zlib
+import mmap
+import base64
+import hashlib
+import logging
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# checksum sent with every part (x-amz-checksum-<algorithm>)
+DEFAULT_CHECKSUM_ALGORITHM = 'SHA256'
+
+# parts hashed and queued ahead of the uploads, per upload thread
+#  (bounds how far the hashing runs ahead of the pages still to be sent)
+PARTS_AHEAD_FACTOR = 2
+
+
+def _crc32(data) -> bytes:
+    return zlib.crc32(data).to_bytes(4, 'big')
+
+def _crc32c(data) -> bytes:
+    # CRC32C needs the AWS CRT package (installed with botocore[crt])
+    from awscrt import checksums
+    return checksums.crc32c(data).to_bytes(4, 'big')
+
+# S3 checksum algorithm: function returning the raw digest of a buffer
+CHECKSUM_FUNCTIONS = {
+    'SHA256': lambda data: hashlib.sha256(data).digest(),
+    'SHA1': lambda data: hashlib.sha1(data).digest(),
+    'CRC32': _crc32,
+    'CRC32C': _crc32c,
+}
+
+
+def part_checksum(data, algorithm: str = DEFAULT_CHECKSUM_ALGORITHM) -> str:
+    """Compute the base64 checksum S3 expects in the checksum header
+
+    Parameters
+    ----------
+    data : bytes-like
+        part content (bytes or memoryview)
+    algorithm : str
+        S3 checksum algorithm, one of CHECKSUM_FUNCTIONS
+
+    Returns
+    -------
+    str
+        base64 encoded digest
+    """
+    return base64.b64encode(CHECKSUM_FUNCTIONS[algorithm](data)).decode()
+
+
+class MappedPart(io.RawIOBase):
+    """Read-only file object over a range of a mapped file
+
+    Used as the request body so botocore streams the part from the mapping
+    (and can rewind it for a retry) without a copy of the part in memory.
+
+    Parameters
+    ----------
+    buffer : memoryview
+        mapping of the whole file
+    start : int
+        offset of the first byte of the part
+    length : int
+        size of the part in bytes
+    """
+
+    def __init__(self, buffer: memoryview, start: int, length: int):
+        super().__init__()
+        self.buffer = buffer
+        self.start = start
+        self.length = length
+        self.loc = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def readinto(self, b) -> int:
+        n_bytes = min(len(b), self.length - self.loc)
+        if n_bytes <= 0:
+            return 0
+        offset = self.start + self.loc
+        memoryview(b)[:n_bytes] = self.buffer[offset:offset + n_bytes]
+        self.loc += n_bytes
+        return n_bytes
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.loc = offset
+        elif whence == io.SEEK_CUR:
+            self.loc += offset
+        elif whence == io.SEEK_END:
+            self.loc = self.length + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        return self.loc
+
+    def tell(self) -> int:
+        return self.loc
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def close(self):
+        self.buffer = None
+        super().close()
+
+
+@contextmanager
+def map_file(local_file: str):
+    """Map a local file read-only
+
+    Parameters
+    ----------
+    local_file : str
+        local data absolute path including filename
+
+    Yields
+    ------
+    tuple
+        (memoryview of the file content, os.stat_result of the file)
+    """
+    with open(local_file, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_size == 0:
+            # an empty file cannot be mapped
+            yield memoryview(b''), stat
+            return
+
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mapping, 'madvise'):
+            # the parts are hashed front to back, let the kernel read ahead
+            mapping.madvise(mmap.MADV_SEQUENTIAL)
+        buffer = memoryview(mapping)
+        try:
+            yield buffer, stat
+        finally:
+            try:
+                buffer.release()
+                mapping.close()
+            except BufferError:
+                # a request body (or a failed netCDF4 open) still references
+                #  the mapping, it is unmapped when the last reference goes away
+                logging.debug("Mapping of %s still referenced, left to close", local_file)
+
+def validate_netcdf_buffer(buffer: memoryview, local_file: str):
+    """Open the mapped netcdf file in memory to check that it is readable
+
+    Parameters
+    ----------
+    buffer : memoryview
+        mapping of the netcdf file
+    local_file : str
+        local file name (used in the error messages)
+
+    Raises
+    ------
+    OSError
+        the content is not a readable netcdf file
+    """
+    import netCDF4
+
+    if len(buffer) == 0:
+        raise OSError(f"{local_file} is empty")
+    ds = netCDF4.Dataset(local_file, mode='r', memory=buffer)
+    ds.close()
+
+@contextmanager
+def request_slot(controller):
+    """Hold a slot of the adaptive concurrency controller (if any) around a request"""
+    if controller is None:
+        yield
+        return
+    controller.acquire()
+    try:
+        yield
+    finally:
+        controller.release()
+
+def _upload_part(
+    s3_client,
+    buffer: memoryview,
+    part: dict,
+    s3_bucket_name: str,
+    obj_name: str,
+    upload_id: str,
+    checksum_algorithm: str,
+    controller=None,
+) -> dict:
+    """Upload one part (inside a controller slot) and check the returned ETag against the part MD5."""
+    checksum_key = f"Checksum{checksum_algorithm}"
+    with request_slot(controller):
+        response = s3_client.upload_part(
+            Bucket=s3_bucket_name,
+            Key=obj_name,
+            UploadId=upload_id,
+            PartNumber=part['PartNumber'],
+            Body=MappedPart(buffer, part['start'], part['length']),
+            ContentLength=part['length'],
+            **{checksum_key: part[checksum_key]}
+        )
+    etag = response['ETag']
+    if etag.strip('"') != part['md5']:
+        raise ValueError(
+            f"Part {part['PartNumber']} of {obj_name}: ETag {etag} does not match MD5 {part['md5']}"
+        )
+    return {'ETag': etag, 'PartNumber': part['PartNumber'], checksum_key: part[checksum_key]}
+
+def upload_mapped(
+    buffer: memoryview,
+    stat: os.stat_result,
+    local_file: str,
+    obj_name: str,
+    s3_bucket_name: str,
+    upload_config,
+    s3_client,
+    metadata: dict = None,
+    checksum_algorithm: str = DEFAULT_CHECKSUM_ALGORITHM,
+) -> dict:
+    """Upload a mapped file, computing all its checksums on the way
+
+    Files smaller than upload_config.multipart_threshold are sent with one
+    put_object, larger files as a multipart upload with
+    upload_config.multipart_chunksize parts and up to
+    upload_config.max_request_concurrency parts in flight. Every request
+    carries the part checksum so S3 rejects a part corrupted in transit,
+    and the ETag of every part is compared with its MD5. With an
+    `AdaptiveTransferConfig`, every request waits for a slot of its
+    controller, so the parts of all the files share the adaptive limit.
+
+    Parameters
+    ----------
+    buffer : memoryview
+        mapping of the local file (see `map_file`)
+    stat : os.stat_result
+        stat of the local file when it was mapped
+    local_file : str
+        local data absolute path including filename
+    obj_name : str
+        object name for the cloud storage
+    s3_bucket_name : str
+        S3 bucket name
+    upload_config : _type_
+        TransferConfig object to configure multipart uploads
+        (AdaptiveTransferConfig to gate the requests on its controller)
+    s3_client : _type_
+        boto3 S3 client object (attached to the controller to observe the requests)
+    metadata : dict, optional
+        user metadata stored with the object
+    checksum_algorithm : str, optional
+        S3 checksum algorithm of the parts, one of CHECKSUM_FUNCTIONS
+
+    Returns
+    -------
+    dict
+        {'sha256', 'md5', 'etag', 'etag_part_size'} of the file, for the
+        checksum record entry (see `s3_upload.record_checksums`)
+
+    Raises
+    ------
+    ValueError
+        an ETag returned by S3 does not match the MD5 of the part
+    """
+    size = len(buffer)
+    part_size = upload_config.multipart_chunksize
+    checksum_key = f"Checksum{checksum_algorithm}"
+    extra_args = {'Metadata': metadata} if metadata else {}
+    controller = getattr(upload_config, 'controller', None)
+
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    part_md5s = []
+
+    def next_part(number: int, start: int) -> dict:
+        """Hash one part (whole-file digests updated in order)."""
+        data = buffer[start:start + part_size]
+        sha256.update(data)
+        md5.update(data)
+        part_md5 = hashlib.md5(data)
+        part_md5s.append(part_md5.digest())
+        part = {
+            'PartNumber': number,
+            'start': start,
+            'length': len(data),
+            'md5': part_md5.hexdigest(),
+            checksum_key: part_checksum(data, checksum_algorithm),
+        }
+        data.release()
+        return part
+
+    starts = range(0, size, part_size)
+    if size < upload_config.multipart_threshold:
+        # single request, the part MD5s are still needed for the multipart ETag
+        parts = [next_part(number, start) for number, start in enumerate(starts, start=1)]
+        if len(parts) == 1:
+            checksum = parts[0][checksum_key]
+        else:
+            checksum = part_checksum(buffer, checksum_algorithm)
+        with request_slot(controller):
+            response = s3_client.put_object(
+                Bucket=s3_bucket_name,
+                Key=obj_name,
+                Body=MappedPart(buffer, 0, size),
+                ContentLength=size,
+                **{checksum_key: checksum},
+                **extra_args
+            )
+        if response['ETag'].strip('"') != md5.hexdigest():
+            raise ValueError(
+                f"{obj_name}: ETag {response['ETag']} does not match MD5 {md5.hexdigest()}"
+            )
+    else:
+        upload_id = s3_client.create_multipart_upload(
+            Bucket=s3_bucket_name,
+            Key=obj_name,
+            ChecksumAlgorithm=checksum_algorithm,
+            **extra_args
+        )['UploadId']
+        max_workers = max(1, upload_config.max_request_concurrency)
+        completed = []
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                pending = deque()
+                for number, start in enumerate(starts, start=1):
+                    part = next_part(number, start)
+                    pending.append(executor.submit(
+                        _upload_part, s3_client, buffer, part,
+                        s3_bucket_name, obj_name, upload_id, checksum_algorithm, controller
+                    ))
+                    # keep the hashing a few parts ahead of the uploads
+                    while len(pending) >= max_workers * PARTS_AHEAD_FACTOR:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            completed.append(future.result())
+                            pending.remove(future)
+                for future in pending:
+                    completed.append(future.result())
+
+            s3_client.complete_multipart_upload(
+                Bucket=s3_bucket_name,
+                Key=obj_name,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': sorted(completed, key=lambda p: p['PartNumber'])}
+            )
+        except BaseException:
+            s3_client.abort_multipart_upload(
+                Bucket=s3_bucket_name, Key=obj_name, UploadId=upload_id
+            )
+            raise
+
+    return {
+        'sha256': sha256.hexdigest(),
+        'md5': md5.hexdigest(),
+        'etag': f"{hashlib.md5(b''.join(part_md5s)).hexdigest()}-{len(part_md5s)}",
+        'etag_part_size': part_size
+    }
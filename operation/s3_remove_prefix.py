@@ -6,6 +6,7 @@ This script deletes all objects in an S3 bucket that match specified prefixes.
 Features:
 - Dry-run mode to preview deletions
 - Batch deletion for efficiency
+- Concurrent batches with adaptive concurrency (backs off on S3 throttling)
 - Comprehensive logging
 - Support for multiple prefixes
 - Error handling and recovery
@@ -23,7 +24,10 @@ import sys
 import os
 from datetime import datetime
 from typing import List, Dict, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.config import Config
 from botocore.exceptions import ClientError, NoCredentialsError
+from s3_throttle import AdaptiveConcurrency, THROTTLE_CODES, MAX_THROTTLE_ATTEMPTS
 
 # Configuration
 S3_BUCKET_NAME = 'noaa-oar-cefi-regional-mom6-pds'
@@ -36,6 +40,10 @@ PREFIXES_TO_DELETE = [
     "northeast_pacific/full_domain/hindcast/daily/regrid/r20250509"
 ]
 
+# concurrency range of the delete_objects requests (adaptive, see s3_throttle)
+INITIAL_DELETE_CONCURRENCY = 4
+MAX_DELETE_CONCURRENCY = 32
+
 def setup_logging(log_file: str = None) -> None:
     """Setup logging configuration"""
 
@@ -56,11 +64,17 @@ def setup_logging(log_file: str = None) -> None:
     )
     return
 
-def get_s3_client():
-    """Create and return S3 client with error handling"""
+def get_s3_client(max_pool_connections: int = None):
+    """Create and return S3 client with error handling
+
+    The connection pool is sized with max_pool_connections (botocore default of 10 when None).
+    """
     try:
         session = boto3.Session()
-        s3_client = session.client("s3")
+        if max_pool_connections is None:
+            s3_client = session.client("s3")
+        else:
+            s3_client = session.client("s3", config=Config(max_pool_connections=max_pool_connections))
         
         return s3_client
         
@@ -74,20 +88,22 @@ def get_s3_client():
 def scan_prefix(
         s3_client,
         bucket_name: str,
-        prefix: str
+        prefix: str,
+        controller: AdaptiveConcurrency = None
     ) -> Tuple[List[Dict], int, int]:
     """
     Scan S3 bucket for objects matching prefix
-    
+
+    The page requests go through the adaptive concurrency controller
+    (shared backoff when S3 throttles), a private one when None.
+
     Returns:
         Tuple of (objects_list, total_count, total_size_bytes)
     """
 
-    try:
-        # boto3 pagination mechanism for handling large S3 bucket listings efficiently.
-        paginator = s3_client.get_paginator('list_objects_v2')
-        pages = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+    controller = controller or AdaptiveConcurrency(initial=1, maximum=1, name='list')
 
+    try:
         objects = []
         total_count = 0
         total_size = 0
@@ -95,7 +111,10 @@ def scan_prefix(
         init_scan_info = f"Scanning prefix: {prefix}"
         logging.info(init_scan_info)
 
-        for _, page in enumerate(pages):
+        # list_objects_v2 pagination (continuation token) for handling large S3 bucket listings
+        page_args = {'Bucket': bucket_name, 'Prefix': prefix}
+        while True:
+            page = controller.call(s3_client.list_objects_v2, **page_args)
             if 'Contents' in page:
                 page_objects = page['Contents']
                 objects.extend(page_objects)
@@ -106,6 +125,10 @@ def scan_prefix(
                 total_count += page_count
                 total_size += page_size
 
+            if not page.get('IsTruncated'):
+                break
+            page_args['ContinuationToken'] = page['NextContinuationToken']
+
         size_count_info = f"Prefix '{prefix}' scan complete: {total_count} objects, {total_size / (1024**2):.2f} MB total"
         logging.info(size_count_info)
 
@@ -116,10 +139,18 @@ def scan_prefix(
         logging.error(scan_error)
         return [], 0, 0
 
-def delete_objects_batch(s3_client, bucket_name: str, objects_to_delete: List[Dict]) -> Tuple[int, int]:
+def delete_objects_batch(
+        s3_client,
+        bucket_name: str,
+        objects_to_delete: List[Dict],
+        controller: AdaptiveConcurrency = None
+    ) -> Tuple[int, int]:
     """
     Delete a batch of objects (max 1000)
-    
+
+    With a controller, the request goes through it and the keys S3
+    reports as throttled (SlowDown) are sent again after the backoff.
+
     Returns:
         Tuple of (successful_deletions, failed_deletions)
     """
@@ -127,6 +158,7 @@ def delete_objects_batch(s3_client, bucket_name: str, objects_to_delete: List[Di
     if not objects_to_delete:
         return 0, 0
 
+    successful = 0
     try:
         # Prepare delete request
         # returned object structure of `objects_to_delete`
@@ -146,23 +178,39 @@ def delete_objects_batch(s3_client, bucket_name: str, objects_to_delete: List[Di
         #         'StorageClass': 'STANDARD'
         #     }
         # ]
-        delete_request = {
-            'Objects': [{'Key': obj['Key']} for obj in objects_to_delete],
-            'Quiet': False
-        }
+        failed = 0
+        remaining = objects_to_delete
+        for attempt in range(MAX_THROTTLE_ATTEMPTS):
+            delete_request = {
+                'Objects': [{'Key': obj['Key']} for obj in remaining],
+                'Quiet': False
+            }
+
+            if controller is None:
+                response = s3_client.delete_objects(Bucket=bucket_name, Delete=delete_request)
+            else:
+                response = controller.call(
+                    s3_client.delete_objects, Bucket=bucket_name, Delete=delete_request
+                )
+
+            successful += len(response.get('Deleted', []))
+
+            throttled_keys = set()
+            for error in response.get('Errors', []):
+                if controller is not None and error['Code'] in THROTTLE_CODES and attempt < MAX_THROTTLE_ATTEMPTS - 1:
+                    throttled_keys.add(error['Key'])
+                    continue
+                # Log any errors
+                logging.error(f"Failed to delete {error['Key']}: {error['Code']} - {error['Message']}")
+                failed += 1
+
+            if not throttled_keys:
+                break
+            # per-key throttling slows the shared controller down before the retry
+            controller.observe('DeleteObjects', 0.0, throttled=True)
+            remaining = [obj for obj in remaining if obj['Key'] in throttled_keys]
+            logging.info(f"Retrying {len(remaining)} throttled deletions")
 
-        response = s3_client.delete_objects(
-            Bucket=bucket_name,
-            Delete=delete_request
-        )
-        
-        successful = len(response.get('Deleted', []))
-        failed = len(response.get('Errors', []))
-        
-        # Log any errors
-        for error in response.get('Errors', []):
-            logging.error(f"Failed to delete {error['Key']}: {error['Code']} - {error['Message']}")
-        
         if successful > 0:
             logging.info(f"Successfully deleted {successful} objects")
         if failed > 0:
@@ -172,11 +220,57 @@ def delete_objects_batch(s3_client, bucket_name: str, objects_to_delete: List[Di
         
     except Exception as e:
         logging.error(f"Error in batch delete: {e}")
-        return 0, len(objects_to_delete)
+        return successful, len(objects_to_delete) - successful
 
-def delete_prefix(s3_client, bucket_name: str, prefix: str, dry_run: bool = True) -> Dict:
+def delete_objects_concurrent(
+        s3_client,
+        bucket_name: str,
+        objects: List[Dict],
+        controller: AdaptiveConcurrency = None
+    ) -> Tuple[int, int]:
+    """
+    Delete objects with concurrent batched delete_objects requests
+
+    The number of requests in flight follows the adaptive concurrency
+    controller (grows while S3 answers fast, backs off on throttling).
+
+    Returns:
+        Tuple of (successful_deletions, failed_deletions)
+    """
+    controller = controller or AdaptiveConcurrency(
+        initial=INITIAL_DELETE_CONCURRENCY, maximum=MAX_DELETE_CONCURRENCY, name='delete'
+    )
+    batch_size = 1000  # AWS limit
+    batches = [objects[i:i + batch_size] for i in range(0, len(objects), batch_size)]
+
+    total_deleted = 0
+    total_failed = 0
+    # threads over the current limit wait for a slot in the controller
+    with ThreadPoolExecutor(max_workers=controller.maximum) as executor:
+        futures = [
+            executor.submit(delete_objects_batch, s3_client, bucket_name, batch, controller)
+            for batch in batches
+        ]
+        for i, future in enumerate(as_completed(futures)):
+            deleted, failed = future.result()
+            total_deleted += deleted
+            total_failed += failed
+            logging.info(f"Processed batch {i + 1}/{len(batches)} (concurrency {controller.concurrency})")
+
+    controller.log_stats()
+    return total_deleted, total_failed
+
+def delete_prefix(
+        s3_client,
+        bucket_name: str,
+        prefix: str,
+        dry_run: bool = True,
+        controller: AdaptiveConcurrency = None
+    ) -> Dict:
     """
     Delete all objects with specified prefix
+
+    One controller can be shared by the prefixes of a bulk deletion.
     
     Returns:
         Dictionary with deletion statistics
@@ -185,7 +279,7 @@ def delete_prefix(s3_client, bucket_name: str, prefix: str, dry_run: bool = True
     logging.info(f"{'[DRY RUN] ' if dry_run else ''}Processing prefix: {prefix}")
 
     # Scan for objects
-    objects, total_count, total_size = scan_prefix(s3_client, bucket_name, prefix)
+    objects, total_count, total_size = scan_prefix(s3_client, bucket_name, prefix, controller)
 
     if total_count == 0:
         logging.info(f"No objects found with prefix '{prefix}'")
@@ -225,21 +319,8 @@ def delete_prefix(s3_client, bucket_name: str, prefix: str, dry_run: bool = True
     # Actual deletion
     logging.info(f"Starting deletion of {total_count} objects...")
 
-    total_deleted = 0
-    total_failed = 0
-    batch_size = 1000  # AWS limit
-
-    # Process in batches
-    for i in range(0, len(objects), batch_size):
-        batch = objects[i:i + batch_size]
-        batch_num = (i // batch_size) + 1
-        total_batches = (len(objects) + batch_size - 1) // batch_size
-        
-        logging.info(f"Processing batch {batch_num}/{total_batches} ({len(batch)} objects)")
-        
-        deleted, failed = delete_objects_batch(s3_client, bucket_name, batch)
-        total_deleted += deleted
-        total_failed += failed
+    # Process in concurrent batches
+    total_deleted, total_failed = delete_objects_concurrent(s3_client, bucket_name, objects, controller)
 
     logging.info(f"Deletion complete for prefix '{prefix}': {total_deleted} deleted, {total_failed} failed")
 
@@ -260,8 +341,13 @@ def bulk_delete_prefixes(prefixes: List[str], bucket_name: str, dry_run: bool =
         List of deletion statistics for each prefix
     """
     
-    s3_client = get_s3_client()
+    s3_client = get_s3_client(max_pool_connections=MAX_DELETE_CONCURRENCY)
     results = []
+
+    # one controller for all the prefixes (same bucket, same request rate limits)
+    controller = AdaptiveConcurrency(
+        initial=INITIAL_DELETE_CONCURRENCY, maximum=MAX_DELETE_CONCURRENCY, name='delete'
+    )
     
     logging.info(f"{'[DRY RUN] ' if dry_run else ''}Starting bulk deletion for {len(prefixes)} prefixes")
     logging.info(f"Target bucket: {bucket_name}")
@@ -272,7 +358,7 @@ def bulk_delete_prefixes(prefixes: List[str], bucket_name: str, dry_run: bool =
         logging.info(f"Processing prefix {i+1}/{len(prefixes)}: {prefix}")
         logging.info(f"{'='*60}")
         
-        result = delete_prefix(s3_client, bucket_name, prefix, dry_run)
+        result = delete_prefix(s3_client, bucket_name, prefix, dry_run, controller)
         results.append(result)
     
     # Summary
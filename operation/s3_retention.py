@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+S3 Release Retention Script
+
+This script keeps the N newest rYYYYMMDD releases of every parent directory
+in the S3 bucket and deletes the older ones. The decision is made from the
+bucket listing alone, so releases that were already removed from the local
+PSL tree are cleaned up as well.
+
+Features:
+- Grouping of keys by parent directory and release folder (compact
+  inventory of the listing, reusable from a local file with --inventory)
+- Keep the N newest releases, with pins for specific releases
+- Dry-run report of the objects and bytes that would be reclaimed
+- Batched concurrent deletion (1000 keys per request, adaptive concurrency)
+- Removal of the deleted releases from the bucket catalog
+
+Usage:
+    python s3_retention.py --dry-run                       # Preview with the default of 1 release kept
+    python s3_retention.py --dry-run --keep 2              # Keep the two newest releases
+    python s3_retention.py --delete --pin r20250212        # Never delete r20250212
+    python s3_retention.py --dry-run --prefix "northeast_pacific/"
+"""
+
+import sys
+import logging
+import argparse
+from typing import Dict, List, Tuple
+import numpy as np
+from s3_remove_prefix import setup_logging, get_s3_client, delete_objects_concurrent
+from s3_throttle import AdaptiveConcurrency
+from s3_inventory import (
+    DEFAULT_MAX_AGE,
+    load_or_scan_inventory,
+    invalidate_inventory,
+)
+from s3_catalog import drop_catalog_releases
+
+# Configuration
+S3_BUCKET_NAME = 'noaa-oar-cefi-regional-mom6-pds'
+
+# number of releases kept per parent directory
+DEFAULT_KEEP = 1
+
+# maximum number of concurrent delete_objects requests (the controller adapts below it)
+DEFAULT_WORKERS = 32
+
+def is_pinned(parent_dir: str, release: str, pins: List[str]) -> bool:
+    """Check if a release is pinned (by 'rYYYYMMDD' or 'parent_dir/rYYYYMMDD')"""
+    return release in pins or f'{parent_dir}/{release}' in pins
+
+
+def plan_retention(
+    groups: Dict[str, Dict[str, np.ndarray]],
+    keep: int,
+    pins: List[str]
+) -> List[Tuple[str, str, np.ndarray]]:
+    """
+    Select the releases to delete
+
+    The `keep` newest releases of each parent directory are kept,
+    pinned releases are kept on top of them. groups is the
+    `ObjectInventory.release_groups` of the listing.
+
+    Returns:
+        List of (parent_dir, release, inventory positions) to delete
+    """
+    to_delete = []
+    for parent_dir in sorted(groups):
+        releases = sorted(groups[parent_dir], reverse=True)
+        for release in releases[keep:]:
+            if is_pinned(parent_dir, release, pins):
+                logging.info(f"Pinned release kept: {parent_dir}/{release}")
+                continue
+            to_delete.append((parent_dir, release, groups[parent_dir][release]))
+    return to_delete
+
+
+def apply_retention(
+    bucket_name: str,
+    prefix: str,
+    keep: int,
+    pins: List[str],
+    dry_run: bool = True,
+    max_workers: int = DEFAULT_WORKERS,
+    s3_client=None,
+    inventory_file: str = None,
+    inventory_max_age: float = DEFAULT_MAX_AGE
+) -> Dict:
+    """
+    Apply the retention policy to all releases under a prefix
+
+    A client is created (and closed) when s3_client is None. The deletes
+    use up to max_workers concurrent requests (adaptive, see s3_throttle).
+    For a dry run the listing comes from inventory_file when it is
+    younger than inventory_max_age seconds (see s3_inventory). Deletes
+    are always planned from a fresh listing, so objects uploaded since
+    the inventory was saved cannot be missed or misplaced in a release;
+    the file is removed after objects were deleted.
+
+    Returns:
+        Dictionary with retention statistics
+    """
+    own_client = s3_client is None
+    if own_client:
+        s3_client = get_s3_client(max_pool_connections=max_workers)
+
+    # listing and deletes share one controller (same bucket request rate)
+    controller = AdaptiveConcurrency(initial=min(4, max_workers), maximum=max_workers, name='retention')
+
+    logging.info(f"{'[DRY RUN] ' if dry_run else ''}Retention on s3://{bucket_name}/{prefix}")
+    logging.info(f"Keeping {keep} newest release(s) per parent directory, pins: {pins}")
+
+    # deletes are planned from a fresh listing (max age 0)
+    inventory = load_or_scan_inventory(
+        s3_client, bucket_name, prefix, inventory_file,
+        inventory_max_age if dry_run else 0, controller
+    )
+    groups = inventory.release_groups()
+    to_delete = plan_retention(groups, keep, pins)
+
+    # Report
+    logging.info(f"{'='*60}")
+    logging.info("RELEASES TO DELETE")
+    logging.info(f"{'='*60}")
+    for parent_dir, release, indices in to_delete:
+        release_size_mb = inventory.sizes[indices].sum() / (1024**2)
+        logging.info(f"{parent_dir}/{release:<12} {len(indices):>6} objects ({release_size_mb:>10.2f} MB)")
+    delete_indices = np.sort(np.concatenate(
+        [indices for _, _, indices in to_delete] or [np.empty(0, dtype=np.int64)]
+    ))
+
+    size_mb = inventory.sizes[delete_indices].sum() / (1024**2)
+    logging.info(f"{'='*60}")
+    logging.info(
+        f"TOTALS: {len(groups)} parent directories, {len(inventory)} objects scanned, "
+        f"{len(to_delete)} releases / {len(delete_indices)} objects ({size_mb:.2f} MB) to reclaim"
+    )
+
+    result = {
+        'parents': len(groups),
+        'releases': len(to_delete),
+        'found': len(delete_indices),
+        'deleted': 0,
+        'failed': 0,
+        'size_mb': float(size_mb),
+        'dry_run': dry_run
+    }
+
+    if dry_run or not len(delete_indices):
+        if own_client:
+            s3_client.close()
+        return result
+
+    logging.info(f"Starting deletion of {len(delete_indices)} objects...")
+    delete_objects_list = [{'Key': key} for key in inventory.keys_at(delete_indices)]
+    deleted, failed = delete_objects_concurrent(
+        s3_client, bucket_name, delete_objects_list, controller
+    )
+    invalidate_inventory(inventory_file)
+    result['deleted'] = deleted
+    result['failed'] = failed
+    logging.info(f"Deletion complete: {deleted} deleted, {failed} failed")
+
+    # keep the bucket catalog in line with the bucket
+    if failed == 0:
+        drop_catalog_releases(
+            [(parent_dir, release) for parent_dir, release, _ in to_delete],
+            bucket_name,
+            s3_client
+        )
+
+    if own_client:
+        s3_client.close()
+    return result
+
+
+def main():
+    """Main function with command line argument parsing"""
+
+    parser = argparse.ArgumentParser(description='Keep the N newest releases per parent directory in S3')
+
+    # Action group - mutually exclusive
+    action_group = parser.add_mutually_exclusive_group(required=True)
+    action_group.add_argument('--dry-run', action='store_true',
+                            help='Report what would be deleted without actually deleting')
+    action_group.add_argument('--delete', action='store_true',
+                            help='Actually delete the objects')
+
+    # Optional arguments
+    parser.add_argument('--keep', type=int, default=DEFAULT_KEEP,
+                       help=f'Number of newest releases kept per parent directory (default: {DEFAULT_KEEP})')
+    parser.add_argument('--pin', type=str, action='append', default=[],
+                       help='Release never deleted, rYYYYMMDD or parent_dir/rYYYYMMDD (repeatable)')
+    parser.add_argument('--prefix', type=str, default='',
+                       help='Only apply retention under this prefix (default: whole bucket)')
+    parser.add_argument('--bucket', type=str, default=S3_BUCKET_NAME,
+                       help=f'S3 bucket name (default: {S3_BUCKET_NAME})')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                       help=f'Maximum concurrent delete requests (default: {DEFAULT_WORKERS})')
+    parser.add_argument('--inventory', type=str, default=None,
+                       help='Inventory file reused between dry runs (default: list the bucket every run)')
+    parser.add_argument('--inventory-max-age', type=float, default=DEFAULT_MAX_AGE / 60,
+                       help=f'Minutes before the inventory is listed again (default: {DEFAULT_MAX_AGE // 60})')
+    parser.add_argument('--log-file', type=str, default='s3_retention.log',
+                       help='Log file path (default: s3_retention.log)')
+
+    args = parser.parse_args()
+
+    if args.keep < 1:
+        parser.error("--keep must be at least 1")
+
+    # Setup logging
+    setup_logging(args.log_file)
+
+    # Confirmation for actual deletion
+    if args.delete:
+        print("\n" + "="*60)
+        print("WARNING: This will permanently delete S3 objects!")
+        print(f"Bucket: {args.bucket}")
+        print(f"Prefix: '{args.prefix}', keep: {args.keep}, pins: {args.pin}")
+        print("="*60)
+
+        response = input("Are you sure you want to proceed? Type 'DELETE' to confirm: ")
+        if response != 'DELETE':
+            print("Deletion cancelled")
+            logging.info("Deletion cancelled by user")
+            sys.exit(0)
+
+    result = apply_retention(
+        args.bucket,
+        args.prefix,
+        args.keep,
+        args.pin,
+        dry_run=args.dry_run,
+        max_workers=args.workers,
+        inventory_file=args.inventory,
+        inventory_max_age=args.inventory_max_age * 60
+    )
+
+    # Exit status
+    if result['failed'] > 0:
+        logging.warning("Some deletions failed. Check log for details.")
+        sys.exit(1)
+
+    logging.info("Operation completed successfully")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+"""
+High-throughput uploader for small objects (kerchunk JSON indexes).
+
+Per-file kerchunk indexes are a few KB to a few MB, so the cost of an
+upload is the request round trip, not the bytes. This module sends them
+as single `put_object` requests (no existence check, no multipart
+machinery) from a thread pool sharing one client whose connection pool
+is sized for the number of threads. Failed requests are retried by
+botocore (standard retry mode) and then again with exponential backoff.
+
+Usage:
+    python s3_small_upload.py --dir ./s3_kerchunk_json             # upload all .json files
+    python s3_small_upload.py --dir ./s3_kerchunk_json --workers 128
+"""
+
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, BotoCoreError
+
+# Configuration
+S3_BUCKET_NAME = 'noaa-oar-cefi-regional-mom6-pds'
+
+# number of concurrent PUT requests (and size of the connection pool)
+DEFAULT_WORKERS = 64
+
+# retries on top of the botocore retries
+MAX_PUT_ATTEMPTS = 3
+
+# maximum number of objects read into memory and waiting to be sent
+MAX_INFLIGHT_FACTOR = 4
+
+
+def get_pooled_s3_client(max_pool_connections: int = DEFAULT_WORKERS, max_attempts: int = 5):
+    """Create an S3 client whose connection pool fits many concurrent threads
+
+    Parameters
+    ----------
+    max_pool_connections : int
+        size of the HTTP connection pool (botocore default is 10)
+    max_attempts : int
+        botocore attempts per request (standard retry mode)
+
+    Returns
+    -------
+    _type_
+        boto3 S3 client object
+    """
+    session = boto3.Session()
+    return session.client(
+        "s3",
+        config=Config(
+            max_pool_connections=max_pool_connections,
+            retries={'max_attempts': max_attempts, 'mode': 'standard'},
+            tcp_keepalive=True
+        )
+    )
+
+
+def put_small_object(
+    local_file: str,
+    obj_name: str,
+    s3_bucket_name: str,
+    s3_client,
+    metadata: dict = None,
+    content_type: str = 'application/json',
+) -> bool:
+    """Upload a small local file with a single put_object request
+
+    Parameters
+    ----------
+    local_file : str
+        local file absolute path
+    obj_name : str
+        object name for the cloud storage
+    s3_bucket_name : str
+        S3 bucket name
+    s3_client : _type_
+        boto3 S3 client object
+    metadata : dict, optional
+        user metadata stored with the object
+    content_type : str
+        content type of the object
+
+    Returns
+    -------
+    bool
+        True if the object was uploaded
+    """
+    with open(local_file, 'rb') as f:
+        body = f.read()
+
+    extra_args = {'Metadata': metadata} if metadata else {}
+    for attempt in range(MAX_PUT_ATTEMPTS):
+        try:
+            s3_client.put_object(
+                Bucket=s3_bucket_name,
+                Key=obj_name,
+                Body=body,
+                ContentType=content_type,
+                **extra_args
+            )
+            logging.info('Uploaded: %s to %s called %s', local_file, s3_bucket_name, obj_name)
+            return True
+        except (ClientError, BotoCoreError) as e:
+            if attempt == MAX_PUT_ATTEMPTS - 1:
+                logging.error("Error uploading %s: %s", obj_name, e)
+                return False
+            # exponential backoff with jitter before the next attempt
+            time.sleep(random.uniform(0, 2 ** attempt))
+    return False
+
+
+def put_small_objects(
+    items,
+    s3_bucket_name: str,
+    s3_client,
+    max_workers: int = DEFAULT_WORKERS,
+) -> tuple:
+    """Upload many small files concurrently
+
+    Parameters
+    ----------
+    items : iterable
+        iterable of {'local': local_file_path, 'cloud': cloud_object_name}
+        (optionally with 'metadata'), consumed lazily
+    s3_bucket_name : str
+        S3 bucket name
+    s3_client : _type_
+        boto3 S3 client object created with a pool of at least max_workers
+        connections (see `get_pooled_s3_client`)
+    max_workers : int
+        number of concurrent PUT requests
+
+    Returns
+    -------
+    tuple
+        (number of uploaded objects, list of failed object names)
+    """
+    uploaded = 0
+    failed = []
+    inflight = threading.BoundedSemaphore(max_workers * MAX_INFLIGHT_FACTOR)
+    start_time = time.monotonic()
+
+    def put_item(item):
+        try:
+            return put_small_object(
+                item['local'],
+                item['cloud'],
+                s3_bucket_name,
+                s3_client,
+                metadata=item.get('metadata')
+            )
+        finally:
+            inflight.release()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for item in items:
+            inflight.acquire()
+            futures[executor.submit(put_item, item)] = item['cloud']
+
+        for future in as_completed(futures):
+            if future.result():
+                uploaded += 1
+            else:
+                failed.append(futures[future])
+
+    elapsed = time.monotonic() - start_time
+    logging.info(
+        "Uploaded %s small objects in %.1f s (%.0f objects/min), %s failed",
+        uploaded, elapsed, uploaded / elapsed * 60 if elapsed > 0 else 0, len(failed)
+    )
+    return uploaded, failed
+
+
+def iter_local_files(local_dir: str, suffix: str = '.json', prefix: str = ''):
+    """Walk a local directory and yield the files to upload
+
+    Object names are the paths relative to local_dir (with an optional prefix),
+    so a directory laid out like the bucket is uploaded to the same keys.
+    """
+    for dirpath, _, filenames in os.walk(local_dir):
+        for filename in sorted(filenames):
+            if not filename.endswith(suffix):
+                continue
+            local_file = os.path.join(dirpath, filename)
+            obj_name = os.path.relpath(local_file, local_dir).replace(os.sep, '/')
+            yield {'local': local_file, 'cloud': f'{prefix}{obj_name}'}
+
+
+def main():
+    """Main function with command line argument parsing"""
+
+    parser = argparse.ArgumentParser(description='Upload many small files (kerchunk JSON) to S3')
+    parser.add_argument('--dir', type=str, required=True,
+                        help='Local directory laid out like the bucket')
+    parser.add_argument('--prefix', type=str, default='',
+                        help='Object name prefix added to the relative paths')
+    parser.add_argument('--suffix', type=str, default='.json',
+                        help='Only upload files with this suffix (default: .json)')
+    parser.add_argument('--bucket', type=str, default=S3_BUCKET_NAME,
+                        help=f'S3 bucket name (default: {S3_BUCKET_NAME})')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f'Concurrent PUT requests (default: {DEFAULT_WORKERS})')
+    parser.add_argument('--log-file', type=str, default='s3_small_upload.log',
+                        help='Log file path (default: s3_small_upload.log)')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.FileHandler(args.log_file)]
+    )
+
+    s3_client = get_pooled_s3_client(max_pool_connections=args.workers)
+    _, failed = put_small_objects(
+        iter_local_files(args.dir, args.suffix, args.prefix),
+        args.bucket,
+        s3_client,
+        max_workers=args.workers
+    )
+    s3_client.close()
+
+    if failed:
+        logging.warning("Some uploads failed. Check log for details.")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+"""
+Adaptive concurrency of the S3 requests (AIMD on throttling and latency).
+
+A fixed number of threads either leaves throughput unused or gets the
+requests throttled (`503 SlowDown`) and fills the log with errors. The
+`AdaptiveConcurrency` controller is shared by the threads sending the
+requests of an operation (uploads, deletes, listings):
+
+- additive increase: the concurrency limit grows by one after a limit's
+  worth of successful requests while the latencies stay healthy
+- multiplicative decrease: the limit is halved on throttling (once per
+  round of requests) and reduced when the median latency of an operation
+  (within a request size class) climbs over `latency_factor` times its floor
+- throttled requests are retried after a jittered exponential backoff
+  shared by all the threads, so they do not come back at the same instant
+
+Requests go through the controller with `controller.call(func, ...)`, or
+take a slot with `acquire`/`release` (multipart parts of `upload_mapped`).
+Requests sent by boto3 itself (multipart upload parts of `upload_file`)
+are observed by attaching the controller to the client events, and the
+part concurrency follows the limit through `AdaptiveTransferConfig`.
+
+`ThrottlingS3StandIn` is an in-memory stand-in of the S3 client that
+throttles above a given capacity, used to check the controller without a bucket:
+    python s3_throttle.py --objects 200000 --capacity 24
+"""
+
+import sys
+import time
+import bisect
+import random
+import logging
+import argparse
+import threading
+import statistics
+from collections import defaultdict, deque
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+# error codes and HTTP status S3 uses to ask for a lower request rate
+THROTTLE_CODES = {
+    'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+    'TooManyRequests', 'TooManyRequestsException', 'RequestThrottled', 'ServiceUnavailable'
+}
+THROTTLE_STATUS = (429, 503)
+
+# retries of a throttled request through the controller
+MAX_THROTTLE_ATTEMPTS = 8
+
+# latencies kept per operation for the median
+LATENCY_WINDOW = 16
+
+# decrease of the limit when the latency climbs (throttling uses decrease_factor)
+LATENCY_DECREASE_FACTOR = 0.8
+
+# growth of the latency floor per full window (follows a slower baseline)
+FLOOR_DRIFT = 1.05
+
+# requests smaller than this share the latency floor of their operation,
+#  larger ones are compared within their size class (doubling from here)
+SIZE_CLASS_MIN = 1024 * 1024
+
+
+def latency_key(operation: str, nbytes: int = None) -> str:
+    """Key of the latency floor of a request: operation and size class
+
+    A 50 MB part takes longer than a 1 MB one without any congestion,
+    so the latencies are only compared between requests of similar size.
+    """
+    if not nbytes or nbytes < SIZE_CLASS_MIN:
+        return operation
+    return f'{operation}:{(int(nbytes) // SIZE_CLASS_MIN).bit_length()}'
+
+
+def is_throttle_error(error: Exception) -> bool:
+    """Check if an exception is a throttling response of S3"""
+    if not isinstance(error, ClientError):
+        return False
+    code = error.response.get('Error', {}).get('Code')
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return code in THROTTLE_CODES or status in THROTTLE_STATUS
+
+
+class AdaptiveConcurrency:
+    """AIMD limit on the number of concurrent S3 requests
+
+    Parameters
+    ----------
+    initial : int
+        concurrency limit at start
+    minimum : int
+        lowest concurrency limit
+    maximum : int
+        highest concurrency limit (size the thread pool and the connection pool for it)
+    decrease_factor : float
+        multiplicative decrease of the limit on throttling
+    latency_factor : float
+        median latency over this factor times the floor counts as congestion
+    base_delay : float
+        first backoff delay in seconds after a throttle
+    max_delay : float
+        highest backoff delay in seconds
+    name : str
+        name used in the log messages
+    """
+
+    def __init__(
+        self,
+        initial: int = 8,
+        minimum: int = 1,
+        maximum: int = 64,
+        decrease_factor: float = 0.5,
+        latency_factor: float = 2.0,
+        base_delay: float = 0.05,
+        max_delay: float = 10.0,
+        name: str = 's3',
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.decrease_factor = decrease_factor
+        self.latency_factor = latency_factor
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.name = name
+
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._successes = 0
+        self._throttle_streak = 0
+        self._backoff_until = 0.0
+        self._last_decrease = 0.0
+        self._latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+        self._floor = {}
+        self._attached = set()
+        self.stats = {
+            'requests': 0, 'throttled': 0, 'errors': 0,
+            'increases': 0, 'decreases': 0,
+            'min_limit': int(self.limit), 'max_limit': int(self.limit),
+        }
+
+    @property
+    def concurrency(self) -> int:
+        """Current concurrency limit"""
+        return int(self.limit)
+
+    def acquire(self):
+        """Wait for a request slot (and for the backoff after a throttle)"""
+        with self._cond:
+            while self._inflight >= int(self.limit):
+                self._cond.wait()
+            self._inflight += 1
+            delay = self._backoff_until - time.monotonic()
+        if delay > 0:
+            # full jitter spreads the threads released by the same backoff
+            time.sleep(random.uniform(0, delay))
+
+    def release(self):
+        """Give back a request slot"""
+        with self._cond:
+            self._inflight -= 1
+            self._cond.notify()
+
+    def _set_limit(self, limit: float):
+        self.limit = min(max(limit, self.minimum), self.maximum)
+        self.stats['min_limit'] = min(self.stats['min_limit'], int(self.limit))
+        self.stats['max_limit'] = max(self.stats['max_limit'], int(self.limit))
+        self._cond.notify_all()
+
+    def _decrease(self, now: float, sent: float, factor: float, reason: str) -> bool:
+        """Multiplicative decrease, once per round of requests
+
+        Requests sent before the previous decrease saw the old limit,
+        their throttles and latencies do not decrease the limit again.
+        """
+        if sent < self._last_decrease:
+            return False
+        self._last_decrease = now
+        self._successes = 0
+        self._latencies.clear()
+        previous = int(self.limit)
+        self._set_limit(self.limit * factor)
+        if int(self.limit) < previous:
+            self.stats['decreases'] += 1
+            logging.info("%s concurrency %s -> %s (%s)", self.name, previous, int(self.limit), reason)
+        return True
+
+    def observe(
+        self,
+        operation: str,
+        latency: float,
+        throttled: bool = False,
+        error: bool = False,
+        nbytes: int = None,
+    ):
+        """Record the outcome of one request and adjust the limit
+
+        Parameters
+        ----------
+        operation : str
+            operation name (latency floors are kept per operation and size class)
+        latency : float
+            request latency in seconds
+        throttled : bool
+            the request got a throttling response
+        error : bool
+            the request failed for another reason
+        nbytes : int, optional
+            bytes sent or received by the request (see `latency_key`)
+        """
+        now = time.monotonic()
+        sent = now - latency
+        with self._cond:
+            self.stats['requests'] += 1
+            if throttled:
+                self.stats['throttled'] += 1
+                if self._decrease(now, sent, self.decrease_factor, f'{operation} throttled'):
+                    # exponential backoff while the throttling goes on (jittered in acquire)
+                    self._throttle_streak += 1
+                    delay = min(self.max_delay, self.base_delay * 2 ** (self._throttle_streak - 1))
+                    self._backoff_until = now + delay
+                return
+            if error:
+                # no increase while requests fail
+                self.stats['errors'] += 1
+                self._successes = 0
+                return
+
+            self._throttle_streak = 0
+            key = latency_key(operation, nbytes)
+            window = self._latencies[key]
+            window.append(latency)
+            if len(window) == window.maxlen:
+                # one latency check per full window
+                median = statistics.median(window)
+                window.clear()
+                floor = min(median, self._floor.get(key, median) * FLOOR_DRIFT)
+                self._floor[key] = floor
+                if median > self.latency_factor * floor:
+                    self._decrease(now, sent, LATENCY_DECREASE_FACTOR, f'{key} latency {median:.3f} s')
+                    return
+
+            # additive increase: +1 per limit's worth of healthy requests
+            self._successes += 1
+            if self._successes >= int(self.limit) and self.limit < self.maximum:
+                self._successes = 0
+                self._set_limit(self.limit + 1)
+                self.stats['increases'] += 1
+
+    def call(self, func, *args, operation: str = None, max_attempts: int = MAX_THROTTLE_ATTEMPTS, **kwargs):
+        """Call an S3 client method inside a request slot
+
+        Throttled calls are retried after the shared backoff, other errors
+        are raised. The outcome is observed unless the client is attached
+        (its requests are then observed through the client events).
+
+        Parameters
+        ----------
+        func : callable
+            client method (ex: s3_client.delete_objects)
+        operation : str, optional
+            operation name (default: name of func)
+        max_attempts : int
+            attempts of a throttled call before the error is raised
+        *args, **kwargs
+            passed to func
+
+        Returns
+        -------
+        _type_
+            result of func
+        """
+        operation = operation or getattr(func, '__name__', 'call')
+        observed = id(getattr(func, '__self__', None)) not in self._attached
+        nbytes = kwargs.get('ContentLength')
+        for attempt in range(max_attempts):
+            self.acquire()
+            start = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                throttled = is_throttle_error(e)
+                if observed:
+                    self.observe(
+                        operation, time.monotonic() - start,
+                        throttled=throttled, error=not throttled, nbytes=nbytes
+                    )
+                if not throttled or attempt == max_attempts - 1:
+                    raise
+                continue
+            finally:
+                self.release()
+            if observed:
+                self.observe(operation, time.monotonic() - start, nbytes=nbytes)
+            return result
+        return None
+
+    def attach(self, s3_client):
+        """Observe every HTTP request of a boto3 client (including the botocore retries)
+
+        Used for the requests boto3 sends itself (upload_file parts), the
+        limit then drives the part concurrency of `AdaptiveTransferConfig`.
+        """
+        local = threading.local()
+
+        def before_send(request=None, **kwargs):
+            local.start = time.monotonic()
+            local.nbytes = int(request.headers.get('Content-Length') or 0) if request is not None else 0
+
+        def needs_retry(response=None, caught_exception=None, operation=None, **kwargs):
+            start = getattr(local, 'start', None)
+            if start is None:
+                return None
+            local.start = None
+            throttled = False
+            error = caught_exception is not None
+            nbytes = local.nbytes
+            if response is not None:
+                http_response, parsed = response
+                code = parsed.get('Error', {}).get('Code')
+                throttled = code in THROTTLE_CODES or http_response.status_code in THROTTLE_STATUS
+                error = error or http_response.status_code >= 500
+                nbytes = max(nbytes, int(http_response.headers.get('Content-Length') or 0))
+            name = getattr(operation, 'name', 's3')
+            self.observe(
+                name, time.monotonic() - start,
+                throttled=throttled, error=error and not throttled, nbytes=nbytes
+            )
+            # None lets the retry handler decide
+            return None
+
+        s3_client.meta.events.register('before-send.s3', before_send)
+        s3_client.meta.events.register_first('needs-retry.s3', needs_retry)
+        self._attached.add(id(s3_client))
+
+    def log_stats(self):
+        """Log the request counts and the range of the limit"""
+        logging.info(
+            "%s concurrency: %s requests, %s throttled, %s errors, limit %s (range %s-%s)",
+            self.name, self.stats['requests'], self.stats['throttled'], self.stats['errors'],
+            int(self.limit), self.stats['min_limit'], self.stats['max_limit']
+        )
+
+
+class AdaptiveTransferConfig(TransferConfig):
+    """TransferConfig whose part concurrency follows an AdaptiveConcurrency limit
+
+    boto3 reads the concurrency when `upload_file` starts, so each file
+    gets its share of the current limit.
+
+    Parameters
+    ----------
+    controller : AdaptiveConcurrency
+        controller attached to the client used for the uploads
+    share : int
+        number of files uploaded at the same time
+    **kwargs
+        passed to TransferConfig
+    """
+
+    def __init__(self, controller: AdaptiveConcurrency, share: int = 1, **kwargs):
+        super().__init__(**kwargs)
+        # set after the TransferConfig validation of the numeric attributes
+        self.controller = controller
+        self.share = share
+
+    @property
+    def max_request_concurrency(self) -> int:
+        controller = self.__dict__.get('controller')
+        if controller is None:
+            # read by TransferConfig.__init__ before the controller is set
+            return self.__dict__['_initial_concurrency']
+        return max(1, controller.concurrency // self.share)
+
+    @max_request_concurrency.setter
+    def max_request_concurrency(self, value):
+        # only the initial value is kept, the controller decides afterwards
+        self.__dict__['_initial_concurrency'] = value
+
+
+class ThrottlingS3StandIn:
+    """In-memory stand-in of an S3 client that throttles like a busy prefix
+
+    Requests take `base_latency` seconds, growing with the number of
+    requests in flight. Over `capacity` requests in flight, requests get
+    a `503 SlowDown` error (and `throttle_rate` of the others get one too).
+
+    Parameters
+    ----------
+    keys : list
+        object keys in the stand-in bucket
+    capacity : int
+        number of concurrent requests served without throttling
+    base_latency : float
+        latency of a request in seconds without load
+    throttle_rate : float
+        probability of a SlowDown under the capacity
+    """
+
+    def __init__(self, keys=(), capacity: int = 16, base_latency: float = 0.01, throttle_rate: float = 0.0):
+        self.objects = {key: 1024 for key in keys}
+        self._sorted_keys = None
+        self.capacity = capacity
+        self.base_latency = base_latency
+        self.throttle_rate = throttle_rate
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self.stats = {'requests': 0, 'throttled': 0, 'max_inflight': 0}
+
+    def _request(self, operation: str):
+        with self._lock:
+            self._inflight += 1
+            inflight = self._inflight
+            self.stats['requests'] += 1
+            self.stats['max_inflight'] = max(self.stats['max_inflight'], inflight)
+        try:
+            time.sleep(self.base_latency * (1 + inflight / self.capacity))
+            if inflight > self.capacity or random.random() < self.throttle_rate:
+                with self._lock:
+                    self.stats['throttled'] += 1
+                raise ClientError(
+                    {
+                        'Error': {'Code': 'SlowDown', 'Message': 'Please reduce your request rate.'},
+                        'ResponseMetadata': {'HTTPStatusCode': 503}
+                    },
+                    operation
+                )
+        finally:
+            with self._lock:
+                self._inflight -= 1
+
+    def list_objects_v2(self, Bucket, Prefix='', MaxKeys=1000, ContinuationToken=None, **kwargs):
+        self._request('ListObjectsV2')
+        with self._lock:
+            if self._sorted_keys is None:
+                self._sorted_keys = sorted(self.objects)
+            keys = self._sorted_keys
+        # continuation token: last key of the previous page
+        start = bisect.bisect_right(keys, ContinuationToken) if ContinuationToken else bisect.bisect_left(keys, Prefix)
+        page = [key for key in keys[start:start + MaxKeys] if key.startswith(Prefix)]
+        response = {'Contents': [{'Key': key, 'Size': self.objects.get(key, 0)} for key in page]}
+        if len(page) == MaxKeys and start + MaxKeys < len(keys) and keys[start + MaxKeys].startswith(Prefix):
+            response.update(IsTruncated=True, NextContinuationToken=page[-1])
+        return response
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._request('DeleteObjects')
+        with self._lock:
+            for obj in Delete['Objects']:
+                self.objects.pop(obj['Key'], None)
+            self._sorted_keys = None
+        return {'Deleted': [{'Key': obj['Key']} for obj in Delete['Objects']]}
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        self._request('PutObject')
+        with self._lock:
+            self.objects[Key] = len(Body)
+            self._sorted_keys = None
+        return {}
+
+    def close(self):
+        pass
+
+
+def main():
+    """Delete a stand-in bucket with fixed and adaptive concurrency and compare"""
+    from s3_remove_prefix import scan_prefix, delete_objects_concurrent
+
+    parser = argparse.ArgumentParser(description='Check the adaptive concurrency against a throttling stand-in')
+    parser.add_argument('--objects', type=int, default=100000,
+                        help='Objects in the stand-in bucket (default: 100000)')
+    parser.add_argument('--capacity', type=int, default=16,
+                        help='Concurrent requests served without throttling (default: 16)')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Request latency in seconds without load (default: 0.02)')
+    parser.add_argument('--fixed', type=int, nargs='+', default=[4, 64],
+                        help='Fixed concurrencies compared (default: 4 64)')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+
+    keys = [f'region/sub/hindcast/daily/raw/r20250101/file{i:07d}.json' for i in range(args.objects)]
+    runs = [('fixed', concurrency) for concurrency in args.fixed] + [('adaptive', 64)]
+    for mode, concurrency in runs:
+        stand_in = ThrottlingS3StandIn(keys, capacity=args.capacity, base_latency=args.latency)
+        if mode == 'fixed':
+            controller = AdaptiveConcurrency(initial=concurrency, minimum=concurrency, maximum=concurrency, name=mode)
+        else:
+            controller = AdaptiveConcurrency(initial=4, maximum=concurrency, name=mode)
+
+        objects, _, _ = scan_prefix(stand_in, 'stand-in', '', controller=controller)
+        start = time.monotonic()
+        deleted, failed = delete_objects_concurrent(stand_in, 'stand-in', objects, controller=controller)
+        elapsed = time.monotonic() - start
+
+        logging.info(
+            "%s %s: %s deleted, %s failed in %.1f s (%.0f objects/s), %s requests, %s throttled",
+            mode, concurrency, deleted, failed, elapsed, deleted / elapsed if elapsed > 0 else 0,
+            stand_in.stats['requests'], stand_in.stats['throttled']
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -12,23 +12,34 @@ You will need to enter
 - Output format (leave as `None` or type `json`)
 
 A configuration JSON file is used to specify the
-local root directories, S3 bucket name, and other parameters.
+local root directories, S3 bucket name, and other parameters
+(run as a script, it is the `upload` subcommand of `cefi_transfer.py`).
 The script will walk through the entire CEFI data root directory,
 find all netcdf files, and upload the latest release to the specified S3 bucket.
 
 """
 
 import os
+import re
 import json
+import hashlib
 import logging
+import threading
 from datetime import datetime
-import fsspec
-import boto3
-from boto3.s3.transfer import TransferConfig
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from botocore.exceptions import ClientError
-import xarray as xr
-from kerchunk.hdf import SingleHdf5ToZarr
-from kerchunk.netCDF3 import NetCDF3ToZarr
+from kerchunk_cache import KerchunkCache, DEFAULT_CACHE_MAX_BYTES
+from s3_catalog import write_release_manifest, update_catalog
+from kerchunk_combine import build_combined_index, COMBINED_INDEX_NAME
+from s3_small_upload import put_small_object, get_pooled_s3_client
+from transfer_shard import ShardAssigner, shard_file, merge_reports
+from remote_readahead import ReadAheadFile
+from s3_throttle import AdaptiveConcurrency, AdaptiveTransferConfig
+from s3_mmap_upload import map_file, validate_netcdf_buffer, upload_mapped
+
+# xarray, fsspec, kerchunk and the zarr and repack stages are imported where they are used
+#  so the scripts importing this module (removal, watch, cefi_transfer) start fast
 
 # set up bucket
 S3_BUCKET_NAME = 'noaa-oar-cefi-regional-mom6-pds'
@@ -39,6 +50,32 @@ date_str = datetime.now().strftime("%Y%m%d")
 LOG_FILE = 's3_upload.log'
 log_path = os.path.join(script_dir, LOG_FILE)
 
+# release folder name (ex: r20250509)
+RELEASE_FOLDER_PATTERN = re.compile(r'^r\d{8}$')
+
+# number of files processed at the same time
+#  (each multipart upload also uses the TransferConfig threads)
+MAX_FILE_WORKERS = 4
+
+# number of release folders waiting to be finalized before discovery pauses
+MAX_PENDING_RELEASES = 8
+
+# concurrent part uploads per file (at start and at most), adapted to S3 throttling
+INITIAL_PART_CONCURRENCY = 10
+MAX_PART_CONCURRENCY = 32
+
+# local record of file checksums
+#  used to detect files that are unchanged between releases
+CHECKSUM_RECORD = os.path.join(script_dir, 's3_checksums.json')
+# guards the checksum record shared by the file worker threads
+CHECKSUM_RECORD_LOCK = threading.Lock()
+
+# run report (counts and object names of the last run)
+REPORT_FILE = os.path.join(script_dir, 's3_upload_report.json')
+
+# number of times objects failing verification are uploaded again
+MAX_REUPLOAD_ATTEMPTS = 2
+
 
 # CEFI data root abs path
 #  used to calculate relative path based on the local_root_dirs
@@ -60,10 +97,16 @@ def boto3_upload(
     s3_bucket_name: str,
     upload_config,
     s3_client,
+    overwrite: bool = False,
+    metadata: dict = None,
+    checksum_record: dict = None,
 ):
     """using boto3 to upload files to S3
     utilizing TransferConfig to configure multipart uploads
 
+    netcdf files are validated, checksummed and uploaded from one memory
+    mapping (see `s3_mmap_upload`), other files go through upload_file
+
     Parameters
     ----------
     local_file : str
@@ -76,18 +119,31 @@ def boto3_upload(
         TransferConfig object to configure multipart uploads
     s3_client : _type_
         boto3 S3 client object
+    overwrite : bool, optional
+        upload even if the object already exists (default: False)
+    metadata : dict, optional
+        user metadata stored with the object
+    checksum_record : dict, optional
+        checksum record created by `load_checksum_record`,
+        filled with the checksums of an uploaded netcdf file
+
+    Returns
+    -------
+    str
+        'uploaded', 'exists' (upload skipped) or 'failed'
     """
 
     # check object existence
     try:
         # Check if the object exists by calling head_object
-        s3_client.head_object(Bucket=s3_bucket_name, Key=obj_name)
-        logging.info(
-            "Object %s already exists in the bucket '%s'. Skipping upload.",
-            obj_name,
-            s3_bucket_name
-        )
-        return
+        if not overwrite:
+            s3_client.head_object(Bucket=s3_bucket_name, Key=obj_name)
+            logging.info(
+                "Object %s already exists in the bucket '%s'. Skipping upload.",
+                obj_name,
+                s3_bucket_name
+            )
+            return 'exists'
 
     except ClientError as e:
         # If the object doesn't exist
@@ -96,30 +152,50 @@ def boto3_upload(
         else:
             # Handle other errors (e.g., permission issues)
             logging.error("Error checking object existence: %s", e)
-            return
+            return 'failed'
 
-    # check local netcdf file data integrity (json file is not checked)
+    # netcdf file: validate, checksum and upload from one mapping of the file
     if local_file.endswith('.nc'):
-        try :
-            ds = xr.open_dataset(local_file)
-            ds.close()
+        try:
+            with map_file(local_file) as (buffer, stat):
+                try:
+                    validate_netcdf_buffer(buffer, local_file)
+                except Exception as e:
+                    logging.error("Error verifying local file %s: %s", local_file, e)
+                    return 'failed'
+                checksums = upload_mapped(
+                    buffer,
+                    stat,
+                    local_file=local_file,
+                    obj_name=obj_name,
+                    s3_bucket_name=s3_bucket_name,
+                    upload_config=upload_config,
+                    s3_client=s3_client,
+                    metadata=metadata
+                )
+                if checksum_record is not None:
+                    record_checksums(checksum_record, local_file, stat, **checksums)
+            logging.info('Uploaded: %s to %s called %s',local_file,s3_bucket_name,obj_name)
         except Exception as e:
-            logging.error("Error verifying local file %s: %s", local_file, e)
-            return
+            logging.error("Error uploading %s: %s",obj_name,e)
+            return 'failed'
+        return 'uploaded'
 
-    # upload object
+    # upload object (json file is not checked)
     try:
         s3_client.upload_file(
             local_file,
             s3_bucket_name,
             obj_name,
+            ExtraArgs={'Metadata': metadata} if metadata else None,
             Config=upload_config
         )
         logging.info('Uploaded: %s to %s called %s',local_file,s3_bucket_name,obj_name)
     except Exception as e:
         logging.error("Error uploading %s: %s",obj_name,e)
+        return 'failed'
 
-    return
+    return 'uploaded'
 
 def create_file_dict(local_root_dirs):
     """Create a dictionary of files to upload.
@@ -222,54 +298,549 @@ def keep_latest_release(dict_files):
 
     return dict_latest_release,dict_outdated_releases
 
-def verify_s3_file_access(s3_bucket_name: str, obj_name: str) -> bool:
+def iter_latest_releases(local_root_dirs):
+    """Walk the local root directory and yield the latest release of each
+    parent directory as soon as that parent directory is scanned.
+
+    Unlike `create_file_dict` and `keep_latest_release`, the whole tree is
+    never held in memory and the outdated release files are only listed
+    (for the unchanged-file detection), so uploads can start right away.
+    Release folders must be named rYYYYMMDD, symlinked folders are skipped.
+
+    Parameters
+    ----------
+    local_root_dirs : str
+        local root directory to search for files
+
+    Yields
+    ------
+    tuple
+        (parent_dir, release_folder, list_files, dict_previous_releases)
+        where list_files is the list of {'local': ..., 'cloud': ...} of the
+        latest release and dict_previous_releases is
+        {release_folder: [file_info, ...]} of the older releases
     """
-    Verify that the uploaded S3 file can be accessed remotely and opened with xarray.
-    
+    for dirpath, dirnames, _ in os.walk(local_root_dirs):
+        release_folders = sorted(
+            (
+                d for d in dirnames
+                if RELEASE_FOLDER_PATTERN.match(d)
+                and not os.path.islink(os.path.join(dirpath, d))
+            ),
+            reverse=True
+        )
+        # do not descend into release folders, walk in a deterministic order
+        dirnames[:] = sorted(d for d in dirnames if not RELEASE_FOLDER_PATTERN.match(d))
+        if not release_folders:
+            continue
+
+        parent_dir = dirpath
+        dict_releases = {}
+        for release_folder in release_folders:
+            release_dirpath = os.path.join(dirpath, release_folder)
+            relative_dirpath = os.path.relpath(release_dirpath, PORTAL_DATA_PATH)
+            try:
+                filenames = sorted(
+                    entry.name for entry in os.scandir(release_dirpath)
+                    if entry.name.endswith('.nc') and entry.is_file()
+                )
+            except OSError as e:
+                logging.error("Error listing %s: %s", release_dirpath, e)
+                continue
+            if filenames:
+                dict_releases[release_folder] = [
+                    {
+                        'local': os.path.join(release_dirpath, filename),
+                        'cloud': os.path.join(relative_dirpath, filename)
+                    }
+                    for filename in filenames
+                ]
+
+        if not dict_releases:
+            continue
+        latest_release = max(dict_releases)
+        list_files = dict_releases.pop(latest_release)
+        yield parent_dir, latest_release, list_files, dict_releases
+
+def load_checksum_record(record_file: str) -> dict:
+    """Load the local checksum record.
+
+    Parameters
+    ----------
+    record_file : str
+        path to the checksum record JSON file
+
+    Returns
+    -------
+    dict
+        Dictionary keyed by local file path. Each value holds the
+        'size', 'mtime' and 'sha256' of the file when it was hashed.
+        ex:
+        record = {
+            local_file_path: {'size': 1234, 'mtime': 1715000000.0, 'sha256': 'abc...'},
+            ...
+        }
+    """
+    if not os.path.exists(record_file):
+        return {}
+    try:
+        with open(record_file, 'r', encoding='utf-8') as jsonfile:
+            return json.load(jsonfile)
+    except (OSError, ValueError) as e:
+        logging.warning("Checksum record %s unreadable, starting fresh: %s", record_file, e)
+        return {}
+
+def save_checksum_record(record: dict, record_file: str):
+    """Save the local checksum record (written to a temp file then renamed).
+
     Parameters
     ----------
+    record : dict
+        checksum record created by `load_checksum_record`
+    record_file : str
+        path to the checksum record JSON file
+    """
+    with CHECKSUM_RECORD_LOCK:
+        snapshot = {local_file: dict(entry) for local_file, entry in record.items()}
+    tmp_file = f'{record_file}.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as jsonfile:
+        json.dump(snapshot, jsonfile)
+    os.replace(tmp_file, record_file)
+
+def record_checksums(record: dict, local_file: str, stat: os.stat_result, **checksums):
+    """Store checksums of a local file in the checksum record.
+
+    The record is shared by the file worker threads, so entries are only
+    changed through this function (under CHECKSUM_RECORD_LOCK). The
+    checksums already in the entry are kept when the file is unchanged,
+    the entry starts over when its size or modification time changed.
+
+    Parameters
+    ----------
+    record : dict
+        checksum record created by `load_checksum_record`, updated in place
+    local_file : str
+        local data absolute path including filename
+    stat : os.stat_result
+        stat of the local file when the checksums were computed
+    **checksums
+        checksum fields of the entry ('sha256', 'md5', 'etag', 'etag_part_size')
+    """
+    with CHECKSUM_RECORD_LOCK:
+        entry = record.get(local_file)
+        if not entry or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        else:
+            entry = dict(entry)
+        entry.update(checksums)
+        record[local_file] = entry
+
+def file_sha256(local_file: str, record: dict = None) -> str:
+    """Compute the SHA-256 checksum of a local file.
+
+    The checksum is reused from the record when the file size and
+    modification time have not changed since it was last hashed.
+
+    Parameters
+    ----------
+    local_file : str
+        local data absolute path including filename
+    record : dict, optional
+        checksum record created by `load_checksum_record`, updated in place
+
+    Returns
+    -------
+    str
+        hex digest of the file content
+    """
+    stat = os.stat(local_file)
+    if record is not None:
+        entry = record.get(local_file)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            # entries created by `compute_s3_etag` have no sha256 yet
+            if entry.get('sha256'):
+                return entry['sha256']
+
+    sha = hashlib.sha256()
+    with open(local_file, 'rb') as f:
+        for block in iter(lambda: f.read(8 * 1024 * 1024), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+
+    if record is not None:
+        record_checksums(record, local_file, stat, sha256=digest)
+    return digest
+
+def find_previous_release_file(
+    file_info: dict,
+    release_folder: str,
+    dict_previous_releases: dict
+):
+    """Find the same file in the most recent previous release.
+
+    CEFI file names carry the release tag
+    (ex: tos.nep.full.hcast.daily.raw.r20250509.199301-201912.nc),
+    so the previous file name is built by swapping the release tag.
+
+    Parameters
+    ----------
+    file_info : dict
+        {'local': local_file_path, 'cloud': cloud_object_name} of the new file
+    release_folder : str
+        release folder of the new file (ex: r20250509)
+    dict_previous_releases : dict
+        older release folders of the same parent directory
+        {release_folder: [file_info, ...]} (see `keep_latest_release`)
+
+    Returns
+    -------
+    dict or None
+        file_info of the previous release file, None if not found
+    """
+    filename = os.path.basename(file_info['local'])
+    for previous_release in sorted(dict_previous_releases, reverse=True):
+        previous_filename = filename.replace(release_folder, previous_release)
+        for previous_info in dict_previous_releases[previous_release]:
+            if os.path.basename(previous_info['local']) == previous_filename:
+                return previous_info
+    return None
+
+def boto3_copy_unchanged(
+    file_info: dict,
+    previous_info: dict,
+    s3_bucket_name: str,
+    upload_config,
+    s3_client,
+    checksum_record: dict,
+) -> bool:
+    """using boto3 server-side copy to create the new release object
+    from the previous release object when the file content is identical
+
+    The managed copy switches to `upload_part_copy` above the
+    TransferConfig multipart threshold, so no data goes over the
+    local network link.
+
+    Parameters
+    ----------
+    file_info : dict
+        {'local': local_file_path, 'cloud': cloud_object_name} of the new file
+    previous_info : dict
+        {'local': local_file_path, 'cloud': cloud_object_name} of the previous release file
     s3_bucket_name : str
         S3 bucket name
-    obj_name : str
-        S3 object key/name
-        
+    upload_config : _type_
+        TransferConfig object to configure multipart copies
+    s3_client : _type_
+        boto3 S3 client object
+    checksum_record : dict
+        checksum record created by `load_checksum_record`
+
     Returns
     -------
     bool
-        True if file can be accessed and opened with xarray, False otherwise
+        True if the new object was created by server-side copy
+    """
+    local_file = file_info['local']
+    obj_name = file_info['cloud']
+    src_obj_name = previous_info['cloud']
+
+    # cheap check before hashing: identical files have identical sizes
+    try:
+        if os.path.getsize(local_file) != os.path.getsize(previous_info['local']):
+            return False
+    except OSError:
+        return False
+
+    # the new object already exists (boto3_upload will skip it as well)
+    try:
+        s3_client.head_object(Bucket=s3_bucket_name, Key=obj_name)
+        return False
+    except ClientError as e:
+        if e.response['Error']['Code'] != '404':
+            logging.error("Error checking object existence: %s", e)
+            return False
+
+    # the previous object has to be in the bucket with the same size
+    try:
+        src_head = s3_client.head_object(Bucket=s3_bucket_name, Key=src_obj_name)
+    except ClientError:
+        return False
+    local_size = os.path.getsize(local_file)
+    if src_head['ContentLength'] != local_size:
+        return False
+
+    checksum = file_sha256(local_file, checksum_record)
+    previous_checksum = src_head.get('Metadata', {}).get('sha256')
+    if previous_checksum is None:
+        previous_checksum = file_sha256(previous_info['local'], checksum_record)
+    if checksum != previous_checksum:
+        return False
+
+    try:
+        s3_client.copy(
+            {'Bucket': s3_bucket_name, 'Key': src_obj_name},
+            s3_bucket_name,
+            obj_name,
+            ExtraArgs={'Metadata': {'sha256': checksum}, 'MetadataDirective': 'REPLACE'},
+            Config=upload_config
+        )
+        logging.info('Copied: %s to %s (unchanged content)', src_obj_name, obj_name)
+        return True
+    except Exception as e:
+        logging.error("Error copying %s to %s: %s", src_obj_name, obj_name, e)
+        return False
+
+def rewrite_kerchunk_index(
+    src_obj_name: str,
+    obj_name: str,
+    s3_bucket_name: str,
+    json_file: str,
+    s3_client,
+):
+    """Create the kerchunk index of a copied object by rewriting the
+    previous release index to point at the new object key
+
+    Parameters
+    ----------
+    src_obj_name : str
+        object name of the previous release netcdf file
+    obj_name : str
+        object name of the new release netcdf file
+    s3_bucket_name : str
+        S3 bucket name
+    json_file : str
+        local path of the rewritten Kerchunk index file
+    s3_client : _type_
+        boto3 S3 client object
+
+    Returns
+    -------
+    str or None
+        local path of the rewritten index, None if the previous index is not available
+    """
+    src_json_name = src_obj_name.removesuffix('.nc') + '.json'
+    try:
+        response = s3_client.get_object(Bucket=s3_bucket_name, Key=src_json_name)
+        refs = json.loads(response['Body'].read())
+    except (ClientError, ValueError) as e:
+        logging.info("Previous kerchunk index %s not available: %s", src_json_name, e)
+        return None
+
+    # hdf5 references are written without the protocol, netcdf3 ones with it
+    old_urls = (f'{s3_bucket_name}/{src_obj_name}', f's3://{s3_bucket_name}/{src_obj_name}')
+    for ref in refs.get('refs', {}).values():
+        # chunk references are [url, offset, length] or [url]
+        if isinstance(ref, list) and ref and ref[0] in old_urls:
+            ref[0] = ref[0].removesuffix(src_obj_name) + obj_name
+
+    os.makedirs(os.path.dirname(json_file), exist_ok=True)
+    with open(json_file, "wb") as f:
+        f.write(json.dumps(refs).encode())
+    logging.info("Rewrote kerchunk index %s for %s", src_json_name, obj_name)
+
+    return json_file
+
+def compute_s3_etag(local_file: str, upload_config, record: dict = None) -> dict:
+    """Compute the ETags S3 can assign to a local file
+
+    Single part uploads (and copy_object) get the MD5 of the content,
+    multipart uploads get the MD5 of the concatenated part MD5s followed
+    by '-<number of parts>' using the upload_config part size.
+
+    Parameters
+    ----------
+    local_file : str
+        local data absolute path including filename
+    upload_config : _type_
+        TransferConfig object used for the upload
+    record : dict, optional
+        checksum record created by `load_checksum_record`, updated in place
+
+    Returns
+    -------
+    dict
+        {'md5': single part ETag, 'multipart': multipart ETag} (without quotes)
     """
-    s3_storage_options = {
-        "remote_options": {"anon": True},
-        "remote_protocol": "s3",
-        # "target_options": {"anon": True},
-        "target_protocol": "s3",
+    stat = os.stat(local_file)
+    part_size = upload_config.multipart_chunksize
+    if record is not None:
+        entry = record.get(local_file)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            if entry.get('etag_part_size') == part_size and entry.get('md5'):
+                return {'md5': entry['md5'], 'multipart': entry['etag']}
+
+    md5 = hashlib.md5()
+    part_md5s = []
+    with open(local_file, 'rb') as f:
+        for part in iter(lambda: f.read(part_size), b''):
+            md5.update(part)
+            part_md5s.append(hashlib.md5(part).digest())
+    etags = {
+        'md5': md5.hexdigest(),
+        'multipart': f"{hashlib.md5(b''.join(part_md5s)).hexdigest()}-{len(part_md5s)}"
     }
+
+    if record is not None:
+        record_checksums(
+            record, local_file, stat,
+            md5=etags['md5'], etag=etags['multipart'], etag_part_size=part_size
+        )
+    return etags
+
+def verify_s3_object(
+    file_info: dict,
+    s3_bucket_name: str,
+    upload_config,
+    s3_client,
+    checksum_record: dict = None,
+    sample_count: int = 4,
+    sample_bytes: int = 64 * 1024,
+) -> bool:
+    """
+    Verify that the uploaded S3 object matches the local file and can be read remotely.
+
+    The remote size and ETag are compared with the local values, then the
+    file header and a sample of byte ranges spread over the object are
+    range-read and compared with the local bytes.
+
+    Parameters
+    ----------
+    file_info : dict
+        {'local': local_file_path, 'cloud': cloud_object_name} of the netcdf file
+    s3_bucket_name : str
+        S3 bucket name
+    upload_config : _type_
+        TransferConfig object used for the upload (to compute the expected ETag)
+    s3_client : _type_
+        boto3 S3 client object
+    checksum_record : dict, optional
+        checksum record created by `load_checksum_record`
+    sample_count : int
+        number of byte ranges read besides the header
+    sample_bytes : int
+        length of each sampled byte range
+
+    Returns
+    -------
+    bool
+        True if the object matches the local file, False otherwise
+    """
+    local_file = file_info['local']
+    obj_name = file_info['cloud']
     try:
-        # Construct S3 path
-        s3_path = f's3://{s3_bucket_name}/{obj_name}'
-
-        with xr.open_dataset(
-            s3_path,
-            engine="netcdf4",
-            chunks='auto',
-            storage_options=s3_storage_options
-        ) as ds:
-            # Basic validation - check if dataset has variables
-            if len(ds.data_vars) > 0:
-                logging.info("File validation passed - %s", ds[ds.attrs['cefi_variable']])
-                return True
-            else:
-                logging.warning("File opened but contains no data variables")
-                return False
-                
+        head = s3_client.head_object(Bucket=s3_bucket_name, Key=obj_name)
+        local_size = os.path.getsize(local_file)
+        if head['ContentLength'] != local_size:
+            logging.error(
+                "Size mismatch for %s: remote %s, local %s",
+                obj_name, head['ContentLength'], local_size
+            )
+            return False
+
+        # multipart objects get a '-<number of parts>' ETag
+        remote_etag = head['ETag'].strip('"')
+        local_etags = compute_s3_etag(local_file, upload_config, checksum_record)
+        local_etag = local_etags['multipart'] if '-' in remote_etag else local_etags['md5']
+        if remote_etag != local_etag:
+            logging.error(
+                "ETag mismatch for %s: remote %s, local %s",
+                obj_name, remote_etag, local_etag
+            )
+            return False
+
+        # header plus ranges spread evenly over the object
+        offsets = [0]
+        if local_size > sample_bytes:
+            step = (local_size - sample_bytes) // max(sample_count, 1)
+            offsets.extend(step * (i + 1) for i in range(sample_count))
+
+        with open(local_file, 'rb') as f:
+            for offset in offsets:
+                length = min(sample_bytes, local_size - offset)
+                if length <= 0:
+                    continue
+                response = s3_client.get_object(
+                    Bucket=s3_bucket_name,
+                    Key=obj_name,
+                    Range=f'bytes={offset}-{offset + length - 1}'
+                )
+                remote_bytes = response['Body'].read()
+                f.seek(offset)
+                if remote_bytes != f.read(length):
+                    logging.error("Byte range %s+%s differs for %s", offset, length, obj_name)
+                    return False
+
+                # netcdf4 (HDF5) or netcdf3 (CDF) signature
+                if offset == 0 and not remote_bytes.startswith((b'\x89HDF\r\n\x1a\n', b'CDF')):
+                    logging.error("Object %s does not start with a netcdf header", obj_name)
+                    return False
+
     except Exception as e:
-        logging.error("Failed to verify S3 file access: %s", e)
+        logging.error("Failed to verify S3 file access for %s: %s", obj_name, e)
         return False
 
+    logging.info("File validation passed - %s", obj_name)
+    return True
+
+def verify_s3_objects(
+    list_file_info: list,
+    s3_bucket_name: str,
+    upload_config,
+    s3_client,
+    checksum_record: dict = None,
+    max_workers: int = 16,
+) -> list:
+    """Verify many uploaded S3 objects concurrently with a bounded thread pool
+
+    Parameters
+    ----------
+    list_file_info : list
+        list of {'local': local_file_path, 'cloud': cloud_object_name}
+    s3_bucket_name : str
+        S3 bucket name
+    upload_config : _type_
+        TransferConfig object used for the upload
+    s3_client : _type_
+        boto3 S3 client object (thread safe, shared by the workers)
+    checksum_record : dict, optional
+        checksum record created by `load_checksum_record`
+    max_workers : int
+        maximum number of objects verified at the same time
+
+    Returns
+    -------
+    list
+        file_info of the objects that failed verification
+    """
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                verify_s3_object,
+                file_info,
+                s3_bucket_name,
+                upload_config,
+                s3_client,
+                checksum_record
+            ): file_info
+            for file_info in list_file_info
+        }
+        for future in as_completed(futures):
+            if not future.result():
+                failed.append(futures[future])
+
+    logging.info(
+        "Verified %s objects: %s passed, %s failed",
+        len(list_file_info), len(list_file_info) - len(failed), len(failed)
+    )
+    return failed
+
 def gen_kerchunk_index(
     s3_path : str,
     save_dir : str,
-    server : str = 's3'
+    server : str = 's3',
+    cache : KerchunkCache = None,
+    read_stats : dict = None
 )-> str:
     """
     Use Kerchunk's `SingleHdf5ToZarr` method to create a 
@@ -284,7 +855,17 @@ def gen_kerchunk_index(
         The directory to save the Kerchunk index file
     server : str
         The cloud storage server to use (default: 's3')
+    cache : KerchunkCache, optional
+        Reference cache keyed by (object key, size, ETag). When given,
+        the index is written into the cache and `save_dir` is not used.
+    read_stats : dict, optional
+        updated with the remote reads of the indexing
+        (requests, bytes_fetched, reads, bytes_read, see `ReadAheadFile`)
     """
+    import fsspec
+    from kerchunk.hdf import SingleHdf5ToZarr
+    from kerchunk.netCDF3 import NetCDF3ToZarr
+
     # start a filesystem reference for publically accessible cloud storage
     fs_read = fsspec.filesystem(server, anon=True)
     s3_file_paths = fs_read.glob(s3_path)
@@ -297,110 +878,849 @@ def gen_kerchunk_index(
 
     # create index file name for the cloud storage netcdf file
     filename = s3_file.split("/")[-1].removesuffix(".nc")
-    json_file = os.path.join(save_dir, f"{filename}.json")
 
-    # check if the json file already exist locally
-    if os.path.exists(json_file):
-        logging.info(f"JSON file already exists, skip kerchunking: {json_file}")
-        return json_file
+    if cache is not None:
+        # reuse the cached index if the netcdf object did not change
+        obj_name = s3_file.split("/", 1)[1]
+        s3_info = fs_read.info(s3_file)
+        json_file = cache.get(obj_name, s3_info['size'], s3_info['ETag'])
+        if json_file is not None:
+            logging.info(f"JSON file found in cache, skip kerchunking: {json_file}")
+            return json_file
+        json_file = cache.path_for(obj_name)
+        os.makedirs(os.path.dirname(json_file), exist_ok=True)
+    else:
+        json_file = os.path.join(save_dir, f"{filename}.json")
 
-    # open file for remote read and indexing
-    with fs_read.open(s3_file, **dict(mode="rb")) as infile:
-        logging_run = f"Running kerchunk index generation for {s3_file}..."
-        logging.info(logging_run)
+        # check if the json file already exist locally
+        if os.path.exists(json_file):
+            logging.info(f"JSON file already exists, skip kerchunking: {json_file}")
+            return json_file
 
-        if 'static' not in filename:
+    logging_run = f"Running kerchunk index generation for {s3_file}..."
+    logging.info(logging_run)
+
+    if 'static' not in filename:
+        # open file for remote read and indexing
+        #  (block read-ahead, the metadata walk takes a few requests instead of hundreds)
+        with ReadAheadFile(fs_read, s3_file) as infile:
             # Chunks smaller than `inline_threshold` will be stored directly
             # in the reference file as data (as opposed to a URL and byte range).
-            kchunks = SingleHdf5ToZarr(infile, s3_file, inline_threshold=300)
-        else: 
-            kchunks = NetCDF3ToZarr('s3://'+s3_file, inline_threshold=300)
+            refs = SingleHdf5ToZarr(infile, s3_file, inline_threshold=300).translate()
+        if read_stats is not None:
+            read_stats.update(infile.stats)
+    else:
+        refs = NetCDF3ToZarr('s3://'+s3_file, inline_threshold=300).translate()
 
+    with open(json_file, "wb") as f:
+        f.write(json.dumps(refs).encode())
 
-        with open(json_file, "wb") as f:
-            f.write(json.dumps(kchunks.translate()).encode())
+    if cache is not None:
+        cache.put(obj_name, s3_info['size'], s3_info['ETag'], json_file)
 
-        return json_file
+    return json_file
 
-if __name__ == '__main__':
-    # setup if performing kerchunking alongside file upload
-    KERCHUNK_FLAG = True
+def remote_index_is_current(
+    obj_name: str,
+    json_obj_name: str,
+    s3_bucket_name: str,
+    s3_client,
+):
+    """Check if the kerchunk index in the bucket was built from the current netcdf object
+
+    The netcdf object size and ETag are stored in the index object
+    metadata ('source-size', 'source-etag') when the index is uploaded.
+
+    Parameters
+    ----------
+    obj_name : str
+        object name of the netcdf file
+    json_obj_name : str
+        object name of the kerchunk index file
+    s3_bucket_name : str
+        S3 bucket name
+    s3_client : _type_
+        boto3 S3 client object
+
+    Returns
+    -------
+    tuple
+        (is_current, source_metadata) where source_metadata is the metadata
+        to store with a newly uploaded index (None if the netcdf object is missing)
+    """
+    try:
+        nc_head = s3_client.head_object(Bucket=s3_bucket_name, Key=obj_name)
+    except ClientError as e:
+        logging.error("Error checking object %s: %s", obj_name, e)
+        return False, None
+    source_metadata = {
+        'source-size': str(nc_head['ContentLength']),
+        'source-etag': nc_head['ETag'].strip('"')
+    }
+
+    try:
+        json_head = s3_client.head_object(Bucket=s3_bucket_name, Key=json_obj_name)
+    except ClientError:
+        return False, source_metadata
 
-    # Setup logging file
-    if os.path.exists(LOG_FILE):
-        os.remove(LOG_FILE)
-    setup_logging(LOG_FILE)
+    json_metadata = json_head.get('Metadata', {})
+    is_current = all(json_metadata.get(k) == v for k, v in source_metadata.items())
+    return is_current, source_metadata
 
-    if KERCHUNK_FLAG:
+def process_file(
+    file_info: dict,
+    release_folder: str,
+    dict_previous_releases: dict,
+    s3_bucket_name: str,
+    upload_config,
+    s3_client,
+    checksum_record: dict,
+    kerchunk_cache: KerchunkCache = None,
+):
+    """Upload (or server-side copy) one netcdf file and its kerchunk index
+
+    Parameters
+    ----------
+    file_info : dict
+        {'local': local_file_path, 'cloud': cloud_object_name} of the netcdf file
+    release_folder : str
+        release folder of the file (ex: r20250509)
+    dict_previous_releases : dict
+        older release folders of the same parent directory
+        {release_folder: [file_info, ...]} (see `keep_latest_release`)
+    s3_bucket_name : str
+        S3 bucket name
+    upload_config : _type_
+        TransferConfig object to configure multipart uploads
+    s3_client : _type_
+        boto3 S3 client object
+    checksum_record : dict
+        checksum record created by `load_checksum_record`
+    kerchunk_cache : KerchunkCache, optional
+        Reference cache that holds the Kerchunk index files,
+        kerchunking is skipped when None
+
+    Returns
+    -------
+    dict
+        result of the file processing
+        {'cloud': cloud_object_name, 'action': action, 'index': index}
+        where action is 'uploaded', 'copied', 'exists' or 'failed'
+        and index is 'built', 'current', 'failed' or None (kerchunking skipped),
+        with 'index_requests' and 'index_bytes' of the remote reads when indexed
+        and 'error' when an exception stopped the transfer or the indexing
+        (errors are caught here so one file does not stop the run)
+    """
+    result = {'cloud': file_info['cloud'], 'action': 'failed', 'index': None}
+    try:
+        previous_info, copied = _transfer_file(
+            file_info, release_folder, dict_previous_releases,
+            s3_bucket_name, upload_config, s3_client, checksum_record, result
+        )
+    except Exception as e:
+        logging.error("Error transferring %s: %s", file_info['local'], e)
+        result.update(action='failed', error=str(e))
+        return result
+
+    if kerchunk_cache is None or result['action'] == 'failed':
+        return result
+
+    try:
+        _index_file(
+            file_info, previous_info, copied,
+            s3_bucket_name, s3_client, kerchunk_cache, result
+        )
+    except Exception as e:
+        logging.error("Error indexing %s: %s", file_info['cloud'], e)
+        result.update(index='failed', error=str(e))
+    return result
+
+def _transfer_file(
+    file_info: dict,
+    release_folder: str,
+    dict_previous_releases: dict,
+    s3_bucket_name: str,
+    upload_config,
+    s3_client,
+    checksum_record: dict,
+    result: dict,
+) -> tuple:
+    """Copy or upload the netcdf file of `process_file`, setting result['action'].
+
+    Returns (previous release file_info or None, True if copied).
+    """
+    # Get the local file path and cloud object name for netcdf
+    local_file_path = file_info['local']
+    cloud_object_name = file_info['cloud']
+
+    # Copy the unchanged netcdf file from the previous release on S3
+    previous_info = find_previous_release_file(
+        file_info, release_folder, dict_previous_releases
+    )
+    copied = False
+    result['action'] = 'copied'
+    if previous_info is not None:
+        copied = boto3_copy_unchanged(
+            file_info=file_info,
+            previous_info=previous_info,
+            s3_bucket_name=s3_bucket_name,
+            upload_config=upload_config,
+            s3_client=s3_client,
+            checksum_record=checksum_record
+        )
+
+    # Upload the netcdf file to S3
+    if not copied:
+        result['action'] = boto3_upload(
+            local_file=local_file_path,
+            obj_name=cloud_object_name,
+            s3_bucket_name=s3_bucket_name,
+            upload_config=upload_config,
+            s3_client=s3_client,
+            checksum_record=checksum_record
+        )
+
+    return previous_info, copied
+
+def _index_file(
+    file_info: dict,
+    previous_info: dict,
+    copied: bool,
+    s3_bucket_name: str,
+    s3_client,
+    kerchunk_cache: KerchunkCache,
+    result: dict,
+):
+    """Build (or rewrite) and upload the kerchunk index of `process_file`, setting result['index']."""
+    cloud_object_name = file_info['cloud']
+
+    # skip indexing when the index in the bucket matches the netcdf object
+    json_obj_name = cloud_object_name.removesuffix(".nc") + ".json"
+    is_current, source_metadata = remote_index_is_current(
+        obj_name=cloud_object_name,
+        json_obj_name=json_obj_name,
+        s3_bucket_name=s3_bucket_name,
+        s3_client=s3_client
+    )
+    if is_current:
+        logging.info("Kerchunk index %s is current, skip kerchunking.", json_obj_name)
+        result['index'] = 'current'
+        return
+    if source_metadata is None:
+        return
+
+    # create kerchunk json file
+    #  (rewrite the previous release index for copied files)
+    local_json_path = kerchunk_cache.get(
+        cloud_object_name,
+        int(source_metadata['source-size']),
+        f'"{source_metadata["source-etag"]}"'
+    )
+    if local_json_path is None and copied:
+        local_json_path = rewrite_kerchunk_index(
+            src_obj_name=previous_info['cloud'],
+            obj_name=cloud_object_name,
+            s3_bucket_name=s3_bucket_name,
+            json_file=kerchunk_cache.path_for(cloud_object_name),
+            s3_client=s3_client
+        )
+        if local_json_path is not None:
+            kerchunk_cache.put(
+                cloud_object_name,
+                int(source_metadata['source-size']),
+                f'"{source_metadata["source-etag"]}"',
+                local_json_path
+            )
+    if local_json_path is None:
+        s3_ncfile_path = f's3://{s3_bucket_name}/{cloud_object_name}'
+        index_read_stats = {}
+        local_json_path = gen_kerchunk_index(
+            s3_path=s3_ncfile_path,
+            save_dir=kerchunk_cache.cache_dir,
+            cache=kerchunk_cache,
+            read_stats=index_read_stats
+        )
+        if index_read_stats:
+            result['index_requests'] = index_read_stats['requests']
+            result['index_bytes'] = index_read_stats['bytes_fetched']
+
+    # Upload the json file to S3 (replacing an outdated index)
+    #  small object, a single PUT without existence check or multipart setup
+    if put_small_object(
+        local_file=local_json_path,
+        obj_name=json_obj_name,
+        s3_bucket_name=s3_bucket_name,
+        s3_client=s3_client,
+        metadata=source_metadata
+    ):
+        result['index'] = 'built'
+    else:
+        result['index'] = 'failed'
+
+def verify_and_reupload(
+    list_file_info: list,
+    s3_bucket_name: str,
+    upload_config,
+    s3_client,
+    checksum_record: dict = None,
+) -> list:
+    """Verify transferred objects and upload the failing ones again
+
+    Parameters
+    ----------
+    list_file_info : list
+        list of {'local': local_file_path, 'cloud': cloud_object_name}
+    s3_bucket_name : str
+        S3 bucket name
+    upload_config : _type_
+        TransferConfig object to configure multipart uploads
+    s3_client : _type_
+        boto3 S3 client object
+    checksum_record : dict, optional
+        checksum record created by `load_checksum_record`
+
+    Returns
+    -------
+    list
+        file_info of the objects still failing after MAX_REUPLOAD_ATTEMPTS
+    """
+    list_verify_failed = verify_s3_objects(
+        list_file_info,
+        s3_bucket_name=s3_bucket_name,
+        upload_config=upload_config,
+        s3_client=s3_client,
+        checksum_record=checksum_record
+    )
+    for attempt in range(MAX_REUPLOAD_ATTEMPTS):
+        if not list_verify_failed:
+            break
+        logging.info(
+            "Re-upload attempt %s for %s objects", attempt + 1, len(list_verify_failed)
+        )
+        for file_info in list_verify_failed:
+            boto3_upload(
+                local_file=file_info['local'],
+                obj_name=file_info['cloud'],
+                s3_bucket_name=s3_bucket_name,
+                upload_config=upload_config,
+                s3_client=s3_client,
+                overwrite=True,
+                checksum_record=checksum_record
+            )
+        list_verify_failed = verify_s3_objects(
+            list_verify_failed,
+            s3_bucket_name=s3_bucket_name,
+            upload_config=upload_config,
+            s3_client=s3_client,
+            checksum_record=checksum_record
+        )
+    return list_verify_failed
+
+def finalize_release(
+    list_files: list,
+    list_release_results: list,
+    s3_bucket_name: str,
+    upload_config,
+    s3_client,
+    checksum_record: dict,
+    run_report: dict,
+    kerchunk_save_dir: str = None,
+    zarr_save_dir: str = None,
+    publish: bool = True,
+) -> dict:
+    """Finish a release folder once all its files are processed
+
+    Verifies the transferred objects (re-uploading failures), creates the
+    optional zarr copies, then publishes the release (see `publish_release`).
+
+    Parameters
+    ----------
+    list_files : list
+        list of {'local': local_file_path, 'cloud': cloud_object_name} of the release
+    list_release_results : list
+        results of `process_file` for list_files
+    s3_bucket_name : str
+        S3 bucket name
+    upload_config : _type_
+        TransferConfig object to configure multipart uploads
+    s3_client : _type_
+        boto3 S3 client object
+    checksum_record : dict
+        checksum record created by `load_checksum_record`
+    run_report : dict
+        run report updated in place ('results', 'verified', 'verify_failed', 'zarr')
+    kerchunk_save_dir : str, optional
+        The directory to save the combined Kerchunk index,
+        combining is skipped when None
+    zarr_save_dir : str, optional
+        The directory of the local zarr stores,
+        zarr copies are skipped when None
+    publish : bool
+        publish the release, False when list_files is only the part of the
+        release processed by a shard (the checksums are then added to
+        run_report['checksums'] for the merge step)
+
+    Returns
+    -------
+    dict or None
+        release summary of `write_release_manifest`, None if not published
+    """
+    release_prefix = os.path.dirname(list_files[0]['cloud'])
+    run_report['results'].extend(list_release_results)
+
+    # verify the transferred objects, upload the failed ones again
+    list_transferred = [
+        file_info for file_info, result in zip(list_files, list_release_results)
+        if result['action'] in ('uploaded', 'copied')
+    ]
+    list_verify_failed = verify_and_reupload(
+        list_transferred,
+        s3_bucket_name=s3_bucket_name,
+        upload_config=upload_config,
+        s3_client=s3_client,
+        checksum_record=checksum_record
+    )
+    run_report['verified'] += len(list_transferred) - len(list_verify_failed)
+    run_report['verify_failed'].extend(file_info['cloud'] for file_info in list_verify_failed)
+
+    # time-series optimized zarr copy under the parallel prefix
+    if zarr_save_dir is not None:
+        from zarr_rechunk import (
+            rechunk_to_zarr,
+            upload_zarr_store,
+            zarr_object_prefix,
+            is_zarr_candidate
+        )
+    for file_info in list_files:
+        if zarr_save_dir is None or not is_zarr_candidate(file_info['cloud']):
+            continue
+        zarr_prefix = zarr_object_prefix(file_info['cloud'])
+        try:
+            zarr_result = rechunk_to_zarr(
+                local_file=file_info['local'],
+                store_path=os.path.join(zarr_save_dir, zarr_prefix),
+                frequency=file_info['cloud'].split('/')[-4],
+                source_release=file_info['cloud'].split('/')[-2],
+                source_sha256=file_sha256(file_info['local'], checksum_record)
+            )
+            zarr_result['uploaded_files'] = upload_zarr_store(
+                store_path=zarr_result['store'],
+                obj_prefix=zarr_prefix,
+                s3_bucket_name=s3_bucket_name,
+                upload_config=upload_config,
+                s3_client=s3_client
+            )
+            zarr_result['prefix'] = zarr_prefix
+            run_report['zarr'].append(zarr_result)
+        except Exception as e:
+            logging.error("Error creating zarr copy of %s: %s", file_info['local'], e)
+
+    # sha256 of the files hashed by the uploader
+    release_checksums = {
+        file_info['cloud']: checksum_record[file_info['local']]['sha256']
+        for file_info in list_files
+        if 'sha256' in checksum_record.get(file_info['local'], {})
+    }
+    if not publish:
+        run_report.setdefault('checksums', {}).update(release_checksums)
+        return None
+
+    return publish_release(
+        release_prefix=release_prefix,
+        list_release_results=list_release_results,
+        s3_bucket_name=s3_bucket_name,
+        s3_client=s3_client,
+        release_checksums=release_checksums,
+        kerchunk_save_dir=kerchunk_save_dir
+    )
+
+def publish_release(
+    release_prefix: str,
+    list_release_results: list,
+    s3_bucket_name: str,
+    s3_client,
+    release_checksums: dict,
+    kerchunk_save_dir: str = None,
+) -> dict:
+    """Rebuild the combined kerchunk index of a release when one of its
+    indexes changed and write the release manifest
+
+    Parameters
+    ----------
+    release_prefix : str
+        release folder object prefix
+    list_release_results : list
+        results of `process_file` for the files of the release
+    s3_bucket_name : str
+        S3 bucket name
+    s3_client : _type_
+        boto3 S3 client object
+    release_checksums : dict
+        {cloud_object_name: sha256} of the release files
+    kerchunk_save_dir : str, optional
+        The directory to save the combined Kerchunk index,
+        combining is skipped when None
+
+    Returns
+    -------
+    dict
+        release summary of `write_release_manifest`
+    """
+    # combined index of the whole release (rebuilt when an index changed)
+    if kerchunk_save_dir is not None:
+        combined_obj_name = f'{release_prefix}/{COMBINED_INDEX_NAME}'
+        combined_outdated = any(
+            result['index'] == 'built' for result in list_release_results
+        )
+        if not combined_outdated:
+            try:
+                s3_client.head_object(Bucket=s3_bucket_name, Key=combined_obj_name)
+            except ClientError:
+                combined_outdated = True
+        if combined_outdated:
+            combined_json_path = os.path.join(kerchunk_save_dir, combined_obj_name)
+            os.makedirs(os.path.dirname(combined_json_path), exist_ok=True)
+            try:
+                if build_combined_index(
+                    release_prefix=release_prefix,
+                    s3_bucket_name=s3_bucket_name,
+                    json_file=combined_json_path
+                ):
+                    put_small_object(
+                        local_file=combined_json_path,
+                        obj_name=combined_obj_name,
+                        s3_bucket_name=s3_bucket_name,
+                        s3_client=s3_client
+                    )
+            except Exception as e:
+                logging.error("Error combining kerchunk indexes of %s: %s", release_prefix, e)
+
+    # per-release manifest
+    summary = write_release_manifest(
+        release_prefix=release_prefix,
+        s3_bucket_name=s3_bucket_name,
+        s3_client=s3_client,
+        checksums=release_checksums
+    )
+    return summary
+
+def write_run_report(run_report: dict, report_file: str):
+    """Write the run report to a JSON file
+
+    Parameters
+    ----------
+    run_report : dict
+        summary of the run (counts and lists of object names)
+    report_file : str
+        path to the report JSON file
+    """
+    with open(report_file, 'w', encoding='utf-8') as jsonfile:
+        json.dump(run_report, jsonfile, indent=2)
+    logging.info("Run report written to %s", report_file)
+
+def run_upload(
+    local_root_dirs: str = PORTAL_DATA_PATH,
+    s3_bucket_name: str = S3_BUCKET_NAME,
+    kerchunk_save_dir: str = None,
+    kerchunk_cache_max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+    zarr_save_dir: str = None,
+    max_file_workers: int = MAX_FILE_WORKERS,
+    checksum_record_file: str = CHECKSUM_RECORD,
+    report_file: str = REPORT_FILE,
+    s3_client=None,
+    shard: tuple = None,
+    repack_dir: str = None,
+    repack_chunks: dict = None,
+) -> dict:
+    """Upload the latest release of every parent directory under a local root directory
+
+    With a shard (i, N), only the files assigned to shard i are processed
+    (see `transfer_shard`). The shard keeps its own checksum record, kerchunk
+    cache directory and run report, and leaves the combined indexes, the
+    manifests and the catalog to `merge_shard_runs`.
+
+    Parameters
+    ----------
+    local_root_dirs : str
+        local root directory to search for files
+        (the CEFI data root or one of its sub-directories)
+    s3_bucket_name : str
+        S3 bucket name
+    kerchunk_save_dir : str, optional
+        kerchunk index cache directory, kerchunking is skipped when None
+    kerchunk_cache_max_bytes : int
+        size limit of the kerchunk index cache
+    zarr_save_dir : str, optional
+        directory of the local zarr stores, zarr copies are skipped when None
+    max_file_workers : int
+        number of files processed at the same time
+    checksum_record_file : str
+        local checksum record (see `load_checksum_record`)
+    report_file : str
+        path to the run report JSON file
+    s3_client : _type_, optional
+        boto3 S3 client object, a pooled client is created (and closed) when None
+    shard : tuple, optional
+        (index, count) of this shard, all the files are processed when None
+    repack_dir : str, optional
+        directory of the repacked netcdf files, the chunk layout of every
+        release is checked and the flagged files are repacked and uploaded
+        in place of the originals (see `hdf5_layout`), skipped when None
+    repack_chunks : dict, optional
+        {dimension name: chunk size} of the repacked files
+        (other dimensions sized by `hdf5_layout.repack_chunks`)
+
+    Returns
+    -------
+    dict
+        run report (see `write_run_report`)
+    """
+    if kerchunk_save_dir is not None:
         logging.info("Kerchunking is enabled.")
     else:
         logging.info("Kerchunking is disabled.")
 
-    # Create a single session and S3 client
-    session = boto3.Session()
-    s3_client_upload = session.client("s3")
+    # total number of concurrent requests, raised while S3 answers fast
+    #  and lowered on throttling (503 SlowDown) or rising latency
+    controller = AdaptiveConcurrency(
+        initial=max_file_workers * INITIAL_PART_CONCURRENCY,
+        minimum=max_file_workers,
+        maximum=max_file_workers * MAX_PART_CONCURRENCY,
+        name='upload'
+    )
 
-    # Configure multipart uploads (Adjust chunk size and concurrency)
-    transfer_config = TransferConfig(
+    # Configure multipart uploads (Adjust chunk size, the concurrency
+    #  of each file is its share of the controller limit)
+    transfer_config = AdaptiveTransferConfig(
+        controller,
+        share=max_file_workers,
         multipart_threshold=100 * 1024 * 1024,  # 100MB threshold for multipart
         multipart_chunksize=50 * 1024 * 1024,   # 50MB chunk size
-        max_concurrency=10,                     # Number of parallel threads
+        max_concurrency=INITIAL_PART_CONCURRENCY,
         use_threads=True                        # Enable threading
     )
 
-    # find all netcdf files under the root directory
-    dict_all_files = create_file_dict(PORTAL_DATA_PATH)
+    # Create a single S3 client shared by all the threads
+    #  (connection pool sized for the file workers and their transfer threads)
+    own_client = s3_client is None
+    if own_client:
+        s3_client = get_pooled_s3_client(
+            max_pool_connections=max_file_workers * (MAX_PART_CONCURRENCY + 1)
+        )
+    controller.attach(s3_client)
+
+    # local checksums used to detect files unchanged since the previous release
+    #  (shards read the merged record and write their own)
+    checksum_record = load_checksum_record(checksum_record_file)
+    if shard is not None:
+        checksum_record_file = shard_file(checksum_record_file, shard)
+        report_file = shard_file(report_file, shard)
+        assigner = ShardAssigner(shard[1])
 
-    # keep only the latest release
-    dict_latest, dict_outdated = keep_latest_release(dict_all_files)
+    # persistent kerchunk index cache (keyed by object key, size and ETag)
+    kerchunk_cache = None
+    if kerchunk_save_dir is not None:
+        kerchunk_cache_dir = kerchunk_save_dir
+        if shard is not None:
+            kerchunk_cache_dir = os.path.join(kerchunk_save_dir, f'shard{shard[0]}of{shard[1]}')
+        kerchunk_cache = KerchunkCache(kerchunk_cache_dir, max_bytes=kerchunk_cache_max_bytes)
 
-    # upload files in the latest release one by one
-    all_local_json_paths = []
-    for parent_dir, dict_releases_folders in dict_latest.items():
-        for release_folder, list_files in dict_releases_folders.items():
-            for file_info in list_files:
+    run_report = {
+        'started': datetime.now().isoformat(),
+        'results': [],
+        'verified': 0,
+        'verify_failed': [],
+        'zarr': [],
+        'layout': []
+    }
+    if shard is not None:
+        run_report.update({'shard': f'{shard[0]}/{shard[1]}', 'releases': [], 'checksums': {}})
+    list_release_summaries = []
 
-                # Get the local file path and cloud object name for netcdf
-                local_file_path = file_info['local']
-                cloud_object_name = file_info['cloud']
+    pending_releases = deque()
 
-                # Upload the netcdf file to S3
-                boto3_upload(
-                    local_file=local_file_path,
-                    obj_name=cloud_object_name,
-                    s3_bucket_name=S3_BUCKET_NAME,
+    def finalize_pending(wait_all=False):
+        """Finalize the pending releases (oldest first) whose files are all processed,
+        waiting on the oldest one when too many releases are pending."""
+        while pending_releases and (
+            wait_all
+            or len(pending_releases) > MAX_PENDING_RELEASES
+            or all(future.done() for future in pending_releases[0][1])
+        ):
+            list_files_done, futures_done = pending_releases.popleft()
+            summary = finalize_release(
+                    list_files=list_files_done,
+                    list_release_results=[future.result() for future in futures_done],
+                    s3_bucket_name=s3_bucket_name,
                     upload_config=transfer_config,
-                    s3_client=s3_client_upload
+                    s3_client=s3_client,
+                    checksum_record=checksum_record,
+                    run_report=run_report,
+                    kerchunk_save_dir=kerchunk_save_dir,
+                    zarr_save_dir=zarr_save_dir,
+                    publish=shard is None
                 )
+            if summary is not None:
+                list_release_summaries.append(summary)
 
-                if KERCHUNK_FLAG :
-                    # create kerchunk json file
-                    s3_ncfile_path = f's3://{S3_BUCKET_NAME}/{cloud_object_name}'
-                    local_json_path = gen_kerchunk_index(
-                        s3_path=s3_ncfile_path,
-                        save_dir='/home/chsu/cefi-cloud-transfer/operation/s3_kerchunk_json'
+    # the report, checksum record and kerchunk cache are saved even when the run stops
+    try:
+        # stream the latest release of each parent directory into the upload pool
+        #  as soon as its directory is scanned
+        with ThreadPoolExecutor(max_workers=max_file_workers) as file_executor:
+            for parent_dir, release_folder, list_files, dict_previous_releases in iter_latest_releases(
+                local_root_dirs
+            ):
+                logging.info("Found %s files in %s/%s", len(list_files), parent_dir, release_folder)
+                if shard is not None:
+                    run_report['releases'].append(os.path.dirname(list_files[0]['cloud']))
+                    list_files = assigner.select(list_files, shard[0])
+                    logging.info("%s files assigned to shard %s/%s", len(list_files), *shard)
+                    if not list_files:
+                        continue
+                if repack_dir is not None:
+                    # repack the files with a costly chunk layout before the upload
+                    from hdf5_layout import prepare_files, repacked_copies
+                    list_files, list_layout_reports = prepare_files(
+                        list_files,
+                        repack_dir=repack_dir,
+                        chunks=repack_chunks,
+                        max_workers=max_file_workers
                     )
-                    all_local_json_paths.append(local_json_path)
-
-                    # Upload the json file to S3
-                    s3_json_filename = cloud_object_name.split("/")[-1].strip(".nc")
-                    s3_json_path = "/".join(cloud_object_name.split("/")[:-1])
-                    boto3_upload(
-                        local_file=local_json_path,
-                        obj_name=f'{s3_json_path}/{s3_json_filename}.json',
-                        s3_bucket_name=S3_BUCKET_NAME,
+                    run_report['layout'].extend(list_layout_reports)
+                    # the previous releases were uploaded from their repacked copies
+                    dict_previous_releases = {
+                        previous_release: repacked_copies(list_previous, repack_dir)
+                        for previous_release, list_previous in dict_previous_releases.items()
+                    }
+                futures = [
+                    file_executor.submit(
+                        process_file,
+                        file_info=file_info,
+                        release_folder=release_folder,
+                        dict_previous_releases=dict_previous_releases,
+                        s3_bucket_name=s3_bucket_name,
                         upload_config=transfer_config,
-                        s3_client=s3_client_upload
+                        s3_client=s3_client,
+                        checksum_record=checksum_record,
+                        kerchunk_cache=kerchunk_cache
                     )
+                    for file_info in list_files
+                ]
+                pending_releases.append((list_files, futures))
+                finalize_pending()
+
+            finalize_pending(wait_all=True)
 
-    # clear the local json file
-    if KERCHUNK_FLAG :
-        for json_file in all_local_json_paths:
-            os.remove(json_file)
-        logging.info("All kerchunk index files cleared.")
+        # top-level catalog with the latest release of every parent directory
+        if shard is None:
+            update_catalog(list_release_summaries, s3_bucket_name, s3_client)
+    finally:
+        controller.log_stats()
+        run_report['concurrency'] = dict(controller.stats, final_limit=controller.concurrency)
+        run_report['finished'] = datetime.now().isoformat()
+        write_run_report(run_report, report_file)
 
-    # Close the S3 client
-    s3_client_upload.close()
+        # keep the checksums for the next release
+        save_checksum_record(checksum_record, checksum_record_file)
+
+        # trim the kerchunk index cache to its size limit
+        if kerchunk_cache is not None:
+            kerchunk_cache.evict()
+            kerchunk_cache.save()
+            logging.info("Kerchunk index cache saved.")
+        if own_client:
+            s3_client.close()
     logging.info("Upload completed.")
-    # Close the logging file
-    logging.shutdown()
+    return run_report
+
+def merge_shard_runs(
+    shard_count: int,
+    s3_bucket_name: str = S3_BUCKET_NAME,
+    kerchunk_save_dir: str = None,
+    checksum_record_file: str = CHECKSUM_RECORD,
+    report_file: str = REPORT_FILE,
+    s3_client=None,
+) -> dict:
+    """Merge the runs of all the shards and publish their releases
+
+    Combines the per-shard run reports into one run report, merges the
+    per-shard checksum records, then rebuilds the combined kerchunk indexes,
+    writes the release manifests and updates the catalog once for all shards.
+
+    Parameters
+    ----------
+    shard_count : int
+        number of shards N of the run
+    s3_bucket_name : str
+        S3 bucket name
+    kerchunk_save_dir : str, optional
+        The directory to save the combined Kerchunk indexes,
+        combining is skipped when None
+    checksum_record_file : str
+        merged checksum record (the shards write their own next to it)
+    report_file : str
+        path to the merged run report (the shards write their own next to it)
+    s3_client : _type_, optional
+        boto3 S3 client object, a pooled client is created (and closed) when None
+
+    Returns
+    -------
+    dict
+        merged run report
+    """
+    shards = [(index, shard_count) for index in range(shard_count)]
+    missing = [shard for shard in shards if not os.path.exists(shard_file(report_file, shard))]
+    if missing:
+        raise FileNotFoundError(f"Missing shard reports: {[shard_file(report_file, s) for s in missing]}")
+
+    run_report = merge_reports([shard_file(report_file, shard) for shard in shards])
+
+    checksum_record = load_checksum_record(checksum_record_file)
+    for shard in shards:
+        checksum_record.update(load_checksum_record(shard_file(checksum_record_file, shard)))
+    save_checksum_record(checksum_record, checksum_record_file)
+
+    own_client = s3_client is None
+    if own_client:
+        s3_client = get_pooled_s3_client()
+
+    list_release_summaries = []
+    for release_prefix in sorted(set(run_report.get('releases', []))):
+        list_release_summaries.append(
+            publish_release(
+                release_prefix=release_prefix,
+                list_release_results=[
+                    result for result in run_report['results']
+                    if os.path.dirname(result['cloud']) == release_prefix
+                ],
+                s3_bucket_name=s3_bucket_name,
+                s3_client=s3_client,
+                release_checksums={
+                    obj_name: sha256 for obj_name, sha256 in run_report.get('checksums', {}).items()
+                    if os.path.dirname(obj_name) == release_prefix
+                },
+                kerchunk_save_dir=kerchunk_save_dir
+            )
+        )
+    update_catalog(list_release_summaries, s3_bucket_name, s3_client)
+
+    if own_client:
+        s3_client.close()
+
+    write_run_report(run_report, report_file)
+    return run_report
+
+if __name__ == '__main__':
+    # same as `cefi_transfer.py [--config FILE] upload [options]`: the kerchunk,
+    #  zarr and repack directories come from the shared configuration file
+    import argparse
+    from cefi_transfer import main
+
+    parser = argparse.ArgumentParser(
+        description='Upload the latest releases (see `cefi_transfer.py upload --help` for the options)'
+    )
+    parser.add_argument('--config', type=str, default=None,
+                        help='Shared JSON configuration file (see cefi_transfer.DEFAULT_CONFIG)')
+    args, upload_args = parser.parse_known_args()
+    main((['--config', args.config] if args.config else []) + ['upload'] + upload_args)
@@ -0,0 +1,642 @@
+"""
+Watch the CEFI data root directory and upload new release files as they land.
+
+The watcher uses inotify (through the optional `inotify_simple` package)
+to get notified when netcdf files are written or moved into the portal tree.
+inotify only sees the writes of the local node, so on network and cluster
+file systems (GPFS, NFS, Lustre, detected from /proc/mounts) or when
+`inotify_simple` is not installed, it falls back to polling the directory
+modification times and only lists the directories that changed.
+
+A netcdf file is passed to the upload and kerchunk path of `s3_upload.py`
+once its size and modification time have not changed for the settle period.
+A failed upload is retried after another settle period, and an uploaded
+file is uploaded again when its size or modification time changes.
+Once no file of a release folder has settled for another settle period
+(and none is still changing), the release is finalized like in
+`s3_upload.py`: the uploads are verified against their ETags, the combined
+kerchunk index and the release manifest are rebuilt and the catalog is
+updated. The checksum record and the kerchunk cache are saved then, and
+the files of the release stop being tracked (with polling, a later
+in-place rewrite is only seen through inotify or a new file in the folder).
+Files in a release folder that is older than the latest release of its
+parent directory are ignored. Files already present when the watcher
+starts are left to the full `s3_upload.py` run.
+
+Usage:
+    python s3_watch.py                    # inotify, polling on GPFS/NFS
+    python s3_watch.py --poll             # force polling
+    python s3_watch.py --settle 600       # wait 10 minutes of no change
+"""
+
+import os
+import time
+import logging
+import argparse
+import boto3
+from boto3.s3.transfer import TransferConfig
+from s3_upload import (
+    setup_logging,
+    create_file_dict,
+    load_checksum_record,
+    save_checksum_record,
+    process_file,
+    finalize_release,
+    publish_release,
+    S3_BUCKET_NAME,
+    PORTAL_DATA_PATH,
+    CHECKSUM_RECORD,
+    RELEASE_FOLDER_PATTERN
+)
+from kerchunk_cache import KerchunkCache
+from s3_catalog import update_catalog
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+LOG_FILE = 's3_watch.log'
+
+# file systems where inotify misses the writes made from other nodes
+REMOTE_FS_TYPES = {
+    'nfs', 'nfs4', 'gpfs', 'lustre', 'cifs', 'smb3', 'ceph', 'beegfs', 'panfs', 'fuse.sshfs'
+}
+MOUNTS_FILE = '/proc/mounts'
+
+
+def mount_fs_type(path: str, mounts_file: str = MOUNTS_FILE) -> str:
+    """Find the file system type of the mount holding path.
+
+    Parameters
+    ----------
+    path : str
+        file or directory path
+    mounts_file : str, optional
+        mount table (default: /proc/mounts)
+
+    Returns
+    -------
+    str
+        file system type of the longest mount point containing path,
+        None when the mount table cannot be read
+    """
+    path = os.path.realpath(path)
+    best_mount, best_type = '', None
+    try:
+        with open(mounts_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # spaces in mount points are escaped as \040
+                mount_point = fields[1].replace('\\040', ' ')
+                prefix = mount_point.rstrip('/') + '/'
+                if (path == mount_point or path.startswith(prefix)) and len(mount_point) >= len(best_mount):
+                    best_mount, best_type = mount_point, fields[2]
+    except OSError:
+        return None
+    return best_type
+
+
+def is_remote_fs(path: str, mounts_file: str = MOUNTS_FILE) -> bool:
+    """Check whether path is on a network or cluster file system (see REMOTE_FS_TYPES)."""
+    fs_type = mount_fs_type(path, mounts_file)
+    return fs_type is not None and fs_type in REMOTE_FS_TYPES
+
+
+def is_latest_release(dirpath: str) -> bool:
+    """Check that the release folder is the newest one under its parent directory.
+
+    Parameters
+    ----------
+    dirpath : str
+        release folder absolute path
+
+    Returns
+    -------
+    bool
+        True if no newer release folder exists next to dirpath
+    """
+    release_folder = os.path.basename(os.path.normpath(dirpath))
+    if not RELEASE_FOLDER_PATTERN.match(release_folder):
+        return False
+    parent_dir = os.path.dirname(os.path.normpath(dirpath))
+    try:
+        siblings = [
+            entry.name for entry in os.scandir(parent_dir)
+            if entry.is_dir(follow_symlinks=False) and RELEASE_FOLDER_PATTERN.match(entry.name)
+        ]
+    except OSError:
+        return False
+    return release_folder == max(siblings, default=release_folder)
+
+
+def previous_releases(dirpath: str) -> dict:
+    """Collect the netcdf files of the older release folders next to dirpath.
+
+    Parameters
+    ----------
+    dirpath : str
+        release folder absolute path
+
+    Returns
+    -------
+    dict
+        {release_folder: [file_info, ...]} for releases older than dirpath
+    """
+    release_folder = os.path.basename(os.path.normpath(dirpath))
+    parent_dir = os.path.dirname(os.path.normpath(dirpath))
+    dict_files = create_file_dict(parent_dir).get(parent_dir, {})
+    return {
+        release: list_files
+        for release, list_files in dict_files.items()
+        if release < release_folder
+    }
+
+
+class StableFileTracker:
+    """Track candidate files until they stop changing.
+
+    Parameters
+    ----------
+    settle_seconds : float
+        time a file size and modification time must stay unchanged
+    """
+
+    def __init__(self, settle_seconds: float):
+        self.settle_seconds = settle_seconds
+        # path -> (size, mtime, time the current state was first seen)
+        self.pending = {}
+        # path -> (size, mtime) when it was handed out as stable
+        self.done = {}
+
+    def add(self, path: str):
+        """Start (or restart) tracking a file."""
+        if path.endswith('.nc') and path not in self.done:
+            self.pending.setdefault(path, (None, None, time.monotonic()))
+
+    def retry(self, path: str):
+        """Track a file handed out by `pop_stable` again (its upload failed)."""
+        self.done.pop(path, None)
+        self.pending[path] = (None, None, time.monotonic())
+
+    def forget(self, dirpath: str):
+        """Stop tracking the handed out files of a folder (its release is finalized)."""
+        for path in [path for path in self.done if os.path.dirname(path) == dirpath]:
+            self.done.pop(path)
+
+    def check_done(self):
+        """Track again the handed out files whose size or modification time changed.
+
+        In-place rewrites do not change the directory modification time
+        the polling watcher relies on, so the files are checked here.
+        """
+        for path, state in list(self.done.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self.done.pop(path)
+                continue
+            if (stat.st_size, stat.st_mtime) != state:
+                self.done.pop(path)
+                self.add(path)
+
+    def pop_stable(self) -> list:
+        """Return the files that have been unchanged for the settle period."""
+        self.check_done()
+        now = time.monotonic()
+        stable = []
+        for path, (size, mtime, since) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # removed or renamed before it settled
+                self.pending.pop(path)
+                continue
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                self.pending[path] = (stat.st_size, stat.st_mtime, now)
+            elif now - since >= self.settle_seconds:
+                self.pending.pop(path)
+                self.done[path] = (size, mtime)
+                stable.append(path)
+        return stable
+
+
+class PollingWatcher:
+    """Poll the directory modification times under root_dir.
+
+    Only directories whose modification time changed are listed,
+    so each poll costs one stat per directory instead of a full rescan.
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        self.dir_mtimes = {}
+        self.dir_children = {}
+        # the first poll only records the current state
+        self.poll(initial=True)
+
+    def poll(self, initial: bool = False) -> list:
+        """Return the netcdf files in directories that changed since the last poll."""
+        changed_files = []
+        stack = [self.root_dir]
+        while stack:
+            dirpath = stack.pop()
+            try:
+                mtime = os.stat(dirpath).st_mtime
+                if self.dir_mtimes.get(dirpath) == mtime:
+                    # unchanged directory, only descend into known subdirectories
+                    stack.extend(self.dir_children.get(dirpath, []))
+                    continue
+                entries = list(os.scandir(dirpath))
+            except OSError:
+                continue
+            self.dir_mtimes[dirpath] = mtime
+
+            subdirs = []
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif not initial and entry.name.endswith('.nc'):
+                    changed_files.append(entry.path)
+            self.dir_children[dirpath] = subdirs
+            stack.extend(subdirs)
+
+        # in-place rewrites do not change the directory mtime,
+        #  the tracker catches those through the file size/mtime (see `StableFileTracker.check_done`)
+        return changed_files
+
+
+class InotifyWatcher:
+    """Recursive inotify watcher on root_dir (requires `inotify_simple`)."""
+
+    def __init__(self, root_dir: str):
+        self.inotify = INotify()
+        self.watch_flags = (
+            inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO
+            | inotify_flags.CREATE | inotify_flags.MODIFY
+        )
+        self.wd_paths = {}
+        self.add_tree(root_dir)
+
+    def add_tree(self, root_dir: str) -> list:
+        """Watch root_dir and all its subdirectories, return netcdf files found."""
+        found_files = []
+        for dirpath, _, filenames in os.walk(root_dir):
+            if os.path.islink(dirpath):
+                continue
+            wd = self.inotify.add_watch(dirpath, self.watch_flags)
+            self.wd_paths[wd] = dirpath
+            found_files.extend(
+                os.path.join(dirpath, f) for f in filenames if f.endswith('.nc')
+            )
+        return found_files
+
+    def poll(self, timeout_ms: int) -> list:
+        """Return the netcdf files that were written or moved in."""
+        changed_files = []
+        for event in self.inotify.read(timeout=timeout_ms):
+            dirpath = self.wd_paths.get(event.wd)
+            if dirpath is None or not event.name:
+                continue
+            path = os.path.join(dirpath, event.name)
+            if event.mask & inotify_flags.ISDIR:
+                if event.mask & (inotify_flags.CREATE | inotify_flags.MOVED_TO):
+                    # new release folder, files may land before the watch is added
+                    changed_files.extend(self.add_tree(path))
+            elif event.name.endswith('.nc'):
+                changed_files.append(path)
+        return changed_files
+
+
+class PendingRelease:
+    """Files of a release folder uploaded since the release was last finalized.
+
+    The older releases of the parent directory (used to copy unchanged
+    files) are listed once per release folder.
+
+    Parameters
+    ----------
+    dirpath : str
+        release folder absolute path
+    """
+
+    def __init__(self, dirpath: str):
+        self.dirpath = dirpath
+        self.dict_previous_releases = previous_releases(dirpath)
+        self.list_files = []
+        self.list_results = []
+        # files whose upload failed and is retried
+        self.failed = set()
+        self.last_settled = time.monotonic()
+
+    def is_settled(self, tracker: StableFileTracker) -> bool:
+        """Check that no file of the release settled for the settle period
+        and that the only files still tracked are failed uploads."""
+        if time.monotonic() - self.last_settled < tracker.settle_seconds:
+            return False
+        return all(
+            path in self.failed
+            for path in tracker.pending if os.path.dirname(path) == self.dirpath
+        )
+
+
+def upload_settled(
+    local_file: str,
+    release: PendingRelease,
+    s3_client,
+    upload_config,
+    checksum_record: dict,
+    kerchunk_cache: KerchunkCache = None,
+) -> bool:
+    """Upload a settled file of the latest release and its kerchunk index.
+
+    Parameters
+    ----------
+    local_file : str
+        local netcdf file absolute path
+    release : PendingRelease
+        release of the file, the result is added to it
+    s3_client : _type_
+        boto3 S3 client object
+    upload_config : _type_
+        TransferConfig object to configure multipart uploads
+    checksum_record : dict
+        checksum record created by `load_checksum_record`
+    kerchunk_cache : KerchunkCache, optional
+        Reference cache that holds the Kerchunk index files,
+        kerchunking is skipped when None
+
+    Returns
+    -------
+    bool
+        False when the upload failed and the file should be retried
+    """
+    file_info = {
+        'local': local_file,
+        'cloud': os.path.relpath(local_file, PORTAL_DATA_PATH)
+    }
+    logging.info("File settled, uploading: %s", local_file)
+    result = process_file(
+        file_info=file_info,
+        release_folder=os.path.basename(release.dirpath),
+        dict_previous_releases=release.dict_previous_releases,
+        s3_bucket_name=S3_BUCKET_NAME,
+        upload_config=upload_config,
+        s3_client=s3_client,
+        checksum_record=checksum_record,
+        kerchunk_cache=kerchunk_cache
+    )
+    release.last_settled = time.monotonic()
+    if result['action'] == 'failed':
+        release.failed.add(local_file)
+        return False
+
+    release.failed.discard(local_file)
+    release.list_files.append(file_info)
+    release.list_results.append(result)
+    return True
+
+
+def release_checksums(dirpath: str, checksum_record: dict) -> dict:
+    """sha256 of the netcdf files of a release folder found in the checksum record
+
+    Parameters
+    ----------
+    dirpath : str
+        release folder absolute path
+    checksum_record : dict
+        checksum record created by `load_checksum_record`
+
+    Returns
+    -------
+    dict
+        {cloud_object_name: sha256}
+    """
+    checksums = {}
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            sha256 = checksum_record.get(entry.path, {}).get('sha256')
+            if entry.name.endswith('.nc') and sha256 is not None:
+                checksums[os.path.relpath(entry.path, PORTAL_DATA_PATH)] = sha256
+    return checksums
+
+
+def finalize_settled(
+    release: PendingRelease,
+    s3_client,
+    upload_config,
+    checksum_record: dict,
+    kerchunk_cache: KerchunkCache = None,
+    kerchunk_save_dir: str = None,
+) -> dict:
+    """Verify the uploads of a settled release, publish it and update the catalog.
+
+    The checksum record and the kerchunk cache are saved once per release.
+
+    Parameters
+    ----------
+    release : PendingRelease
+        settled release
+    s3_client : _type_
+        boto3 S3 client object
+    upload_config : _type_
+        TransferConfig object to configure multipart uploads
+    checksum_record : dict
+        checksum record created by `load_checksum_record`
+    kerchunk_cache : KerchunkCache, optional
+        Reference cache that holds the Kerchunk index files
+    kerchunk_save_dir : str, optional
+        The directory to save the combined Kerchunk index,
+        combining is skipped when None
+
+    Returns
+    -------
+    dict
+        release report ('results', 'verified', 'verify_failed', 'zarr'),
+        None when the release could not be published and should be retried
+    """
+    release_report = {'results': [], 'verified': 0, 'verify_failed': [], 'zarr': []}
+    try:
+        if release.list_files:
+            # verification only, the release is published with the checksums of all its files
+            finalize_release(
+                list_files=release.list_files,
+                list_release_results=release.list_results,
+                s3_bucket_name=S3_BUCKET_NAME,
+                upload_config=upload_config,
+                s3_client=s3_client,
+                checksum_record=checksum_record,
+                run_report=release_report,
+                publish=False
+            )
+            summary = publish_release(
+                release_prefix=os.path.dirname(release.list_files[0]['cloud']),
+                list_release_results=release.list_results,
+                s3_bucket_name=S3_BUCKET_NAME,
+                s3_client=s3_client,
+                release_checksums=release_checksums(release.dirpath, checksum_record),
+                kerchunk_save_dir=kerchunk_save_dir
+            )
+            update_catalog([summary], S3_BUCKET_NAME, s3_client)
+            logging.info(
+                "Release %s finalized: %s files verified, %s failed verification",
+                release.dirpath, release_report['verified'], len(release_report['verify_failed'])
+            )
+    except Exception as e:
+        logging.error("Error finalizing release %s: %s", release.dirpath, e)
+        release.last_settled = time.monotonic()
+        return None
+    finally:
+        save_checksum_record(checksum_record, CHECKSUM_RECORD)
+        if kerchunk_cache is not None:
+            kerchunk_cache.evict()
+            kerchunk_cache.save()
+    return release_report
+
+
+def watch(
+    root_dir: str,
+    settle_seconds: float,
+    interval: float,
+    force_poll: bool,
+    kerchunk_cache: KerchunkCache = None,
+    kerchunk_save_dir: str = None,
+):
+    """Watch root_dir and upload the latest release files once they are stable.
+
+    Parameters
+    ----------
+    root_dir : str
+        CEFI data root directory
+    settle_seconds : float
+        time a file must stay unchanged before it is uploaded
+    interval : float
+        seconds between polls (and between stability checks)
+    force_poll : bool
+        use polling even when inotify is available
+        (polling is always used on GPFS/NFS, see `is_remote_fs`)
+    kerchunk_cache : KerchunkCache, optional
+        Reference cache that holds the Kerchunk index files,
+        kerchunking is skipped when None
+    kerchunk_save_dir : str, optional
+        The directory to save the combined Kerchunk index of the releases,
+        combining is skipped when None
+    """
+    if INotify is not None and not force_poll and not is_remote_fs(root_dir):
+        watcher = InotifyWatcher(root_dir)
+        logging.info("Watching %s with inotify", root_dir)
+    else:
+        watcher = PollingWatcher(root_dir)
+        logging.info("Watching %s with polling every %s s", root_dir, interval)
+
+    tracker = StableFileTracker(settle_seconds)
+
+    # Create a single session and S3 client
+    session = boto3.Session()
+    s3_client_upload = session.client("s3")
+
+    # Configure multipart uploads (Adjust chunk size and concurrency)
+    transfer_config = TransferConfig(
+        multipart_threshold=100 * 1024 * 1024,  # 100MB threshold for multipart
+        multipart_chunksize=50 * 1024 * 1024,   # 50MB chunk size
+        max_concurrency=10,                     # Number of parallel threads
+        use_threads=True                        # Enable threading
+    )
+
+    checksum_record = load_checksum_record(CHECKSUM_RECORD)
+    # release folder path -> PendingRelease
+    releases = {}
+
+    try:
+        while True:
+            if isinstance(watcher, InotifyWatcher):
+                changed_files = watcher.poll(timeout_ms=int(interval * 1000))
+            else:
+                time.sleep(interval)
+                changed_files = watcher.poll()
+
+            for path in changed_files:
+                tracker.add(path)
+
+            for local_file in tracker.pop_stable():
+                dirpath = os.path.dirname(local_file)
+                if not is_latest_release(dirpath):
+                    logging.info("Skip file in outdated release: %s", local_file)
+                    tracker.done.pop(local_file, None)
+                    continue
+                if dirpath not in releases:
+                    releases[dirpath] = PendingRelease(dirpath)
+                if not upload_settled(
+                    local_file,
+                    releases[dirpath],
+                    s3_client=s3_client_upload,
+                    upload_config=transfer_config,
+                    checksum_record=checksum_record,
+                    kerchunk_cache=kerchunk_cache
+                ):
+                    logging.info("Upload of %s will be retried", local_file)
+                    tracker.retry(local_file)
+
+            for dirpath, release in list(releases.items()):
+                if release.is_settled(tracker) and finalize_settled(
+                    release,
+                    s3_client=s3_client_upload,
+                    upload_config=transfer_config,
+                    checksum_record=checksum_record,
+                    kerchunk_cache=kerchunk_cache,
+                    kerchunk_save_dir=kerchunk_save_dir
+                ) is not None:
+                    tracker.forget(dirpath)
+                    del releases[dirpath]
+
+    except KeyboardInterrupt:
+        logging.info("Watch stopped.")
+    finally:
+        # the pending releases are finalized by the next watcher or upload run
+        save_checksum_record(checksum_record, CHECKSUM_RECORD)
+        if kerchunk_cache is not None:
+            kerchunk_cache.evict()
+            kerchunk_cache.save()
+        s3_client_upload.close()
+
+
+def main():
+    """Main function with command line argument parsing"""
+
+    parser = argparse.ArgumentParser(description='Upload new CEFI release files as they land')
+    parser.add_argument('--root', type=str, default=PORTAL_DATA_PATH,
+                        help=f'Directory to watch (default: {PORTAL_DATA_PATH})')
+    parser.add_argument('--poll', action='store_true',
+                        help='Use polling instead of inotify (automatic on GPFS/NFS)')
+    parser.add_argument('--interval', type=float, default=30.0,
+                        help='Seconds between polls (default: 30)')
+    parser.add_argument('--settle', type=float, default=300.0,
+                        help='Seconds a file must stay unchanged before upload (default: 300)')
+    parser.add_argument('--kerchunk-dir', type=str, default=None,
+                        help='Kerchunk index cache directory (kerchunking disabled if not set)')
+    parser.add_argument('--log-file', type=str, default=LOG_FILE,
+                        help=f'Log file path (default: {LOG_FILE})')
+
+    args = parser.parse_args()
+
+    setup_logging(args.log_file)
+
+    kerchunk_cache = None
+    if args.kerchunk_dir is not None:
+        kerchunk_cache = KerchunkCache(args.kerchunk_dir)
+
+    watch(
+        root_dir=args.root,
+        settle_seconds=args.settle,
+        interval=args.interval,
+        force_poll=args.poll,
+        kerchunk_cache=kerchunk_cache,
+        kerchunk_save_dir=args.kerchunk_dir
+    )
+
+    logging.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Shared fixtures of the operation script tests."""
+
+import os
+import sys
+import json
+import socket
+
+import numpy as np
+import pytest
+
+# the operation scripts import each other by module name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BUCKET = 'bucket1'
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    """boto3 S3 client on a moto bucket"""
+    moto = pytest.importorskip('moto')
+    import boto3
+
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture
+def public_s3(monkeypatch):
+    """boto3 S3 client on a moto server bucket that s3fs reads anonymously
+
+    The anonymous s3fs filesystems of the operation scripts are pointed at
+    the server through the fsspec configuration.
+    """
+    moto_server = pytest.importorskip('moto.server')
+    import boto3
+    from s3fs import S3FileSystem
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    endpoint = f'http://127.0.0.1:{port}'
+    server = moto_server.ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+
+    # the moto backends are shared by every server of the process
+    import urllib.request
+    urllib.request.urlopen(urllib.request.Request(f'{endpoint}/moto-api/reset', method='POST'))
+
+    import fsspec
+    monkeypatch.setitem(fsspec.config.conf, 's3', {'endpoint_url': endpoint})
+    S3FileSystem.clear_instance_cache()
+    try:
+        client = boto3.client(
+            's3', endpoint_url=endpoint, region_name='us-east-1',
+            aws_access_key_id='testing', aws_secret_access_key='testing'
+        )
+        client.create_bucket(Bucket=BUCKET)
+        # moto checks anonymous HEAD requests against 's3:HeadObject'
+        client.put_bucket_policy(Bucket=BUCKET, Policy=json.dumps({
+            'Version': '2012-10-17',
+            'Statement': [{
+                'Effect': 'Allow',
+                'Principal': '*',
+                'Action': ['s3:GetObject', 's3:HeadObject', 's3:ListBucket'],
+                'Resource': [f'arn:aws:s3:::{BUCKET}', f'arn:aws:s3:::{BUCKET}/*'],
+            }]
+        }))
+        yield client
+    finally:
+        S3FileSystem.clear_instance_cache()
+        server.stop()
+
+
+def write_netcdf(path, ntime=4, nlat=6, nlon=8, start='2000-01-01', seed=0, chunks=None):
+    """Write a small synthetic (time, lat, lon) netcdf file (tos chunked by chunks)"""
+    import pandas as pd
+    import xarray as xr
+
+    rng = np.random.default_rng(seed)
+    ds = xr.Dataset(
+        {'tos': (('time', 'lat', 'lon'), rng.random((ntime, nlat, nlon), dtype='float32'))},
+        coords={
+            'time': pd.date_range(start, periods=ntime, freq='MS'),
+            'lat': np.linspace(30, 45, nlat),
+            'lon': np.linspace(-80, -60, nlon),
+        },
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    encoding = {'tos': {'chunksizes': chunks}} if chunks else None
+    ds.to_netcdf(path, encoding=encoding)
+    return path
+
+
+RELEASE_DIR = 'northwest_atlantic/full_domain/hindcast/monthly/regrid'
+
+
+def write_release(portal_dir, release, variables=('tos', 'sos'), ntime=4, seed=0, parent=RELEASE_DIR):
+    """Write the netcdf files of a release folder under a local portal tree
+
+    Returns the list of {'local': path, 'cloud': object name} of the release.
+    """
+    list_files = []
+    for i, variable in enumerate(variables):
+        cloud = f'{parent}/{release}/{variable}.nwa.full.hcast.monthly.regrid.{release}.199301-199304.nc'
+        local = os.path.join(str(portal_dir), cloud)
+        write_netcdf(local, ntime=ntime, seed=seed + i)
+        list_files.append({'local': local, 'cloud': cloud})
+    return list_files
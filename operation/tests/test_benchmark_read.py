@@ -0,0 +1,41 @@
+"""Smoke run of the read benchmark on a tiny synthetic dataset."""
+
+import socket
+import importlib
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('moto')
+pytest.importorskip('h5netcdf')
+pytest.importorskip('kerchunk')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_every_access_path_runs(monkeypatch):
+    import fsspec
+    import benchmark_read
+
+    # the benchmark points every s3 filesystem at its local stand-in
+    registry = importlib.import_module('fsspec.registry')._registry
+    monkeypatch.setitem(registry, 's3', registry.get('s3', fsspec.get_filesystem_class('s3')))
+    monkeypatch.setitem(fsspec.config.conf, 's3', dict(fsspec.config.conf.get('s3', {})))
+
+    args = SimpleNamespace(
+        nlat=6, nlon=8, months=24, inits=2, members=2, leads=3, repeat=1, port=free_port()
+    )
+    results = benchmark_read.run_benchmark(args)
+
+    accesses = {result['access'] for result in results}
+    assert {'kerchunk', 'kerchunk-cold', 'kerchunk-warm', 'zarr'} <= accesses
+    assert set(benchmark_read.NETCDF_CACHES) <= accesses
+    queries = {result['query'] for result in results}
+    assert 'reforecast_member_lead' in queries
+    for result in results:
+        assert result['latency_s'] > 0
+        assert result['requests'] > 0
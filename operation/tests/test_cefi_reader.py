@@ -0,0 +1,130 @@
+import os
+import json
+
+import fsspec
+import pytest
+import xarray as xr
+
+from conftest import write_netcdf
+import cefi_reader
+from cefi_reader import ChunkCacheStore
+
+
+@pytest.fixture
+def reference_mapper(tmp_path):
+    kerchunk_hdf = pytest.importorskip('kerchunk.hdf')
+    local_file = write_netcdf(str(tmp_path / 'r20250101' / 'tos.nc'), ntime=12, chunks=(1, 6, 8))
+    refs = kerchunk_hdf.SingleHdf5ToZarr(local_file).translate()
+    fs = fsspec.filesystem('reference', fo=refs, remote_protocol='file')
+    return local_file, fs.get_mapper()
+
+
+class CountingMapper(dict):
+    """Mapping recording the keys read from it (same references as mapper)"""
+
+    def __init__(self, mapper):
+        super().__init__((key, mapper[key]) for key in mapper)
+        self.fs = mapper.fs
+        self._key_to_str = mapper._key_to_str
+        self.reads = []
+
+    def __getitem__(self, key):
+        self.reads.append(key)
+        return super().__getitem__(key)
+
+
+def test_open_through_cache(tmp_path, reference_mapper):
+    local_file, mapper = reference_mapper
+    cache_dir = str(tmp_path / 'cache')
+
+    store = ChunkCacheStore(mapper, cache_dir=cache_dir, namespace='ns', prefetch=2)
+    with xr.open_dataset(store, engine='zarr', consolidated=False) as ds, \
+            xr.open_dataset(local_file) as expected:
+        xr.testing.assert_equal(ds.tos.load(), expected.tos)
+    store.close()
+    assert store._executor is None
+    # one cached file per tos chunk and coordinate
+    assert len(os.listdir(os.path.join(cache_dir, 'ns'))) >= 12
+
+    # warm cache: no chunk read from the source
+    counting = CountingMapper(mapper)
+    store = ChunkCacheStore(counting, cache_dir=cache_dir, namespace='ns', prefetch=0)
+    with xr.open_dataset(store, engine='zarr', consolidated=False) as ds:
+        ds.tos.load()
+    chunk_reads = [
+        key for key in counting.reads
+        if not key.rpartition('/')[2].startswith('.') and key != 'zarr.json'
+    ]
+    assert chunk_reads == []
+
+
+def test_regenerated_reference_not_served_from_cache(tmp_path, monkeypatch):
+    kerchunk_hdf = pytest.importorskip('kerchunk.hdf')
+    reference_file = tmp_path / 'tos.json'
+    monkeypatch.setattr(cefi_reader, 'resolve_reference', lambda *args, **kwargs: str(reference_file))
+
+    # same reference URL, indexing another upload of the file
+    for seed, name in enumerate(['tos.nc', 'tos.reupload.nc']):
+        local_file = write_netcdf(str(tmp_path / 'r20250101' / name), ntime=6, seed=seed, chunks=(1, 6, 8))
+        reference_file.write_text(json.dumps(kerchunk_hdf.SingleHdf5ToZarr(local_file).translate()))
+        with cefi_reader.open_cefi(
+            'northwest_atlantic', 'hindcast', 'monthly', 'tos',
+            cloud='file', cache_dir=str(tmp_path / 'cache'), prefetch=0
+        ) as ds, xr.open_dataset(local_file) as expected:
+            xr.testing.assert_equal(ds.tos.load(), expected.tos)
+
+
+def test_prefetch_along_time(tmp_path, reference_mapper):
+    _, mapper = reference_mapper
+    store = ChunkCacheStore(mapper, cache_dir=str(tmp_path / 'cache'), namespace='ns', prefetch=3)
+    store._read('tos/0.0.0')
+    store._executor.shutdown(wait=True)
+    for t in range(1, 4):
+        assert os.path.exists(store._cache_path(f'tos/{t}.0.0'))
+    assert not os.path.exists(store._cache_path('tos/4.0.0'))
+
+
+def test_eviction_uses_running_index(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    mapper = {f'v/{i}': bytes(1000) for i in range(10)}
+    store = ChunkCacheStore(mapper, cache_dir=cache_dir, namespace='ns', max_bytes=5000, prefetch=0)
+
+    def no_walk(*args, **kwargs):
+        raise AssertionError('cache directory walked')
+
+    monkeypatch.setattr(cefi_reader.os, 'walk', no_walk)
+    for i in range(10):
+        store._read(f'v/{i}')
+    assert store._index.total_bytes <= 5000
+    cached = os.listdir(os.path.join(cache_dir, 'ns'))
+    assert len(cached) == store._index.total_bytes // 1000
+    # the most recent chunks are kept
+    assert os.path.exists(store._cache_path('v/9'))
+    assert not os.path.exists(store._cache_path('v/0'))
+
+    # a second store of the process reuses the index
+    ChunkCacheStore(mapper, cache_dir=cache_dir, namespace='other', max_bytes=5000, prefetch=0)
+
+
+def test_open_cefi_close_stops_read_ahead(tmp_path, monkeypatch):
+    kerchunk_hdf = pytest.importorskip('kerchunk.hdf')
+    local_file = write_netcdf(str(tmp_path / 'r20250101' / 'tos.nc'), ntime=6, chunks=(1, 6, 8))
+    reference_file = tmp_path / 'tos.json'
+    reference_file.write_text(json.dumps(kerchunk_hdf.SingleHdf5ToZarr(local_file).translate()))
+    monkeypatch.setattr(cefi_reader, 'resolve_reference', lambda *args, **kwargs: str(reference_file))
+    closed = []
+    store_close = ChunkCacheStore.close
+
+    def spy_close(store):
+        closed.append(store)
+        store_close(store)
+
+    monkeypatch.setattr(ChunkCacheStore, 'close', spy_close)
+
+    ds = cefi_reader.open_cefi(
+        'northwest_atlantic', 'hindcast', 'monthly', 'tos',
+        cloud='file', cache_dir=str(tmp_path / 'cache')
+    )
+    assert float(ds.tos.isel(time=0).mean()) > 0
+    ds.close()
+    assert len(closed) == 1 and closed[0]._executor is None
@@ -0,0 +1,48 @@
+"""Tests of the chunk-aware subset extraction (cefi_subset)."""
+
+import json
+
+import numpy as np
+import pytest
+
+from conftest import write_netcdf
+
+pytest.importorskip('kerchunk')
+
+BBOX = (-75, 35, -66, 44)
+TIME = ('2000-03', '2001-02')
+
+
+@pytest.fixture
+def reference(tmp_path):
+    """Kerchunk reference of a 24x21x21 file chunked (5, 8, 8)"""
+    from kerchunk.hdf import SingleHdf5ToZarr
+
+    source = write_netcdf(str(tmp_path / 'source.nc'), ntime=24, nlat=21, nlon=21, chunks=(5, 8, 8))
+    reference_file = tmp_path / 'source.json'
+    reference_file.write_text(json.dumps(SingleHdf5ToZarr(source, inline_threshold=0).translate()))
+    return source, str(reference_file)
+
+
+@pytest.mark.parametrize('output_name', ['subset.nc', 'subset.zarr'])
+def test_subset_matches_sel_off_chunk_boundaries(reference, tmp_path, output_name):
+    import xarray as xr
+    from cefi_subset import subset_reference
+
+    source, reference_file = reference
+    output = str(tmp_path / output_name)
+    stats = subset_reference(reference_file, 'tos', output, bbox=BBOX, time=TIME, cloud='file')
+
+    with xr.open_dataset(source) as ds:
+        expected = ds.sel(
+            lon=slice(BBOX[0], BBOX[2]), lat=slice(BBOX[1], BBOX[3]), time=slice(*TIME)
+        ).load()
+    engine = 'zarr' if output.endswith('.zarr') else None
+    with xr.open_dataset(output, engine=engine) as result:
+        assert result['tos'].shape == expected['tos'].shape == tuple(stats['shape'])
+        np.testing.assert_array_equal(result['tos'].values, expected['tos'].values)
+        np.testing.assert_array_equal(result['time'].values, expected['time'].values)
+        np.testing.assert_array_equal(result['lat'].values, expected['lat'].values)
+        np.testing.assert_array_equal(result['lon'].values, expected['lon'].values)
+    # only the chunks intersecting the selection are read
+    assert stats['chunks_fetched'] + stats['chunks_fill'] < stats['chunks_total']
@@ -0,0 +1,37 @@
+import json
+import os
+import runpy
+
+import pytest
+
+import cefi_transfer
+
+
+def test_s3_upload_script_reads_configuration(tmp_path, monkeypatch):
+    config_file = tmp_path / 'config.json'
+    config_file.write_text(json.dumps({
+        'kerchunk_save_dir': str(tmp_path / 'kerchunk'),
+        'zarr_save_dir': str(tmp_path / 'zarr'),
+        'log_dir': str(tmp_path),
+    }))
+    calls = []
+
+    def fake_upload(args, config):
+        calls.append((args, config))
+        return 0
+
+    monkeypatch.setattr(cefi_transfer, 'cmd_upload', fake_upload)
+    monkeypatch.setattr('sys.argv', [
+        's3_upload.py', '--config', str(config_file), '--root', str(tmp_path / 'portal'), '--no-kerchunk'
+    ])
+    script = os.path.join(os.path.dirname(cefi_transfer.__file__), 's3_upload.py')
+    with pytest.raises(SystemExit) as exit_info:
+        runpy.run_path(script, run_name='__main__')
+
+    assert exit_info.value.code == 0
+    args, config = calls[0]
+    assert args.command == 'upload'
+    assert args.root == str(tmp_path / 'portal')
+    assert args.no_kerchunk
+    assert config['kerchunk_save_dir'] == str(tmp_path / 'kerchunk')
+    assert config['zarr_save_dir'] == str(tmp_path / 'zarr')
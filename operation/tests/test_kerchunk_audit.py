@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+from conftest import BUCKET, RELEASE_DIR, write_netcdf
+from kerchunk_audit import audit_prefix, pair_objects
+from kerchunk_combine import is_reference_key
+from kerchunk_rewrite import find_references
+
+RELEASE = f'{RELEASE_DIR}/r20250101'
+
+
+def test_is_reference_key():
+    assert is_reference_key(f'{RELEASE}/tos.nwa.r20250101.json')
+    assert not is_reference_key(f'{RELEASE}/all.json')
+    assert is_reference_key(f'{RELEASE}/all.json', combined=True)
+    assert not is_reference_key(f'{RELEASE}/manifest.json', combined=True)
+    assert not is_reference_key('catalog.json', combined=True)
+    assert not is_reference_key(f'zarr/{RELEASE_DIR}/tos.zarr/zarr.json', combined=True)
+    assert not is_reference_key(f'zarr/{RELEASE_DIR}/tos.zarr/tos/zarr.json')
+    assert not is_reference_key(f'{RELEASE}/tos.nc')
+
+
+def test_pair_objects_ignores_non_reference_json():
+    listing = {
+        f'{RELEASE}/tos.nc': 1,
+        f'{RELEASE}/tos.json': 1,
+        f'{RELEASE}/sos.json': 1,
+        f'{RELEASE}/all.json': 1,
+        f'{RELEASE}/manifest.json': 1,
+        'catalog.json': 1,
+        f'zarr/{RELEASE_DIR}/tos.zarr/zarr.json': 1,
+    }
+    assert pair_objects(listing) == {'missing_index': [], 'orphan_index': [f'{RELEASE}/sos.json']}
+
+
+def test_audit_clean_prefix(tmp_path, s3_client):
+    kerchunk_hdf = pytest.importorskip('kerchunk.hdf')
+    local_file = write_netcdf(str(tmp_path / 'tos.nc'), chunks=(1, 6, 8))
+    key = f'{RELEASE}/tos.nwa.full.hcast.monthly.regrid.r20250101.199301-199304.nc'
+    with open(local_file, 'rb') as f:
+        s3_client.put_object(Bucket=BUCKET, Key=key, Body=f.read())
+        f.seek(0)
+        refs = kerchunk_hdf.SingleHdf5ToZarr(f, url=f's3://{BUCKET}/{key}', inline_threshold=0).translate()
+    for extra_key, body in (
+        (key.replace('.nc', '.json'), refs),
+        (f'{RELEASE}/all.json', refs),
+        (f'{RELEASE}/manifest.json', []),
+        ('catalog.json', {'parents': {}}),
+        (f'zarr/{RELEASE_DIR}/tos.zarr/zarr.json', {'zarr_format': 3}),
+    ):
+        s3_client.put_object(Bucket=BUCKET, Key=extra_key, Body=json.dumps(body).encode())
+
+    result = audit_prefix(BUCKET, '', samples=2, s3_client=s3_client)
+    assert result['stale'] == []
+    assert result['missing_index'] == []
+    assert result['references'] == 2
+    assert result['ranges'] > 0
+
+
+def test_rewrite_finds_references_only(tmp_path):
+    for relative_path in (
+        f'{RELEASE}/tos.json', f'{RELEASE}/all.json', f'{RELEASE}/manifest.json',
+        'catalog.json', f'zarr/{RELEASE_DIR}/tos.zarr/zarr.json',
+    ):
+        path = tmp_path / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text('{}')
+    import fsspec
+    fs = fsspec.filesystem('file')
+    references = find_references(fs, str(tmp_path))
+    assert sorted(path.rsplit('/', 1)[-1] for _, path in references) == ['all.json', 'tos.json']
+
+
+def test_audit_reports_index_of_a_replaced_netcdf(tmp_path, s3_client):
+    kerchunk_hdf = pytest.importorskip('kerchunk.hdf')
+    key = f'{RELEASE}/tos.nwa.full.hcast.monthly.regrid.r20250101.199301-199304.nc'
+    json_key = key.replace('.nc', '.json')
+
+    def upload_netcdf(seed):
+        local_file = write_netcdf(str(tmp_path / f'tos{seed}.nc'), seed=seed, chunks=(1, 6, 8))
+        with open(local_file, 'rb') as f:
+            s3_client.put_object(Bucket=BUCKET, Key=key, Body=f.read())
+            f.seek(0)
+            refs = kerchunk_hdf.SingleHdf5ToZarr(f, url=f's3://{BUCKET}/{key}', inline_threshold=0).translate()
+        head = s3_client.head_object(Bucket=BUCKET, Key=key)
+        return refs, {'source-size': str(head['ContentLength']), 'source-etag': head['ETag'].strip('"')}
+
+    refs, metadata = upload_netcdf(0)
+    s3_client.put_object(Bucket=BUCKET, Key=json_key, Body=json.dumps(refs).encode(), Metadata=metadata)
+    assert audit_prefix(BUCKET, RELEASE, samples=2, s3_client=s3_client)['stale'] == []
+
+    # same size, ranges that still decode, other content
+    new_refs, new_metadata = upload_netcdf(1)
+    assert new_refs == refs and new_metadata['source-size'] == metadata['source-size']
+    result = audit_prefix(BUCKET, RELEASE, samples=2, s3_client=s3_client)
+    (stale,) = result['stale']
+    assert stale['reference'] == json_key
+    assert stale['netcdf'] == key
+    assert stale['problems'] == [
+        f"index built from ETag {metadata['source-etag']}, {key} has ETag {new_metadata['source-etag']}"
+    ]
+    assert result['sizes'] == {key: int(metadata['source-size'])}
@@ -0,0 +1,67 @@
+"""Tests of the kerchunk reference cache (kerchunk_cache)."""
+
+import os
+import json
+
+import pytest
+
+from conftest import BUCKET, write_netcdf
+
+KEY = 'northwest_atlantic/full_domain/hindcast/monthly/regrid/r20250101/tos.nwa.full.hcast.monthly.regrid.r20250101.199301-199304.nc'
+
+
+def test_reference_rebuilt_only_when_the_object_changes(public_s3, tmp_path, monkeypatch):
+    pytest.importorskip('kerchunk')
+    import kerchunk.hdf
+    from s3_upload import gen_kerchunk_index
+    from kerchunk_cache import KerchunkCache
+
+    local = write_netcdf(str(tmp_path / 'tos.nc'))
+    public_s3.upload_file(local, BUCKET, KEY)
+
+    translations = []
+    translate = kerchunk.hdf.SingleHdf5ToZarr.translate
+
+    def counting_translate(self, *args, **kwargs):
+        translations.append(self)
+        return translate(self, *args, **kwargs)
+
+    monkeypatch.setattr(kerchunk.hdf.SingleHdf5ToZarr, 'translate', counting_translate)
+
+    cache_dir = str(tmp_path / 'cache')
+    cache = KerchunkCache(cache_dir)
+    json_file = gen_kerchunk_index(f's3://{BUCKET}/{KEY}', None, cache=cache)
+    assert json_file == cache.path_for(KEY)
+    assert 'tos/.zarray' in json.load(open(json_file, encoding='utf-8'))['refs']
+    cache.save()
+
+    # a new session reuses the reference of the unchanged object
+    cache = KerchunkCache(cache_dir)
+    assert gen_kerchunk_index(f's3://{BUCKET}/{KEY}', None, cache=cache) == json_file
+    assert len(translations) == 1
+
+    # the object is replaced: new ETag, the reference is rebuilt
+    write_netcdf(local, seed=1)
+    public_s3.upload_file(local, BUCKET, KEY)
+    gen_kerchunk_index(f's3://{BUCKET}/{KEY}', None, cache=cache)
+    assert len(translations) == 2
+
+
+def test_least_recently_used_entries_evicted(tmp_path):
+    from kerchunk_cache import KerchunkCache
+
+    cache = KerchunkCache(str(tmp_path / 'cache'), max_bytes=250)
+    for name in ('a', 'b', 'c'):
+        json_file = tmp_path / f'{name}.json'
+        json_file.write_text('x' * 100)
+        cache.put(f'r20250101/{name}.nc', 1000, f'etag-{name}', str(json_file))
+    # 'a' used after 'b'
+    cache.entries['r20250101/b.nc']['atime'] -= 10
+    assert cache.get('r20250101/a.nc', 1000, 'etag-a') is not None
+
+    cache.evict()
+    assert sorted(cache.entries) == ['r20250101/a.nc', 'r20250101/c.nc']
+    assert not os.path.exists(cache.path_for('r20250101/b.nc'))
+    # size or ETag mismatch: the entry is dropped
+    assert cache.get('r20250101/c.nc', 1000, 'etag-other') is None
+    assert 'r20250101/c.nc' not in cache.entries
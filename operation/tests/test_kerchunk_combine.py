@@ -0,0 +1,73 @@
+"""Tests of the combined release index (kerchunk_combine)."""
+
+import os
+import json
+
+import numpy as np
+import pytest
+
+from conftest import BUCKET
+
+pytest.importorskip('kerchunk')
+
+PREFIX = 'northwest_atlantic/full_domain/seasonal_reforecast/monthly/regrid/r20250212'
+
+
+def write_reforecast(path, seed):
+    """Reforecast file of one initialization (member, lead, lat, lon)"""
+    import xarray as xr
+
+    rng = np.random.default_rng(seed)
+    ds = xr.Dataset(
+        {'tos': (('member', 'lead', 'lat', 'lon'), rng.random((2, 3, 10, 12), dtype='float32'))},
+        coords={
+            'member': np.arange(1, 3),
+            'lead': np.arange(3),
+            'lat': np.linspace(30, 45, 10),
+            'lon': np.linspace(-80, -60, 12),
+        },
+    )
+    ds.to_netcdf(path)
+    return ds
+
+
+def test_reforecast_combined_along_init_time(public_s3, tmp_path):
+    from s3_upload import gen_kerchunk_index
+    from kerchunk_combine import build_combined_index
+
+    expected = {}
+    for seed, init in enumerate(['199401', '199404']):
+        name = f'tos.nwa.full.ss_refcast.monthly.regrid.r20250212.enss.i{init}.nc'
+        local = str(tmp_path / name)
+        expected[init] = write_reforecast(local, seed)
+        key = f'{PREFIX}/{name}'
+        public_s3.upload_file(local, BUCKET, key)
+        json_file = gen_kerchunk_index(f's3://{BUCKET}/{key}', str(tmp_path))
+        public_s3.upload_file(json_file, BUCKET, key.removesuffix('.nc') + '.json')
+    # not a per-file index, left out of the combination
+    public_s3.put_object(Bucket=BUCKET, Key=f'{PREFIX}/manifest.json', Body=b'{}')
+
+    combined_file = str(tmp_path / 'all.json')
+    assert build_combined_index(PREFIX, BUCKET, combined_file) == combined_file
+    with open(combined_file, encoding='utf-8') as f:
+        refs = json.load(f)
+    assert 'tos/.zarray' in refs['refs']
+
+    tos = json.loads(refs['refs']['tos/.zarray'])
+    assert tos['shape'] == [2, 2, 3, 10, 12]
+    # init_time follows the file order, each init reads its own file
+    chunk_keys = sorted(k for k in refs['refs'] if k.startswith('tos/') and not k.startswith('tos/.'))
+    first = {k.split('/')[1].split('.')[0] for k in chunk_keys}
+    assert first == {'0', '1'}
+    for key in chunk_keys:
+        url = refs['refs'][key][0]
+        init = list(expected)[int(key.split('/')[1].split('.')[0])]
+        assert url.endswith(f'.i{init}.nc')
+
+
+def test_no_reference_to_combine(public_s3, tmp_path):
+    from kerchunk_combine import build_combined_index
+
+    public_s3.put_object(Bucket=BUCKET, Key=f'{PREFIX}/manifest.json', Body=b'{}')
+    assert build_combined_index(PREFIX, BUCKET, str(tmp_path / 'all.json')) is None
+    assert not os.path.exists(tmp_path / 'all.json')
@@ -0,0 +1,65 @@
+"""Tests of the mirror reference rewriting (kerchunk_rewrite)."""
+
+import json
+
+import pandas as pd
+
+from conftest import RELEASE_DIR
+from kerchunk_rewrite import MIRROR_PREFIXES, rewrite_references
+
+S3 = 'noaa-oar-cefi-regional-mom6-pds'
+FILE = f'{RELEASE_DIR}/r20250101/tos.nwa.full.hcast.monthly.regrid.r20250101.199301-199304.nc'
+
+
+def test_release_references_rewritten_for_gcs(tmp_path):
+    release = tmp_path / 'src' / RELEASE_DIR / 'r20250101'
+    release.mkdir(parents=True)
+    # per-file reference as written by kerchunk for an s3 file ('bucket/key')
+    (release / 'tos.json').write_text(json.dumps({
+        'version': 1,
+        'refs': {
+            '.zgroup': '{"zarr_format":2}',
+            'tos/0.0.0': [f'{S3}/{FILE}', 100, 50],
+            'tos/0.0.1': [f'{S3}/{FILE}', 150, 50],
+            'lat/0': 'base64:AAAA',
+            'other/0': ['https://example.com/other.nc', 0, 10],
+        },
+    }))
+    # combined reference with a template
+    (release / 'all.json').write_text(json.dumps({
+        'version': 1,
+        'templates': {'u': f's3://{S3}/{FILE}'},
+        'refs': {'tos/0.0.0': ['{{u}}', 100, 50]},
+    }))
+    # parquet reference
+    parquet = release / 'tos.parq'
+    (parquet / 'tos').mkdir(parents=True)
+    (parquet / '.zmetadata').write_text('{"metadata": {}, "record_size": 10}')
+    pd.DataFrame({
+        'path': [f's3://{S3}/{FILE}', None],
+        'offset': [100, 0], 'size': [50, 0], 'raw': [None, b'x'],
+    }).to_parquet(parquet / 'tos' / 'refs.0.parq', index=False)
+    # not references
+    (tmp_path / 'src' / 'catalog.json').write_text('{}')
+
+    dst = tmp_path / 'dst'
+    totals = rewrite_references(str(tmp_path / 'src'), str(dst), 's3', 'gcs', max_workers=3)
+    assert totals == {'references': 3, 'rewritten': 3, 'skipped': 1, 'failed': []}
+
+    gcs_url = MIRROR_PREFIXES['gcs'] + FILE
+    out = dst / RELEASE_DIR / 'r20250101'
+    refs = json.loads((out / 'tos.json').read_text())['refs']
+    assert refs['tos/0.0.0'] == [gcs_url, 100, 50]
+    assert refs['tos/0.0.1'] == [gcs_url, 150, 50]
+    assert refs['lat/0'] == 'base64:AAAA'
+    assert refs['other/0'] == ['https://example.com/other.nc', 0, 10]
+
+    combined = json.loads((out / 'all.json').read_text())
+    assert combined['templates'] == {'u': gcs_url}
+    assert combined['refs']['tos/0.0.0'] == ['{{u}}', 100, 50]
+
+    table = pd.read_parquet(out / 'tos.parq' / 'tos' / 'refs.0.parq')
+    assert table['path'][0] == gcs_url
+    assert pd.isna(table['path'][1])
+    assert (out / 'tos.parq' / '.zmetadata').exists()
+    assert not (dst / 'catalog.json').exists()
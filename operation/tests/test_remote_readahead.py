@@ -0,0 +1,85 @@
+"""Tests of the read-ahead remote file (remote_readahead)."""
+
+import os
+import random
+
+import pytest
+from fsspec.implementations.local import LocalFileSystem
+
+from conftest import write_netcdf
+from remote_readahead import ReadAheadFile
+
+BLOCK = 1024
+
+
+class CountingFileSystem(LocalFileSystem):
+    """Local filesystem recording the range requests"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ranges = []
+
+    def cat_file(self, path, start=None, end=None, **kwargs):
+        self.ranges.append((start, end))
+        return super().cat_file(path, start=start, end=end, **kwargs)
+
+
+@pytest.fixture
+def remote(tmp_path):
+    data = os.urandom(40 * BLOCK + 100)
+    path = tmp_path / 'object.bin'
+    path.write_bytes(data)
+    return CountingFileSystem(skip_instance_cache=True), str(path), data
+
+
+def test_reads_served_from_aligned_blocks(remote):
+    fs, path, data = remote
+    with ReadAheadFile(fs, path, block_size=BLOCK, prefetch_bytes=2 * BLOCK) as f:
+        assert fs.ranges == [(0, 2 * BLOCK)]
+        # small reads in the prefetched head: no request
+        f.seek(10)
+        assert f.read(100) == data[10:110]
+        f.seek(BLOCK + 5)
+        assert f.read(BLOCK) == data[BLOCK + 5:2 * BLOCK + 5]
+        assert fs.ranges[1:] == [(2 * BLOCK, 3 * BLOCK)]
+
+        # blocks 10 and 12 are merged into one request (cached block 11 in between)
+        f.seek(11 * BLOCK)
+        f.read(10)
+        f.seek(10 * BLOCK)
+        assert f.read(3 * BLOCK) == data[10 * BLOCK:13 * BLOCK]
+        assert fs.ranges[2:] == [(11 * BLOCK, 12 * BLOCK), (10 * BLOCK, 13 * BLOCK)]
+
+        # reads past the end are truncated to the object
+        f.seek(-50, os.SEEK_END)
+        assert f.read(BLOCK) == data[-50:]
+        assert f.read(10) == b''
+        assert f.stats['bytes_read'] == 100 + BLOCK + 10 + 3 * BLOCK + 50
+        assert f.stats['requests'] == len(fs.ranges)
+
+
+def test_random_reads_with_a_small_cache(remote):
+    fs, path, data = remote
+    rng = random.Random(0)
+    with ReadAheadFile(fs, path, block_size=BLOCK, prefetch_bytes=0, max_cache_bytes=4 * BLOCK) as f:
+        for _ in range(200):
+            offset = rng.randrange(len(data))
+            length = rng.randrange(1, 6 * BLOCK)
+            f.seek(offset)
+            assert f.read(length) == data[offset:offset + length]
+        assert len(f.blocks) <= 6
+
+
+def test_kerchunk_references_unchanged_with_fewer_requests(tmp_path):
+    pytest.importorskip('kerchunk')
+    from kerchunk.hdf import SingleHdf5ToZarr
+
+    source = write_netcdf(str(tmp_path / 'tos.nc'), ntime=12, chunks=(1, 6, 8))
+    expected = SingleHdf5ToZarr(source, inline_threshold=0).translate()
+
+    fs = CountingFileSystem(skip_instance_cache=True)
+    with ReadAheadFile(fs, source, block_size=64 * 1024) as f:
+        refs = SingleHdf5ToZarr(f, source, inline_threshold=0).translate()
+        stats = dict(f.stats)
+    assert refs == expected
+    assert stats['requests'] < stats['reads']
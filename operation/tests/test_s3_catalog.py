@@ -0,0 +1,81 @@
+import io
+import json
+
+import pandas as pd
+
+from conftest import BUCKET, RELEASE_DIR
+from s3_catalog import write_release_manifest, update_catalog, drop_catalog_releases, load_catalog
+
+
+def put_release(s3_client, release, variables=('tos', 'sos')):
+    for variable in variables:
+        key = f'{RELEASE_DIR}/{release}/{variable}.nwa.full.hcast.monthly.regrid.{release}.199301-199304.nc'
+        s3_client.put_object(Bucket=BUCKET, Key=key, Body=b'data')
+    return write_release_manifest(f'{RELEASE_DIR}/{release}', BUCKET, s3_client)
+
+
+def read_catalog_parquet(s3_client):
+    body = s3_client.get_object(Bucket=BUCKET, Key='catalog.parquet')['Body'].read()
+    return pd.read_parquet(io.BytesIO(body))
+
+
+def test_manifest_and_catalog_describe_the_releases(s3_client):
+    prefix = f'{RELEASE_DIR}/r20250101'
+    key = f'{prefix}/tos.nwa.full.hcast.monthly.regrid.r20250101.199301-199304.nc'
+    s3_client.put_object(Bucket=BUCKET, Key=key, Body=b'data')
+    s3_client.put_object(Bucket=BUCKET, Key=key.removesuffix('.nc') + '.json', Body=b'{}')
+    summary = write_release_manifest(prefix, BUCKET, s3_client, checksums={key: 'sha'})
+
+    body = s3_client.get_object(Bucket=BUCKET, Key=f'{prefix}/manifest.json')['Body'].read()
+    manifest = json.loads(body)
+    assert manifest == summary['entries']
+    (entry,) = manifest
+    assert entry['key'] == key
+    assert entry['size'] == 4
+    assert entry['sha256'] == 'sha'
+    assert entry['reference'] == key.removesuffix('.nc') + '.json'
+    assert (entry['region'], entry['experiment'], entry['frequency']) == (
+        'northwest_atlantic', 'hindcast', 'monthly'
+    )
+    assert (entry['variable'], entry['time_range'], entry['init']) == ('tos', '199301-199304', None)
+
+    update_catalog([summary], BUCKET, s3_client)
+    update_catalog([put_release(s3_client, 'r20240101')], BUCKET, s3_client)
+    catalog = load_catalog(BUCKET, s3_client)
+    parent = catalog['parents'][RELEASE_DIR]
+    assert parent['latest_release'] == 'r20250101'
+    assert parent['latest_prefix'] == prefix
+    assert parent['releases']['r20240101']['files'] == 2
+    assert parent['releases']['r20250101'] == {
+        'manifest': f'{prefix}/manifest.json', 'files': 1, 'bytes': 4
+    }
+
+
+def test_drop_releases_rewrites_catalog_parquet(s3_client):
+    old = put_release(s3_client, 'r20240101')
+    update_catalog([old], BUCKET, s3_client)
+    new = put_release(s3_client, 'r20250101', variables=('tos',))
+    update_catalog([new], BUCKET, s3_client)
+    assert set(read_catalog_parquet(s3_client)['release']) == {'r20250101'}
+
+    drop_catalog_releases([(RELEASE_DIR, 'r20250101')], BUCKET, s3_client)
+
+    catalog = load_catalog(BUCKET, s3_client)
+    assert catalog['parents'][RELEASE_DIR]['latest_release'] == 'r20240101'
+    table = read_catalog_parquet(s3_client)
+    assert set(table['release']) == {'r20240101'}
+    assert len(table) == 2
+
+
+def test_catalog_parquet_deleted_without_pandas(s3_client, monkeypatch):
+    import s3_catalog
+
+    first = put_release(s3_client, 'r20240101')
+    update_catalog([first], BUCKET, s3_client)
+    update_catalog([put_release(s3_client, 'r20250101')], BUCKET, s3_client)
+
+    monkeypatch.setattr(s3_catalog, '_put_parquet', lambda *args: False)
+    drop_catalog_releases([(RELEASE_DIR, 'r20250101')], BUCKET, s3_client)
+    keys = [obj['Key'] for obj in s3_client.list_objects_v2(Bucket=BUCKET)['Contents']]
+    assert 'catalog.json' in keys
+    assert 'catalog.parquet' not in keys
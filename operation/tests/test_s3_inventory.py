@@ -0,0 +1,103 @@
+"""Tests of the compact object inventory (s3_inventory)."""
+
+from conftest import BUCKET, RELEASE_DIR
+from s3_inventory import ObjectInventory, scan_inventory, load_or_scan_inventory
+
+
+def put_objects(s3_client):
+    """Two releases (one over a listing page) and a file outside the release folders"""
+    sizes = {}
+    for release, count in (('r20240101', 1010), ('r20250101', 5)):
+        for i in range(count):
+            key = f'{RELEASE_DIR}/{release}/tos.{i:04d}.nc'
+            sizes[key] = i % 7 + 1
+    sizes[f'{RELEASE_DIR}/README.md'] = 3
+    for key, size in sizes.items():
+        s3_client.put_object(Bucket=BUCKET, Key=key, Body=b'x' * size)
+    return sizes
+
+
+def test_inventory_matches_the_listing(s3_client):
+    sizes = put_objects(s3_client)
+    inventory = scan_inventory(s3_client, BUCKET, 'northwest_atlantic/')
+
+    assert list(inventory) == sorted(sizes)
+    assert dict(inventory) == sizes
+    assert inventory.total_size() == sum(sizes.values())
+    key = f'{RELEASE_DIR}/r20240101/tos.0333.nc'
+    assert inventory.key(inventory.index_of(key)) == key
+    assert f'{RELEASE_DIR}/r20240101/tos.9999.nc' not in inventory
+
+    start, stop = inventory.prefix_range(f'{RELEASE_DIR}/r20250101/')
+    assert list(inventory.iter_keys(start, stop)) == [
+        f'{RELEASE_DIR}/r20250101/tos.{i:04d}.nc' for i in range(5)
+    ]
+    selected = inventory.select(f'{RELEASE_DIR}/r20250101/')
+    assert len(selected) == 5 and selected.prefix == f'{RELEASE_DIR}/r20250101/'
+
+    old = [size for key, size in sizes.items() if '/r20240101/' in key]
+    assert inventory.release_totals() == {
+        (RELEASE_DIR, 'r20240101'): (1010, sum(old)),
+        (RELEASE_DIR, 'r20250101'): (5, 15),
+    }
+    groups = inventory.release_groups()
+    assert sorted(groups[RELEASE_DIR]) == ['r20240101', 'r20250101']
+    assert [inventory.key(i) for i in groups[RELEASE_DIR]['r20250101']] == list(selected)
+    assert [obj['Key'] for obj in inventory.objects(groups[RELEASE_DIR]['r20250101'])] == list(selected)
+
+
+def test_etags_kept_compact(s3_client, tmp_path):
+    from boto3.s3.transfer import TransferConfig
+
+    part_size = 5 * 1024 * 1024
+    local_file = tmp_path / 'large.nc'
+    local_file.write_bytes(b'x' * (part_size + 10))
+    s3_client.upload_file(
+        str(local_file), BUCKET, f'{RELEASE_DIR}/r20250101/large.nc',
+        Config=TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size)
+    )
+    s3_client.put_object(Bucket=BUCKET, Key=f'{RELEASE_DIR}/r20250101/small.nc', Body=b'data')
+    listed = {
+        obj['Key']: obj['ETag'].strip('"')
+        for obj in s3_client.list_objects_v2(Bucket=BUCKET)['Contents']
+    }
+    assert listed[f'{RELEASE_DIR}/r20250101/large.nc'].endswith('-2')
+
+    inventory = scan_inventory(s3_client, BUCKET, '')
+    assert {key: inventory.etag(inventory.index_of(key)) for key in inventory} == listed
+    assert inventory.etags.shape == (2, 16)
+    inventory.save(str(tmp_path / 'inventory.npz'))
+    loaded = ObjectInventory.load(str(tmp_path / 'inventory.npz'))
+    assert {obj['Key']: obj['ETag'] for obj in loaded.objects()} == listed
+    assert {obj['Key']: obj['ETag'] for obj in loaded.select(f'{RELEASE_DIR}/r20250101/s').objects()} == {
+        f'{RELEASE_DIR}/r20250101/small.nc': listed[f'{RELEASE_DIR}/r20250101/small.nc']
+    }
+    # objects listed without an ETag
+    unknown = ObjectInventory.from_objects([{'Key': 'a', 'Size': 1}, {'Key': 'b', 'Size': 2, 'ETag': 'x'}])
+    assert [unknown.etag(0), unknown.etag(1)] == [None, None]
+
+
+def test_saved_inventory_reused_until_too_old(s3_client, tmp_path, monkeypatch):
+    sizes = put_objects(s3_client)
+    inventory_file = str(tmp_path / 'inventory.npz')
+    first = load_or_scan_inventory(s3_client, BUCKET, 'northwest_atlantic/', inventory_file)
+
+    loaded = ObjectInventory.load(inventory_file)
+    assert dict(loaded) == sizes
+    assert loaded.release_totals() == first.release_totals()
+    assert (loaded.bucket, loaded.prefix, loaded.listed_at) == (BUCKET, 'northwest_atlantic/', first.listed_at)
+
+    pages = []
+    list_objects_v2 = s3_client.list_objects_v2
+    monkeypatch.setattr(
+        s3_client, 'list_objects_v2', lambda **kwargs: pages.append(kwargs) or list_objects_v2(**kwargs)
+    )
+    # a sub-prefix of the saved inventory is served without listing
+    release = load_or_scan_inventory(
+        s3_client, BUCKET, f'{RELEASE_DIR}/r20250101/', inventory_file
+    )
+    assert len(release) == 5
+    assert not pages
+
+    load_or_scan_inventory(s3_client, BUCKET, f'{RELEASE_DIR}/r20250101/', inventory_file, max_age=0)
+    assert len(pages) == 1
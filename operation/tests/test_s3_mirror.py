@@ -0,0 +1,68 @@
+"""Tests of the bucket mirror (s3_mirror)."""
+
+import os
+import threading
+
+from boto3.s3.transfer import TransferConfig
+
+from conftest import BUCKET
+
+PREFIX = 'northwest_atlantic/full_domain/hindcast/monthly/regrid/r20250212'
+
+# smallest part size S3 accepts
+PART_SIZE = 5 * 1024 * 1024
+
+
+def test_mirror_checks_unknown_files_off_the_main_thread(s3_client, tmp_path, monkeypatch):
+    import s3_mirror
+
+    contents = {
+        f'{PREFIX}/same.nc': b'a' * 1000,
+        f'{PREFIX}/changed.nc': b'b' * 1000,
+        f'{PREFIX}/missing.nc': b'c' * 10,
+        f'{PREFIX}/multipart.nc': os.urandom(2 * PART_SIZE + 100),
+    }
+    source = tmp_path / 'source'
+    source.mkdir()
+    config = TransferConfig(multipart_threshold=PART_SIZE, multipart_chunksize=PART_SIZE)
+    for key, data in contents.items():
+        local = source / os.path.basename(key)
+        local.write_bytes(data)
+        s3_client.upload_file(str(local), BUCKET, key, Config=config)
+
+    # local tree copied by other means: no mirror state yet
+    dest = tmp_path / 'mirror'
+    for key in (f'{PREFIX}/same.nc', f'{PREFIX}/multipart.nc'):
+        path = s3_mirror.local_path_of_key(str(dest), key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(contents[key])
+    path = s3_mirror.local_path_of_key(str(dest), f'{PREFIX}/changed.nc')
+    with open(path, 'wb') as f:
+        f.write(b'x' * 1000)
+
+    check_threads = set()
+    local_etag_matches = s3_mirror.local_etag_matches
+
+    def recording_etag_matches(*args, **kwargs):
+        check_threads.add(threading.current_thread().name)
+        return local_etag_matches(*args, **kwargs)
+
+    monkeypatch.setattr(s3_mirror, 'local_etag_matches', recording_etag_matches)
+
+    result = s3_mirror.mirror_prefix(BUCKET, PREFIX, str(dest), s3_client=s3_client)
+    assert result['current'] == 2
+    assert result['to_download'] == 2
+    assert result['downloaded'] == 2
+    assert not result['failed']
+    assert check_threads and threading.main_thread().name not in check_threads
+    for key, data in contents.items():
+        with open(s3_mirror.local_path_of_key(str(dest), key), 'rb') as f:
+            assert f.read() == data
+
+    # the checked files are in the state, the next run does not read them
+    check_threads.clear()
+    result = s3_mirror.mirror_prefix(BUCKET, PREFIX, str(dest), s3_client=s3_client)
+    assert result['current'] == 4
+    assert result['to_download'] == 0
+    assert not check_threads
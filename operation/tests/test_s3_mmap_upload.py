@@ -0,0 +1,62 @@
+"""Tests of the single-pass upload from a memory mapping (s3_mmap_upload)."""
+
+import os
+import hashlib
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import BUCKET, write_netcdf
+from s3_mmap_upload import map_file, upload_mapped, validate_netcdf_buffer
+from s3_upload import compute_s3_etag, file_sha256
+
+# smallest part size S3 accepts
+PART_SIZE = 5 * 1024 * 1024
+
+UPLOAD_CONFIG = SimpleNamespace(
+    multipart_threshold=PART_SIZE,
+    multipart_chunksize=PART_SIZE,
+    max_request_concurrency=2,
+)
+
+
+@pytest.mark.parametrize('size', [1000, 2 * PART_SIZE + 100])
+def test_checksums_match_the_stored_object(s3_client, tmp_path, size):
+    local_file = tmp_path / 'tos.nc'
+    local_file.write_bytes(os.urandom(size))
+    obj_name = 'data/r20250101/tos.nc'
+
+    with map_file(str(local_file)) as (buffer, stat):
+        assert stat.st_size == size
+        checksums = upload_mapped(
+            buffer, stat, str(local_file), obj_name, BUCKET, UPLOAD_CONFIG, s3_client,
+            metadata={'release': 'r20250101'}
+        )
+
+    etags = compute_s3_etag(str(local_file), UPLOAD_CONFIG)
+    assert checksums == {
+        'sha256': file_sha256(str(local_file)),
+        'md5': etags['md5'],
+        'etag': etags['multipart'],
+        'etag_part_size': PART_SIZE,
+    }
+    head = s3_client.head_object(Bucket=BUCKET, Key=obj_name)
+    remote_etag = head['ETag'].strip('"')
+    assert remote_etag == (etags['multipart'] if size >= PART_SIZE else etags['md5'])
+    assert head['Metadata'] == {'release': 'r20250101'}
+    body = s3_client.get_object(Bucket=BUCKET, Key=obj_name)['Body'].read()
+    assert hashlib.sha256(body).hexdigest() == checksums['sha256']
+
+
+def test_validation_reads_the_mapping(tmp_path):
+    pytest.importorskip('netCDF4')
+    local_file = write_netcdf(str(tmp_path / 'tos.nc'))
+    with map_file(local_file) as (buffer, _):
+        validate_netcdf_buffer(buffer, local_file)
+
+    truncated = tmp_path / 'truncated.nc'
+    with open(local_file, 'rb') as f:
+        truncated.write_bytes(f.read()[:500])
+    with map_file(str(truncated)) as (buffer, _):
+        with pytest.raises(OSError):
+            validate_netcdf_buffer(buffer, str(truncated))
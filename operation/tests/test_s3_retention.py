@@ -0,0 +1,47 @@
+from conftest import BUCKET, RELEASE_DIR
+from s3_retention import apply_retention
+
+
+def put_release(s3_client, release, variables=('tos', 'sos')):
+    for variable in variables:
+        key = f'{RELEASE_DIR}/{release}/{variable}.{release}.nc'
+        s3_client.put_object(Bucket=BUCKET, Key=key, Body=b'data')
+
+
+def remaining_releases(s3_client):
+    keys = [obj['Key'] for obj in s3_client.list_objects_v2(Bucket=BUCKET)['Contents']]
+    return sorted({key.split('/')[-2] for key in keys})
+
+
+def test_delete_uses_fresh_listing(tmp_path, s3_client):
+    inventory_file = str(tmp_path / 'inventory.npz')
+    put_release(s3_client, 'r20240101')
+    put_release(s3_client, 'r20240601')
+
+    # dry run saves the inventory (two releases)
+    result = apply_retention(
+        BUCKET, '', keep=1, pins=[], dry_run=True, s3_client=s3_client,
+        inventory_file=inventory_file, inventory_max_age=3600
+    )
+    assert result['releases'] == 1
+
+    # a new release lands after the inventory was saved
+    put_release(s3_client, 'r20250101')
+    result = apply_retention(
+        BUCKET, '', keep=1, pins=[], dry_run=False, s3_client=s3_client,
+        inventory_file=inventory_file, inventory_max_age=3600
+    )
+    assert result['releases'] == 2
+    assert result['deleted'] == 4
+    assert remaining_releases(s3_client) == ['r20250101']
+
+
+def test_pinned_release_kept(s3_client):
+    put_release(s3_client, 'r20240101')
+    put_release(s3_client, 'r20240601')
+    put_release(s3_client, 'r20250101')
+    result = apply_retention(
+        BUCKET, RELEASE_DIR, keep=1, pins=['r20240101'], dry_run=False, s3_client=s3_client
+    )
+    assert result['deleted'] == 2
+    assert remaining_releases(s3_client) == ['r20240101', 'r20250101']
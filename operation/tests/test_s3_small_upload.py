@@ -0,0 +1,55 @@
+"""Tests of the small object uploader (s3_small_upload)."""
+
+import json
+
+from botocore.exceptions import ClientError
+
+from conftest import BUCKET, RELEASE_DIR
+import s3_small_upload
+from s3_small_upload import get_pooled_s3_client, iter_local_files, put_small_objects
+
+
+class FlakyClient:
+    """S3 client failing the first PUT of every key"""
+
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+        self.attempts = {}
+
+    def put_object(self, Key, **kwargs):
+        self.attempts[Key] = self.attempts.get(Key, 0) + 1
+        if self.attempts[Key] == 1:
+            raise ClientError({'Error': {'Code': 'SlowDown', 'Message': 'slow down'}}, 'PutObject')
+        return self.s3_client.put_object(Key=Key, **kwargs)
+
+
+def test_tree_uploaded_to_the_same_keys_with_retries(s3_client, tmp_path, monkeypatch):
+    local_dir = tmp_path / 'json'
+    release = local_dir / RELEASE_DIR / 'r20250101'
+    release.mkdir(parents=True)
+    for i in range(20):
+        (release / f'tos.{i:02d}.json').write_text(json.dumps({'refs': {'i': i}}))
+    (release / 'tos.00.nc').write_bytes(b'netcdf')
+
+    monkeypatch.setattr(s3_small_upload.time, 'sleep', lambda seconds: None)
+    client = FlakyClient(get_pooled_s3_client(max_pool_connections=8))
+    uploaded, failed = put_small_objects(
+        iter_local_files(str(local_dir)), BUCKET, client, max_workers=8
+    )
+    assert (uploaded, failed) == (20, [])
+    assert all(count == 2 for count in client.attempts.values())
+
+    keys = [obj['Key'] for obj in s3_client.list_objects_v2(Bucket=BUCKET)['Contents']]
+    assert sorted(keys) == [f'{RELEASE_DIR}/r20250101/tos.{i:02d}.json' for i in range(20)]
+    response = s3_client.get_object(Bucket=BUCKET, Key=f'{RELEASE_DIR}/r20250101/tos.07.json')
+    assert response['ContentType'] == 'application/json'
+    assert json.loads(response['Body'].read()) == {'refs': {'i': 7}}
+
+
+def test_failed_objects_reported(s3_client, tmp_path, monkeypatch):
+    (tmp_path / 'a.json').write_text('{}')
+    monkeypatch.setattr(s3_small_upload.time, 'sleep', lambda seconds: None)
+    uploaded, failed = put_small_objects(
+        iter_local_files(str(tmp_path)), 'missing-bucket', s3_client, max_workers=2
+    )
+    assert (uploaded, failed) == (0, ['a.json'])
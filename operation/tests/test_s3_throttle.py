@@ -0,0 +1,91 @@
+"""Tests of the adaptive request concurrency (s3_throttle) and its use by the uploads."""
+
+import os
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from s3_throttle import AdaptiveConcurrency, AdaptiveTransferConfig, LATENCY_WINDOW
+
+
+def test_large_requests_do_not_look_congested():
+    controller = AdaptiveConcurrency(initial=8, maximum=8)
+    for _ in range(LATENCY_WINDOW):
+        controller.observe('PutObject', 0.01, nbytes=4096)
+    for _ in range(LATENCY_WINDOW):
+        controller.observe('PutObject', 1.0, nbytes=50 * 1024**2)
+    assert controller.stats['decreases'] == 0
+    assert controller.concurrency == 8
+
+    # the same slow-down within a size class is congestion
+    for _ in range(LATENCY_WINDOW):
+        controller.observe('PutObject', 0.5, nbytes=4096)
+    assert controller.stats['decreases'] == 1
+    assert controller.concurrency < 8
+
+
+class PartCountingClient:
+    """Multipart upload client recording the parts in flight"""
+
+    def __init__(self, latency=0.02):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.max_inflight = 0
+        self.parts = 0
+
+    def create_multipart_upload(self, **kwargs):
+        return {'UploadId': 'upload'}
+
+    def upload_part(self, Body, **kwargs):
+        with self.lock:
+            self.inflight += 1
+            self.parts += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            data = Body.read()
+            time.sleep(self.latency)
+            return {'ETag': f'"{hashlib.md5(data).hexdigest()}"'}
+        finally:
+            with self.lock:
+                self.inflight -= 1
+
+    def complete_multipart_upload(self, **kwargs):
+        return {}
+
+    def abort_multipart_upload(self, **kwargs):
+        return {}
+
+
+def test_mapped_parts_wait_for_a_controller_slot(tmp_path):
+    from s3_mmap_upload import map_file, upload_mapped
+
+    part_size = 64 * 1024
+    local_files = []
+    for i in range(2):
+        local_file = tmp_path / f'file{i}.nc'
+        local_file.write_bytes(os.urandom(10 * part_size))
+        local_files.append(str(local_file))
+
+    # parts of both files share a limit of 3 requests (3 part threads per file)
+    controller = AdaptiveConcurrency(initial=3, minimum=3, maximum=3)
+    upload_config = AdaptiveTransferConfig(
+        controller, share=1, multipart_threshold=part_size, multipart_chunksize=part_size
+    )
+    client = PartCountingClient()
+
+    def upload(local_file):
+        with map_file(local_file) as (buffer, stat):
+            return upload_mapped(
+                buffer, stat, local_file, os.path.basename(local_file), 'bucket1', upload_config, client
+            )
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(upload, local_files))
+
+    assert client.parts == 20
+    assert client.max_inflight <= 3
+    for local_file, checksums in zip(local_files, results):
+        with open(local_file, 'rb') as f:
+            assert checksums['md5'] == hashlib.md5(f.read()).hexdigest()
@@ -0,0 +1,205 @@
+import os
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import BUCKET, RELEASE_DIR, write_netcdf, write_release
+import s3_upload
+from s3_upload import (
+    boto3_upload, compute_s3_etag, file_sha256, run_upload,
+    load_checksum_record, save_checksum_record, verify_s3_objects, verify_and_reupload,
+)
+
+UPLOAD_CONFIG = SimpleNamespace(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_request_concurrency=2,
+)
+
+
+def test_file_sha256_after_etag_only_entry(tmp_path):
+    local_file = tmp_path / 'a.bin'
+    local_file.write_bytes(b'x' * 1000)
+    record = {}
+
+    etags = compute_s3_etag(str(local_file), UPLOAD_CONFIG, record)
+    assert 'sha256' not in record[str(local_file)]
+
+    digest = file_sha256(str(local_file), record)
+    entry = record[str(local_file)]
+    assert entry['sha256'] == digest
+    # the etags of the unchanged file are kept
+    assert entry['md5'] == etags['md5']
+    assert file_sha256(str(local_file), record) == digest
+
+
+def test_record_reset_when_file_changes(tmp_path):
+    local_file = tmp_path / 'a.bin'
+    local_file.write_bytes(b'x' * 1000)
+    record = {}
+    compute_s3_etag(str(local_file), UPLOAD_CONFIG, record)
+
+    local_file.write_bytes(b'y' * 2000)
+    file_sha256(str(local_file), record)
+    assert 'md5' not in record[str(local_file)]
+
+
+def test_concurrent_record_updates(tmp_path):
+    files = []
+    for i in range(32):
+        local_file = tmp_path / f'{i}.bin'
+        local_file.write_bytes(os.urandom(4096))
+        files.append(str(local_file))
+    record = {}
+    record_file = str(tmp_path / 'record.json')
+
+    def work(local_file):
+        file_sha256(local_file, record)
+        compute_s3_etag(local_file, UPLOAD_CONFIG, record)
+
+    threads = [threading.Thread(target=work, args=(f,)) for f in files]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    save_checksum_record(record, record_file)
+    saved = load_checksum_record(record_file)
+    assert sorted(saved) == sorted(files)
+    assert all({'sha256', 'md5', 'etag'} <= set(entry) for entry in saved.values())
+
+
+def test_netcdf_upload_records_checksums(tmp_path, s3_client):
+    local_file = write_netcdf(str(tmp_path / 'r20250101' / 'tos.nc'))
+    record = {}
+
+    result = boto3_upload(
+        local_file, 'data/r20250101/tos.nc', BUCKET, UPLOAD_CONFIG, s3_client,
+        checksum_record=record
+    )
+    assert result == 'uploaded'
+    assert record[local_file]['sha256'] == file_sha256(local_file)
+    head = s3_client.head_object(Bucket=BUCKET, Key='data/r20250101/tos.nc')
+    assert head['ETag'].strip('"') == record[local_file]['md5']
+
+
+def test_run_upload_survives_index_errors(tmp_path, monkeypatch, s3_client):
+    portal_dir = tmp_path / 'portal'
+    list_files = write_release(portal_dir, 'r20250101')
+    monkeypatch.setattr(s3_upload, 'PORTAL_DATA_PATH', str(portal_dir))
+
+    def broken_index(**kwargs):
+        raise OSError('kerchunk scan failed')
+
+    monkeypatch.setattr(s3_upload, 'gen_kerchunk_index', broken_index)
+    record_file = str(tmp_path / 'checksums.json')
+    report_file = str(tmp_path / 'report.json')
+
+    run_report = run_upload(
+        local_root_dirs=str(portal_dir),
+        s3_bucket_name=BUCKET,
+        kerchunk_save_dir=str(tmp_path / 'kerchunk'),
+        max_file_workers=2,
+        checksum_record_file=record_file,
+        report_file=report_file,
+        s3_client=s3_client,
+    )
+
+    results = {result['cloud']: result for result in run_report['results']}
+    assert set(results) == {file_info['cloud'] for file_info in list_files}
+    for result in results.values():
+        assert result['action'] == 'uploaded'
+        assert result['index'] == 'failed'
+        assert 'kerchunk scan failed' in result['error']
+    with open(report_file, encoding='utf-8') as f:
+        assert len(json.load(f)['results']) == 2
+    assert sorted(load_checksum_record(record_file)) == sorted(f['local'] for f in list_files)
+
+
+def test_run_upload_saves_state_when_stopped(tmp_path, monkeypatch, s3_client):
+    portal_dir = tmp_path / 'portal'
+    list_files = write_release(portal_dir, 'r20250101')
+    monkeypatch.setattr(s3_upload, 'PORTAL_DATA_PATH', str(portal_dir))
+
+    def broken_catalog(*args, **kwargs):
+        raise RuntimeError('catalog update failed')
+
+    monkeypatch.setattr(s3_upload, 'update_catalog', broken_catalog)
+    record_file = str(tmp_path / 'checksums.json')
+    report_file = str(tmp_path / 'report.json')
+
+    with pytest.raises(RuntimeError):
+        run_upload(
+            local_root_dirs=str(portal_dir),
+            s3_bucket_name=BUCKET,
+            checksum_record_file=record_file,
+            report_file=report_file,
+            s3_client=s3_client,
+        )
+    assert os.path.exists(report_file)
+    assert sorted(load_checksum_record(record_file)) == sorted(f['local'] for f in list_files)
+
+
+def test_repacked_release_copies_unchanged_files(tmp_path, monkeypatch, s3_client):
+    pytest.importorskip('h5py')
+    portal_dir = tmp_path / 'portal'
+    repack_dir = str(tmp_path / 'repacked')
+    monkeypatch.setattr(s3_upload, 'PORTAL_DATA_PATH', str(portal_dir))
+
+    def write_tiny_chunks(release):
+        # 80 KB variable in 1 KB chunks: flagged and repacked
+        cloud = f'{RELEASE_DIR}/{release}/tos.nwa.full.hcast.monthly.regrid.{release}.199301-199804.nc'
+        write_netcdf(str(portal_dir / cloud), ntime=64, nlat=16, nlon=20, chunks=(1, 16, 20))
+        return cloud
+
+    def upload():
+        return run_upload(
+            local_root_dirs=str(portal_dir),
+            s3_bucket_name=BUCKET,
+            max_file_workers=2,
+            checksum_record_file=str(tmp_path / 'checksums.json'),
+            report_file=str(tmp_path / 'report.json'),
+            s3_client=s3_client,
+            repack_dir=repack_dir,
+        )
+
+    first = write_tiny_chunks('r20250101')
+    run_report = upload()
+    assert [result['action'] for result in run_report['results']] == ['uploaded']
+    assert run_report['layout'][0]['repacked'] is not None
+    assert os.path.exists(os.path.join(repack_dir, first))
+
+    # same content in the next release: server-side copy of the repacked object
+    second = write_tiny_chunks('r20250201')
+    run_report = upload()
+    assert [(result['cloud'], result['action']) for result in run_report['results']] == [(second, 'copied')]
+    first_object = s3_client.get_object(Bucket=BUCKET, Key=first)['Body'].read()
+    second_object = s3_client.get_object(Bucket=BUCKET, Key=second)['Body'].read()
+    assert first_object == second_object
+    with open(os.path.join(repack_dir, second), 'rb') as f:
+        assert f.read() == second_object
+
+
+def test_verify_objects_reports_and_reuploads_bad_objects(tmp_path, s3_client):
+    list_file_info = []
+    for name in ('tos', 'sos', 'zos'):
+        local_file = write_netcdf(str(tmp_path / f'{name}.nc'))
+        list_file_info.append({'local': local_file, 'cloud': f'data/r20250101/{name}.nc'})
+        boto3_upload(local_file, f'data/r20250101/{name}.nc', BUCKET, UPLOAD_CONFIG, s3_client)
+
+    # same size but different content, and a missing object
+    with open(list_file_info[1]['local'], 'rb') as f:
+        data = bytearray(f.read())
+    data[-1] ^= 0xFF
+    s3_client.put_object(Bucket=BUCKET, Key='data/r20250101/sos.nc', Body=bytes(data))
+    s3_client.delete_object(Bucket=BUCKET, Key='data/r20250101/zos.nc')
+
+    failed = verify_s3_objects(list_file_info, BUCKET, UPLOAD_CONFIG, s3_client, max_workers=3)
+    assert sorted(file_info['cloud'] for file_info in failed) == [
+        'data/r20250101/sos.nc', 'data/r20250101/zos.nc'
+    ]
+
+    assert verify_and_reupload(list_file_info, BUCKET, UPLOAD_CONFIG, s3_client) == []
+    assert verify_s3_objects(list_file_info, BUCKET, UPLOAD_CONFIG, s3_client) == []
@@ -0,0 +1,155 @@
+import os
+
+import s3_watch
+from s3_watch import StableFileTracker, PendingRelease, mount_fs_type, is_remote_fs, upload_settled
+
+
+def test_tracker_retracks_changed_done_file(tmp_path):
+    path = tmp_path / 'r20250101' / 'tos.nc'
+    path.parent.mkdir()
+    path.write_bytes(b'a' * 10)
+    tracker = StableFileTracker(settle_seconds=0)
+
+    tracker.add(str(path))
+    assert tracker.pop_stable() == []
+    assert tracker.pop_stable() == [str(path)]
+    # an unchanged file is not handed out twice
+    tracker.add(str(path))
+    assert tracker.pop_stable() == []
+
+    path.write_bytes(b'b' * 20)
+    tracker.pop_stable()
+    assert tracker.pop_stable() == [str(path)]
+
+    os.remove(path)
+    tracker.pop_stable()
+    assert tracker.done == {}
+
+
+def test_tracker_retry(tmp_path):
+    path = tmp_path / 'tos.nc'
+    path.write_bytes(b'a')
+    tracker = StableFileTracker(settle_seconds=0)
+    tracker.add(str(path))
+    tracker.pop_stable()
+    assert tracker.pop_stable() == [str(path)]
+
+    tracker.retry(str(path))
+    tracker.pop_stable()
+    assert tracker.pop_stable() == [str(path)]
+
+
+def test_remote_fs_detection(tmp_path):
+    mounts = tmp_path / 'mounts'
+    mounts.write_text(
+        "/dev/sda1 / ext4 rw 0 0\n"
+        "gpfs1 /gpfs/f5 gpfs rw 0 0\n"
+        "server:/export /gpfs/f5/local\\040dir nfs4 rw 0 0\n"
+    )
+    assert mount_fs_type('/gpfs/f5/cefi/data', str(mounts)) == 'gpfs'
+    assert mount_fs_type('/gpfs/f5/local dir/x', str(mounts)) == 'nfs4'
+    assert mount_fs_type('/gpfs/f50', str(mounts)) == 'ext4'
+    assert is_remote_fs('/gpfs/f5', str(mounts))
+    assert not is_remote_fs('/home', str(mounts))
+    assert not is_remote_fs('/home', str(tmp_path / 'missing'))
+
+
+def test_upload_settled_failure_is_retryable(tmp_path, monkeypatch):
+    release_dir = tmp_path / 'cefi' / 'r20250101'
+    release_dir.mkdir(parents=True)
+    local_file = release_dir / 'tos.nc'
+    local_file.write_bytes(b'a')
+    monkeypatch.setattr(s3_watch, 'PORTAL_DATA_PATH', str(tmp_path))
+    release = PendingRelease(str(release_dir))
+
+    monkeypatch.setattr(s3_watch, 'process_file', lambda **kwargs: {'action': 'failed'})
+    assert not upload_settled(str(local_file), release, None, None, {})
+    assert release.failed == {str(local_file)} and release.list_files == []
+
+    monkeypatch.setattr(s3_watch, 'process_file', lambda **kwargs: {'action': 'uploaded'})
+    assert upload_settled(str(local_file), release, None, None, {})
+    assert release.failed == set()
+    assert release.list_files == [{'local': str(local_file), 'cloud': 'cefi/r20250101/tos.nc'}]
+
+
+def test_watch_finalizes_each_settled_release_once(tmp_path, monkeypatch):
+    parent_dir = tmp_path / 'cefi'
+    (parent_dir / 'r20240101').mkdir(parents=True)
+    (parent_dir / 'r20240101' / 'tos.nc').write_bytes(b'old')
+    release_dir = parent_dir / 'r20250101'
+    release_dir.mkdir()
+    monkeypatch.setattr(s3_watch, 'PORTAL_DATA_PATH', str(tmp_path))
+    monkeypatch.setattr(s3_watch, 'CHECKSUM_RECORD', str(tmp_path / 'record.json'))
+    monkeypatch.setattr(s3_watch, 'INotify', None)
+    monkeypatch.setattr(s3_watch.boto3, 'Session', lambda: type(
+        'Session', (), {'client': lambda self, name: type('Client', (), {'close': lambda self: None})()}
+    )())
+
+    calls = {'list': 0, 'process': [], 'finalize': [], 'publish': [], 'catalog': [], 'save': 0}
+    create_file_dict = s3_watch.create_file_dict
+
+    def counting_create_file_dict(root):
+        calls['list'] += 1
+        return create_file_dict(root)
+
+    def fake_process_file(file_info, dict_previous_releases, checksum_record, **kwargs):
+        assert list(dict_previous_releases) == ['r20240101']
+        checksum_record[file_info['local']] = {'sha256': os.path.basename(file_info['local'])}
+        calls['process'].append(file_info['cloud'])
+        return {'cloud': file_info['cloud'], 'action': 'uploaded', 'index': None}
+
+    def fake_finalize_release(list_files, run_report, publish, **kwargs):
+        assert not publish
+        calls['finalize'].append(sorted(file_info['cloud'] for file_info in list_files))
+        run_report['verified'] += len(list_files)
+
+    def fake_publish_release(release_prefix, release_checksums, **kwargs):
+        calls['publish'].append((release_prefix, release_checksums))
+        if len(calls['publish']) == 1:
+            raise OSError('bucket unreachable')
+        return {'release': release_prefix}
+
+    monkeypatch.setattr(s3_watch, 'create_file_dict', counting_create_file_dict)
+    monkeypatch.setattr(s3_watch, 'process_file', fake_process_file)
+    monkeypatch.setattr(s3_watch, 'finalize_release', fake_finalize_release)
+    monkeypatch.setattr(s3_watch, 'publish_release', fake_publish_release)
+    monkeypatch.setattr(s3_watch, 'update_catalog', lambda summaries, *args: calls['catalog'].append(summaries))
+    monkeypatch.setattr(
+        s3_watch, 'save_checksum_record', lambda record, f: calls.__setitem__('save', calls['save'] + 1)
+    )
+
+    trackers = []
+    tracker_class = s3_watch.StableFileTracker
+
+    def keep_tracker(settle_seconds):
+        trackers.append(tracker_class(settle_seconds))
+        return trackers[-1]
+
+    monkeypatch.setattr(s3_watch, 'StableFileTracker', keep_tracker)
+
+    # files land over several polls, then the watcher is stopped
+    polls = iter(range(8))
+
+    def sleep(seconds):
+        poll = next(polls, None)
+        if poll is None:
+            raise KeyboardInterrupt
+        if poll < 3:
+            (release_dir / f'tos.{poll}.nc').write_bytes(b'x' * (poll + 1))
+
+    monkeypatch.setattr(s3_watch.time, 'sleep', sleep)
+    s3_watch.watch(str(tmp_path), settle_seconds=0, interval=1, force_poll=True)
+
+    cloud_names = [f'cefi/r20250101/tos.{i}.nc' for i in range(3)]
+    assert sorted(calls['process']) == cloud_names
+    # the older releases are listed once for the release folder
+    assert calls['list'] == 1
+    # the failed publication is retried on the next poll
+    assert calls['finalize'] == [cloud_names] * 2
+    assert calls['publish'] == [(
+        'cefi/r20250101', {name: os.path.basename(name) for name in cloud_names}
+    )] * 2
+    assert calls['catalog'] == [[{'release': 'cefi/r20250101'}]]
+    # saved once per finalization and once when the watch stops
+    assert calls['save'] == 3
+    assert trackers[0].done == {}
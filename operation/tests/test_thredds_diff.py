@@ -0,0 +1,70 @@
+"""Tests of the THREDDS catalog to bucket diff (thredds_diff)."""
+
+import pytest
+
+from conftest import BUCKET, RELEASE_DIR
+
+httpx = pytest.importorskip('httpx')
+
+import thredds_crawler
+from thredds_crawler import CEFI_THREDDS_BASE
+from thredds_diff import THREDDS_FILESERVER, THREDDS_ROOT_PATH, thredds_files, diff_thredds_bucket
+from s3_remove_prefix import scan_prefix
+
+NS = 'http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0'
+RELEASE = f'{RELEASE_DIR}/r20250101'
+
+
+def dataset(name, size, units, modified):
+    return (
+        f'<dataset name="{name}" urlPath="{THREDDS_ROOT_PATH}{RELEASE}/{name}">'
+        f'<dataSize units="{units}">{size}</dataSize>'
+        f'<date type="modified">{modified}</date></dataset>'
+    )
+
+
+CATALOGS = {
+    f'{CEFI_THREDDS_BASE}{RELEASE_DIR}/catalog.xml': (
+        f'<catalog xmlns="{NS}" xmlns:xlink="http://www.w3.org/1999/xlink">'
+        '<catalogRef xlink:href="r20250101/catalog.xml" xlink:title="r20250101"/></catalog>'
+    ),
+    f'{CEFI_THREDDS_BASE}{RELEASE}/catalog.xml': (
+        f'<catalog xmlns="{NS}"><dataset name="r20250101">'
+        + dataset('current.nc', '2.000', 'Kbytes', '2020-01-01T00:00:00Z')
+        + dataset('resized.nc', '3.000', 'Kbytes', '2020-01-01T00:00:00Z')
+        + dataset('stale.nc', '2.048', 'Kbytes', '2999-01-01T00:00:00Z')
+        + dataset('missing.nc', '1.5', 'Mbytes', '2020-01-01T00:00:00Z')
+        + '</dataset></catalog>'
+    ),
+}
+
+
+def test_diff_reports_the_files_to_transfer(s3_client, monkeypatch):
+    def handler(request):
+        body = CATALOGS.get(str(request.url))
+        return httpx.Response(200, text=body) if body else httpx.Response(404)
+
+    client = httpx.Client
+    monkeypatch.setattr(
+        thredds_crawler.httpx, 'Client',
+        lambda **kwargs: client(transport=httpx.MockTransport(handler), **kwargs)
+    )
+    for name, size in [('current.nc', 2048), ('resized.nc', 2048), ('stale.nc', 2048), ('extra.nc', 10)]:
+        s3_client.put_object(Bucket=BUCKET, Key=f'{RELEASE}/{name}', Body=b'x' * size)
+
+    thredds = thredds_files(f'{RELEASE_DIR}/')
+    assert sorted(thredds) == [
+        f'{RELEASE}/{name}' for name in ('current.nc', 'missing.nc', 'resized.nc', 'stale.nc')
+    ]
+    assert thredds[f'{RELEASE}/missing.nc']['data_size_units'] == 'Mbytes'
+
+    bucket_objects, _, _ = scan_prefix(s3_client, BUCKET, f'{RELEASE_DIR}/')
+    diff = diff_thredds_bucket(thredds, bucket_objects)
+    assert {category: [entry['key'] for entry in entries] for category, entries in diff.items()} == {
+        'missing': [f'{RELEASE}/missing.nc'],
+        'size_different': [f'{RELEASE}/resized.nc'],
+        'stale': [f'{RELEASE}/stale.nc'],
+        'extra': [f'{RELEASE}/extra.nc'],
+    }
+    assert diff['missing'][0]['url'] == f'{THREDDS_FILESERVER}{THREDDS_ROOT_PATH}{RELEASE}/missing.nc'
+    assert diff['size_different'][0]['bucket_size'] == 2048
@@ -0,0 +1,86 @@
+"""Tests of the transfer sharding (transfer_shard)."""
+
+import json
+
+from transfer_shard import ShardAssigner, merge_reports
+
+
+def make_items(names):
+    return [{'local': f'/portal/{name}', 'cloud': name} for name in names]
+
+
+def file_size(item):
+    """Spread of sizes of a release: a few large files and many small ones"""
+    index = int(item['cloud'].split('.')[-2])
+    return 50_000_000 if index % 25 == 0 else 1_000_000 + (index * 7919) % 9_000_000
+
+
+def test_assignment_covers_every_file_and_balances_bytes():
+    items = make_items([f'r2025/tos.{i:03d}.nc' for i in range(200)])
+
+    shards = [ShardAssigner(4).select(items, index, size=file_size) for index in range(4)]
+    assigned = sorted(item['cloud'] for shard in shards for item in shard)
+    assert assigned == sorted(item['cloud'] for item in items)
+    # per-shard byte totals within the largest file of the mean
+    totals = [sum(file_size(item) for item in shard) for shard in shards]
+    mean = sum(totals) / 4
+    assert max(totals) - mean <= 50_000_000
+    assert max(totals) - min(totals) <= 0.05 * mean
+
+
+def test_assignment_same_on_every_node():
+    items = make_items([f'r2025/sos.{i:03d}.nc' for i in range(120)])
+    shards = {
+        item['cloud']: index
+        for index in range(3) for item in ShardAssigner(3).select(items, index, size=file_size)
+    }
+
+    # other walk order, an assigner that already balanced another release
+    assigner = ShardAssigner(3)
+    assigner.select(make_items(['other/a.001.nc', 'other/b.002.nc']), 0, size=file_size)
+    for index in range(3):
+        reordered = assigner.select(list(reversed(items)), index, size=file_size)
+        assert [item['cloud'] for item in reordered] == [
+            item['cloud'] for item in reversed(items) if shards[item['cloud']] == index
+        ]
+    assert ShardAssigner(3).assign([(item['cloud'], file_size(item)) for item in items]) == shards
+
+
+def test_equal_sizes_spread_by_count():
+    items = make_items([f'r2025/empty.{i:03d}.nc' for i in range(10)])
+    counts = [len(ShardAssigner(4).select(items, index, size=lambda item: 0)) for index in range(4)]
+    assert sorted(counts) == [2, 2, 3, 3]
+
+
+def test_merge_reports_keeps_per_shard_limits(tmp_path):
+    reports = []
+    for index, (limit, requests) in enumerate([(12, 100), (30, 50)]):
+        report = {
+            'shard': f'{index}/2',
+            'started': f'2025-01-0{index + 1}T00:00:00',
+            'finished': f'2025-01-0{index + 3}T00:00:00',
+            'results': [{'cloud': f'file{index}.nc', 'action': 'uploaded'}],
+            'verified': 1,
+            'verify_failed': [],
+            'checksums': {f'file{index}.nc': f'sha{index}'},
+            'concurrency': {
+                'requests': requests, 'throttled': index, 'errors': 0,
+                'increases': 3, 'decreases': 1,
+                'min_limit': 4 + index, 'max_limit': limit + 2, 'final_limit': limit,
+            },
+        }
+        report_file = tmp_path / f'report.shard{index}of2.json'
+        report_file.write_text(json.dumps(report))
+        reports.append(str(report_file))
+
+    merged = merge_reports(reports)
+    assert merged['shards'] == ['0/2', '1/2']
+    assert merged['started'] == '2025-01-01T00:00:00'
+    assert merged['finished'] == '2025-01-04T00:00:00'
+    assert [r['cloud'] for r in merged['results']] == ['file0.nc', 'file1.nc']
+    assert merged['verified'] == 2
+    assert merged['checksums'] == {'file0.nc': 'sha0', 'file1.nc': 'sha1'}
+    assert merged['concurrency'] == {
+        'requests': 150, 'throttled': 1, 'errors': 0, 'increases': 6, 'decreases': 2,
+        'min_limit': 4, 'max_limit': 32, 'final_limit': {'0/2': 12, '1/2': 30},
+    }
@@ -0,0 +1,116 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from boto3.s3.transfer import TransferConfig
+
+import xarray as xr
+
+from conftest import BUCKET, write_netcdf
+import zarr_rechunk
+from zarr_rechunk import rechunk_to_zarr, upload_zarr_store, store_is_complete
+
+UPLOAD_CONFIG = TransferConfig(use_threads=False)
+
+
+def test_rechunk_and_extend(tmp_path, monkeypatch):
+    monkeypatch.setattr(zarr_rechunk, 'SPATIAL_CHUNKS', {'lat': 4, 'lon': 4})
+    # several slabs of two time steps
+    monkeypatch.setattr(zarr_rechunk, 'SLAB_BYTES', 2 * 10 * 12 * 4)
+    store_path = str(tmp_path / 'zarr' / 'tos.zarr')
+
+    short_file = write_netcdf(str(tmp_path / 'r1' / 'tos.nc'), ntime=7, nlat=10, nlon=12, chunks=(1, 10, 12))
+    result = rechunk_to_zarr(short_file, store_path, 'monthly', 'tos', max_workers=2, tiles_per_block=2)
+    assert result['time_written'] == 7
+    with xr.open_zarr(store_path) as ds, xr.open_dataset(short_file) as expected:
+        assert ds.tos.encoding['chunks'] == (7, 4, 4)
+        xr.testing.assert_equal(ds.tos.load(), expected.tos)
+
+    long_file = write_netcdf(str(tmp_path / 'r2' / 'tos.nc'), ntime=11, nlat=10, nlon=12, chunks=(1, 10, 12))
+    result = rechunk_to_zarr(long_file, store_path, 'monthly', 'tos', max_workers=2, tiles_per_block=2)
+    assert result['time_written'] == 4
+    with xr.open_zarr(store_path) as ds, xr.open_dataset(long_file) as expected:
+        xr.testing.assert_equal(ds.tos.load(), expected.tos)
+    # staging files are removed
+    assert sorted(p.name for p in (tmp_path / 'zarr').iterdir()) == ['tos.zarr']
+
+
+def test_rewritten_store_drops_stale_objects(tmp_path, monkeypatch, s3_client):
+    monkeypatch.setattr(zarr_rechunk, 'SPATIAL_CHUNKS', {'lat': 4, 'lon': 4})
+    monkeypatch.setattr(zarr_rechunk, 'TIME_CHUNKS', {'monthly': 4})
+    store_path = str(tmp_path / 'zarr' / 'tos.zarr')
+    prefix = 'zarr/region/tos.zarr'
+
+    first = write_netcdf(str(tmp_path / 'r1' / 'tos.nc'), ntime=12, nlat=8, nlon=8)
+    rechunk_to_zarr(first, store_path, 'monthly', 'tos', max_workers=1)
+    upload_zarr_store(store_path, prefix, BUCKET, UPLOAD_CONFIG, s3_client)
+    first_keys = {
+        obj['Key'] for obj in s3_client.list_objects_v2(Bucket=BUCKET, Prefix=prefix)['Contents']
+    }
+
+    # different start time: the store is rewritten with fewer time chunks
+    second = write_netcdf(str(tmp_path / 'r2' / 'tos.nc'), ntime=4, nlat=8, nlon=8, start='1990-01-01')
+    rechunk_to_zarr(second, store_path, 'monthly', 'tos', max_workers=1)
+    upload_zarr_store(store_path, prefix, BUCKET, UPLOAD_CONFIG, s3_client)
+    second_keys = {
+        obj['Key'] for obj in s3_client.list_objects_v2(Bucket=BUCKET, Prefix=prefix)['Contents']
+    }
+
+    assert second_keys < first_keys
+    assert not any('/tos/c/2/' in key or '/tos/2.' in key for key in second_keys)
+
+
+def test_regenerated_release_rewrites_the_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(zarr_rechunk, 'SPATIAL_CHUNKS', {'lat': 4, 'lon': 4})
+    store_path = str(tmp_path / 'zarr' / 'tos.zarr')
+
+    first = write_netcdf(str(tmp_path / 'r20240101' / 'tos.nc'), ntime=6, nlat=8, nlon=8)
+    rechunk_to_zarr(first, store_path, 'monthly', 'tos', max_workers=1)
+    assert rechunk_to_zarr(first, store_path, 'monthly', 'tos', max_workers=1)['time_written'] == 0
+
+    # same time axis, other values (then more time steps, other values)
+    for ntime in (6, 9):
+        second = write_netcdf(
+            str(tmp_path / f'r2025010{ntime}' / 'tos.nc'), ntime=ntime, nlat=8, nlon=8, seed=ntime
+        )
+        result = rechunk_to_zarr(second, store_path, 'monthly', 'tos', max_workers=1)
+        assert result['time_written'] == ntime
+        with xr.open_zarr(store_path) as ds, xr.open_dataset(second) as expected:
+            xr.testing.assert_equal(ds.tos.load(), expected.tos)
+            assert ds.attrs['source_release'] == f'r2025010{ntime}'
+            assert ds.attrs['copy_complete'] is True
+
+
+class ThreadExecutor(ThreadPoolExecutor):
+    """Thread pool in place of the spawned workers (patched functions apply)"""
+
+    def __init__(self, max_workers=None, mp_context=None):
+        super().__init__(max_workers=max_workers)
+
+
+def test_interrupted_store_rewritten_and_not_uploaded(tmp_path, monkeypatch, s3_client):
+    monkeypatch.setattr(zarr_rechunk, 'SPATIAL_CHUNKS', {'lat': 4, 'lon': 4})
+    monkeypatch.setattr(zarr_rechunk, 'ProcessPoolExecutor', ThreadExecutor)
+    store_path = str(tmp_path / 'zarr' / 'tos.zarr')
+    local_file = write_netcdf(str(tmp_path / 'r20250101' / 'tos.nc'), ntime=6, nlat=8, nlon=8)
+
+    copy_block = zarr_rechunk._copy_block
+
+    def failing_copy_block(staging_file, *args):
+        if staging_file.endswith('block1.npy'):
+            raise OSError('disk full')
+        return copy_block(staging_file, *args)
+
+    monkeypatch.setattr(zarr_rechunk, '_copy_block', failing_copy_block)
+    with pytest.raises(OSError):
+        rechunk_to_zarr(local_file, store_path, 'monthly', 'tos', max_workers=1, tiles_per_block=1)
+    assert not store_is_complete(store_path)
+    with pytest.raises(ValueError):
+        upload_zarr_store(store_path, 'zarr/region/tos.zarr', BUCKET, UPLOAD_CONFIG, s3_client)
+    assert 'Contents' not in s3_client.list_objects_v2(Bucket=BUCKET)
+
+    monkeypatch.setattr(zarr_rechunk, '_copy_block', copy_block)
+    result = rechunk_to_zarr(local_file, store_path, 'monthly', 'tos', max_workers=1, tiles_per_block=1)
+    assert result['time_written'] == 6
+    with xr.open_zarr(store_path) as ds, xr.open_dataset(local_file) as expected:
+        xr.testing.assert_equal(ds.tos.load(), expected.tos)
+    assert upload_zarr_store(store_path, 'zarr/region/tos.zarr', BUCKET, UPLOAD_CONFIG, s3_client) > 0
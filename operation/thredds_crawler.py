@@ -2,15 +2,32 @@ import httpx
 import xml.etree.ElementTree as ET
 from urllib.parse import urljoin
 import json
+import argparse
 
 # Constants
 CEFI_THREDDS_BASE = "https://psl.noaa.gov/thredds/catalog/Projects/CEFI/regional_mom6/cefi_portal/"
 
 
-def find_all_files_thredds(base_catalog_url):
+def dataset_metadata(ds, ns):
+    """
+    Returns the size (dataSize value and units) and modified date of a catalog dataset.
+    Missing elements are returned as None.
+    """
+    size_element = ds.find("x:dataSize", ns)
+    date_element = ds.find("x:date[@type='modified']", ns)
+    return {
+        'data_size': size_element.text.strip() if size_element is not None else None,
+        'data_size_units': size_element.attrib.get('units') if size_element is not None else None,
+        'modified': date_element.text.strip() if date_element is not None else None,
+    }
+
+
+def find_all_files_thredds(base_catalog_url, metadata=False):
     """
     Recursively crawls a THREDDS catalog and returns a dict of catalogs that contain .nc files.
     Keys are catalog HTML URLs; values are lists of NetCDF file access URLs (OPeNDAP or HTTPServer).
+    With metadata=True the values are lists of dicts with the access URL, the urlPath,
+    the dataSize (value and units as shown by the catalog) and the modified date.
     """
     visited = set()
     result = {}
@@ -47,7 +64,10 @@ def find_all_files_thredds(base_catalog_url):
             if url_path.endswith('.nc'):
                 # Build access URL (assuming OPeNDAP or HTTPServer base)
                 access_url = urljoin("https://psl.noaa.gov/thredds/dodsC/", url_path)
-                nc_urls.append(access_url)
+                if metadata:
+                    nc_urls.append({'url': access_url, 'url_path': url_path, **dataset_metadata(ds, ns)})
+                else:
+                    nc_urls.append(access_url)
 
         if nc_urls:
             html_url = catalog_xml_url.replace('/catalog.xml', '/catalog.html')
@@ -70,7 +90,12 @@ def find_all_files_thredds(base_catalog_url):
 
 if __name__ == "__main__":
 
-    catalog_dict = find_all_files_thredds(CEFI_THREDDS_BASE)
+    parser = argparse.ArgumentParser(description='Crawl the CEFI THREDDS catalog for NetCDF files')
+    parser.add_argument('--metadata', action='store_true',
+                        help='Also capture the dataSize and modified date of every file')
+    args = parser.parse_args()
+
+    catalog_dict = find_all_files_thredds(CEFI_THREDDS_BASE, metadata=args.metadata)
 
     # output to json format
     print("Found catalogs and files:")
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Diff of the PSL THREDDS catalog against the S3 bucket.
+
+The THREDDS catalog is crawled once with the file sizes and modified dates
+(`thredds_crawler.find_all_files_thredds(metadata=True)`) and the bucket is
+listed once. The diff gives the files to transfer:
+
+- missing: on THREDDS, not in the bucket
+- size_different: the bucket size does not match the THREDDS dataSize
+  (dataSize is rounded to a few digits in Kbytes/Mbytes/Gbytes, so the
+  sizes are compared within the rounding of the displayed value)
+- stale: modified on THREDDS after the bucket object was written
+
+Bucket objects that are not on THREDDS are reported as `extra` (not transferred).
+
+Usage:
+    python thredds_diff.py --prefix "northeast_pacific/full_domain/hindcast/"
+    python thredds_diff.py --prefix "" --output thredds_diff.json --transfer-list to_transfer.txt
+"""
+
+import json
+import logging
+import argparse
+from datetime import datetime, timezone
+from typing import Dict, List
+from thredds_crawler import find_all_files_thredds, CEFI_THREDDS_BASE
+from s3_remove_prefix import setup_logging, get_s3_client, scan_prefix
+
+# Configuration
+S3_BUCKET_NAME = 'noaa-oar-cefi-regional-mom6-pds'
+
+# urlPath prefix of the bucket root on THREDDS
+THREDDS_ROOT_PATH = 'Projects/CEFI/regional_mom6/cefi_portal/'
+
+# direct download server of the THREDDS files
+THREDDS_FILESERVER = 'https://psl.noaa.gov/thredds/fileServer/'
+
+# exponent of the dataSize units
+SIZE_UNIT_EXPONENTS = {
+    'bytes': 0,
+    'kbytes': 1,
+    'mbytes': 2,
+    'gbytes': 3,
+    'tbytes': 4,
+}
+
+
+def size_matches(size_bytes: int, data_size: str, units: str) -> bool:
+    """
+    Check if an object size matches a THREDDS dataSize value
+
+    The value is compared with the object size expressed in the same units
+    (1000 and 1024 based) within half a unit of its last displayed digit.
+    """
+    exponent = SIZE_UNIT_EXPONENTS.get((units or 'bytes').lower())
+    if exponent is None or data_size is None:
+        return True
+    value = float(data_size)
+    decimals = len(data_size.split('.')[1]) if '.' in data_size else 0
+    tolerance = 0.5 * 10 ** -decimals
+    return any(
+        abs(size_bytes / base ** exponent - value) <= tolerance + 1e-9
+        for base in (1000, 1024)
+    )
+
+
+def parse_modified(modified: str):
+    """Parse a THREDDS modified date (ISO 8601, UTC when no offset is given)"""
+    if not modified:
+        return None
+    date = datetime.fromisoformat(modified.replace('Z', '+00:00'))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def thredds_files(prefix: str) -> Dict[str, Dict]:
+    """
+    Crawl the THREDDS catalog under a bucket prefix
+
+    Returns:
+        Dictionary {object key: file metadata} of the netcdf files
+    """
+    catalog_url = CEFI_THREDDS_BASE + prefix.rsplit('/', 1)[0] + '/' if '/' in prefix else CEFI_THREDDS_BASE
+    catalog_dict = find_all_files_thredds(catalog_url, metadata=True)
+
+    files = {}
+    for nc_files in catalog_dict.values():
+        for nc_file in nc_files:
+            url_path = nc_file['url_path']
+            if not url_path.startswith(THREDDS_ROOT_PATH):
+                continue
+            key = url_path[len(THREDDS_ROOT_PATH):]
+            if key.startswith(prefix):
+                files[key] = nc_file
+    return files
+
+
+def diff_thredds_bucket(thredds: Dict[str, Dict], bucket_objects: List[Dict]) -> Dict[str, List[Dict]]:
+    """
+    Compare the THREDDS files with the bucket objects
+
+    Returns:
+        Dictionary of entries {'key', 'url', ...} by category
+        ('missing', 'size_different', 'stale', 'extra')
+    """
+    listing = {obj['Key']: obj for obj in bucket_objects if obj['Key'].endswith('.nc')}
+    diff = {'missing': [], 'size_different': [], 'stale': [], 'extra': []}
+
+    for key in sorted(thredds):
+        nc_file = thredds[key]
+        entry = {
+            'key': key,
+            'url': THREDDS_FILESERVER + nc_file['url_path'],
+            'data_size': nc_file['data_size'],
+            'data_size_units': nc_file['data_size_units'],
+            'modified': nc_file['modified'],
+        }
+        obj = listing.get(key)
+        if obj is None:
+            diff['missing'].append(entry)
+            continue
+
+        entry['bucket_size'] = obj['Size']
+        entry['bucket_modified'] = obj['LastModified'].isoformat()
+        if not size_matches(obj['Size'], nc_file['data_size'], nc_file['data_size_units']):
+            diff['size_different'].append(entry)
+            continue
+        modified = parse_modified(nc_file['modified'])
+        if modified is not None and modified > obj['LastModified']:
+            diff['stale'].append(entry)
+
+    for key in sorted(set(listing) - set(thredds)):
+        diff['extra'].append({'key': key, 'bucket_size': listing[key]['Size']})
+
+    return diff
+
+
+def main():
+    """Main function with command line argument parsing"""
+
+    parser = argparse.ArgumentParser(description='Diff the THREDDS catalog against the S3 bucket')
+    parser.add_argument('--prefix', type=str, required=True,
+                        help='Bucket prefix to compare (empty string for the whole portal)')
+    parser.add_argument('--bucket', type=str, default=S3_BUCKET_NAME,
+                        help=f'S3 bucket name (default: {S3_BUCKET_NAME})')
+    parser.add_argument('--output', type=str, default='thredds_diff.json',
+                        help='Output file of the diff (default: thredds_diff.json)')
+    parser.add_argument('--transfer-list', type=str, default=None,
+                        help='Optional text file with the fileServer URL of every file to transfer')
+    parser.add_argument('--log-file', type=str, default='thredds_diff.log',
+                        help='Log file path (default: thredds_diff.log)')
+
+    args = parser.parse_args()
+
+    setup_logging(args.log_file)
+
+    thredds = thredds_files(args.prefix)
+    logging.info(f"THREDDS crawl complete: {len(thredds)} netcdf files under '{args.prefix}'")
+
+    s3_client = get_s3_client()
+    bucket_objects, _, _ = scan_prefix(s3_client, args.bucket, args.prefix)
+    s3_client.close()
+
+    diff = diff_thredds_bucket(thredds, bucket_objects)
+    logging.info(
+        f"Diff: {len(diff['missing'])} missing, {len(diff['size_different'])} size different, "
+        f"{len(diff['stale'])} stale, {len(diff['extra'])} only in the bucket"
+    )
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(diff, f, indent=2)
+    logging.info(f"Diff written to {args.output}")
+
+    to_transfer = diff['missing'] + diff['size_different'] + diff['stale']
+    if args.transfer_list:
+        with open(args.transfer_list, 'w', encoding='utf-8') as f:
+            for entry in to_transfer:
+                f.write(f"{entry['url']}\n")
+        logging.info(f"{len(to_transfer)} files to transfer written to {args.transfer_list}")
+
+if __name__ == '__main__':
+    main()
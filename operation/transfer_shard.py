@@ -0,0 +1,216 @@
+"""
+Deterministic partitioning of a transfer over several data-mover nodes.
+
+Each node runs the same command with `--shard i/N` (i from 0 to N-1) and
+assigns each batch of files (the files of one release) on its own. Files
+are taken largest first and each one goes to the shard with the least
+bytes assigned so far in the batch; ties on the size are ordered by a hash
+of the object key and ties on the load go to the shard with the fewest
+files, then to a shard picked from the key hash. The assignment only
+depends on the (key, size) pairs of the batch, not on the walk order or on
+the previous batches, so every node computes the same assignment without
+talking to the others, each file is processed by exactly one shard, and
+the shards get about 1/N of the bytes of every release.
+
+Each shard writes its own result file (run report with a `.shard<i>of<N>`
+suffix). The merge step combines them into one run report.
+
+"""
+
+import os
+import json
+import hashlib
+import logging
+
+# run report counts added across the shards
+SUMMED_FIELDS = ('verified',)
+
+# adaptive concurrency counters added across the shards (see s3_throttle)
+CONCURRENCY_COUNTS = ('requests', 'throttled', 'errors', 'increases', 'decreases')
+
+
+def parse_shard(shard: str) -> tuple:
+    """Parse a 'i/N' shard specification
+
+    Parameters
+    ----------
+    shard : str
+        shard index and number of shards (ex: '0/4'), index from 0 to N-1
+
+    Returns
+    -------
+    tuple
+        (index, count)
+    """
+    try:
+        index, count = (int(value) for value in shard.split('/'))
+    except ValueError as e:
+        raise ValueError(f"Invalid shard '{shard}', expected i/N (ex: 0/4)") from e
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard '{shard}', index must be in 0..N-1")
+    return index, count
+
+
+def shard_suffix(shard: tuple) -> str:
+    """File name suffix of a shard (ex: '.shard0of4')"""
+    return f'.shard{shard[0]}of{shard[1]}'
+
+
+def shard_file(file_path: str, shard: tuple) -> str:
+    """Per-shard version of a result file path (ex: report.shard0of4.json)"""
+    root, ext = os.path.splitext(file_path)
+    return f'{root}{shard_suffix(shard)}{ext}'
+
+
+def key_hash(key: str) -> int:
+    """Stable hash of an object key (same value on every node and run)"""
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], 'big')
+
+
+class ShardAssigner:
+    """Greedy size-balanced assignment of files to shards
+
+    Every call to `assign` or `select` balances its own batch from empty
+    shards, so the result does not depend on the batches assigned before.
+
+    Parameters
+    ----------
+    count : int
+        number of shards
+    """
+
+    def __init__(self, count: int):
+        self.count = count
+
+    def assign(self, sized_keys: list) -> dict:
+        """Assign a batch of files, largest first, to the least loaded shard
+
+        Parameters
+        ----------
+        sized_keys : list
+            (object key, size in bytes) of the files of the batch
+
+        Returns
+        -------
+        dict
+            shard index of each object key
+        """
+        loads = [0] * self.count
+        counts = [0] * self.count
+        shards = {}
+        ordered = sorted(
+            ((size, key_hash(key), key) for key, size in sized_keys),
+            key=lambda entry: (-entry[0], entry[1], entry[2])
+        )
+        for size, hashed, key in ordered:
+            start = hashed % self.count
+            shard = min(
+                range(self.count),
+                key=lambda index: (loads[index], counts[index], (index - start) % self.count)
+            )
+            loads[shard] += size
+            counts[shard] += 1
+            shards[key] = shard
+        return shards
+
+    def select(self, items: list, index: int, key=None, size=None) -> list:
+        """Assign a batch of items and keep the ones of shard `index`
+
+        Parameters
+        ----------
+        items : list
+            items to assign (ex: list of {'local': ..., 'cloud': ...})
+        index : int
+            shard index of the caller
+        key : callable, optional
+            object key of an item (default: item['cloud'])
+        size : callable, optional
+            size in bytes of an item (default: size of item['local'])
+
+        Returns
+        -------
+        list
+            items assigned to shard `index`, in their original order
+        """
+        key = key or (lambda item: item['cloud'])
+        size = size or (lambda item: os.path.getsize(item['local']))
+        shards = self.assign([(key(item), size(item)) for item in items])
+        return [item for item in items if shards[key(item)] == index]
+
+
+def merge_concurrency(stats: list) -> dict:
+    """Combine the adaptive concurrency stats of the shards
+
+    Request counts are added, the limit range spans the shards and the
+    final limit of every shard is kept (the limits are per node, a sum
+    means nothing).
+
+    Parameters
+    ----------
+    stats : list
+        (shard, concurrency stats of its run report)
+
+    Returns
+    -------
+    dict
+        merged stats, 'final_limit' keyed by shard
+    """
+    merged = {name: 0 for name in CONCURRENCY_COUNTS}
+    merged['final_limit'] = {}
+    for shard, shard_stats in stats:
+        for name in CONCURRENCY_COUNTS:
+            merged[name] += shard_stats.get(name, 0)
+        for name, pick in (('min_limit', min), ('max_limit', max)):
+            if name in shard_stats:
+                merged[name] = pick(merged.get(name, shard_stats[name]), shard_stats[name])
+        if 'final_limit' in shard_stats:
+            merged['final_limit'][shard] = shard_stats['final_limit']
+    return merged
+
+
+def merge_reports(report_files: list) -> dict:
+    """Combine the run reports of the shards into one run report
+
+    Lists are concatenated, 'verified' is added, 'checksums' are joined,
+    'started' is the earliest and 'finished' the latest time of the shards
+    and the concurrency stats are merged by `merge_concurrency`. Other
+    fields are not merged (logged).
+
+    Parameters
+    ----------
+    report_files : list
+        paths of the per-shard run reports
+
+    Returns
+    -------
+    dict
+        merged run report (with the list of merged 'shards')
+    """
+    merged = {'shards': []}
+    concurrency = []
+    for report_file in sorted(report_files):
+        with open(report_file, 'r', encoding='utf-8') as jsonfile:
+            report = json.load(jsonfile)
+        shard = report.get('shard', report_file)
+        merged['shards'].append(shard)
+        for name, value in report.items():
+            if name == 'shard':
+                continue
+            if name == 'started':
+                merged[name] = min(merged.get(name, value), value)
+            elif name == 'finished':
+                merged[name] = max(merged.get(name, value), value)
+            elif name in SUMMED_FIELDS:
+                merged[name] = merged.get(name, 0) + value
+            elif name == 'checksums':
+                merged.setdefault(name, {}).update(value)
+            elif name == 'concurrency':
+                concurrency.append((shard, value))
+            elif isinstance(value, list):
+                merged.setdefault(name, []).extend(value)
+            else:
+                logging.warning("Report field %s of shard %s is not merged", name, shard)
+    if concurrency:
+        merged['concurrency'] = merge_concurrency(concurrency)
+    logging.info("Merged %s shard reports", len(merged['shards']))
+    return merged
@@ -0,0 +1,492 @@
+"""
+Time-series optimized Zarr copies of CEFI hindcast variables.
+
+The published netcdf files keep the model output chunking (one time slice
+per chunk), so reading a long time series at one grid point needs one
+request per time step. This stage writes a Zarr copy of selected
+hindcast variables with time-contiguous chunks (many years of time steps
+per chunk, small spatial tiles).
+
+The netcdf time chunks are decompressed once: time slabs are read by a
+process pool and scattered into one uncompressed staging file per spatial
+tile block (next to the store). The copy is then written one tile block
+at a time from its staging file, so the memory used by a worker is
+bounded by one time slab or one tile block over the time axis. The store of a variable does
+not depend on the release, so when a new release only adds time steps
+the existing store is extended and only the new time steps are written
+(only the last time chunk of each tile and the new ones change). A store
+that is rewritten is uploaded in full and the chunk objects it no longer
+has are deleted from the bucket.
+
+The store attributes record the release folder and sha256 of the netcdf
+file it was written from, and are marked complete only after the last
+block is written. An incomplete store (interrupted run) or a store
+written from other data (a release regenerating the values) is rewritten,
+and an incomplete store is never uploaded.
+
+The Zarr stores are uploaded under a parallel prefix of the bucket
+    zarr/<parent directory of the netcdf object>/<variable>.zarr/
+
+"""
+
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import xarray as xr
+
+# bucket prefix of the Zarr copies
+ZARR_PREFIX = 'zarr'
+
+# target chunk sizes of the spatial dimensions
+SPATIAL_CHUNKS = {
+    'xh': 32, 'yh': 32,
+    'lon': 32, 'lat': 32,
+}
+
+# target chunk size of the time dimension by output frequency
+TIME_CHUNKS = {
+    'daily': 3660,
+    'monthly': 480,
+}
+
+# experiments and variables converted by default
+ZARR_EXPERIMENTS = ('hindcast',)
+ZARR_VARIABLES = ('tos', 'sos', 'tob', 'sob', 'ssh', 'MLD_003')
+
+TIME_DIM = 'time'
+
+# bytes of a time slab read at once by a scatter worker
+SLAB_BYTES = 256 * 1024**2
+
+# store attributes: source of the copy, set complete after the last block write
+SOURCE_RELEASE_ATTR = 'source_release'
+SOURCE_SHA256_ATTR = 'source_sha256'
+COMPLETE_ATTR = 'copy_complete'
+
+# worker processes are spawned: the caller may run upload threads holding locks
+MP_CONTEXT = 'spawn'
+
+
+def zarr_object_prefix(obj_name: str) -> str:
+    """Bucket prefix of the Zarr copy of a netcdf object (release independent)."""
+    parts = obj_name.split('/')
+    parent_dir = '/'.join(parts[:-2])
+    variable = parts[-1].split('.')[0]
+    return f'{ZARR_PREFIX}/{parent_dir}/{variable}.zarr'
+
+
+def is_zarr_candidate(obj_name: str, variables=ZARR_VARIABLES, experiments=ZARR_EXPERIMENTS) -> bool:
+    """Check if a netcdf object is selected for the Zarr copy
+
+    Parameters
+    ----------
+    obj_name : str
+        object name of the netcdf file
+    variables : tuple
+        variable names to convert
+    experiments : tuple
+        experiment directories to convert
+
+    Returns
+    -------
+    bool
+        True if the variable and experiment of the object are selected
+    """
+    parts = obj_name.split('/')
+    if len(parts) < 7:
+        return False
+    variable = parts[-1].split('.')[0]
+    return parts[-5] in experiments and variable in variables
+
+
+def _target_chunks(data_array: xr.DataArray, frequency: str) -> dict:
+    """Chunk sizes with long time chunks and small spatial tiles."""
+    return {
+        dim: min(TIME_CHUNKS.get(frequency, size) if dim == TIME_DIM else SPATIAL_CHUNKS.get(dim, size), size)
+        for dim, size in data_array.sizes.items()
+    }
+
+
+def _tile_blocks(data_array: xr.DataArray, chunks: dict, tiles_per_block: int) -> list:
+    """Split the spatial dimensions into blocks of whole chunks.
+
+    Returns a list of {dim: slice} covering the non-time dimensions,
+    each block covering `tiles_per_block` chunks along the last dimension.
+    """
+    dims = [dim for dim in data_array.dims if dim != TIME_DIM]
+
+    blocks = [{}]
+    for i, dim in enumerate(dims):
+        step = chunks[dim] * (tiles_per_block if i == len(dims) - 1 else 1)
+        size = data_array.sizes[dim]
+        blocks = [
+            {**block, dim: slice(start, min(start + step, size))}
+            for block in blocks
+            for start in range(0, size, step)
+        ]
+    return blocks
+
+
+def _staging_file(staging_dir: str, index: int) -> str:
+    return os.path.join(staging_dir, f'block{index}.npy')
+
+
+def _slab_steps(data_array: xr.DataArray) -> int:
+    """Time steps per slab: whole netcdf time chunks, about SLAB_BYTES."""
+    if TIME_DIM not in data_array.dims:
+        return 1
+    step_bytes = max(1, data_array.nbytes // data_array.sizes[TIME_DIM])
+    chunksizes = data_array.encoding.get('chunksizes')
+    native = chunksizes[data_array.dims.index(TIME_DIM)] if chunksizes else 1
+    return max(native, SLAB_BYTES // step_bytes // native * native)
+
+
+def _scatter_slab(
+    local_file: str,
+    variable: str,
+    staging_dir: str,
+    blocks: list,
+    time_start: int,
+    slab: slice,
+):
+    """Read one time slab of the netcdf file and scatter it into the block staging files.
+
+    Runs in a worker process, each netcdf time chunk is decompressed once.
+    """
+    with xr.open_dataset(local_file) as ds:
+        data_array = ds[variable]
+        if TIME_DIM in data_array.dims:
+            data_array = data_array.isel({TIME_DIM: slab})
+        values = data_array.values
+
+    for index, block in enumerate(blocks):
+        staged = np.load(_staging_file(staging_dir, index), mmap_mode='r+')
+        subset = values[tuple(block.get(dim, slice(None)) for dim in data_array.dims)]
+        if TIME_DIM in data_array.dims:
+            axis = data_array.dims.index(TIME_DIM)
+            target = [slice(None)] * staged.ndim
+            target[axis] = slice(slab.start - time_start, slab.stop - time_start)
+            staged[tuple(target)] = subset
+        else:
+            staged[...] = subset
+        staged.flush()
+        del staged
+
+
+def _copy_block(
+    staging_file: str,
+    variable: str,
+    dims: tuple,
+    store_path: str,
+    block: dict,
+    time_start: int,
+) -> int:
+    """Copy one spatial block (time_start onward) from its staging file into the Zarr store.
+
+    Runs in a worker process, returns the number of bytes written.
+    """
+    values = np.load(staging_file, mmap_mode='r')
+    region = dict(block)
+    if TIME_DIM in dims:
+        region[TIME_DIM] = slice(time_start, time_start + values.shape[dims.index(TIME_DIM)])
+    subset = xr.Dataset({variable: (dims, np.asarray(values))})
+    subset.to_zarr(store_path, mode='r+', region=region)
+    return subset[variable].nbytes
+
+
+def _file_sha256(local_file: str) -> str:
+    digest = hashlib.sha256()
+    with open(local_file, 'rb') as f:
+        for block in iter(lambda: f.read(8 * 1024**2), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _set_store_attrs(store_path: str, **attrs):
+    """Update the root attributes of a store (and its consolidated metadata)."""
+    import zarr
+
+    zarr.open_group(store_path, mode='r+').attrs.update(attrs)
+    zarr.consolidate_metadata(store_path)
+
+
+def store_is_complete(store_path: str) -> bool:
+    """Check that every block of a local Zarr store was written."""
+    import zarr
+
+    try:
+        return zarr.open_group(store_path, mode='r').attrs.get(COMPLETE_ATTR) is True
+    except FileNotFoundError:
+        return False
+
+
+def rechunk_to_zarr(
+    local_file: str,
+    store_path: str,
+    frequency: str,
+    variable: str = None,
+    max_workers: int = 4,
+    tiles_per_block: int = 8,
+    source_release: str = None,
+    source_sha256: str = None,
+) -> dict:
+    """Write (or extend) a time-contiguous Zarr copy of a netcdf variable
+
+    A complete store written from the same file (sha256) is left as is.
+    A complete store whose time axis is the start of the file's, with the
+    same values at its last time step, is extended. Any other store is
+    rewritten.
+
+    Parameters
+    ----------
+    local_file : str
+        local netcdf file absolute path
+    store_path : str
+        local Zarr store directory
+    frequency : str
+        output frequency ('daily' or 'monthly') used for the time chunk size
+    variable : str, optional
+        variable to copy (default: the `cefi_variable` global attribute)
+    max_workers : int
+        number of worker processes (spawned, see MP_CONTEXT)
+    tiles_per_block : int
+        number of spatial chunks read by a worker at once
+        (bounds the memory to tiles_per_block * tile size * time steps)
+    source_release : str, optional
+        release folder of the netcdf file (default: its parent directory name)
+    source_sha256 : str, optional
+        sha256 of the netcdf file (computed when None)
+
+    Returns
+    -------
+    dict
+        {'store': store_path, 'variable': variable, 'time_written': n, 'bytes': n}
+    """
+    source = {
+        SOURCE_RELEASE_ATTR: source_release or os.path.basename(os.path.dirname(local_file)),
+        SOURCE_SHA256_ATTR: source_sha256 or _file_sha256(local_file),
+    }
+
+    with xr.open_dataset(local_file, chunks={}) as ds:
+        variable = variable or ds.attrs['cefi_variable']
+        data_array = ds[variable]
+        chunks = _target_chunks(data_array, frequency)
+        n_time = data_array.sizes.get(TIME_DIM, 1)
+
+        # lazy template: coordinates and metadata are written, data is not computed
+        #  (the store stays incomplete until the last block is written)
+        template = ds[[variable]].chunk(chunks)
+        template[variable].encoding = {}
+        template.attrs.update(source, **{COMPLETE_ATTR: False})
+
+        time_start = 0
+        if os.path.exists(store_path):
+            with xr.open_zarr(store_path) as existing:
+                existing_time = existing[TIME_DIM].values
+                n_existing = len(existing_time)
+                complete = existing.attrs.get(COMPLETE_ATTR) is True
+                if complete and existing.attrs.get(SOURCE_SHA256_ATTR) == source[SOURCE_SHA256_ATTR]:
+                    logging.info("Zarr store %s is up to date", store_path)
+                    return {'store': store_path, 'variable': variable, 'time_written': 0, 'bytes': 0}
+                # other data: the time axis is extended only if the values already
+                #  written are the same (checked on the last existing time step)
+                extend = (
+                    complete
+                    and 0 < n_existing < n_time
+                    and np.array_equal(existing_time, ds[TIME_DIM].values[:n_existing])
+                    and np.array_equal(
+                        existing[variable].isel({TIME_DIM: n_existing - 1}).values,
+                        data_array.isel({TIME_DIM: n_existing - 1}).values,
+                        equal_nan=True
+                    )
+                )
+                previous_release = existing.attrs.get(SOURCE_RELEASE_ATTR)
+            if extend:
+                # new time steps only, extend the time axis
+                logging.info("Extending Zarr store %s of %s", store_path, previous_release)
+                time_start = n_existing
+                _set_store_attrs(store_path, **{COMPLETE_ATTR: False})
+                template.isel({TIME_DIM: slice(n_existing, None)}).to_zarr(
+                    store_path, append_dim=TIME_DIM, compute=False
+                )
+            else:
+                logging.info(
+                    "Zarr store %s is incomplete or from other data (%s), rewriting",
+                    store_path, previous_release
+                )
+                shutil.rmtree(store_path)
+
+        if time_start == 0:
+            template.to_zarr(
+                store_path,
+                mode='w',
+                compute=False,
+                encoding={variable: {'chunks': tuple(chunks[dim] for dim in data_array.dims)}}
+            )
+
+        dims = data_array.dims
+        dtype = data_array.dtype
+        slab_steps = _slab_steps(data_array)
+
+    blocks = _tile_blocks(data_array, chunks, tiles_per_block)
+    logging.info(
+        "Writing %s to %s: %s blocks, time %s-%s", variable, store_path, len(blocks), time_start, n_time
+    )
+
+    # uncompressed staging files of the new time steps, one per tile block
+    staging_dir = tempfile.mkdtemp(
+        prefix='.staging-', dir=os.path.dirname(os.path.abspath(store_path))
+    )
+    try:
+        for index, block in enumerate(blocks):
+            shape = tuple(
+                n_time - time_start if dim == TIME_DIM else block[dim].stop - block[dim].start
+                for dim in dims
+            )
+            np.lib.format.open_memmap(
+                _staging_file(staging_dir, index), mode='w+', dtype=dtype, shape=shape
+            ).flush()
+
+        total_bytes = 0
+        mp_context = multiprocessing.get_context(MP_CONTEXT)
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+            futures = [
+                executor.submit(
+                    _scatter_slab, local_file, variable, staging_dir, blocks, time_start,
+                    slice(start, min(start + slab_steps, n_time))
+                )
+                for start in range(time_start, n_time, slab_steps)
+            ] if TIME_DIM in dims else [
+                executor.submit(_scatter_slab, local_file, variable, staging_dir, blocks, 0, slice(None))
+            ]
+            for future in as_completed(futures):
+                future.result()
+
+            futures = [
+                executor.submit(
+                    _copy_block, _staging_file(staging_dir, index), variable, dims,
+                    store_path, block, time_start
+                )
+                for index, block in enumerate(blocks)
+            ]
+            for future in as_completed(futures):
+                total_bytes += future.result()
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    _set_store_attrs(store_path, **source, **{COMPLETE_ATTR: True})
+
+    return {
+        'store': store_path,
+        'variable': variable,
+        'time_written': n_time - time_start,
+        'bytes': total_bytes,
+    }
+
+
+def upload_zarr_store(
+    store_path: str,
+    obj_prefix: str,
+    s3_bucket_name: str,
+    upload_config,
+    s3_client,
+) -> int:
+    """Upload all the files of a local Zarr store under a bucket prefix
+
+    Chunks of the time steps that did not change are identical on disk,
+    only files newer than the previous upload are sent again. A store
+    uploaded for the first time (new or rewritten, no upload stamp) is
+    sent in full and the objects under the prefix that are not part of
+    it are deleted. An incomplete store (see `rechunk_to_zarr`) is not uploaded.
+
+    Parameters
+    ----------
+    store_path : str
+        local Zarr store directory
+    obj_prefix : str
+        bucket prefix of the store (see `zarr_object_prefix`)
+    s3_bucket_name : str
+        S3 bucket name
+    upload_config : _type_
+        TransferConfig object to configure multipart uploads
+    s3_client : _type_
+        boto3 S3 client object
+
+    Returns
+    -------
+    int
+        number of files uploaded
+
+    Raises
+    ------
+    ValueError
+        the store is incomplete
+    """
+    if not store_is_complete(store_path):
+        raise ValueError(f"Zarr store {store_path} is incomplete, not uploaded")
+
+    stamp_file = os.path.join(store_path, '.uploaded')
+    last_upload = os.path.getmtime(stamp_file) if os.path.exists(stamp_file) else 0
+
+    uploaded = 0
+    for dirpath, _, filenames in os.walk(store_path):
+        for filename in filenames:
+            local_file = os.path.join(dirpath, filename)
+            if filename == '.uploaded' or os.path.getmtime(local_file) <= last_upload:
+                continue
+            obj_name = f'{obj_prefix}/{os.path.relpath(local_file, store_path)}'
+            s3_client.upload_file(local_file, s3_bucket_name, obj_name, Config=upload_config)
+            uploaded += 1
+
+    if last_upload == 0:
+        delete_stale_objects(store_path, obj_prefix, s3_bucket_name, s3_client)
+
+    with open(stamp_file, 'w', encoding='utf-8'):
+        pass
+    logging.info("Uploaded %s files of %s to %s", uploaded, store_path, obj_prefix)
+    return uploaded
+
+
+def delete_stale_objects(store_path: str, obj_prefix: str, s3_bucket_name: str, s3_client) -> int:
+    """Delete the objects under the store prefix that the local store does not have
+
+    A rewritten store can have fewer chunks than the previous one (for
+    example a shorter time axis), the extra chunk objects would otherwise
+    stay in the bucket and be read as part of the store.
+
+    Parameters
+    ----------
+    store_path : str
+        local Zarr store directory
+    obj_prefix : str
+        bucket prefix of the store (see `zarr_object_prefix`)
+    s3_bucket_name : str
+        S3 bucket name
+    s3_client : _type_
+        boto3 S3 client object
+
+    Returns
+    -------
+    int
+        number of objects deleted
+    """
+    from s3_remove_prefix import delete_objects_concurrent
+
+    stale_objects = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=s3_bucket_name, Prefix=f'{obj_prefix}/'):
+        for obj in page.get('Contents', []):
+            relative_path = obj['Key'][len(obj_prefix) + 1:]
+            if not os.path.isfile(os.path.join(store_path, relative_path)):
+                stale_objects.append({'Key': obj['Key']})
+    if not stale_objects:
+        return 0
+
+    deleted, failed = delete_objects_concurrent(s3_client, s3_bucket_name, stale_objects)
+    logging.info("Deleted %s stale objects under %s (%s failed)", deleted, obj_prefix, failed)
+    return deleted